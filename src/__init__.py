@@ -1,4 +1,21 @@
-from .models import GeminiChainOfThought
-from .config import GeminiConfig, PromptConfig
+"""AIデザインパターンの実装
 
-__all__ = ['GeminiChainOfThought', 'GeminiConfig', 'PromptConfig'] 
\ No newline at end of file
+パターンのモジュールはLangChainなどの読み込みに時間がかかるため、属性を最初に参照したときに読み込む。
+"""
+import importlib
+
+__all__ = ['GeminiChainOfThought', 'GeminiConfig', 'PromptConfig']
+
+# 公開する名前 → 定義しているモジュール
+_EXPORTS = {
+    'GeminiChainOfThought': '.models',
+    'GeminiConfig': '.config',
+    'PromptConfig': '.config',
+}
+
+def __getattr__(name):
+    if name not in _EXPORTS:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    globals()[name] = value
+    return value
@@ -1,8 +1,109 @@
 import streamlit as st
-from models import GeminiChainOfThought, GeminiReasoning, EvaluatorOptimizer, DebateBasedCooperation
-from typing import Dict, Any, List
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Dict, Any, List, Optional, Iterator, Iterable, Set
 from enum import Enum
 
+# `streamlit run src/app.py`でもsrcパッケージとして読み込めるようにする
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.models import (
+    DirectQuery, GeminiChainOfThought, GeminiReasoning, EvaluatorOptimizer, DebateBasedCooperation,
+    StepCallback, StepChunk, StepEvent, StepEventType
+)
+from src.cache import create_response_cache
+from src.cassette import Cassette, create_cassette
+from src.config import ComparisonConfig, GeminiConfig, MetricsConfig
+from src.context_budget import create_context_budget
+from src.history import RunRecord, RunStore, create_run_store
+from src.jobs import Job, JobQueue, JobStatus, create_job_queue
+from src.metrics import METRICS, RunTrace
+from src.rate_limit import create_rate_limiter, create_retry_policy
+from src.registry import get_registry
+from src.router import PatternRouter
+from src.run_budget import RunBudget, create_run_budget, use_budget
+from src.semantic_cache import create_semantic_cache
+
+@st.cache_resource
+def setup_response_cache():
+    """プロセスで1度だけ応答キャッシュを開いてレジストリに登録"""
+    cache = create_response_cache()
+    get_registry().set_response_cache(cache)
+    return cache
+
+@st.cache_resource
+def setup_semantic_cache():
+    """プロセスで1度だけ意味的キャッシュを読み込んでレジストリに登録"""
+    cache = create_semantic_cache()
+    get_registry().set_semantic_cache(cache)
+    return cache
+
+@st.cache_resource
+def setup_rate_limiter():
+    """プロセスで1度だけレート制限と再試行の方針を作成し、全セッションで共有する"""
+    registry = get_registry()
+    limiter = create_rate_limiter()
+    registry.set_rate_limiter(limiter)
+    registry.set_retry_policy(create_retry_policy())
+    return limiter
+
+@st.cache_resource
+def setup_context_budget():
+    """プロセスで1度だけステップ間の受け渡しの予算を作成してレジストリに登録"""
+    budget = create_context_budget()
+    get_registry().set_context_budget(budget)
+    return budget
+
+@st.cache_resource
+def setup_cassette() -> Optional[Cassette]:
+    """プロセスで1度だけカセットを開き、記録・再生するクライアントをレジストリに登録"""
+    cassette = create_cassette()
+    if cassette is not None:
+        get_registry().set_llm_factory(cassette.llm_factory())
+    return cassette
+
+@st.cache_resource
+def setup_run_store() -> Optional[RunStore]:
+    """プロセスで1度だけ実行履歴を開き、全セッションで共有する"""
+    return create_run_store()
+
+def run_demo(runner: str, question: str, config: GeminiConfig, on_step: StepCallback) -> Dict[str, Any]:
+    """ジョブキューのワーカーでAIPatternDemoのメソッドを実行（Streamlitは呼ばない。実行の予算はジョブごと）"""
+    with use_budget(create_run_budget()):
+        return getattr(AIPatternDemo(config), runner)(question, on_step)
+
+@st.cache_resource
+def setup_job_queue() -> JobQueue:
+    """プロセスで1度だけジョブキューのワーカーを起動し、全セッションで共有する
+
+    完了したジョブはワーカーで実行履歴に保存するため、実行中にページを離れても結果は残る。
+    """
+    run_store = setup_run_store()
+
+    def record(job: Job) -> None:
+        if run_store is not None and job.status == JobStatus.SUCCEEDED:
+            run_store.record(
+                job.pattern, job.question, {**job.outputs, **job.result}, job.trace, job.outputs, job.config
+            )
+
+    return create_job_queue(run_demo, on_finish=record)
+
+@st.cache_resource
+def setup_comparison_pool() -> ThreadPoolExecutor:
+    """プロセスで1度だけ比較モードのスレッドプールを作成し、全セッションで同時に実行するパターン数を抑える"""
+    return ThreadPoolExecutor(max_workers=ComparisonConfig().max_workers, thread_name_prefix="compare")
+
+@st.cache_resource
+def setup_metrics() -> MetricsConfig:
+    """プロセスで1度だけメトリクスのエンドポイントを起動"""
+    config = MetricsConfig()
+    if config.port:
+        METRICS.serve(config.port)
+    return config
+
 class StepStatus(Enum):
     WAITING = "waiting"
     PROCESSING = "processing"
@@ -14,6 +115,10 @@ class StepProgress:
         self.steps = steps
         self.status = {step: StepStatus.WAITING for step in steps}
         self.current_step = 0
+        # display_progressが描画した先と、ステップごとの枠・描画済みの状態
+        self.container = None
+        self.slots: Dict[str, Any] = {}
+        self.rendered: Dict[str, StepStatus] = {}
     
     def update_status(self, step: str, status: StepStatus) -> None:
         if step in self.status:
@@ -24,114 +129,440 @@ class StepProgress:
     def get_current_step(self) -> int:
         return self.current_step
 
+    def apply_event(self, event: StepEvent, step_labels: Dict[str, str]) -> bool:
+        """モデル層からのステップ通知を状態に反映（表示しないステップならFalse）"""
+        label = step_labels.get(event.step)
+        if label is None:
+            return False
+        if event.type == StepEventType.STARTED:
+            self.update_status(label, StepStatus.PROCESSING)
+        elif event.type == StepEventType.FINISHED:
+            self.update_status(label, StepStatus.COMPLETED)
+        else:
+            self.update_status(label, StepStatus.FAILED)
+        return True
+
+# 進捗表示のスタイル（ページの実行ごとにinject_progress_cssで1度だけ埋め込む）
+PROGRESS_CSS = """
+<style>
+    .status-item {
+        text-align: center;
+        padding: 10px 15px;
+        border-radius: 8px;
+        background: #1E1E1E;
+        color: #CCCCCC;
+        font-weight: bold;
+        border: 1px solid #333333;
+    }
+    .status-item.processing {
+        background: #2D2D2D;
+        color: #FFA500;
+        border: 1px solid #FFA500;
+    }
+    .status-item.completed {
+        background: #1E3A1E;
+        color: #4CAF50;
+        border: 1px solid #4CAF50;
+    }
+    .status-item.failed {
+        background: #3A1E1E;
+        color: #FF4444;
+        border: 1px solid #FF4444;
+    }
+</style>
+"""
+
+STATUS_ICONS = {
+    StepStatus.WAITING: "⏳",
+    StepStatus.PROCESSING: "🔄",
+    StepStatus.COMPLETED: "✅",
+    StepStatus.FAILED: "❌",
+}
+
+def inject_progress_css() -> None:
+    """進捗表示のスタイルを埋め込む（ステータスの更新ごとには送らない）"""
+    st.markdown(PROGRESS_CSS, unsafe_allow_html=True)
+
 def display_progress(step_progress: StepProgress, status_container) -> None:
-    """進捗状況を表示"""
+    """進捗状況を表示（前回の表示から状態が変わったステップだけを描き直す）
+
+    初回はstatus_containerにステップごとの列と枠を作り、以降は状態が変わったステップの枠だけを更新する。
+    """
     if not step_progress:
         return
-    
-    # ステップの状態を1行で表示
-    status_items = []
-    current_step_detail = ""
-    
+    if step_progress.container is not status_container:
+        with status_container.container():
+            columns = st.columns(len(step_progress.steps))
+        step_progress.container = status_container
+        step_progress.slots = {step: column.empty() for step, column in zip(step_progress.steps, columns)}
+        step_progress.rendered = {}
     for step, status in step_progress.status.items():
-        # ステップの状態に応じたスタイルを設定
-        if status == StepStatus.PROCESSING:
-            status_items.append(f'<div class="status-item processing">🔄 {step}</div>')
-        elif status == StepStatus.COMPLETED:
-            status_items.append(f'<div class="status-item completed">✅ {step}</div>')
-        elif status == StepStatus.FAILED:
-            status_items.append(f'<div class="status-item failed">❌ {step}</div>')
-        else:
-            status_items.append(f'<div class="status-item">⏳ {step}</div>')
-    
-    # ステータスを表示
-    status_container.markdown(
-        f"""
-        <style>
-            .status-container {{
-                width: 100%;
-                display: flex;
-                justify-content: space-between;
-                align-items: center;
-                padding: 15px;
-                background: #262730;
-                border-radius: 8px;
-                margin: 10px 0;
-                box-sizing: border-box;
-            }}
-            .status-item {{
-                flex: 1;
-                text-align: center;
-                margin: 0 5px;
-                min-width: 150px;
-                padding: 10px 15px;
-                border-radius: 8px;
-                background: #1E1E1E;
-                color: #CCCCCC;
-                font-weight: bold;
-                border: 1px solid #333333;
-            }}
-            .status-item.processing {{
-                background: #2D2D2D;
-                color: #FFA500;
-                border: 1px solid #FFA500;
-            }}
-            .status-item.completed {{
-                background: #1E3A1E;
-                color: #4CAF50;
-                border: 1px solid #4CAF50;
-            }}
-            .status-item.failed {{
-                background: #3A1E1E;
-                color: #FF4444;
-                border: 1px solid #FF4444;
-            }}
-        </style>
-        {current_step_detail if current_step_detail else ""}
-        <div class='status-container'>
-            {"".join(status_items)}
-        </div>
-        """,
-        unsafe_allow_html=True
-    )
+        if step_progress.rendered.get(step) == status:
+            continue
+        step_progress.slots[step].markdown(
+            f'<div class="status-item {status.value}">{STATUS_ICONS[status]} {step}</div>', unsafe_allow_html=True
+        )
+        step_progress.rendered[step] = status
 
 class AIPatternDemo:
-    def __init__(self):
-        self.cot_solver = GeminiChainOfThought()
-        self.reasoner = GeminiReasoning()
-        self.evaluator_optimizer = EvaluatorOptimizer()
-        self.debate_cooperator = DebateBasedCooperation()
+    def __init__(self, config: Optional[GeminiConfig] = None):
+        # パターンはプロセス内で設定ごとに1度だけ生成し、リランやセッションをまたいで再利用する
+        registry = get_registry()
+        self.direct_solver = registry.get_pattern(DirectQuery, config)
+        self.cot_solver = registry.get_pattern(GeminiChainOfThought, config)
+        self.reasoner = registry.get_pattern(GeminiReasoning, config)
+        self.evaluator_optimizer = registry.get_pattern(EvaluatorOptimizer, config)
+        self.debate_cooperator = registry.get_pattern(DebateBasedCooperation, config)
+        self.router = registry.get_pattern(PatternRouter, config)
         
-    def direct_query(self, question: str) -> str:
+    def direct_query(self, question: str, on_step: Optional[StepCallback] = None) -> Dict[str, str]:
         """単純な質問応答"""
-        result = self.reasoner.llm.invoke(question)
+        result = self.direct_solver.answer(question, on_step)
         return result
     
-    def chain_of_thought(self, question: str) -> Dict[str, str]:
+    def chain_of_thought(self, question: str, on_step: Optional[StepCallback] = None) -> Dict[str, str]:
         """Chain of Thoughtパターン"""
-        result = self.cot_solver.solve_problem(question)
+        result = self.cot_solver.solve_problem(question, on_step)
+        result["final_response"] = result["final_answer"]
         return result
     
-    def direct_reasoning(self, question: str) -> Dict[str, str]:
+    def direct_reasoning(self, question: str, on_step: Optional[StepCallback] = None) -> Dict[str, str]:
         """直接推論パターン"""
-        result = self.reasoner.direct_reasoning(question)
+        result = self.reasoner.direct_reasoning(question, on_step)
+        result["final_response"] = result["reasoning"]
         return result
     
-    def chained_reasoning(self, question: str) -> Dict[str, str]:
+    def chained_reasoning(self, question: str, on_step: Optional[StepCallback] = None) -> Dict[str, str]:
         """チェーン推論パターン"""
-        result = self.reasoner.chained_reasoning(question)
+        result = self.reasoner.chained_reasoning(question, on_step)
+        result["final_response"] = result["final_result"]
         return result
     
-    def evaluator_optimizer_workflow(self, question: str) -> Dict[str, Any]:
+    def evaluator_optimizer_workflow(self, question: str, on_step: Optional[StepCallback] = None) -> Dict[str, Any]:
         """Evaluator-Optimizerワークフロー"""
-        result = self.evaluator_optimizer.generate_optimized_response(question)
+        result = self.evaluator_optimizer.generate_optimized_response(question, on_step)
         return result
     
-    def debate_based_cooperation(self, question: str) -> Dict[str, Any]:
+    def debate_based_cooperation(self, question: str, on_step: Optional[StepCallback] = None) -> Dict[str, Any]:
         """ディベートベースの協調パターン"""
-        result = self.debate_cooperator.generate_debate_response(question)
+        result = self.debate_cooperator.generate_debate_response(question, on_step)
         return result
 
+    def auto(self, question: str, on_step: Optional[StepCallback] = None) -> Dict[str, Any]:
+        """質問に合わせて最も安いパターンを選んで実行（自動選択）"""
+        return self.router.answer(question, on_step)
+
+    def stream(self, runner: str, question: str, on_step: Optional[StepCallback] = None) -> Iterator[StepChunk]:
+        """パターンをストリーミングで実行（runnerは通常実行のメソッド名）"""
+        streams = {
+            "direct_query": self.direct_solver.stream_answer,
+            "chain_of_thought": self.cot_solver.stream_solve_problem,
+            "direct_reasoning": self.reasoner.stream_direct_reasoning,
+            "chained_reasoning": self.reasoner.stream_chained_reasoning,
+            "evaluator_optimizer_workflow": self.evaluator_optimizer.stream_optimized_response,
+            "debate_based_cooperation": self.debate_cooperator.stream_debate_response
+        }
+        return streams[runner](question, on_step)
+
+class PatternExecutor:
+    """パターンを1回だけ実行し、実際のステップ開始・終了をStepProgressへ反映する"""
+    def __init__(self, demo: AIPatternDemo, step_progress: StepProgress, status_container, step_labels: Dict[str, str]):
+        self.demo = demo
+        self.step_progress = step_progress
+        self.status_container = status_container
+        self.step_labels = step_labels
+        # 完了したステップの出力（完了した時点で参照できる）
+        self.outputs: Dict[str, str] = {}
+        # ステップごとの計測値
+        self.trace = RunTrace()
+
+    def on_step(self, event: StepEvent) -> None:
+        """モデル層からのステップ通知を進捗表示に反映"""
+        self.trace.on_step(event)
+        if event.type == StepEventType.FINISHED:
+            self.outputs[event.step] = event.output
+        if self.step_progress.apply_event(event, self.step_labels):
+            display_progress(self.step_progress, self.status_container)
+
+    def run(self, runner: str, question: str) -> Dict[str, Any]:
+        """AIPatternDemoのメソッド名を指定してパターンを実行"""
+        self.trace.question = question
+        return getattr(self.demo, runner)(question, self.on_step)
+
+    def stream(self, runner: str, question: str) -> Iterator[StepChunk]:
+        """パターンをストリーミングで1回だけ実行"""
+        self.trace.question = question
+        return self.demo.stream(runner, question, self.on_step)
+
+@dataclass
+class ComparisonResult:
+    """比較モードでの1パターン分の実行結果"""
+    pattern: str
+    trace: RunTrace
+    elapsed: float
+    # 完了したステップの出力
+    outputs: Dict[str, str]
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[Exception] = None
+    budget: Optional[RunBudget] = None
+
+def run_comparison(
+    demo: AIPatternDemo,
+    runners: Dict[str, str],
+    question: str,
+    max_workers: int,
+    pool: Optional[ThreadPoolExecutor] = None,
+    run_store: Optional[RunStore] = None
+) -> Iterator[ComparisonResult]:
+    """複数のパターンをpool（既定は全セッション共有のプール）で最大max_workersずつ実行し、終わった順に結果を返す
+
+    ワーカーはStreamlitを呼ばない（描画は呼び出し側のスレッドで行う）。
+    runnersはパターン名 → AIPatternDemoのメソッド名。パターンごとに実行の予算を適用し、
+    完了したものはrun_storeに保存する。
+    """
+    pool = pool or setup_comparison_pool()
+
+    def run(pattern: str) -> ComparisonResult:
+        trace = RunTrace(question)
+        outputs: Dict[str, str] = {}
+
+        def on_step(event: StepEvent) -> None:
+            trace.on_step(event)
+            if event.type == StepEventType.FINISHED:
+                outputs[event.step] = event.output
+
+        start = time.perf_counter()
+        with use_budget(create_run_budget()) as budget:
+            try:
+                result = getattr(demo, runners[pattern])(question, on_step)
+            except Exception as e:
+                return ComparisonResult(pattern, trace, time.perf_counter() - start, outputs, error=e, budget=budget)
+        if run_store is not None:
+            run_store.record(runners[pattern], question, {**outputs, **result}, trace, outputs)
+        return ComparisonResult(pattern, trace, time.perf_counter() - start, outputs, result=result, budget=budget)
+
+    # プールは他のセッションと共有するため、このセッションの分は最大max_workersずつ投入する
+    pending = list(runners)
+    running: Set[Future] = set()
+    while pending or running:
+        while pending and len(running) < max_workers:
+            running.add(pool.submit(run, pending.pop(0)))
+        done, running = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+def display_comparison(
+    demo: AIPatternDemo,
+    pattern_descriptions: Dict[str, Dict[str, Any]],
+    patterns: List[str],
+    question: str,
+    max_workers: int,
+    run_store: Optional[RunStore] = None
+) -> None:
+    """選択したパターンを同時に実行し、終わったものから列に表示"""
+    # 1行に3列まで並べる
+    columns = []
+    for row in range(0, len(patterns), 3):
+        columns.extend(st.columns(3)[:len(patterns[row:row + 3])])
+    placeholders = {}
+    for pattern, column in zip(patterns, columns):
+        with column:
+            st.markdown(f"#### {pattern}")
+            placeholders[pattern] = st.empty()
+            placeholders[pattern].info("実行中...")
+
+    summary = st.empty()
+    start = time.perf_counter()
+    total_latency = 0.0
+    runners = {pattern: pattern_descriptions[pattern]["runner"] for pattern in patterns}
+    for comparison in run_comparison(demo, runners, question, max_workers, run_store=run_store):
+        total_latency += comparison.elapsed
+        stats = comparison.trace.to_dict()
+        with placeholders[comparison.pattern].container():
+            st.caption(
+                f"⏱ {comparison.elapsed:.1f}秒 ・ LLM呼び出し {stats['llm_calls']}回 ・ "
+                f"トークン {stats['prompt_tokens'] + stats['completion_tokens']}"
+            )
+            if comparison.error is not None:
+                st.error(f"エラーが発生しました: {comparison.error}")
+            else:
+                st.success(comparison.result["final_response"])
+                display_budget(comparison.budget)
+                step_labels = pattern_descriptions[comparison.pattern]["steps"]
+                # 最終ステップ以外の出力を途中経過として表示
+                intermediate = [step for step in list(step_labels)[:-1] if step in comparison.outputs]
+                if intermediate:
+                    with st.expander("途中のステップ", expanded=False):
+                        for step in intermediate:
+                            st.markdown(f"**{step_labels[step]}**")
+                            st.write(comparison.outputs[step])
+        summary.caption(
+            f"全体 {time.perf_counter() - start:.1f}秒（各パターンの合計 {total_latency:.1f}秒）"
+        )
+
+def display_budget(budget: Optional[RunBudget]) -> None:
+    """実行の予算の消費量を表示（使い切って省いたステップがあれば警告する）"""
+    if budget is None:
+        return
+    summary = budget.summary()
+    st.caption(
+        f"実行の予算: {summary['prompt_tokens'] + summary['completion_tokens']}トークン"
+        f"・推定 ${summary['cost']:.4f}・{summary['elapsed']:.1f}秒（{summary['calls']}回呼び出し）"
+    )
+    if summary["exhausted"] is not None:
+        reasons = {"tokens": "トークン数", "cost": "費用", "time": "実行時間"}
+        st.warning(
+            f"実行の予算（{reasons.get(summary['exhausted'], summary['exhausted'])}）の上限に達したため、"
+            f"{len(summary['skipped'])}個のステップを省略して途中までの結果を表示しています"
+        )
+
+def display_trace(trace: RunTrace, step_labels: Dict[str, str], config: MetricsConfig) -> None:
+    """ステップごとの計測値を表示し、JSONトレースをダウンロード・保存できるようにする"""
+    if not trace.steps:
+        return
+    if config.path:
+        METRICS.write(config.path)
+    if config.trace_dir:
+        os.makedirs(config.trace_dir, exist_ok=True)
+        trace.save(os.path.join(config.trace_dir, f"trace-{trace.started_at:.0f}.json"))
+    with st.expander("実行メトリクス", expanded=False):
+        st.table(step_rows([step.to_dict() for step in trace.steps], step_labels))
+        st.download_button("JSONトレースをダウンロード", trace.to_json(), file_name="trace.json", mime="application/json")
+
+def step_rows(steps: List[Dict[str, Any]], step_labels: Dict[str, str]) -> List[Dict[str, Any]]:
+    """ステップごとの計測値（StepMetrics.to_dict）を表示用の行にする"""
+    return [
+        {
+            "ステップ": step_labels.get(step["step"], step["step"]),
+            "時間(秒)": round(step["duration"], 2),
+            "最初のトークン(秒)": round(step["ttft"], 2) if step["ttft"] is not None else None,
+            "入力トークン": step["prompt_tokens"],
+            "出力トークン": step["completion_tokens"],
+            "再試行": step["retries"],
+            "キャッシュ": step["cache"] or "",
+            "受け渡し(圧縮前→後)": (
+                f"{step['context_tokens']}→{step['compacted_tokens']}" if step.get("context_tokens") is not None else ""
+            ),
+            "圧縮": step.get("compaction") or "",
+        }
+        for step in steps
+    ]
+
+def pattern_name(pattern_descriptions: Dict[str, Dict[str, Any]], runner: str) -> str:
+    """AIPatternDemoのメソッド名から表示用のパターン名を引く（見つからなければそのまま）"""
+    return next((name for name, description in pattern_descriptions.items() if description["runner"] == runner), runner)
+
+def display_replay(record: RunRecord, pattern_descriptions: Dict[str, Dict[str, Any]]) -> None:
+    """保存した実行をLLMを呼ばずに再表示する"""
+    pattern = pattern_name(pattern_descriptions, record.pattern)
+    st.markdown(f"## 実行履歴の再表示: {pattern}")
+    st.caption(
+        f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(record.created_at))} に実行"
+        f"（{record.duration:.1f}秒・モデル {record.config.get('model_name', '')}）・LLMは呼び出していません"
+    )
+    st.info(record.question)
+    format_response(record.result, pattern)
+    if record.steps:
+        with st.expander("実行メトリクス", expanded=False):
+            step_labels = pattern_descriptions.get(pattern, {}).get("steps", {})
+            st.table(step_rows(record.steps, step_labels))
+
+def display_job(
+    job_queue: JobQueue,
+    job_id: str,
+    pattern_descriptions: Dict[str, Dict[str, Any]],
+    metrics_config: MetricsConfig
+) -> None:
+    """バックグラウンドのジョブの進捗と結果を表示する
+
+    実行中は進捗だけをフラグメントとして0.5秒ごとに再実行し、ページ全体は再実行しない。
+    ジョブが終わったらページを1度だけ再実行して結果を表示する（実行はワーカーで続くため、ページを離れても失われない）。
+    """
+    job = job_queue.get(job_id)
+    if job is None:
+        st.warning("ジョブの結果は保持期間を過ぎたため破棄されました")
+        return
+    pattern = pattern_name(pattern_descriptions, job.pattern)
+    step_labels = pattern_descriptions.get(pattern, {}).get("steps", {})
+    st.markdown(f"### ジョブ {job.id}: {pattern}")
+    st.caption(job.question)
+
+    # ステップの状態と反映済みのイベント数はセッションに残し、再実行のたびに最初から反映し直さない
+    # （スクリプトの再実行でStepStatusのクラスが作り直されるため、状態は値で持つ）
+    progress = st.session_state.get("job_progress")
+    if progress is None or progress["job_id"] != job.id:
+        progress = {"job_id": job.id, "cursor": 0, "status": {}}
+        st.session_state["job_progress"] = progress
+
+    def show_progress() -> bool:
+        """前回から届いたイベントだけを進捗に反映して表示し、ジョブが終わったかを返す"""
+        step_progress = StepProgress(list(step_labels.values()))
+        for step, status in progress["status"].items():
+            step_progress.update_status(step, StepStatus(status))
+        events, done = job_queue.wait(job.id, since=progress["cursor"], timeout=0)
+        for event in events:
+            step_progress.apply_event(event, step_labels)
+        progress["cursor"] += len(events)
+        progress["status"] = {step: status.value for step, status in step_progress.status.items()}
+        display_progress(step_progress, st.empty())
+        return done
+
+    if not job.done:
+        @st.fragment(run_every=0.5)
+        def poll() -> None:
+            if show_progress():
+                st.rerun()
+
+        poll()
+        return
+    show_progress()
+    if job.status == JobStatus.FAILED:
+        st.error(f"エラーが発生しました: {job.error}")
+        return
+    st.caption(f"⏱ {job.duration:.1f}秒（待ち時間 {job.started_at - job.created_at:.1f}秒）")
+    format_response(job.result, pattern)
+    display_trace(job.trace, step_labels, metrics_config)
+
+def format_streaming_response(
+    chunks: Iterable[StepChunk],
+    step_labels: Dict[str, str],
+    final_step: Optional[str] = None
+) -> Dict[str, Any]:
+    """ストリーミング応答を届いた順に各ステップのエキスパンダーへ描画
+
+    final_stepのトークンは最終回答の欄に描画する。ジェネレータが結果（final_responseを含むdict）を
+    返した場合は、最後にそれを最終回答として表示する。戻り値は各ステップの出力とfinal_responseで、
+    ジェネレータが結果を返した場合はその内容も含む（format_responseで再表示できる形）。
+    """
+    st.write("### 最終回答")
+    final_placeholder = st.empty()
+    placeholders = {}
+    parts: Dict[str, List[str]] = {}
+    iterator = iter(chunks)
+    returned: Dict[str, Any] = {}
+    while True:
+        try:
+            chunk = next(iterator)
+        except StopIteration as stop:
+            if isinstance(stop.value, dict) and "final_response" in stop.value:
+                final_placeholder.success(stop.value["final_response"])
+                returned = stop.value
+            break
+        parts.setdefault(chunk.step, []).append(chunk.text)
+        text = "".join(parts[chunk.step])
+        if chunk.step == final_step:
+            final_placeholder.success(text)
+            continue
+        # ステップの最初のトークンが届いた時点でエキスパンダーを作成
+        if chunk.step not in placeholders:
+            with st.expander(step_labels.get(chunk.step, chunk.step), expanded=True):
+                placeholders[chunk.step] = st.empty()
+        placeholders[chunk.step].info(text)
+    result: Dict[str, Any] = {step: "".join(texts) for step, texts in parts.items()}
+    if final_step in result:
+        result["final_response"] = result[final_step]
+    return {**result, **returned}
+
 def format_response(response: Dict[str, Any], pattern: str) -> None:
     """レスポンスを整形して表示"""
     if pattern == "シンプルな質問応答":
@@ -167,26 +598,265 @@ def format_response(response: Dict[str, Any], pattern: str) -> None:
     elif pattern == "生成と評価の繰り返し":
         st.write("### 最終回答")
         st.success(response["final_response"])
+        reasons = {
+            "target_score": "目標の点数に到達",
+            "plateau": "改善が頭打ち",
+            "max_iterations": "最大回数に到達",
+            "budget": "実行の予算の上限に到達"
+        }
+        st.caption(
+            f"評価 {response['final_score']:g}点 ・ {len(response['iterations'])}回評価して終了"
+            f"（{reasons.get(response['stop_reason'], response['stop_reason'])}）"
+        )
         for iteration in response["iterations"]:
-            with st.expander(f"イテレーション {iteration['iteration']}", expanded=False):
-                st.info(f"生成: {iteration['response']}")
-                st.warning(f"評価: {iteration['evaluation']}")
-                st.success(f"最適化: {iteration['optimized_response']}")
+            with st.expander(
+                f"イテレーション {iteration['iteration']}（{iteration['score']:g}点・{iteration['elapsed']:.1f}秒）",
+                expanded=False
+            ):
+                st.info(f"回答: {iteration['response']}")
+                st.warning(f"評価: {iteration['critique']}")
+                if iteration["optimized_response"] is not None:
+                    st.success(f"最適化: {iteration['optimized_response']}")
     elif pattern == "ディベートベースの協調":
         st.write("### 最終回答（合意形成）")
         st.success(response["final_response"])
-        for iteration in response["iterations"]:
-            position_a = iteration["position_a"]
-            position_b = iteration["position_b"]
-            with st.expander(f"ディベート {iteration['iteration']}", expanded=False):
-                st.info(f"### {position_a['emoji']} {position_a['name']}からの意見")
-                st.write(iteration["position_a_opinion"])
-                st.warning(f"### {position_b['emoji']} {position_b['name']}からの反論")
-                st.write(iteration["position_b_rebuttal"])
-                st.info(f"### {position_a['emoji']} {position_a['name']}からの再反論")
-                st.write(iteration["position_a_rebuttal"])
-                st.warning(f"### {position_b['emoji']} {position_b['name']}からの最終反論")
-                st.write(iteration["position_b_final_rebuttal"])
+        if response.get("converged"):
+            st.caption(f"立場の主張が収束したため、{len(response['rounds'])}ラウンドで議論を終えました")
+        for debate_round in response.get("rounds", []):
+            with st.expander(f"ラウンド {debate_round['round']}", expanded=False):
+                for position in response["positions"]:
+                    # 立場のstyle（info・warningなど）に対応する表示で発言を描画
+                    show = getattr(st, position.get("style", "info"), st.info)
+                    show(f"### {position['emoji']} {position['name']}")
+                    st.write(debate_round["statements"][position["key"]])
+    elif pattern == "自動選択":
+        route = response["route"]
+        kinds = {"simple": "単純な質問", "reasoning": "推論が必要な質問", "complex": "多段の分析が必要な質問", "opinion": "賛否・立場の比較"}
+        classification = route["classification"]
+        st.write("### 最終回答")
+        st.success(response["final_response"])
+        st.caption(
+            f"{kinds.get(classification['kind'], classification['kind'])}（確信度 {classification['confidence']:.2f}）と判定し、"
+            f"{route['pattern']}で回答 ・ LLM呼び出し {route['llm_calls']}回（{route['baseline']}より"
+            + (f"{route['extra_calls']}回多い）" if route.get("extra_calls") else f"{route['calls_saved']}回少ない）")
+        )
+        if len(route["attempts"]) > 1:
+            st.caption("答え直し: " + " → ".join(
+                f"{attempt['pattern']}（{attempt['reason'] or '十分'}）" for attempt in route["attempts"]
+            ))
+
+# パターンの説明（表示名 → 説明・入力例・AIPatternDemoのメソッド名・ステップ名 → 表示名）
+# 設定で決まるステップはパターンのクラスを置き、load_pattern_descriptionsでstep_labels()に置き換える
+PATTERN_DESCRIPTIONS: Dict[str, Dict[str, Any]] = {
+    "シンプルな質問応答": {
+        "description": """
+        **特徴:**
+        - 最もシンプルで直感的なパターン
+        - 人間が質問するように、そのままAIに質問を投げかける
+        - 複雑な推論や長い回答には不向き
+        - 回答の信頼性は比較的低い
+
+        **適しているユースケース:**
+        - 単純な事実確認や定義の説明
+          - 例：「Pythonとは何ですか？」「東京の人口は？」
+        - 簡単な計算問題
+          - 例：「2+2は？」「100円の20%引きは？」
+        - 短い回答で十分な場合
+          - 例：「今日の天気は？」「この単語の意味は？」
+        - 素早い回答が必要な場合
+          - 例：「現在時刻は？」「次の電車は何時？」
+
+        **例:**
+        - 「Pythonとは何ですか？」
+        - 「2+2は？」
+        - 「東京の人口は？」
+        """,
+        "example": "Pythonとは何ですか？",
+        "runner": "direct_query",
+        "steps": {"final_response": "回答生成"}
+    },
+    "段階的思考（Chain of Thought）": {
+        "description": """
+        **特徴:**
+        - 人間の思考プロセスを模倣したパターン
+        - 「なぜそうなるのか」を段階的に説明
+        - 複雑な問題でも正確な回答が得られる
+        - 回答の信頼性が高い
+
+        **適しているユースケース:**
+        - 数学的な問題解決
+          - 例：「15個のリンゴが入った箱が3つと、20個のリンゴが入った箱が2つあります。合計で何個のリンゴがありますか？」
+        - 論理的な推論が必要な問題
+          - 例：「AさんはBさんより2歳年上で、BさんはCさんより3歳年上です。AさんはCさんより何歳年上ですか？」
+        - 複数のステップを要する問題
+          - 例：「この数学の問題を解くには、どのような手順で進めればよいですか？」
+        - 思考プロセスの説明が重要な場合
+          - 例：「なぜこの結論に至ったのか、その理由を説明してください」
+
+        **例:**
+        - 「15個のリンゴが入った箱が3つと、20個のリンゴが入った箱が2つあります。合計で何個のリンゴがありますか？」
+        - 「AさんはBさんより2歳年上で、BさんはCさんより3歳年上です。AさんはCさんより何歳年上ですか？」
+        """,
+        "example": "15個のリンゴが入った箱が3つと、20個のリンゴが入った箱が2つあります。合計で何個のリンゴがありますか？",
+        "runner": "chain_of_thought",
+        "steps": {
+            "analysis": "問題分析",
+            "thought_process": "思考プロセス構築",
+            "reasoning": "段階的推論",
+            "final_answer": "回答生成"
+        }
+    },
+    "構造化推論": {
+        "description": """
+        **特徴:**
+        - 問題を構造化して分析するパターン
+        - 前提条件、データ、プロセス、結論を明確に分けて考える
+        - 論理的な分析に適している
+        - 分析結果の再現性が高い
+
+        **適しているユースケース:**
+        - 統計データの分析
+          - 例：「このデータから何が言えるか、前提条件と分析プロセスを明確にして説明してください」
+        - 市場調査の結果解釈
+          - 例：「このアンケート結果から、どのような市場動向が読み取れるか分析してください」
+        - 技術的な問題の診断
+          - 例：「このエラーメッセージの原因を、発生条件と解決手順を明確にして説明してください」
+        - 構造化された情報の処理
+          - 例：「このレポートの要点を、前提条件と結論を明確にして要約してください」
+
+        **例:**
+        - 「日本の少子高齢化の影響を分析してください」
+        - 「このエラーメッセージの原因を特定してください」
+        """,
+        "example": "日本の少子高齢化の影響を分析してください",
+        "runner": "direct_reasoning",
+        "steps": {
+            "assumptions": "前提条件分析",
+            "data_processing": "データ処理",
+            "reasoning": "推論実行"
+        }
+    },
+    "連鎖推論": {
+        "description": """
+        **特徴:**
+        - 複数の推論を連鎖させて問題を解決するパターン
+        - 1つの推論の結果が次の推論の前提条件になる
+        - 複雑な問題を段階的に解決できる
+        - 推論の過程が透明で理解しやすい
+
+        **適しているユースケース:**
+        - 複雑な意思決定プロセス
+          - 例：「新しいビジネスを始める際のリスク評価を、各要因の関連性を考慮して分析してください」
+        - 複数の要因が絡む問題
+          - 例：「都市計画における交通渋滞の解決策を、経済的影響と環境への影響を考慮して提案してください」
+        - 段階的な分析が必要な問題
+          - 例：「このプロジェクトの成功要因を、各段階の依存関係を考慮して分析してください」
+        - 不確実性の高い問題
+          - 例：「将来の市場動向を、様々なシナリオを考慮して予測してください」
+
+        **例:**
+        - 「新しいビジネスを始める際のリスク評価」
+        - 「都市計画における交通渋滞の解決策」
+        """,
+        "example": "新しいビジネスを始める際のリスク評価",
+        "runner": "chained_reasoning",
+        "steps": {
+            "decomposition": "問題分解",
+            "data_analysis": "データ分析",
+            "assumptions": "仮定設定",
+            "final_result": "推論実行"
+        }
+    },
+    "生成と評価の繰り返し": {
+        "description": """
+        **特徴:**
+        - 生成と評価を繰り返して回答を改善するパターン
+        - 2つのAIが協力して高品質な回答を作成
+        - 生成AIが回答を作成し、評価AIが改善点を指摘
+        - より洗練された回答が得られる
+
+        **適しているユースケース:**
+        - クリエイティブなコンテンツ生成
+          - 例：「新しい製品のマーケティング戦略を、ターゲット層と競合分析を考慮して提案してください」
+        - 技術的なドキュメント作成
+          - 例：「このAPIの仕様書を、技術的な正確性と読みやすさを考慮して作成してください」
+        - 複雑な問題解決
+          - 例：「このビジネスケースの分析を、複数の観点から評価して改善案を提案してください」
+        - 高品質な回答が求められる場合
+          - 例：「この研究論文の要約を、正確性と簡潔さを考慮して作成してください」
+
+        **例:**
+        - 「新しい製品のマーケティング戦略を提案してください」
+        - 「技術的なホワイトペーパーの作成」
+        - 「複雑なビジネスケースの分析」
+        """,
+        "example": "新しい製品のマーケティング戦略を提案してください",
+        "runner": "evaluator_optimizer_workflow",
+        # 最大回数（EVALUATOR_MAX_ITERATIONS）まで繰り返した場合のステップ（load_pattern_descriptionsでパターンから作る）
+        "steps": EvaluatorOptimizer,
+        # 最終回答は最後のステップではなく最も点数の高い回答（実行結果から表示する）
+        "final_step": None
+    },
+    "ディベートベースの協調": {
+        "description": """
+        **特徴:**
+        - ディベートベースの協調パターン
+        - 2つのAIが協力して高品質な回答を作成
+        - ディベートの結果を利用して回答を改善
+        - より洗練された回答が得られる
+
+        **適しているユースケース:**
+        - 複雑な問題解決
+          - 例：「このビジネスケースの分析を、複数の観点から評価して改善案を提案してください」
+        - 高品質な回答が求められる場合
+          - 例：「この研究論文の要約を、正確性と簡潔さを考慮して作成してください」
+
+        **例:**
+        - 「このビジネスケースの分析を、複数の観点から評価して改善案を提案してください」
+        - 「この研究論文の要約を、正確性と簡潔さを考慮して作成してください」
+        """,
+        "example": "このビジネスケースの分析を、複数の観点から評価して改善案を提案してください",
+        "runner": "debate_based_cooperation",
+        # 立場の数・ラウンド数（DEBATE_ROUNDS）に合わせて生成する（load_pattern_descriptionsでパターンから作る）
+        "steps": DebateBasedCooperation
+    },
+    "自動選択": {
+        "description": """
+        **特徴:**
+        - 質問の文面から種類（単純・推論・多段の分析・賛否）を判定し、十分に答えられる最も安いパターンを選ぶ
+        - 回答が空・曖昧・短すぎる場合は、より重いパターンで答え直す
+        - 選択の記録（呼び出し回数・省いた回数）を残し、判定のしきい値を調整できる
+
+        **適しているユースケース:**
+        - どのパターンを選べばよいかわからない場合
+          - 例：「2+2は？」は単純な質問応答（1回の呼び出し）で答える
+        - 質問の種類が混在する場合
+          - 例：事実確認と賛否の相談が混ざる問い合わせ
+
+        **例:**
+        - 「2+2は？」
+        - 「在宅勤務を導入すべきか」
+        """,
+        "example": "2+2は？",
+        "runner": "auto",
+        "steps": {"route": "パターンの選択", "answer": "回答生成"},
+        # 回答を確かめて答え直す場合があるため、ストリーミングせずに実行する
+        "stream": False
+    }
+}
+
+@st.cache_resource
+def load_pattern_descriptions() -> Dict[str, Dict[str, Any]]:
+    """ステップの表示名を埋めたパターンの説明（プロセスで1度だけ作り、リランでは作り直さない）"""
+    registry = get_registry()
+    return {
+        name: {
+            **description,
+            "steps": description["steps"] if isinstance(description["steps"], dict)
+            else registry.get_pattern(description["steps"]).step_labels()
+        }
+        for name, description in PATTERN_DESCRIPTIONS.items()
+    }
 
 def main():
     """メイン関数"""
@@ -198,158 +868,12 @@ def main():
     
     st.title("AIエージェント デザインパターン")
     st.write("異なるAIエージェントのデザインパターンを比較・検証できます")
+    inject_progress_css()
+    # パターンを生成する前にクライアントの生成方法を差し替える
+    cassette = setup_cassette()
     
-    # パターンの説明を定義
-    pattern_descriptions = {
-        "シンプルな質問応答": {
-            "description": """
-            **特徴:**
-            - 最もシンプルで直感的なパターン
-            - 人間が質問するように、そのままAIに質問を投げかける
-            - 複雑な推論や長い回答には不向き
-            - 回答の信頼性は比較的低い
-
-            **適しているユースケース:**
-            - 単純な事実確認や定義の説明
-              - 例：「Pythonとは何ですか？」「東京の人口は？」
-            - 簡単な計算問題
-              - 例：「2+2は？」「100円の20%引きは？」
-            - 短い回答で十分な場合
-              - 例：「今日の天気は？」「この単語の意味は？」
-            - 素早い回答が必要な場合
-              - 例：「現在時刻は？」「次の電車は何時？」
-
-            **例:**
-            - 「Pythonとは何ですか？」
-            - 「2+2は？」
-            - 「東京の人口は？」
-            """,
-            "example": "Pythonとは何ですか？",
-            "steps": ["問題分析", "回答生成"]
-        },
-        "段階的思考（Chain of Thought）": {
-            "description": """
-            **特徴:**
-            - 人間の思考プロセスを模倣したパターン
-            - 「なぜそうなるのか」を段階的に説明
-            - 複雑な問題でも正確な回答が得られる
-            - 回答の信頼性が高い
-
-            **適しているユースケース:**
-            - 数学的な問題解決
-              - 例：「15個のリンゴが入った箱が3つと、20個のリンゴが入った箱が2つあります。合計で何個のリンゴがありますか？」
-            - 論理的な推論が必要な問題
-              - 例：「AさんはBさんより2歳年上で、BさんはCさんより3歳年上です。AさんはCさんより何歳年上ですか？」
-            - 複数のステップを要する問題
-              - 例：「この数学の問題を解くには、どのような手順で進めればよいですか？」
-            - 思考プロセスの説明が重要な場合
-              - 例：「なぜこの結論に至ったのか、その理由を説明してください」
-
-            **例:**
-            - 「15個のリンゴが入った箱が3つと、20個のリンゴが入った箱が2つあります。合計で何個のリンゴがありますか？」
-            - 「AさんはBさんより2歳年上で、BさんはCさんより3歳年上です。AさんはCさんより何歳年上ですか？」
-            """,
-            "example": "15個のリンゴが入った箱が3つと、20個のリンゴが入った箱が2つあります。合計で何個のリンゴがありますか？",
-            "steps": ["問題分析", "思考プロセス構築", "段階的推論", "回答生成"]
-        },
-        "構造化推論": {
-            "description": """
-            **特徴:**
-            - 問題を構造化して分析するパターン
-            - 前提条件、データ、プロセス、結論を明確に分けて考える
-            - 論理的な分析に適している
-            - 分析結果の再現性が高い
-
-            **適しているユースケース:**
-            - 統計データの分析
-              - 例：「このデータから何が言えるか、前提条件と分析プロセスを明確にして説明してください」
-            - 市場調査の結果解釈
-              - 例：「このアンケート結果から、どのような市場動向が読み取れるか分析してください」
-            - 技術的な問題の診断
-              - 例：「このエラーメッセージの原因を、発生条件と解決手順を明確にして説明してください」
-            - 構造化された情報の処理
-              - 例：「このレポートの要点を、前提条件と結論を明確にして要約してください」
-
-            **例:**
-            - 「日本の少子高齢化の影響を分析してください」
-            - 「このエラーメッセージの原因を特定してください」
-            """,
-            "example": "日本の少子高齢化の影響を分析してください",
-            "steps": ["前提条件分析", "データ処理", "推論実行"]
-        },
-        "連鎖推論": {
-            "description": """
-            **特徴:**
-            - 複数の推論を連鎖させて問題を解決するパターン
-            - 1つの推論の結果が次の推論の前提条件になる
-            - 複雑な問題を段階的に解決できる
-            - 推論の過程が透明で理解しやすい
-
-            **適しているユースケース:**
-            - 複雑な意思決定プロセス
-              - 例：「新しいビジネスを始める際のリスク評価を、各要因の関連性を考慮して分析してください」
-            - 複数の要因が絡む問題
-              - 例：「都市計画における交通渋滞の解決策を、経済的影響と環境への影響を考慮して提案してください」
-            - 段階的な分析が必要な問題
-              - 例：「このプロジェクトの成功要因を、各段階の依存関係を考慮して分析してください」
-            - 不確実性の高い問題
-              - 例：「将来の市場動向を、様々なシナリオを考慮して予測してください」
-
-            **例:**
-            - 「新しいビジネスを始める際のリスク評価」
-            - 「都市計画における交通渋滞の解決策」
-            """,
-            "example": "新しいビジネスを始める際のリスク評価",
-            "steps": ["問題分解", "データ分析", "仮定設定", "推論実行"]
-        },
-        "生成と評価の繰り返し": {
-            "description": """
-            **特徴:**
-            - 生成と評価を繰り返して回答を改善するパターン
-            - 2つのAIが協力して高品質な回答を作成
-            - 生成AIが回答を作成し、評価AIが改善点を指摘
-            - より洗練された回答が得られる
-
-            **適しているユースケース:**
-            - クリエイティブなコンテンツ生成
-              - 例：「新しい製品のマーケティング戦略を、ターゲット層と競合分析を考慮して提案してください」
-            - 技術的なドキュメント作成
-              - 例：「このAPIの仕様書を、技術的な正確性と読みやすさを考慮して作成してください」
-            - 複雑な問題解決
-              - 例：「このビジネスケースの分析を、複数の観点から評価して改善案を提案してください」
-            - 高品質な回答が求められる場合
-              - 例：「この研究論文の要約を、正確性と簡潔さを考慮して作成してください」
-
-            **例:**
-            - 「新しい製品のマーケティング戦略を提案してください」
-            - 「技術的なホワイトペーパーの作成」
-            - 「複雑なビジネスケースの分析」
-            """,
-            "example": "新しい製品のマーケティング戦略を提案してください",
-            "steps": ["初期回答生成", "評価", "最適化"]
-        },
-        "ディベートベースの協調": {
-            "description": """
-            **特徴:**
-            - ディベートベースの協調パターン
-            - 2つのAIが協力して高品質な回答を作成
-            - ディベートの結果を利用して回答を改善
-            - より洗練された回答が得られる
-
-            **適しているユースケース:**
-            - 複雑な問題解決
-              - 例：「このビジネスケースの分析を、複数の観点から評価して改善案を提案してください」
-            - 高品質な回答が求められる場合
-              - 例：「この研究論文の要約を、正確性と簡潔さを考慮して作成してください」
-
-            **例:**
-            - 「このビジネスケースの分析を、複数の観点から評価して改善案を提案してください」
-            - 「この研究論文の要約を、正確性と簡潔さを考慮して作成してください」
-            """,
-            "example": "このビジネスケースの分析を、複数の観点から評価して改善案を提案してください",
-            "steps": ["ディベートの準備", "ディベートの実施", "結果の分析"]
-        }
-    }
+    # 静的な説明はモジュールに置き、設定で決まるステップだけをプロセスで1度作る
+    pattern_descriptions = load_pattern_descriptions()
     
     # サイドバーでパターンを選択
     pattern = st.sidebar.selectbox(
@@ -361,6 +885,90 @@ def main():
     st.sidebar.markdown("### 選択されたパターンの説明")
     st.sidebar.markdown(pattern_descriptions[pattern]["description"])
     
+    streaming = st.sidebar.checkbox("ストリーミング表示", value=True)
+    metrics_config = setup_metrics()
+
+    st.sidebar.markdown("### 比較モード")
+    compare = st.sidebar.checkbox("複数のパターンを同時に実行して比較", value=False)
+    if compare:
+        compared_patterns = st.sidebar.multiselect(
+            "比較するパターン", list(pattern_descriptions), default=list(pattern_descriptions)
+        )
+        max_workers = st.sidebar.slider(
+            "同時に実行するパターン数の上限", 1, len(pattern_descriptions), value=len(pattern_descriptions),
+            help=f"全セッションの合計はCOMPARE_MAX_WORKERS（{ComparisonConfig().max_workers}）までに抑えます"
+        )
+    
+    st.sidebar.markdown("### バックグラウンド実行")
+    background = st.sidebar.checkbox("ジョブとして実行（ページを離れても実行を続ける）", value=False)
+    job_queue = setup_job_queue() if background else None
+    if job_queue is not None:
+        stats = job_queue.stats()
+        st.sidebar.caption(
+            f"ジョブ: 実行中 {stats['running']}・待機中 {stats['queued']}・完了 {stats['succeeded'] + stats['failed']}"
+            f"（ワーカー {stats['workers']}・重複の投入 {stats['deduplicated']}回）"
+        )
+        jobs = {job.id: job for job in job_queue.jobs(limit=20)}
+        if jobs:
+            selected_job = st.sidebar.selectbox(
+                "最近のジョブ",
+                list(jobs),
+                format_func=lambda job_id: (
+                    f"{jobs[job_id].status.value} {pattern_name(pattern_descriptions, jobs[job_id].pattern)}: "
+                    f"{jobs[job_id].question[:30]}"
+                )
+            )
+            if st.sidebar.button("ジョブの経過・結果を表示"):
+                st.session_state["job_id"] = selected_job
+    
+    response_cache = setup_response_cache()
+    if response_cache is not None:
+        stats = response_cache.stats()
+        st.sidebar.caption(f"応答キャッシュ: ヒット {stats['hits']} / ミス {stats['misses']}")
+    semantic_cache = setup_semantic_cache()
+    if semantic_cache is not None:
+        stats = semantic_cache.stats()
+        st.sidebar.caption(f"意味的キャッシュ: ヒット {stats['hits']} / ミス {stats['misses']}（{stats['entries']}件）")
+    rate_limiter = setup_rate_limiter()
+    if rate_limiter is not None:
+        stats = rate_limiter.stats()
+        st.sidebar.caption(
+            f"レート制限: 待機 {stats['throttled']}/{stats['requests']}回（計{stats['wait_seconds']:.1f}秒）"
+            f"・再試行 {get_registry().retry_policy.retries}回"
+        )
+    if cassette is not None:
+        stats = cassette.stats()
+        st.sidebar.caption(
+            f"カセット（{cassette.mode}）: 再生 {stats['hits']}回・記録 {stats['recorded']}件・未記録 {stats['misses']}回"
+        )
+    context_budget = setup_context_budget()
+    if context_budget is not None:
+        st.sidebar.caption(f"受け渡しの予算: 1ステップ {context_budget.step_tokens}トークン（{context_budget.strategy}）")
+    flight_stats = get_registry().singleflight.stats()
+    if flight_stats["shared"]:
+        st.sidebar.caption(f"同時実行の共有: {flight_stats['shared']}回の呼び出しを省略（最大待機 {flight_stats['max_waiters']}件）")
+    
+    run_store = setup_run_store()
+    replay = None
+    if run_store is not None:
+        st.sidebar.markdown("### 実行履歴")
+        keyword = st.sidebar.text_input("履歴を検索（質問・回答）", value="")
+        runs = run_store.search(keyword, limit=50)
+        if runs:
+            selected = st.sidebar.selectbox(
+                # 全件の件数は数えない（件数が増えても再実行のたびにCOUNT(*)を走らせない）
+                f"過去の実行（新しい順に{len(runs)}件）",
+                runs,
+                format_func=lambda run: (
+                    f"{time.strftime('%m/%d %H:%M', time.localtime(run.created_at))} {run.pattern}: {run.question[:30]}"
+                )
+            )
+            if st.sidebar.button("再表示（LLMを呼び出さない）"):
+                replay = run_store.get(selected.id)
+    if replay is not None:
+        display_replay(replay, pattern_descriptions)
+        return
+
     # 入力エリア（選択されたパターンの例を初期値として設定）
     st.markdown("## 入力フォーム")
     question = st.text_area(
@@ -369,9 +977,22 @@ def main():
         height=100
     )
 
+    if compare:
+        if st.button("実行", disabled=not compared_patterns):
+            display_comparison(AIPatternDemo(), pattern_descriptions, compared_patterns, question, max_workers, run_store)
+        return
+
+    if job_queue is not None:
+        # 同じ内容のジョブが実行中・完了済みならそのジョブを表示する
+        if st.button("実行"):
+            st.session_state["job_id"] = job_queue.submit(pattern_descriptions[pattern]["runner"], question)
+        if st.session_state.get("job_id"):
+            display_job(job_queue, st.session_state["job_id"], pattern_descriptions, metrics_config)
+        return
+
     # パターン選択時にステータス表示を初期化
     if pattern:
-        step_progress = StepProgress(pattern_descriptions[pattern]["steps"])
+        step_progress = StepProgress(list(pattern_descriptions[pattern]["steps"].values()))
         # 初期状態を表示
         st.markdown("### 実行中の処理ステップ")
         status_container = st.empty()
@@ -380,142 +1001,28 @@ def main():
     # 実行ボタン
     if st.button("実行"):
         demo = AIPatternDemo()
+        executor = PatternExecutor(
+            demo, step_progress, status_container, pattern_descriptions[pattern]["steps"]
+        )
         
-        with st.spinner("AIが考えています..."):
+        with st.spinner("AIが考えています..."), use_budget(create_run_budget()) as budget:
             try:
-                if pattern == "シンプルな質問応答":
-                    step_progress.update_status("問題分析", StepStatus.PROCESSING)
-                    display_progress(step_progress, status_container)
-                    result = demo.direct_query(question)
-                    step_progress.update_status("問題分析", StepStatus.COMPLETED)
-                    display_progress(step_progress, status_container)
-                    
-                    step_progress.update_status("回答生成", StepStatus.PROCESSING)
-                    display_progress(step_progress, status_container)
-                    step_progress.update_status("回答生成", StepStatus.COMPLETED)
-                    display_progress(step_progress, status_container)
-                    format_response(result, pattern)
-                
-                elif pattern == "段階的思考（Chain of Thought）":
-                    step_progress.update_status("問題分析", StepStatus.PROCESSING)
-                    display_progress(step_progress, status_container)
-                    step_progress.update_status("問題分析", StepStatus.COMPLETED)
-                    display_progress(step_progress, status_container)
-
-                    step_progress.update_status("思考プロセス構築", StepStatus.PROCESSING)
-                    display_progress(step_progress, status_container)
-                    step_progress.update_status("思考プロセス構築", StepStatus.COMPLETED)
-                    display_progress(step_progress, status_container)
-
-                    step_progress.update_status("段階的推論", StepStatus.PROCESSING)
-                    display_progress(step_progress, status_container)
-                    step_progress.update_status("段階的推論", StepStatus.COMPLETED)
-                    display_progress(step_progress, status_container)
-
-                    step_progress.update_status("回答生成", StepStatus.PROCESSING)
-                    display_progress(step_progress, status_container)
-                    result = demo.chain_of_thought(question)
-                    step_progress.update_status("回答生成", StepStatus.COMPLETED)
-                    display_progress(step_progress, status_container)
-                    format_response(result, pattern)
-                
-                elif pattern == "構造化推論":
-                    step_progress.update_status("前提条件分析", StepStatus.PROCESSING)
-                    display_progress(step_progress, status_container)
-                    step_progress.update_status("前提条件分析", StepStatus.COMPLETED)
-                    display_progress(step_progress, status_container)
-
-                    step_progress.update_status("データ処理", StepStatus.PROCESSING)
-                    display_progress(step_progress, status_container)
-                    step_progress.update_status("データ処理", StepStatus.COMPLETED)
-                    display_progress(step_progress, status_container)
-
-                    step_progress.update_status("推論実行", StepStatus.PROCESSING)
-                    display_progress(step_progress, status_container)
-                    result = demo.direct_reasoning(question)
-                    step_progress.update_status("推論実行", StepStatus.COMPLETED)
-                    display_progress(step_progress, status_container)
-                    format_response(result, pattern)
-                
-                elif pattern == "連鎖推論":
-                    step_progress.update_status("問題分解", StepStatus.PROCESSING)
-                    display_progress(step_progress, status_container)
-                    decomposition = demo.chained_reasoning(question)["decomposition"]
-                    step_progress.update_status("問題分解", StepStatus.COMPLETED)
-                    display_progress(step_progress, status_container)
-                    
-                    step_progress.update_status("データ分析", StepStatus.PROCESSING)
-                    display_progress(step_progress, status_container)
-                    data_analysis = demo.chained_reasoning(question)["data_analysis"]
-                    step_progress.update_status("データ分析", StepStatus.COMPLETED)
-                    display_progress(step_progress, status_container)
-                    
-                    step_progress.update_status("仮定設定", StepStatus.PROCESSING)
-                    display_progress(step_progress, status_container)
-                    assumptions = demo.chained_reasoning(question)["assumptions"]
-                    step_progress.update_status("仮定設定", StepStatus.COMPLETED)
-                    display_progress(step_progress, status_container)
-                    
-                    step_progress.update_status("推論実行", StepStatus.PROCESSING)
-                    display_progress(step_progress, status_container)
-                    final_result = demo.chained_reasoning(question)["final_result"]
-                    step_progress.update_status("推論実行", StepStatus.COMPLETED)
-                    display_progress(step_progress, status_container)
-                    format_response(final_result, pattern)
-                
-                elif pattern == "生成と評価の繰り返し":
-                    step_progress.update_status("初期回答生成", StepStatus.PROCESSING)
-                    display_progress(step_progress, status_container)
-                    initial_response = demo.evaluator_optimizer_workflow(question)["response"]
-                    step_progress.update_status("初期回答生成", StepStatus.COMPLETED)
-                    display_progress(step_progress, status_container)
-                    
-                    step_progress.update_status("評価", StepStatus.PROCESSING)
-                    display_progress(step_progress, status_container)
-                    evaluation = demo.evaluator_optimizer_workflow(question)["evaluation"]
-                    step_progress.update_status("評価", StepStatus.COMPLETED)
-                    display_progress(step_progress, status_container)
-                    
-                    step_progress.update_status("最適化", StepStatus.PROCESSING)
-                    display_progress(step_progress, status_container)
-                    optimized_response = demo.evaluator_optimizer_workflow(question)["optimized_response"]
-                    step_progress.update_status("最適化", StepStatus.COMPLETED)
-                    display_progress(step_progress, status_container)
-                    
-                    format_response(optimized_response, pattern)
-                
-                elif pattern == "ディベートベースの協調":
-                    step_progress.update_status("ディベートの準備", StepStatus.PROCESSING)
-                    display_progress(step_progress, status_container)
-                    step_progress.update_status("ディベートの準備", StepStatus.COMPLETED)
-                    display_progress(step_progress, status_container)
-
-                    step_progress.update_status("革新的な意見の生成", StepStatus.PROCESSING)
-                    display_progress(step_progress, status_container)
-                    step_progress.update_status("革新的な意見の生成", StepStatus.COMPLETED)
-                    display_progress(step_progress, status_container)
-
-                    step_progress.update_status("保守的な反論の生成", StepStatus.PROCESSING)
-                    display_progress(step_progress, status_container)
-                    step_progress.update_status("保守的な反論の生成", StepStatus.COMPLETED)
-                    display_progress(step_progress, status_container)
-
-                    step_progress.update_status("革新的な再反論の生成", StepStatus.PROCESSING)
-                    display_progress(step_progress, status_container)
-                    step_progress.update_status("革新的な再反論の生成", StepStatus.COMPLETED)
-                    display_progress(step_progress, status_container)
-
-                    step_progress.update_status("保守的な最終反論の生成", StepStatus.PROCESSING)
-                    display_progress(step_progress, status_container)
-                    step_progress.update_status("保守的な最終反論の生成", StepStatus.COMPLETED)
-                    display_progress(step_progress, status_container)
-
-                    step_progress.update_status("合意形成", StepStatus.PROCESSING)
-                    display_progress(step_progress, status_container)
-                    result = demo.debate_based_cooperation(question)
-                    step_progress.update_status("合意形成", StepStatus.COMPLETED)
-                    display_progress(step_progress, status_container)
+                # 各パターンは1回だけ実行し、ステップの進捗はモデル層からの通知で更新する
+                runner = pattern_descriptions[pattern]["runner"]
+                if streaming and pattern_descriptions[pattern].get("stream", True):
+                    step_labels = pattern_descriptions[pattern]["steps"]
+                    result = format_streaming_response(
+                        executor.stream(runner, question),
+                        step_labels,
+                        pattern_descriptions[pattern].get("final_step", list(step_labels)[-1])
+                    )
+                else:
+                    result = executor.run(runner, question)
                     format_response(result, pattern)
+                display_budget(budget)
+                display_trace(executor.trace, pattern_descriptions[pattern]["steps"], metrics_config)
+                if run_store is not None:
+                    run_store.record(runner, question, {**executor.outputs, **result}, executor.trace, executor.outputs)
             
             except Exception as e:
                 st.error(f"エラーが発生しました: {str(e)}")
@@ -0,0 +1,154 @@
+"""複数の質問をまとめて1つのパターンで実行するバッチ処理
+
+使い方:
+    python -m src.batch chained_reasoning questions.jsonl --output results.jsonl --concurrency 16
+"""
+from dataclasses import dataclass, asdict
+from typing import TYPE_CHECKING, Dict, Any, List, Optional, Tuple
+import argparse
+import asyncio
+import json
+import sys
+from .cache import SQLiteResponseCache
+from .config import CassetteConfig, GeminiConfig
+from .context_budget import create_context_budget
+from .metrics import METRICS
+from .rate_limit import create_rate_limiter, create_retry_policy
+from .registry import get_registry
+
+if TYPE_CHECKING:
+    from .models import BatchOutput
+
+# パターン名 → (パターンのクラス名, バッチ実行メソッド名)
+# クラスは実行時にレジストリが読み込むため、--helpや引数の検証だけならパターンのモジュールを読み込まない
+BATCH_PATTERNS: Dict[str, Tuple[str, str]] = {
+    "direct_query": ("DirectQuery", "batch_answer"),
+    "chain_of_thought": ("GeminiChainOfThought", "batch_solve_problem"),
+    "direct_reasoning": ("GeminiReasoning", "batch_direct_reasoning"),
+    "chained_reasoning": ("GeminiReasoning", "batch_chained_reasoning"),
+    "evaluator_optimizer": ("EvaluatorOptimizer", "batch_optimized_response"),
+    "debate_based_cooperation": ("DebateBasedCooperation", "batch_debate_response"),
+}
+
+@dataclass
+class BatchResult:
+    """バッチ内の1件分の結果"""
+    index: int
+    question: str
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[str] = None
+
+def _to_results(questions: List[str], outputs: List["BatchOutput"]) -> List[BatchResult]:
+    """パターンの出力を入力順のBatchResultに変換"""
+    return [
+        BatchResult(index=i, question=question, error=f"{type(output).__name__}: {output}")
+        if isinstance(output, Exception)
+        else BatchResult(index=i, question=question, result=output)
+        for i, (question, output) in enumerate(zip(questions, outputs))
+    ]
+
+def _get_runner(pattern: str, config: Optional[GeminiConfig], prefix: str = ""):
+    """パターン名からバッチ実行メソッドを取得"""
+    if pattern not in BATCH_PATTERNS:
+        raise ValueError(f"未対応のパターンです: {pattern}（{', '.join(BATCH_PATTERNS)}）")
+    pattern_class, method = BATCH_PATTERNS[pattern]
+    return getattr(get_registry().get_pattern(pattern_class, config), prefix + method)
+
+def run_batch(
+    pattern: str,
+    questions: List[str],
+    max_concurrency: int = 8,
+    config: Optional[GeminiConfig] = None
+) -> List[BatchResult]:
+    """質問リストをパターンで一括実行し、入力順の結果を返す
+
+    各ステップは全質問分をまとめて最大max_concurrency並列で実行する。
+    失敗した質問はerrorに理由を記録し、バッチ全体は止めない。
+    """
+    outputs = _get_runner(pattern, config)(questions, max_concurrency)
+    return _to_results(questions, outputs)
+
+async def arun_batch(
+    pattern: str,
+    questions: List[str],
+    max_concurrency: int = 8,
+    config: Optional[GeminiConfig] = None
+) -> List[BatchResult]:
+    """run_batchの非同期版"""
+    outputs = await _get_runner(pattern, config, prefix="a")(questions, max_concurrency)
+    return _to_results(questions, outputs)
+
+def load_questions(path: str) -> List[str]:
+    """JSONL（{"question": ...}または文字列）かテキスト（1行1問）から質問を読み込む"""
+    questions = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith(".jsonl"):
+                record = json.loads(line)
+                questions.append(record["question"] if isinstance(record, dict) else str(record))
+            else:
+                questions.append(line)
+    return questions
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """バッチ処理のCLIエントリーポイント"""
+    parser = argparse.ArgumentParser(description="複数の質問をまとめてパターンで実行します")
+    parser.add_argument("pattern", choices=list(BATCH_PATTERNS), help="実行するパターン")
+    parser.add_argument("input", help="質問ファイル（.jsonlまたは1行1問のテキスト）")
+    parser.add_argument("--output", help="結果を書き出すJSONLファイル（省略時は標準出力）")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時に実行する呼び出しの上限")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="asyncio（abatch）で実行する")
+    parser.add_argument("--cache", help="応答キャッシュのSQLiteファイル（同じプロンプトの再実行を省く）")
+    parser.add_argument("--metrics", help="ステップごとの計測値をPrometheusのテキスト形式で書き出すファイル")
+    parser.add_argument("--cassette", help="呼び出しを記録・再生するカセットファイル（省略時はCASSETTE_MODE・CASSETTE_PATH）")
+    parser.add_argument("--cassette-mode", choices=["record", "replay"], default="replay", help="--cassetteのモード")
+    parser.add_argument("--replay-latency", action="store_true", help="再生時に記録時の待ち時間を再現する")
+    args = parser.parse_args(argv)
+
+    registry = get_registry()
+    config = CassetteConfig()
+    if args.cassette:
+        config = CassetteConfig(mode=args.cassette_mode, path=args.cassette, replay_latency=args.replay_latency)
+    cassette = None
+    if config.mode != "off":
+        # カセットはLangChainのモデル層を読み込むため、使うときだけ読み込む
+        from .cassette import create_cassette
+        cassette = create_cassette(config)
+        registry.set_llm_factory(cassette.llm_factory())
+    # 再生はネットワークを使わないため、レート制限を掛けずに全速で実行する
+    replaying = cassette is not None and cassette.mode == "replay"
+    registry.set_rate_limiter(None if replaying else create_rate_limiter())
+    registry.set_retry_policy(create_retry_policy())
+    registry.set_context_budget(create_context_budget())
+    if args.cache:
+        registry.set_response_cache(SQLiteResponseCache(args.cache))
+
+    questions = load_questions(args.input)
+    if args.use_async:
+        results = asyncio.run(arun_batch(args.pattern, questions, args.concurrency))
+    else:
+        results = run_batch(args.pattern, questions, args.concurrency)
+
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for result in results:
+            out.write(json.dumps({"pattern": args.pattern, **asdict(result)}, ensure_ascii=False) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    if args.metrics:
+        METRICS.write(args.metrics)
+    if cassette is not None:
+        cassette.close()
+        print(f"カセット: {cassette.stats()}", file=sys.stderr)
+
+    failed = sum(1 for result in results if result.error)
+    print(f"{len(results)}件中{len(results) - failed}件成功、{failed}件失敗", file=sys.stderr)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,255 @@
+"""フェイクのLLMでパターンの性能を計測するベンチマーク（ネットワーク不要）
+
+使い方:
+    python -m src.benchmark --questions 32 --concurrency 1 4 16 --ttft 0.05 --tokens-per-second 200
+    python -m src.benchmark --imports  # 起動時のimport時間（python -X importtime）を計測
+"""
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+import argparse
+import gc
+import json
+import os
+import subprocess
+import sys
+import time
+from .fake_llm import FakeChatModel, LATENCY_DISTRIBUTIONS
+from .registry import get_registry
+
+# パターン名 → (パターンのクラス名, 1問を実行するメソッド名)
+BENCHMARK_PATTERNS: Dict[str, Tuple[str, str]] = {
+    "direct_query": ("DirectQuery", "answer"),
+    "chain_of_thought": ("GeminiChainOfThought", "solve_problem"),
+    "direct_reasoning": ("GeminiReasoning", "direct_reasoning"),
+    "chained_reasoning": ("GeminiReasoning", "chained_reasoning"),
+    "evaluator_optimizer": ("EvaluatorOptimizer", "generate_optimized_response"),
+    "debate_based_cooperation": ("DebateBasedCooperation", "generate_debate_response"),
+}
+
+# 起動時間を計測するモジュール → (import時間の上限ミリ秒, 読み込んではいけない依存)
+# UIのStreamlitとGeminiのSDKは使うときまで読み込まない。パターンの定義（src.models）はLangChainとnumpyも読み込まない。
+# 上限は計測値（src.modelsは約180ms）の2倍弱とし、遅いCI環境でも超えない程度に余裕を持たせている
+IMPORT_TARGETS: Dict[str, Tuple[float, Tuple[str, ...]]] = {
+    "src": (100.0, ("streamlit", "langchain_google_genai", "langchain_core", "src.models")),
+    "src.batch": (1000.0, ("streamlit", "langchain_google_genai", "numpy", "src.models")),
+    "src.models": (350.0, ("streamlit", "langchain_google_genai", "langchain_core", "numpy")),
+}
+
+_PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@dataclass
+class BenchmarkResult:
+    """1パターン・1並列度分の計測結果"""
+    pattern: str
+    concurrency: int
+    questions: int
+    llm_calls: int
+    calls_per_question: float
+    # 1呼び出しあたりのフレームワークのオーバーヘッド（フェイクの待ち時間を除いた時間）
+    overhead_per_call_ms: float
+    p50_ms: float
+    p90_ms: float
+    p99_ms: float
+    qps: float
+    # 例外で終わった質問の数
+    errors: int = 0
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """線形補間によるパーセンタイル（qは0〜100）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+def run_benchmark(
+    pattern: str,
+    questions: List[str],
+    concurrency: int = 1,
+    llm_factory: Optional[Callable[[], FakeChatModel]] = None
+) -> BenchmarkResult:
+    """質問をconcurrency並列で1問ずつ実行し、呼び出し回数とレイテンシを計測
+
+    計測中はキャッシュ・レート制限・LLMファクトリを差し替え、終了後に呼び出し元の設定へ戻す。
+    """
+    if pattern not in BENCHMARK_PATTERNS:
+        raise ValueError(f"未対応のパターンです: {pattern}（{', '.join(BENCHMARK_PATTERNS)}）")
+    llm = (llm_factory or FakeChatModel)()
+    registry = get_registry()
+    saved = (registry.response_cache, registry.semantic_cache, registry.rate_limiter, registry.llm_factory)
+    registry.set_response_cache(None)
+    registry.set_semantic_cache(None)
+    registry.set_rate_limiter(None)
+    registry.set_llm_factory(lambda config: llm)
+    try:
+        pattern_class, method = BENCHMARK_PATTERNS[pattern]
+        runner = getattr(registry.get_pattern(pattern_class), method)
+        errors = []
+
+        def timed(question: str) -> float:
+            start = time.perf_counter()
+            try:
+                runner(question)
+            except Exception as e:
+                errors.append(e)
+            return time.perf_counter() - start
+
+        # timeitと同じく計測中はGCを止める（世代2のGCの停止時間が短いレイテンシの計測に混ざるため）
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                latencies = list(pool.map(timed, questions))
+            elapsed = time.perf_counter() - start
+        finally:
+            gc.enable()
+    finally:
+        registry.set_llm_factory(saved[3])
+        registry.set_response_cache(saved[0])
+        registry.set_semantic_cache(saved[1])
+        registry.set_rate_limiter(saved[2])
+
+    calls = llm.calls
+    overhead = (sum(latencies) - llm.simulated_seconds) / calls if calls else 0.0
+    return BenchmarkResult(
+        pattern=pattern,
+        concurrency=concurrency,
+        questions=len(questions),
+        llm_calls=calls,
+        calls_per_question=calls / len(questions) if questions else 0.0,
+        overhead_per_call_ms=max(overhead, 0.0) * 1000,
+        p50_ms=percentile(latencies, 50) * 1000,
+        p90_ms=percentile(latencies, 90) * 1000,
+        p99_ms=percentile(latencies, 99) * 1000,
+        qps=len(questions) / elapsed if elapsed else 0.0,
+        errors=len(errors),
+    )
+
+def run_suite(
+    patterns: Sequence[str],
+    concurrency_levels: Sequence[int],
+    num_questions: int = 16,
+    llm_factory: Optional[Callable[[], FakeChatModel]] = None
+) -> List[BenchmarkResult]:
+    """パターンと並列度の全組み合わせを計測"""
+    # 同時実行の共有でまとめられないよう、質問はすべて異なるものにする
+    questions = [f"ベンチマーク用の質問{i}" for i in range(num_questions)]
+    return [
+        run_benchmark(pattern, questions, concurrency, llm_factory)
+        for pattern in patterns
+        for concurrency in concurrency_levels
+    ]
+
+@dataclass
+class ImportProfile:
+    """1モジュール分のimport時間の計測結果"""
+    module: str
+    # 新しいプロセスでimportするまでの時間（依存の読み込みを含む）
+    total_ms: float
+    # 依存を含めた読み込み時間が長い順のモジュール
+    slowest: List[Tuple[str, float]]
+    # 読み込まれた依存のうち、読み込んではいけないもの
+    unexpected: List[str]
+
+def measure_import_time(module: str, forbidden: Sequence[str] = (), repeat: int = 3, top: int = 5) -> ImportProfile:
+    """新しいプロセスで`python -X importtime`を実行してimport時間を計測（repeat回のうち最短の回を使う）"""
+    best: Optional[ImportProfile] = None
+    for _ in range(repeat):
+        completed = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+            cwd=_PROJECT_ROOT, capture_output=True, text=True, check=True
+        )
+        # 各行は "import time: 自身[us] | 依存を含む[us] | モジュール名"（依存は字下げされ、親より先に出る）
+        cumulative: Dict[str, float] = {}
+        for line in completed.stderr.splitlines():
+            fields = line.removeprefix("import time:").split("|")
+            if len(fields) != 3 or not fields[1].strip().isdigit():
+                continue
+            if fields[2] == " site":
+                # ここまではインタープリタの起動時の読み込み
+                cumulative.clear()
+                continue
+            cumulative[fields[2].strip()] = int(fields[1]) / 1000
+        profile = ImportProfile(
+            module=module,
+            total_ms=cumulative.get(module, 0.0),
+            slowest=sorted(
+                ((name, ms) for name, ms in cumulative.items() if name != module), key=lambda item: -item[1]
+            )[:top],
+            unexpected=[
+                dep for dep in forbidden
+                if any(name == dep or name.startswith(dep + ".") for name in cumulative)
+            ],
+        )
+        if best is None or profile.total_ms < best.total_ms:
+            best = profile
+    return best
+
+def import_problems(profile: ImportProfile, budget_ms: float) -> List[str]:
+    """import時間の上限超過と、読み込んではいけない依存の説明（問題がなければ空）"""
+    problems = []
+    if profile.unexpected:
+        problems.append(f"{profile.module}: {', '.join(profile.unexpected)}を読み込んでいます")
+    if profile.total_ms > budget_ms:
+        problems.append(f"{profile.module}: import時間 {profile.total_ms:.0f}ms が上限 {budget_ms:.0f}ms を超えています")
+    return problems
+
+def format_table(results: List[BenchmarkResult]) -> str:
+    """結果を表形式の文字列にする"""
+    header = f"{'pattern':<26}{'conc':>5}{'calls/q':>9}{'ovh/call ms':>13}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'qps':>9}{'errors':>8}"
+    lines = [header, "-" * len(header)]
+    for r in results:
+        lines.append(
+            f"{r.pattern:<26}{r.concurrency:>5}{r.calls_per_question:>9.1f}{r.overhead_per_call_ms:>13.2f}"
+            f"{r.p50_ms:>9.1f}{r.p90_ms:>9.1f}{r.p99_ms:>9.1f}{r.qps:>9.1f}{r.errors:>8}"
+        )
+    return "\n".join(lines)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """ベンチマークのCLIエントリーポイント"""
+    parser = argparse.ArgumentParser(description="フェイクのLLMでパターンの性能を計測します")
+    parser.add_argument("--patterns", nargs="+", default=list(BENCHMARK_PATTERNS), choices=list(BENCHMARK_PATTERNS))
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16], help="計測する並列度")
+    parser.add_argument("--questions", type=int, default=16, help="1回の計測で実行する質問数")
+    parser.add_argument("--ttft", type=float, default=0.05, help="最初のトークンまでの平均秒数")
+    parser.add_argument("--distribution", default="lognormal", choices=LATENCY_DISTRIBUTIONS)
+    parser.add_argument("--tokens-per-second", type=float, default=200.0)
+    parser.add_argument("--output-tokens", type=int, default=32)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--json", dest="json_path", help="結果をJSONで書き出すファイル")
+    parser.add_argument("--imports", action="store_true", help="パターンの代わりに起動時のimport時間を計測する")
+    args = parser.parse_args(argv)
+
+    if args.imports:
+        problems = []
+        for module, (budget_ms, forbidden) in IMPORT_TARGETS.items():
+            profile = measure_import_time(module, forbidden)
+            slowest = ", ".join(f"{name} {ms:.0f}ms" for name, ms in profile.slowest)
+            print(f"{module:<12}{profile.total_ms:>8.1f}ms (上限 {budget_ms:.0f}ms)  {slowest}")
+            problems += import_problems(profile, budget_ms)
+        for problem in problems:
+            print(problem, file=sys.stderr)
+        return 1 if problems else 0
+
+    def factory() -> FakeChatModel:
+        return FakeChatModel(
+            ttft=args.ttft,
+            latency_distribution=args.distribution,
+            tokens_per_second=args.tokens_per_second,
+            output_tokens=args.output_tokens,
+            failure_rate=args.failure_rate,
+        )
+
+    results = run_suite(args.patterns, args.concurrency, args.questions, factory)
+    print(format_table(results))
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump([asdict(r) for r in results], f, ensure_ascii=False, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,207 @@
+from typing import Dict, Optional
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from .config import CacheConfig, GeminiConfig
+
+def prompt_hash(prompt: str) -> str:
+    """展開済みプロンプトのハッシュ"""
+    return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+def response_cache_key(config: GeminiConfig, prompt: str) -> str:
+    """モデル名・サンプリング設定・プロンプトのハッシュからキャッシュキーを作成"""
+    params = {
+        "model": config.model_name,
+        "temperature": config.temperature,
+        "top_p": config.top_p,
+        "top_k": config.top_k,
+        "max_output_tokens": config.max_output_tokens,
+        "candidate_count": config.candidate_count,
+        "stop_sequences": list(config.stop_sequences or []),
+        "prompt": prompt_hash(prompt),
+    }
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """LLM応答キャッシュのインターフェース
+
+    バックエンドを差し替える場合はlookup/update/clearを実装する。
+    """
+    def __init__(self, cache_sampled: bool = True):
+        # Falseにするとtemperature>0の呼び出しはキャッシュしない
+        self.cache_sampled = cache_sampled
+        self.hits = 0
+        self.misses = 0
+
+    def accepts(self, config: GeminiConfig) -> bool:
+        """この設定での呼び出しをキャッシュするか"""
+        return self.cache_sampled or config.temperature == 0
+
+    def lookup(self, key: str) -> Optional[str]:
+        """キャッシュ済みの応答を取得（なければNone）"""
+        raise NotImplementedError
+
+    def update(self, key: str, response: str, model: str = "") -> None:
+        """応答をキャッシュに保存"""
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        """キャッシュをすべて削除"""
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, float]:
+        """ヒット・ミスの統計"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+class SQLiteResponseCache(ResponseCache):
+    """SQLiteに保存する永続応答キャッシュ
+
+    ttl秒を過ぎたエントリはミス扱いで削除し、max_entriesを超えたら最終アクセスが古い順に削除する。
+    ヒットのたびに書き込まないよう、最終アクセスの更新はtouch_batch件またはtouch_interval秒ごと
+    （と保存のとき）にまとめて書き込む。
+    """
+    def __init__(
+        self,
+        path: str = ".cache/responses.sqlite3",
+        ttl: Optional[float] = None,
+        max_entries: Optional[int] = 100_000,
+        cache_sampled: bool = True,
+        touch_batch: int = 100,
+        touch_interval: float = 5.0
+    ):
+        super().__init__(cache_sampled)
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.touch_batch = touch_batch
+        self.touch_interval = touch_interval
+        self.evictions = 0
+        self.expirations = 0
+        self._lock = threading.Lock()
+        # まだ書き込んでいない最終アクセス（キー → 時刻）
+        self._touched: Dict[str, float] = {}
+        self._flushed_at = time.time()
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        if path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses(accessed_at)")
+        self._conn.commit()
+        self._size = self._count()
+
+    def _count(self) -> int:
+        """DB上のエントリ数（他のプロセスの書き込みも含む）"""
+        return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def _write_touches(self, now: float) -> None:
+        """溜めた最終アクセスを書き込む（コミットは呼び出し側）"""
+        if self._touched:
+            # 他のプロセスが書いたより新しい時刻は戻さない
+            self._conn.executemany(
+                "UPDATE responses SET accessed_at = MAX(accessed_at, ?) WHERE key = ?",
+                [(accessed_at, key) for key, accessed_at in self._touched.items()]
+            )
+            self._touched.clear()
+        self._flushed_at = now
+
+    def lookup(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                self._size -= self._conn.execute("DELETE FROM responses WHERE key = ?", (key,)).rowcount
+                self._touched.pop(key, None)
+                self._conn.commit()
+                self.expirations += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._touched[key] = now
+            if len(self._touched) >= self.touch_batch or now - self._flushed_at >= self.touch_interval:
+                self._write_touches(now)
+                self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def update(self, key: str, response: str, model: str = "") -> None:
+        now = time.time()
+        with self._lock:
+            # 削除する順が最終アクセスに沿うよう、溜めた最終アクセスを先に書き込む
+            self._write_touches(now)
+            self._touched.pop(key, None)
+            updated = self._conn.execute(
+                "UPDATE responses SET response = ?, created_at = ?, accessed_at = ? WHERE key = ?",
+                (response, now, now, key)
+            ).rowcount
+            if not updated:
+                self._conn.execute(
+                    "INSERT INTO responses (key, model, response, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, model, response, now, now)
+                )
+                # 他のプロセスも同じファイルに書き込むため、件数は数え直す
+                self._size = self._count()
+            if self.max_entries is not None and self._size > self.max_entries:
+                # 最終アクセスが古いものから上限を超えた分だけ削除（LRU）
+                excess = self._size - self.max_entries
+                deleted = self._conn.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY accessed_at ASC LIMIT ?)",
+                    (excess,)
+                ).rowcount
+                self._size -= deleted
+                self.evictions += deleted
+            self._conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+            self._touched.clear()
+            self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def stats(self) -> Dict[str, float]:
+        stats = super().stats()
+        stats.update({
+            "entries": self._size,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        })
+        return stats
+
+def create_response_cache(config: Optional[CacheConfig] = None) -> Optional[ResponseCache]:
+    """設定から既定（SQLite）の応答キャッシュを作成（無効ならNone）"""
+    config = config or CacheConfig()
+    if not config.enabled:
+        return None
+    return SQLiteResponseCache(
+        path=config.path,
+        ttl=config.ttl,
+        max_entries=config.max_entries,
+        cache_sampled=config.cache_sampled
+    )
@@ -0,0 +1,293 @@
+"""Geminiとのやり取りを記録・再生するカセット（ネットワークなしで決定的に実行するため）
+
+記録モードでは実際のクライアントを包み、呼び出しごとに展開済みのプロンプト・モデル設定・応答・
+ストリーミングのチャンクの間隔をカセットファイルに追記する。再生モードでは同じ設定・プロンプトの
+呼び出しに記録した応答を返す（既定では待ち時間なし、replay_latencyで記録時の待ち時間を再現）。
+
+カセットは1行1呼び出しの「キー<TAB>JSON」形式で、再生時はファイルをメモリマップしてキーの索引だけを作り、
+応答は使うときに読み込む。同じキーの記録が複数あれば記録した順に返す（評価の繰り返しなどで同じプロンプトを
+何度も呼ぶ場合のため）。
+
+    cassette = Cassette(".cache/cassette.jsonl", mode="record")
+    get_registry().set_llm_factory(cassette.llm_factory())
+"""
+from dataclasses import asdict
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+import asyncio
+import json
+import mmap
+import os
+import threading
+import time
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from .cache import response_cache_key
+from .config import CassetteConfig, GeminiConfig
+from .registry import LLMFactory, create_gemini_llm
+
+CASSETTE_MODES = ("record", "replay")
+
+class CassetteMissError(KeyError):
+    """再生モードでカセットに記録のない呼び出しがあった"""
+
+def _prompt(messages: List[BaseMessage]) -> str:
+    """チャットモデルに渡されたメッセージを展開済みのプロンプトにする"""
+    return "\n".join(str(message.content) for message in messages)
+
+class Cassette:
+    """呼び出しの記録を追記・検索するカセットファイル（スレッドセーフ）"""
+    def __init__(self, path: str, mode: str = "replay", replay_latency: bool = False):
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"未対応のカセットのモードです: {mode}（{', '.join(CASSETTE_MODES)}）")
+        self.path = path
+        self.mode = mode
+        self.replay_latency = replay_latency
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+        self._lock = threading.Lock()
+        # キー → 記録の(開始位置, 終了位置)の一覧
+        self._index: Dict[str, List[Tuple[int, int]]] = {}
+        # キー → 次に返す記録の番号
+        self._cursors: Dict[str, int] = {}
+        self._file = None
+        self._map: Optional[mmap.mmap] = None
+        if mode == "record":
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            self._file = open(path, "a", encoding="utf-8")
+        else:
+            self._load()
+
+    def _load(self) -> None:
+        """カセットをメモリマップし、各行の先頭のキーから索引を作る"""
+        with open(self.path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        start = 0
+        size = len(self._map)
+        while start < size:
+            end = self._map.find(b"\n", start)
+            end = size if end < 0 else end
+            tab = self._map.find(b"\t", start, end)
+            if tab > start:
+                key = self._map[start:tab].decode("ascii")
+                self._index.setdefault(key, []).append((tab + 1, end))
+            start = end + 1
+
+    def key(self, config: GeminiConfig, prompt: str) -> str:
+        """モデル設定とプロンプトから記録のキーを作る（応答キャッシュと同じキー）"""
+        return response_cache_key(config, prompt)
+
+    def lookup(self, key: str) -> Dict[str, Any]:
+        """キーの記録を記録した順に返す（最後まで返したら最初に戻る）"""
+        with self._lock:
+            entries = self._index.get(key)
+            if not entries:
+                self.misses += 1
+                raise CassetteMissError(f"カセット{self.path}に記録のない呼び出しです（キー {key[:12]}…）")
+            position = self._cursors.get(key, 0)
+            self._cursors[key] = position + 1
+            self.hits += 1
+        start, end = entries[position % len(entries)]
+        return json.loads(self._map[start:end].decode("utf-8"))
+
+    def record(self, key: str, entry: Dict[str, Any]) -> None:
+        """呼び出しの記録を追記する"""
+        line = f"{key}\t{json.dumps(entry, ensure_ascii=False)}\n"
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            self.recorded += 1
+
+    def llm_factory(self, inner: Optional[LLMFactory] = None) -> LLMFactory:
+        """registryに渡すLLMファクトリ（記録モードではinnerで作った実際のクライアントを包む）"""
+        def create(config: GeminiConfig) -> "CassetteChatModel":
+            upstream = (inner or create_gemini_llm)(config) if self.mode == "record" else None
+            return CassetteChatModel(cassette=self, config=config, inner=upstream)
+        return create
+
+    def __len__(self) -> int:
+        return sum(len(entries) for entries in self._index.values())
+
+    def stats(self) -> Dict[str, int]:
+        """再生のヒット・ミスと記録した件数"""
+        return {"entries": len(self), "hits": self.hits, "misses": self.misses, "recorded": self.recorded}
+
+    def close(self) -> None:
+        """ファイルとメモリマップを閉じる"""
+        if self._file is not None:
+            self._file.close()
+        if self._map is not None:
+            self._map.close()
+
+class CassetteChatModel(BaseChatModel):
+    """カセットに記録しながら実際のクライアントを呼ぶ、またはカセットから再生するチャットモデル"""
+    cassette: Any
+    config: Any
+    # 記録モードで実際に呼び出すクライアント（再生モードではNone）
+    inner: Optional[Any] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "cassette-chat-model"
+
+    def _entry(
+        self,
+        prompt: str,
+        texts: List[str],
+        usage: Optional[Dict[str, int]],
+        duration: float,
+        chunks: Optional[List[Tuple[float, str]]] = None
+    ) -> Dict[str, Any]:
+        """1回の呼び出しの記録"""
+        return {
+            "model": self.config.model_name,
+            "config": asdict(self.config),
+            "prompt": prompt,
+            "responses": texts,
+            "usage": usage,
+            "duration": duration,
+            # ストリーミングで記録した場合の[前のチャンクからの秒数, テキスト]の列
+            "chunks": chunks,
+        }
+
+    def _record_result(self, prompt: str, result: ChatResult, duration: float) -> None:
+        texts = [generation.text for generation in result.generations]
+        usage = getattr(result.generations[0].message, "usage_metadata", None) if result.generations else None
+        self.cassette.record(self.cassette.key(self.config, prompt), self._entry(prompt, texts, usage, duration))
+
+    def _replay(self, messages: List[BaseMessage]) -> Dict[str, Any]:
+        return self.cassette.lookup(self.cassette.key(self.config, _prompt(messages)))
+
+    @staticmethod
+    def _result(entry: Dict[str, Any]) -> ChatResult:
+        return ChatResult(generations=[
+            ChatGeneration(message=AIMessage(content=text, usage_metadata=entry["usage"] if i == 0 else None))
+            for i, text in enumerate(entry["responses"])
+        ])
+
+    @staticmethod
+    def _replay_chunks(entry: Dict[str, Any]) -> List[Tuple[float, str]]:
+        """再生するチャンクの列（ストリーミングで記録していなければ全文を1チャンクで返す）"""
+        return entry["chunks"] or [(entry["duration"], entry["responses"][0])]
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any
+    ) -> ChatResult:
+        if self.inner is not None:
+            start = time.perf_counter()
+            result = self.inner._generate(messages, stop=stop, **kwargs)
+            self._record_result(_prompt(messages), result, time.perf_counter() - start)
+            return result
+        entry = self._replay(messages)
+        if self.cassette.replay_latency:
+            time.sleep(entry["duration"])
+        return self._result(entry)
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any
+    ) -> ChatResult:
+        if self.inner is not None:
+            start = time.perf_counter()
+            result = await self.inner._agenerate(messages, stop=stop, **kwargs)
+            self._record_result(_prompt(messages), result, time.perf_counter() - start)
+            return result
+        entry = self._replay(messages)
+        if self.cassette.replay_latency:
+            await asyncio.sleep(entry["duration"])
+        return self._result(entry)
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any
+    ) -> Iterator[ChatGenerationChunk]:
+        if self.inner is not None:
+            recorder = _StreamRecorder(self, _prompt(messages))
+            for chunk in self.inner._stream(messages, stop=stop, **kwargs):
+                recorder.add(chunk)
+                if run_manager:
+                    run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+            recorder.finish()
+            return
+        entry = self._replay(messages)
+        chunks = self._replay_chunks(entry)
+        for i, (delay, text) in enumerate(chunks):
+            if self.cassette.replay_latency:
+                time.sleep(delay)
+            chunk = _chunk(text, entry["usage"] if i == len(chunks) - 1 else None)
+            if run_manager:
+                run_manager.on_llm_new_token(text, chunk=chunk)
+            yield chunk
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        if self.inner is not None:
+            recorder = _StreamRecorder(self, _prompt(messages))
+            async for chunk in self.inner._astream(messages, stop=stop, **kwargs):
+                recorder.add(chunk)
+                if run_manager:
+                    await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+            recorder.finish()
+            return
+        entry = self._replay(messages)
+        chunks = self._replay_chunks(entry)
+        for i, (delay, text) in enumerate(chunks):
+            if self.cassette.replay_latency:
+                await asyncio.sleep(delay)
+            chunk = _chunk(text, entry["usage"] if i == len(chunks) - 1 else None)
+            if run_manager:
+                await run_manager.on_llm_new_token(text, chunk=chunk)
+            yield chunk
+
+class _StreamRecorder:
+    """ストリーミングのチャンクと間隔を集め、最後に1件の記録として追記する"""
+    def __init__(self, model: CassetteChatModel, prompt: str):
+        self.model = model
+        self.prompt = prompt
+        self.chunks: List[Tuple[float, str]] = []
+        self.message: Optional[AIMessageChunk] = None
+        self._start = self._last = time.perf_counter()
+
+    def add(self, chunk: ChatGenerationChunk) -> None:
+        now = time.perf_counter()
+        self.chunks.append((now - self._last, chunk.text))
+        self._last = now
+        self.message = chunk.message if self.message is None else self.message + chunk.message
+
+    def finish(self) -> None:
+        text = "".join(text for _, text in self.chunks)
+        usage = getattr(self.message, "usage_metadata", None)
+        entry = self.model._entry(self.prompt, [text], usage, self._last - self._start, self.chunks)
+        self.model.cassette.record(self.model.cassette.key(self.model.config, self.prompt), entry)
+
+def _chunk(text: str, usage: Optional[Dict[str, int]]) -> ChatGenerationChunk:
+    return ChatGenerationChunk(message=AIMessageChunk(content=text, usage_metadata=usage))
+
+def create_cassette(config: Optional[CassetteConfig] = None) -> Optional[Cassette]:
+    """設定からカセットを作成（モードがoffならNone）"""
+    config = config or CassetteConfig()
+    if config.mode == "off":
+        return None
+    return Cassette(config.path, mode=config.mode, replay_latency=config.replay_latency)
@@ -1,18 +1,36 @@
-from dataclasses import dataclass
-from typing import Optional
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Callable, Optional
 import os
 from dotenv import load_dotenv
 
-load_dotenv()
+@lru_cache(maxsize=None)
+def load_env() -> None:
+    """.envファイルを1度だけ環境変数に読み込む（import時ではなく、最初に設定を作成したときに呼ばれる）"""
+    load_dotenv()
+
+def env(name: str, default: Optional[str], cast: Callable[[str], Any] = str) -> Any:
+    """環境変数の値をdefault_factoryとして読む（未設定・空ならdefault、defaultもNoneならNone）
+
+    設定の既定値はインスタンスの作成時に読むため、import後に変更した環境変数も反映される。
+    """
+    def read() -> Any:
+        load_env()
+        value = os.getenv(name) or default
+        return cast(value) if value is not None else None
+    return field(default_factory=read)
+
+def _flag(value: str) -> bool:
+    return value.lower() == "true"
 
 @dataclass
 class GeminiConfig:
     """Geminiモデルの設定オプション"""
-    model_name: str = os.getenv("GEMINI_MODEL", "gemini-2.0-flash-lite")
-    temperature: float = float(os.getenv("GEMINI_TEMPERATURE", "0.7"))
+    model_name: str = env("GEMINI_MODEL", "gemini-2.0-flash-lite")
+    temperature: float = env("GEMINI_TEMPERATURE", "0.7", float)
     top_p: float = 0.8
     top_k: int = 40
-    max_output_tokens: int = int(os.getenv("GEMINI_MAX_TOKENS", "2048"))
+    max_output_tokens: int = env("GEMINI_MAX_TOKENS", "2048", int)
     candidate_count: int = 1
     stop_sequences: Optional[list] = None
 
@@ -24,4 +42,155 @@ class PromptConfig:
     
     def __post_init__(self):
         if self.input_variables is None:
-            self.input_variables = ["question"] 
\ No newline at end of file
+            self.input_variables = ["question"] 
+
+@dataclass
+class CacheConfig:
+    """応答キャッシュの設定オプション"""
+    enabled: bool = env("RESPONSE_CACHE_ENABLED", "true", _flag)
+    path: str = env("RESPONSE_CACHE_PATH", ".cache/responses.sqlite3")
+    ttl: Optional[float] = env("RESPONSE_CACHE_TTL", None, float)
+    max_entries: int = env("RESPONSE_CACHE_MAX_ENTRIES", "100000", int)
+    # falseにするとtemperature>0の呼び出しはキャッシュしない
+    cache_sampled: bool = env("RESPONSE_CACHE_SAMPLED", "true", _flag)
+
+@dataclass
+class SemanticCacheConfig:
+    """意味的キャッシュ（言い換えの近い質問に保存済みの結果を返す）の設定オプション"""
+    enabled: bool = env("SEMANTIC_CACHE_ENABLED", "false", _flag)
+    threshold: float = env("SEMANTIC_CACHE_THRESHOLD", "0.9", float)
+    snapshot_path: str = env("SEMANTIC_CACHE_PATH", ".cache/semantic")
+    max_entries: int = env("SEMANTIC_CACHE_MAX_ENTRIES", "100000", int)
+
+@dataclass
+class RateLimitConfig:
+    """APIのレート制限と再試行の設定オプション（上限0で制限しない）"""
+    requests_per_minute: float = env("RATE_LIMIT_RPM", "30", float)
+    tokens_per_minute: float = env("RATE_LIMIT_TPM", "1000000", float)
+    # 応答前に1リクエストあたり予約しておくトークン数（応答後に実際の使用量で精算）
+    estimated_tokens: int = env("RATE_LIMIT_ESTIMATED_TOKENS", "1000", int)
+    max_attempts: int = env("RETRY_MAX_ATTEMPTS", "5", int)
+    base_delay: float = env("RETRY_BASE_DELAY", "1.0", float)
+    max_delay: float = env("RETRY_MAX_DELAY", "60.0", float)
+
+@dataclass
+class MetricsConfig:
+    """ステップの計測値の出力設定"""
+    # 0以外なら/metricsを返すHTTPサーバーをこのポートで起動する
+    port: int = env("METRICS_PORT", "0", int)
+    # 指定すると実行のたびにPrometheusのテキスト形式で書き出す
+    path: Optional[str] = env("METRICS_PATH", None)
+    # 指定すると実行ごとのJSONトレースをこのディレクトリに保存する
+    trace_dir: Optional[str] = env("TRACE_DIR", None)
+
+@dataclass
+class DebateConfig:
+    """ディベートの設定オプション"""
+    # 各立場が発言するラウンド数（1ラウンド目は最初の意見、2ラウンド目以降は前のラウンドへの反論）
+    rounds: int = env("DEBATE_ROUNDS", "2", int)
+    # 全立場の発言が前のラウンドとこの類似度以上になったら残りのラウンドを省く（1より大きくすると無効）
+    convergence_threshold: float = env("DEBATE_CONVERGENCE_THRESHOLD", "0.9", float)
+
+@dataclass
+class EvaluatorConfig:
+    """生成と評価の繰り返しの設定オプション（点数は0〜10）"""
+    # 評価の最大回数（最適化はその1回少ない回数まで）
+    max_iterations: int = env("EVALUATOR_MAX_ITERATIONS", "3", int)
+    # この点数以上の評価が出たら終える
+    target_score: float = env("EVALUATOR_TARGET_SCORE", "8", float)
+    # 前回の評価からの上昇がこれ未満なら改善が頭打ちとみなして終える
+    min_improvement: float = env("EVALUATOR_MIN_IMPROVEMENT", "0.5", float)
+
+@dataclass
+class ConsistencyConfig:
+    """自己整合性（複数の候補の答えの多数決）の設定オプション"""
+    # 1回の呼び出しで生成する候補の数（candidate_count）
+    samples: int = env("SELF_CONSISTENCY_SAMPLES", "5", int)
+    # 候補をばらつかせるためのtemperature
+    temperature: float = env("SELF_CONSISTENCY_TEMPERATURE", "0.8", float)
+    # 数値を含まない答えは、文字n-gramの類似度がこれ以上なら同じ答えとして数える
+    similarity: float = env("SELF_CONSISTENCY_SIMILARITY", "0.8", float)
+
+@dataclass
+class ContextBudgetConfig:
+    """ステップ間の受け渡しのトークン数の予算"""
+    # 1ステップのプロンプトに埋め込む前段の出力の合計トークン数の上限（0で制限しない）
+    step_tokens: int = env("CONTEXT_STEP_TOKENS", "2000", int)
+    # 予算を超えたときの圧縮方法（truncate: 切り詰め、extractive: 重要文の抽出、summarize: LLMで要約）
+    strategy: str = env("CONTEXT_STRATEGY", "extractive")
+
+@dataclass
+class HistoryConfig:
+    """実行履歴の保存設定"""
+    enabled: bool = env("HISTORY_ENABLED", "true", _flag)
+    path: str = env("HISTORY_PATH", ".cache/runs.sqlite3")
+
+@dataclass
+class CassetteConfig:
+    """呼び出しの記録・再生の設定"""
+    # off: 使わない、record: 実際に呼び出して記録する、replay: 記録から再生する
+    mode: str = env("CASSETTE_MODE", "off")
+    path: str = env("CASSETTE_PATH", ".cache/cassette.jsonl")
+    # trueにすると再生時に記録時の待ち時間（最初のトークンまで・チャンクの間隔）を再現する
+    replay_latency: bool = env("CASSETTE_REPLAY_LATENCY", "false", _flag)
+
+@dataclass
+class ServerConfig:
+    """HTTP APIサーバーの設定（同時実行数・待ち行列・期限）"""
+    host: str = env("SERVER_HOST", "127.0.0.1")
+    port: int = env("SERVER_PORT", "8000", int)
+    # 同時に実行するリクエスト数の上限
+    max_concurrency: int = env("SERVER_MAX_CONCURRENCY", "16", int)
+    # 実行待ちにできるリクエスト数（超えたら503で断る）
+    queue_size: int = env("SERVER_QUEUE_SIZE", "64", int)
+    # 1クライアントが同時に受け付けてもらえるリクエスト数（超えたら429で断る）
+    client_concurrency: int = env("SERVER_CLIENT_CONCURRENCY", "4", int)
+    # 待ち行列での待ち時間を含めたリクエストの期限（秒）
+    timeout: float = env("SERVER_TIMEOUT", "120", float)
+
+@dataclass
+class JobsConfig:
+    """バックグラウンドのジョブキューの設定"""
+    # パターンを実行するワーカースレッドの数
+    workers: int = env("JOB_WORKERS", "4", int)
+    # 保持する完了済みのジョブの数（超えたら古いものから捨てる）
+    max_finished: int = env("JOB_MAX_FINISHED", "100", int)
+    # 完了したジョブを保持する秒数
+    ttl: float = env("JOB_TTL", "3600", float)
+
+@dataclass
+class ComparisonConfig:
+    """アプリの比較モードの設定"""
+    # 全セッションで共有する、同時に実行するパターン数の上限
+    max_workers: int = env("COMPARE_MAX_WORKERS", "6", int)
+
+@dataclass
+class RunBudgetConfig:
+    """パターン1回の実行全体の予算（いずれも0で制限しない）"""
+    # 入力と出力を合わせたトークン数の上限
+    max_tokens: int = env("RUN_MAX_TOKENS", "0", int)
+    # 推定費用の上限（USD）
+    max_cost: float = env("RUN_MAX_COST", "0", float)
+    # 実行時間の上限（秒）
+    max_seconds: float = env("RUN_MAX_SECONDS", "0", float)
+    # 費用の推定に使う100万トークンあたりの単価（USD）
+    input_price: float = env("GEMINI_INPUT_PRICE", "0.075", float)
+    output_price: float = env("GEMINI_OUTPUT_PRICE", "0.30", float)
+    # 残りの予算でこれより短い出力しか許せなくなったら、以降のステップは実行しない
+    min_output_tokens: int = env("RUN_MIN_OUTPUT_TOKENS", "64", int)
+
+@dataclass
+class RouterConfig:
+    """自動選択（質問に合わせたパターンの選択）の設定"""
+    # heuristic: 質問の文面だけで分類する、llm: 文面で確信が持てなければ短い呼び出しを1回使って分類する
+    classifier: str = env("ROUTER_CLASSIFIER", "heuristic")
+    # 文面からの分類の確信度（0〜1）がこれ未満ならLLMで分類する（classifier=llmのとき）
+    min_confidence: float = env("ROUTER_MIN_CONFIDENCE", "0.6", float)
+    # 単純な質問以外で、これより短い回答は不十分として重いパターンで答え直す
+    min_answer_chars: int = env("ROUTER_MIN_ANSWER_CHARS", "40", int)
+    # 重いパターンへ切り替える回数の上限
+    max_escalations: int = env("ROUTER_MAX_ESCALATIONS", "2", int)
+    # 省いた呼び出し回数の比較対象のパターン
+    baseline: str = env("ROUTER_BASELINE", "chain_of_thought")
+    # 選択の記録を追記するJSONLファイル（空で記録しない）
+    log_path: str = env("ROUTER_LOG_PATH", ".cache/router.jsonl")
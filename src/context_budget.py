@@ -0,0 +1,184 @@
+"""ステップ間の受け渡しをトークン数の予算内に収める
+
+前段のステップの出力（やディベートの議論など）は次のステップのプロンプトにそのまま埋め込まれるため、
+冗長な出力が続くと入力トークン数とレイテンシが膨らむ。ContextBudgetは1ステップに埋め込む
+受け渡し部分の合計トークン数を予算内に収め、超えた分を戦略（切り詰め・重要文の抽出・LLMでの要約）に従って圧縮する。
+"""
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence
+import math
+import re
+import unicodedata
+from .config import ContextBudgetConfig
+
+COMPACTION_STRATEGIES = ("truncate", "extractive", "summarize")
+
+# (圧縮する文章, 目標のトークン数) → 要約
+Summarizer = Callable[[str, int], str]
+AsyncSummarizer = Callable[[str, int], Awaitable[str]]
+
+# summarizeで受け渡しを要約させるプロンプト
+SUMMARY_TEMPLATE = "以下の文章を、重要な情報を残して{tokens}トークン程度に要約してください。要約だけを出力してください。\n\n{text}"
+
+_SENTENCE_END = re.compile(r"(?<=[。！？!?])|(?<=\.)\s+|\n+")
+_OMITTED = "…（省略）"
+
+def estimate_tokens(text: str) -> int:
+    """おおよそのトークン数（日本語は1文字≒1トークン、英数字は4文字≒1トークン）"""
+    ascii_chars = sum(1 for c in text if c.isascii())
+    return max(1, (len(text) - ascii_chars) + ascii_chars // 4)
+
+def split_sentences(text: str) -> List[str]:
+    """文（句点・感嘆符・疑問符・改行の区切り）に分ける"""
+    return [sentence.strip() for sentence in _SENTENCE_END.split(text) if sentence and sentence.strip()]
+
+def truncate(text: str, budget: int) -> str:
+    """先頭からbudgetトークン分だけ残す"""
+    if estimate_tokens(text) <= budget:
+        return text
+    kept = []
+    used = estimate_tokens(_OMITTED)
+    ascii_run = 0
+    for c in text:
+        # 英数字は4文字で1トークンとして数える
+        if c.isascii():
+            ascii_run += 1
+            cost = 1 if ascii_run % 4 == 1 else 0
+        else:
+            cost = 1
+        if used + cost > budget:
+            break
+        used += cost
+        kept.append(c)
+    return "".join(kept).rstrip() + _OMITTED
+
+def _terms(sentence: str) -> List[str]:
+    """文の特徴語（文字2-gram）"""
+    normalized = "".join(unicodedata.normalize("NFKC", sentence).lower().split())
+    return [normalized[i:i + 2] for i in range(max(len(normalized) - 1, 1))]
+
+def extract_key_sentences(text: str, budget: int) -> str:
+    """文章全体によく出る語を多く含む文を、元の順序のままbudgetトークン分選ぶ
+
+    最初の文（多くの場合は結論や主題）は優先して残す。
+    """
+    if estimate_tokens(text) <= budget:
+        return text
+    sentences = split_sentences(text)
+    if len(sentences) <= 1:
+        return truncate(text, budget)
+    frequency: Dict[str, int] = {}
+    for sentence in sentences:
+        for term in set(_terms(sentence)):
+            frequency[term] = frequency.get(term, 0) + 1
+
+    def score(index: int) -> float:
+        terms = _terms(sentences[index])
+        # 長い文ほど有利にならないよう、語数の平方根で割る
+        value = sum(frequency[t] for t in terms) / math.sqrt(len(terms))
+        return value * (1.5 if index == 0 else 1.0)
+
+    chosen = []
+    used = 0
+    for index in sorted(range(len(sentences)), key=score, reverse=True):
+        cost = estimate_tokens(sentences[index])
+        if used + cost <= budget:
+            chosen.append(index)
+            used += cost
+    if not chosen:
+        return truncate(sentences[0], budget)
+    return "\n".join(sentences[i] for i in sorted(chosen))
+
+def allocate(sizes: Dict[str, int], budget: int) -> Dict[str, int]:
+    """予算を各受け渡しに配分する（短いものはそのまま残し、残りを長いものに均等に割り当てる）"""
+    allocation = {}
+    remaining = budget
+    names = sorted(sizes, key=lambda name: sizes[name])
+    for position, name in enumerate(names):
+        share = remaining // (len(names) - position)
+        allocation[name] = min(sizes[name], share)
+        remaining -= allocation[name]
+    return allocation
+
+@dataclass
+class Compaction:
+    """1ステップ分の受け渡しの圧縮結果"""
+    values: Dict[str, str]
+    tokens_before: int
+    tokens_after: int
+    # 圧縮しなかった場合はNone
+    strategy: Optional[str] = None
+
+class ContextBudget:
+    """1ステップのプロンプトに埋め込む受け渡しの合計トークン数を予算内に収める
+
+    質問など利用者の入力（preserve）は圧縮しない。summarizeで要約する関数が渡されなければ
+    重要文の抽出で代用し、要約が予算を超えた場合は切り詰める。
+    """
+    def __init__(
+        self,
+        step_tokens: int = 2000,
+        strategy: str = "extractive",
+        preserve: Sequence[str] = ("question",)
+    ):
+        if strategy not in COMPACTION_STRATEGIES:
+            raise ValueError(f"未対応の圧縮方法です: {strategy}（{', '.join(COMPACTION_STRATEGIES)}）")
+        self.step_tokens = step_tokens
+        self.strategy = strategy
+        self.preserve = set(preserve)
+
+    def _plan(self, values: Dict[str, str]) -> Optional[Dict[str, int]]:
+        """受け渡しごとの予算（予算内に収まっていればNone）"""
+        sizes = {name: estimate_tokens(text) for name, text in values.items() if name not in self.preserve}
+        if sum(sizes.values()) <= self.step_tokens:
+            return None
+        return allocate(sizes, self.step_tokens)
+
+    def _compact_locally(self, text: str, budget: int) -> str:
+        if self.strategy == "truncate":
+            return truncate(text, budget)
+        return extract_key_sentences(text, budget)
+
+    def _result(self, values: Dict[str, str], compacted: Dict[str, str], strategy: Optional[str]) -> Compaction:
+        merged = {**values, **compacted}
+        count = lambda items: sum(estimate_tokens(text) for name, text in items.items() if name not in self.preserve)
+        return Compaction(merged, count(values), count(merged), strategy)
+
+    def compact(self, values: Dict[str, str], summarize: Optional[Summarizer] = None) -> Compaction:
+        """予算を超える受け渡しを圧縮した値を返す"""
+        plan = self._plan(values)
+        if plan is None:
+            return self._result(values, {}, None)
+        use_llm = self.strategy == "summarize" and summarize is not None
+        compacted = {}
+        for name, budget in plan.items():
+            text = values[name]
+            if estimate_tokens(text) <= budget:
+                continue
+            compacted[name] = truncate(summarize(text, budget), budget) if use_llm else self._compact_locally(text, budget)
+        return self._result(values, compacted, self.strategy if use_llm else self._local_strategy())
+
+    async def acompact(self, values: Dict[str, str], summarize: Optional[AsyncSummarizer] = None) -> Compaction:
+        """compactの非同期版"""
+        plan = self._plan(values)
+        if plan is None:
+            return self._result(values, {}, None)
+        use_llm = self.strategy == "summarize" and summarize is not None
+        compacted = {}
+        for name, budget in plan.items():
+            text = values[name]
+            if estimate_tokens(text) <= budget:
+                continue
+            compacted[name] = truncate(await summarize(text, budget), budget) if use_llm else self._compact_locally(text, budget)
+        return self._result(values, compacted, self.strategy if use_llm else self._local_strategy())
+
+    def _local_strategy(self) -> str:
+        """LLMを使わずに圧縮した場合の戦略名"""
+        return "truncate" if self.strategy == "truncate" else "extractive"
+
+def create_context_budget(config: Optional[ContextBudgetConfig] = None) -> Optional[ContextBudget]:
+    """設定から受け渡しの予算を作成（予算が0ならNone）"""
+    config = config or ContextBudgetConfig()
+    if not config.step_tokens:
+        return None
+    return ContextBudget(step_tokens=config.step_tokens, strategy=config.strategy)
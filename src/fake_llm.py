@@ -0,0 +1,230 @@
+"""APIキーなしで動くレイテンシ設定可能なフェイクのチャットモデル
+
+registryのLLMファクトリに渡すと、src/models.pyのすべてのパターンがネットワークなしで動く:
+
+    get_registry().set_llm_factory(lambda config: FakeChatModel(ttft=0.2, tokens_per_second=50))
+"""
+from typing import Any, Dict, Iterator, AsyncIterator, List, Optional
+import asyncio
+import hashlib
+import math
+import random
+import threading
+import time
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from pydantic import PrivateAttr
+from .context_budget import estimate_tokens
+
+LATENCY_DISTRIBUTIONS = ("constant", "uniform", "exponential", "lognormal")
+
+class FakeLLMError(Exception):
+    """フェイクモデルが注入する一般的なエラー（再試行されない）"""
+
+class FakeRateLimitError(FakeLLMError):
+    """フェイクモデルが注入する429エラー（RetryPolicyで再試行される）"""
+    code = 429
+
+    def __init__(self, message: str = "429 Resource has been exhausted", retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class FakeChatModel(BaseChatModel):
+    """決定的なフェイクのチャットモデル
+
+    応答・待ち時間・失敗はすべてseed・プロンプト・そのプロンプトの呼び出し回数から決まるため、
+    同時実行で呼び出し順が変わっても同じ結果になる。
+    待ち時間は最初のトークンまで（ttft）をlatency_distributionに従って引き、
+    以降はtokens_per_secondの速度でトークンを生成する。
+    """
+    # 固定の応答（指定しなければプロンプトごとに決まった応答を生成する）
+    responses: Optional[List[str]] = None
+    output_tokens: int = 32
+    # 最初のトークンまでの平均秒数
+    ttft: float = 0.0
+    latency_distribution: str = "constant"
+    # lognormalのばらつき（対数の標準偏差）
+    latency_sigma: float = 0.5
+    # Noneなら全トークンを待ちなしで生成する
+    tokens_per_second: Optional[float] = None
+    # 呼び出しが失敗する確率と、失敗のうち429にする割合
+    failure_rate: float = 0.0
+    rate_limit_ratio: float = 1.0
+    retry_after: Optional[float] = None
+    # 1回の呼び出しで返す候補数（GeminiConfig.candidate_count相当）
+    n: int = 1
+    seed: int = 0
+
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _attempts: Dict[str, int] = PrivateAttr(default_factory=dict)
+    _calls: int = PrivateAttr(default=0)
+    _simulated_seconds: float = PrivateAttr(default=0.0)
+    _prompts: List[str] = PrivateAttr(default_factory=list)
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    @property
+    def calls(self) -> int:
+        """これまでの呼び出し回数（失敗も含む）"""
+        return self._calls
+
+    @property
+    def prompts(self) -> List[str]:
+        """呼び出されたプロンプト（呼び出し順）"""
+        return list(self._prompts)
+
+    @property
+    def simulated_seconds(self) -> float:
+        """待ち時間として消費した秒数の合計（フレームワークのオーバーヘッドの算出用）"""
+        return self._simulated_seconds
+
+    def reset(self) -> None:
+        """呼び出し回数などの記録を消す"""
+        with self._lock:
+            self._attempts.clear()
+            self._calls = 0
+            self._simulated_seconds = 0.0
+            self._prompts.clear()
+
+    def _plan(self, messages: List[BaseMessage]) -> Dict[str, Any]:
+        """1回分の呼び出しの応答・待ち時間・失敗を決める"""
+        prompt = "\n".join(str(message.content) for message in messages)
+        with self._lock:
+            attempt = self._attempts.get(prompt, 0)
+            self._attempts[prompt] = attempt + 1
+            index = self._calls
+            self._calls += 1
+            self._prompts.append(prompt)
+        rng = random.Random(f"{self.seed}:{attempt}:{prompt}")
+        ttft = self._sample_latency(rng)
+        if rng.random() < self.failure_rate:
+            if rng.random() < self.rate_limit_ratio:
+                error: Exception = FakeRateLimitError(retry_after=self.retry_after)
+            else:
+                error = FakeLLMError("injected failure")
+            return {"ttft": ttft, "error": error, "candidates": []}
+        candidates = [self._tokens(prompt, index, i) for i in range(self.n)]
+        return {"ttft": ttft, "error": None, "candidates": candidates, "prompt": prompt}
+
+    def _sample_latency(self, rng: random.Random) -> float:
+        mean = self.ttft
+        if mean <= 0 or self.latency_distribution == "constant":
+            return max(mean, 0.0)
+        if self.latency_distribution == "uniform":
+            return rng.uniform(0, 2 * mean)
+        if self.latency_distribution == "exponential":
+            return rng.expovariate(1 / mean)
+        if self.latency_distribution == "lognormal":
+            # 平均がttftになるように補正
+            sigma = self.latency_sigma
+            return mean * math.exp(rng.gauss(0, sigma) - sigma ** 2 / 2)
+        raise ValueError(f"未対応の分布です: {self.latency_distribution}（{', '.join(LATENCY_DISTRIBUTIONS)}）")
+
+    def _tokens(self, prompt: str, index: int, candidate: int) -> List[str]:
+        """応答をトークンの列として作る"""
+        if self.responses:
+            return list(self.responses[index % len(self.responses)])
+        digest = hashlib.sha256(f"{self.seed}:{candidate}:{prompt}".encode("utf-8")).hexdigest()[:8]
+        return [f"[{digest}]"] + [f" 語{i}" for i in range(1, self.output_tokens)]
+
+    def _token_delay(self) -> float:
+        return 1 / self.tokens_per_second if self.tokens_per_second else 0.0
+
+    def _record_wait(self, seconds: float) -> None:
+        with self._lock:
+            self._simulated_seconds += seconds
+
+    def _result(self, plan: Dict[str, Any]) -> ChatResult:
+        usage = _usage(plan["prompt"], plan["candidates"])
+        return ChatResult(generations=[
+            ChatGeneration(message=AIMessage(content="".join(tokens), usage_metadata=usage if i == 0 else None))
+            for i, tokens in enumerate(plan["candidates"])
+        ])
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any
+    ) -> ChatResult:
+        plan = self._plan(messages)
+        wait = plan["ttft"] + (len(plan["candidates"][0]) * self._token_delay() if plan["candidates"] else 0)
+        time.sleep(wait)
+        self._record_wait(wait)
+        if plan["error"] is not None:
+            raise plan["error"]
+        return self._result(plan)
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any
+    ) -> ChatResult:
+        plan = self._plan(messages)
+        wait = plan["ttft"] + (len(plan["candidates"][0]) * self._token_delay() if plan["candidates"] else 0)
+        await asyncio.sleep(wait)
+        self._record_wait(wait)
+        if plan["error"] is not None:
+            raise plan["error"]
+        return self._result(plan)
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any
+    ) -> Iterator[ChatGenerationChunk]:
+        plan = self._plan(messages)
+        time.sleep(plan["ttft"])
+        self._record_wait(plan["ttft"])
+        if plan["error"] is not None:
+            raise plan["error"]
+        tokens = plan["candidates"][0]
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep(self._token_delay())
+                self._record_wait(self._token_delay())
+            chunk = _chunk(token, plan["prompt"], tokens if i == len(tokens) - 1 else None)
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: Any
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        plan = self._plan(messages)
+        await asyncio.sleep(plan["ttft"])
+        self._record_wait(plan["ttft"])
+        if plan["error"] is not None:
+            raise plan["error"]
+        tokens = plan["candidates"][0]
+        for i, token in enumerate(tokens):
+            if i:
+                await asyncio.sleep(self._token_delay())
+                self._record_wait(self._token_delay())
+            chunk = _chunk(token, plan["prompt"], tokens if i == len(tokens) - 1 else None)
+            if run_manager:
+                await run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+def _usage(prompt: str, candidates: List[List[str]]) -> Dict[str, int]:
+    input_tokens = estimate_tokens(prompt)
+    output_tokens = sum(len(tokens) for tokens in candidates)
+    return {"input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens}
+
+def _chunk(token: str, prompt: str, tokens: Optional[List[str]]) -> ChatGenerationChunk:
+    """ストリーミングの1チャンク（最後のチャンクに使用量を付ける）"""
+    usage = _usage(prompt, [tokens]) if tokens is not None else None
+    return ChatGenerationChunk(message=AIMessageChunk(content=token, usage_metadata=usage))
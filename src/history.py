@@ -0,0 +1,199 @@
+"""パターンの実行履歴（質問・設定・各ステップの出力と計測値）を保存・検索・再表示する
+
+履歴は追記のみで、1回の実行を1行としてSQLiteに保存する。ステップの出力と計測値はzlibで圧縮した
+JSONにまとめ、検索用の全文索引（FTS5）は本文を持たない索引だけのテーブルにして容量を抑える。
+保存済みの実行はLLMを呼ばずにそのまま再表示できる。
+"""
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from .config import GeminiConfig, HistoryConfig
+from .metrics import RunTrace
+
+def question_hash(question: str) -> str:
+    """同じ質問の実行を引くためのハッシュ（前後の空白は無視）"""
+    return hashlib.sha256(question.strip().encode("utf-8")).hexdigest()
+
+@dataclass
+class RunSummary:
+    """一覧・検索結果の1件（ステップの出力は展開しない）"""
+    id: int
+    created_at: float
+    pattern: str
+    question: str
+    # 最初のステップの開始から最後のステップの終了までの実時間（秒）
+    duration: float
+
+@dataclass
+class RunRecord(RunSummary):
+    """保存した実行の全体"""
+    config: Dict[str, Any] = field(default_factory=dict)
+    # パターンの戻り値（final_responseを含む）
+    result: Dict[str, Any] = field(default_factory=dict)
+    # ステップごとの計測値（StepMetrics.to_dict）と出力（output）
+    steps: List[Dict[str, Any]] = field(default_factory=list)
+
+class RunStore:
+    """SQLiteに保存する追記のみの実行履歴
+
+    パターン・日時・質問のハッシュに索引を張り、質問とステップの出力を全文検索できる。
+    SQLiteがFTS5（trigram）に対応していない場合、検索は質問の部分一致だけになる。
+    """
+    def __init__(self, path: str = ".cache/runs.sqlite3"):
+        self.path = path
+        self._lock = threading.Lock()
+        if path != ":memory:" and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        if path != ":memory:":
+            self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY,
+                created_at REAL NOT NULL,
+                pattern TEXT NOT NULL,
+                question TEXT NOT NULL,
+                question_hash TEXT NOT NULL,
+                duration REAL NOT NULL,
+                config TEXT NOT NULL,
+                payload BLOB NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_runs_pattern_created ON runs(pattern, created_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_runs_created ON runs(created_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_runs_question ON runs(question_hash, created_at)")
+        try:
+            # 日本語は単語に分かち書きされないため、3文字単位の索引で部分一致を検索する
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS runs_fts USING fts5(question, outputs, content='', tokenize='trigram')"
+            )
+            self.full_text = True
+        except sqlite3.OperationalError:
+            self.full_text = False
+        self._conn.commit()
+
+    def record(
+        self,
+        pattern: str,
+        question: str,
+        result: Dict[str, Any],
+        trace: Optional[RunTrace] = None,
+        outputs: Optional[Dict[str, str]] = None,
+        config: Optional[GeminiConfig] = None
+    ) -> int:
+        """1回の実行を保存してIDを返す（outputsはステップ名 → 出力）"""
+        outputs = outputs or {}
+        steps = [
+            {**step.to_dict(), "output": outputs.get(step.step)}
+            for step in (trace.steps if trace is not None else [])
+        ]
+        payload = zlib.compress(
+            json.dumps({"result": result, "steps": steps}, ensure_ascii=False, default=str).encode("utf-8")
+        )
+        searchable = "\n".join(
+            [str(result.get("final_response", ""))] + [text for text in outputs.values() if text]
+        )
+        with self._lock:
+            run_id = self._conn.execute(
+                "INSERT INTO runs (created_at, pattern, question, question_hash, duration, config, payload) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    trace.started_at if trace is not None else time.time(),
+                    pattern,
+                    question,
+                    question_hash(question),
+                    trace.elapsed if trace is not None else 0.0,
+                    json.dumps(asdict(config or GeminiConfig()), ensure_ascii=False),
+                    payload,
+                )
+            ).lastrowid
+            if self.full_text:
+                self._conn.execute(
+                    "INSERT INTO runs_fts (rowid, question, outputs) VALUES (?, ?, ?)", (run_id, question, searchable)
+                )
+            self._conn.commit()
+        return run_id
+
+    def get(self, run_id: int) -> Optional[RunRecord]:
+        """保存した実行を取得（なければNone）"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, created_at, pattern, question, duration, config, payload FROM runs WHERE id = ?", (run_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        payload = json.loads(zlib.decompress(row[6]).decode("utf-8"))
+        return RunRecord(
+            *row[:5], config=json.loads(row[5]), result=payload["result"], steps=payload["steps"]
+        )
+
+    def _summaries(self, where: str, params: tuple, limit: int) -> List[RunSummary]:
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT id, created_at, pattern, question, duration FROM runs {where} "
+                "ORDER BY created_at DESC, id DESC LIMIT ?",
+                (*params, limit)
+            ).fetchall()
+        return [RunSummary(*row) for row in rows]
+
+    def recent(self, pattern: Optional[str] = None, limit: int = 20, before: Optional[float] = None) -> List[RunSummary]:
+        """新しい順の一覧（beforeより前の日時に絞り込める）"""
+        conditions, params = [], []
+        if pattern is not None:
+            conditions.append("pattern = ?")
+            params.append(pattern)
+        if before is not None:
+            conditions.append("created_at < ?")
+            params.append(before)
+        where = "WHERE " + " AND ".join(conditions) if conditions else ""
+        return self._summaries(where, tuple(params), limit)
+
+    def latest(self, question: str, pattern: Optional[str] = None) -> Optional[RunSummary]:
+        """同じ質問の最新の実行（なければNone）"""
+        where, params = "WHERE question_hash = ?", (question_hash(question),)
+        if pattern is not None:
+            where, params = where + " AND pattern = ?", params + (pattern,)
+        found = self._summaries(where, params, 1)
+        return found[0] if found else None
+
+    def search(self, text: str, pattern: Optional[str] = None, limit: int = 20) -> List[RunSummary]:
+        """質問とステップの出力から文字列を含む実行を新しい順に検索"""
+        text = text.strip()
+        if not text:
+            return self.recent(pattern, limit)
+        # trigramの索引は3文字未満の語を引けないため、短い語は質問の部分一致で探す
+        if self.full_text and len(text) >= 3:
+            where = "WHERE id IN (SELECT rowid FROM runs_fts WHERE runs_fts MATCH ?)"
+            params: tuple = ('"' + text.replace('"', '""') + '"',)
+        else:
+            where = r"WHERE question LIKE ? ESCAPE '\'"
+            escaped = text.replace("\\", "\\\\").replace("%", r"\%").replace("_", r"\_")
+            params = ("%" + escaped + "%",)
+        if pattern is not None:
+            where, params = where + " AND pattern = ?", params + (pattern,)
+        return self._summaries(where, params, limit)
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+
+    def stats(self) -> Dict[str, float]:
+        """保存件数と、圧縮したステップの出力の合計バイト数"""
+        with self._lock:
+            runs, stored = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(LENGTH(payload)), 0) FROM runs").fetchone()
+        return {"runs": runs, "payload_bytes": stored}
+
+def create_run_store(config: Optional[HistoryConfig] = None) -> Optional[RunStore]:
+    """設定から実行履歴を作成（無効ならNone）"""
+    config = config or HistoryConfig()
+    if not config.enabled:
+        return None
+    return RunStore(config.path)
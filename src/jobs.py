@@ -0,0 +1,238 @@
+"""時間のかかるパターンをバックグラウンドのワーカーで実行するジョブキュー
+
+(パターン, 質問, モデル設定)をジョブとして投入するとIDが返り、ワーカースレッドのプールが実行する。
+ステップの開始・終了はジョブのイベントとして溜まり、waitで新しいイベントを待って受け取れる
+（UIのセッションが終わっても実行は続き、後から結果を取り出せる）。
+同じ内容の投入は実行中・完了済みのジョブにまとめ、完了したジョブは件数と保持時間の上限で古いものから捨てる。
+
+    queue = JobQueue(workers=4)
+    job_id = queue.submit("chained_reasoning", "在宅勤務を導入すべきか")
+    events, done = queue.wait(job_id, since=0, timeout=1.0)
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import logging
+import threading
+import time
+import uuid
+from .config import GeminiConfig, JobsConfig
+from .metrics import RunTrace
+from .registry import config_key, get_registry
+
+logger = logging.getLogger(__name__)
+
+# パターン名 → (パターンのクラス名, 1問を実行するメソッド名)
+JOB_PATTERNS: Dict[str, Tuple[str, str]] = {
+    "direct_query": ("DirectQuery", "answer"),
+    "chain_of_thought": ("GeminiChainOfThought", "solve_problem"),
+    "direct_reasoning": ("GeminiReasoning", "direct_reasoning"),
+    "chained_reasoning": ("GeminiReasoning", "chained_reasoning"),
+    "evaluator_optimizer": ("EvaluatorOptimizer", "generate_optimized_response"),
+    "debate_based_cooperation": ("DebateBasedCooperation", "generate_debate_response"),
+    # 質問に合わせてパターンを選ぶ（router.PatternRouter）
+    "auto": ("PatternRouter", "answer"),
+}
+
+# (パターン名, 質問, モデル設定, ステップの通知先) → パターンの戻り値
+JobRunner = Callable[[str, str, GeminiConfig, Callable], Dict[str, Any]]
+
+def run_pattern(pattern: str, question: str, config: GeminiConfig, on_step: Callable) -> Dict[str, Any]:
+    """JOB_PATTERNSのパターンを実行する既定のJobRunner"""
+    if pattern not in JOB_PATTERNS:
+        raise ValueError(f"未対応のパターンです: {pattern}（{', '.join(JOB_PATTERNS)}）")
+    pattern_class, method = JOB_PATTERNS[pattern]
+    return getattr(get_registry().get_pattern(pattern_class, config), method)(question, on_step)
+
+class JobStatus(Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+
+@dataclass
+class Job:
+    """投入されたジョブと実行の経過"""
+    id: str
+    pattern: str
+    question: str
+    config: GeminiConfig
+    status: JobStatus = JobStatus.QUEUED
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    # ステップの開始・終了・失敗の通知（StepEvent）を届いた順に溜める
+    events: List[Any] = field(default_factory=list)
+    # 完了したステップの出力
+    outputs: Dict[str, str] = field(default_factory=dict)
+    trace: RunTrace = field(default_factory=RunTrace)
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[BaseException] = None
+    # 同じ内容の投入をまとめた回数（最初の投入を含む）
+    submissions: int = 1
+
+    @property
+    def done(self) -> bool:
+        return self.status in (JobStatus.SUCCEEDED, JobStatus.FAILED)
+
+    @property
+    def duration(self) -> Optional[float]:
+        """実行にかかった秒数（待ち時間を除く。終わっていなければNone）"""
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+class JobQueue:
+    """ワーカースレッドのプールでジョブを実行するキュー（スレッドセーフ）
+
+    同じ(パターン, 質問, モデル設定)の投入は、待機中・実行中・成功済みのジョブがあればそのIDを返す
+    （失敗したジョブは再投入で実行し直す）。完了したジョブはmax_finished件・ttl秒まで保持する。
+    on_finishは完了したジョブを受け取り、ワーカースレッドで呼ばれる（実行履歴への保存など）。
+    """
+    def __init__(
+        self,
+        runner: Optional[JobRunner] = None,
+        workers: int = 4,
+        max_finished: int = 100,
+        ttl: Optional[float] = 3600.0,
+        on_finish: Optional[Callable[[Job], None]] = None
+    ):
+        self.runner = runner or run_pattern
+        self.workers = workers
+        self.max_finished = max_finished
+        self.ttl = ttl
+        self.on_finish = on_finish
+        self.deduplicated = 0
+        self.evicted = 0
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._condition = threading.Condition()
+        # 投入順のジョブ（古いものから捨てる）
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        # 重複をまとめるキー → ジョブID
+        self._keys: Dict[Tuple, str] = {}
+
+    @staticmethod
+    def _key(pattern: str, question: str, config: GeminiConfig) -> Tuple:
+        return (pattern, question.strip(), config_key(config))
+
+    def submit(self, pattern: str, question: str, config: Optional[GeminiConfig] = None) -> str:
+        """ジョブを投入してIDを返す（同じ内容のジョブがあればそのID）"""
+        config = config or GeminiConfig()
+        key = self._key(pattern, question, config)
+        with self._condition:
+            self._evict()
+            existing = self._jobs.get(self._keys.get(key, ""))
+            if existing is not None and existing.status != JobStatus.FAILED:
+                existing.submissions += 1
+                self.deduplicated += 1
+                return existing.id
+            job = Job(id=uuid.uuid4().hex[:12], pattern=pattern, question=question, config=config)
+            job.trace.question = question
+            self._jobs[job.id] = job
+            self._keys[key] = job.id
+        self._pool.submit(self._run, job)
+        return job.id
+
+    def _run(self, job: Job) -> None:
+        from .models import StepEventType
+
+        def on_step(event) -> None:
+            with self._condition:
+                job.trace.on_step(event)
+                if event.type == StepEventType.FINISHED:
+                    job.outputs[event.step] = event.output
+                job.events.append(event)
+                self._condition.notify_all()
+
+        with self._condition:
+            job.status = JobStatus.RUNNING
+            job.started_at = time.time()
+            self._condition.notify_all()
+        try:
+            result = self.runner(job.pattern, job.question, job.config, on_step)
+        except Exception as e:
+            with self._condition:
+                job.error = e
+                job.status = JobStatus.FAILED
+        else:
+            with self._condition:
+                job.result = result
+                job.status = JobStatus.SUCCEEDED
+        with self._condition:
+            job.finished_at = time.time()
+            self._evict()
+            self._condition.notify_all()
+        if self.on_finish is not None:
+            try:
+                self.on_finish(job)
+            except Exception:
+                # ワーカーの例外は誰も受け取らないため、履歴の保存などの失敗はログに残す
+                logger.exception("ジョブ%sの完了時の処理に失敗しました", job.id)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        """ジョブを取得（知らない・捨てたIDならNone）"""
+        with self._condition:
+            return self._jobs.get(job_id)
+
+    def wait(self, job_id: str, since: int = 0, timeout: Optional[float] = None) -> Tuple[List[Any], bool]:
+        """since番目以降のイベントが届くかジョブが終わるまで待ち、(新しいイベント, 終わったか)を返す
+
+        timeoutを過ぎたら届いた分だけ返す。知らないIDはKeyError。
+        """
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None:
+                raise KeyError(job_id)
+            self._condition.wait_for(lambda: len(job.events) > since or job.done, timeout)
+            return job.events[since:], job.done
+
+    def result(self, job_id: str, timeout: Optional[float] = None) -> Job:
+        """ジョブが終わるまで待って返す（timeoutを過ぎたらTimeoutError）"""
+        with self._condition:
+            job = self._jobs.get(job_id)
+            if job is None:
+                raise KeyError(job_id)
+            if not self._condition.wait_for(lambda: job.done, timeout):
+                raise TimeoutError(f"ジョブ{job_id}が{timeout}秒以内に終わりませんでした")
+            return job
+
+    def jobs(self, limit: int = 20) -> List[Job]:
+        """新しい順のジョブの一覧"""
+        with self._condition:
+            return list(reversed(self._jobs.values()))[:limit]
+
+    def _evict(self) -> None:
+        """保持時間を過ぎた・上限を超えた完了済みのジョブを古い順に捨てる（ロックを持って呼ぶ）"""
+        now = time.time()
+        finished = [job for job in self._jobs.values() if job.done]
+        expired = [job for job in finished if self.ttl is not None and now - job.finished_at > self.ttl]
+        alive = [job for job in finished if self.ttl is None or now - job.finished_at <= self.ttl]
+        for job in expired + alive[:max(len(alive) - self.max_finished, 0)]:
+            del self._jobs[job.id]
+            key = self._key(job.pattern, job.question, job.config)
+            if self._keys.get(key) == job.id:
+                del self._keys[key]
+            self.evicted += 1
+
+    def stats(self) -> Dict[str, int]:
+        """状態ごとのジョブ数と、まとめた投入・捨てたジョブの数"""
+        with self._condition:
+            counts = {status.value: 0 for status in JobStatus}
+            for job in self._jobs.values():
+                counts[job.status.value] += 1
+        return {**counts, "workers": self.workers, "deduplicated": self.deduplicated, "evicted": self.evicted}
+
+    def shutdown(self, wait: bool = True) -> None:
+        """ワーカーを止める（waitなら実行中・待機中のジョブが終わるまで待つ）"""
+        self._pool.shutdown(wait=wait)
+
+def create_job_queue(
+    runner: Optional[JobRunner] = None,
+    on_finish: Optional[Callable[[Job], None]] = None,
+    config: Optional[JobsConfig] = None
+) -> JobQueue:
+    """設定からジョブキューを作成"""
+    config = config or JobsConfig()
+    return JobQueue(runner, config.workers, config.max_finished, config.ttl, on_finish)
@@ -0,0 +1,182 @@
+"""APIサーバー（src/server.py）の負荷試験（スループットとレイテンシの裾を計測）
+
+固定数の同時接続からリクエストを送り続け、ステータスごとの件数・スループット・p50/p90/p99を表示する。
+--fakeでは同じプロセス内（別スレッド）にフェイクのLLMで動くサーバーを立てるため、APIキーもネットワークも要らない。
+
+使い方:
+    python -m src.loadtest --url http://127.0.0.1:8000 --pattern chained_reasoning --requests 200 --concurrency 32
+    python -m src.loadtest --fake --requests 200 --concurrency 64 --max-concurrency 16 --queue-size 16 --stream
+"""
+from collections import Counter
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+import argparse
+import asyncio
+import json
+import socket
+import sys
+import threading
+import time
+import httpx
+from .benchmark import percentile
+from .config import ServerConfig
+from .fake_llm import FakeChatModel
+from .registry import get_registry
+from .server import SERVER_PATTERNS, create_app
+
+@dataclass
+class LoadTestResult:
+    """負荷試験の結果（レイテンシはミリ秒）"""
+    pattern: str
+    requests: int
+    concurrency: int
+    stream: bool
+    elapsed: float
+    # ステータスコード → 件数（接続エラーは0）
+    statuses: Dict[int, int] = field(default_factory=dict)
+    throughput: float = 0.0
+    # 200で終わったリクエストのスループット
+    goodput: float = 0.0
+    p50_ms: float = 0.0
+    p90_ms: float = 0.0
+    p99_ms: float = 0.0
+    # ストリーミングで最初のトークンが届くまで
+    ttft_p50_ms: Optional[float] = None
+    ttft_p99_ms: Optional[float] = None
+
+async def _send(client: httpx.AsyncClient, url: str, body: Dict, stream: bool, client_id: str):
+    """1リクエストを送り、(ステータス, 所要秒数, 最初のトークンまでの秒数)を返す"""
+    started = time.perf_counter()
+    headers = {"X-Client-ID": client_id}
+    try:
+        if not stream:
+            response = await client.post(url, json=body, headers=headers)
+            return response.status_code, time.perf_counter() - started, None
+        ttft = None
+        event = None
+        async with client.stream("POST", url, json={**body, "stream": True}, headers=headers) as response:
+            status = response.status_code
+            async for line in response.aiter_lines():
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                    if event == "chunk" and ttft is None:
+                        ttft = time.perf_counter() - started
+                elif line.startswith("data: ") and event == "error":
+                    # 期限切れ・実行時のエラーはヘッダーの送信後にerrorイベントで届く
+                    status = json.loads(line[len("data: "):])["status"]
+        return status, time.perf_counter() - started, ttft
+    except httpx.HTTPError:
+        return 0, time.perf_counter() - started, None
+
+async def run_load_test(
+    url: str,
+    pattern: str = "direct_query",
+    requests: int = 100,
+    concurrency: int = 16,
+    stream: bool = False,
+    clients: int = 0
+) -> LoadTestResult:
+    """concurrency本の接続からrequests件を送り、結果を集計する
+
+    clientsを指定するとX-Client-IDをその数で使い回す（0なら接続ごとに別のクライアント）。
+    """
+    endpoint = f"{url.rstrip('/')}/patterns/{pattern}"
+    remaining = iter(range(requests))
+    samples = []
+
+    async def worker(number: int, client: httpx.AsyncClient) -> None:
+        client_id = f"loadtest-{number % clients if clients else number}"
+        for i in remaining:
+            samples.append(await _send(client, endpoint, {"question": f"負荷試験の質問{i}"}, stream, client_id))
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=None) as client:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(n, client) for n in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    statuses = Counter(status for status, _, _ in samples)
+    latencies = [duration for status, duration, _ in samples if status == 200]
+    ttfts = [ttft for status, _, ttft in samples if status == 200 and ttft is not None]
+    return LoadTestResult(
+        pattern=pattern,
+        requests=requests,
+        concurrency=concurrency,
+        stream=stream,
+        elapsed=elapsed,
+        statuses=dict(sorted(statuses.items())),
+        throughput=len(samples) / elapsed if elapsed else 0.0,
+        goodput=len(latencies) / elapsed if elapsed else 0.0,
+        p50_ms=percentile(latencies, 50) * 1000,
+        p90_ms=percentile(latencies, 90) * 1000,
+        p99_ms=percentile(latencies, 99) * 1000,
+        ttft_p50_ms=percentile(ttfts, 50) * 1000 if ttfts else None,
+        ttft_p99_ms=percentile(ttfts, 99) * 1000 if ttfts else None,
+    )
+
+def serve_in_background(config: ServerConfig) -> str:
+    """APIサーバーを別スレッドのuvicornで起動し、URLを返す（空いているポートを使う）
+
+    httpxのASGITransportは応答を最後まで溜めてから返すため、ストリーミングの計測には実際のサーバーを使う。
+    """
+    import uvicorn
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(uvicorn.Config(create_app(config), log_level="warning"))
+    threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True).start()
+    while not server.started:
+        time.sleep(0.01)
+    return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+def format_result(result: LoadTestResult) -> str:
+    """結果を読みやすい文字列にする"""
+    statuses = ", ".join(f"{status or 'error'}: {count}" for status, count in result.statuses.items())
+    lines = [
+        f"{result.pattern}（{'SSE' if result.stream else 'JSON'}） {result.requests}件 / 同時接続{result.concurrency}"
+        f" / {result.elapsed:.2f}秒",
+        f"  ステータス: {statuses}",
+        f"  スループット: {result.throughput:.1f} req/s（成功 {result.goodput:.1f} req/s）",
+        f"  レイテンシ: p50 {result.p50_ms:.1f}ms / p90 {result.p90_ms:.1f}ms / p99 {result.p99_ms:.1f}ms",
+    ]
+    if result.ttft_p50_ms is not None:
+        lines.append(f"  最初のトークン: p50 {result.ttft_p50_ms:.1f}ms / p99 {result.ttft_p99_ms:.1f}ms")
+    return "\n".join(lines)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """負荷試験のCLIエントリーポイント"""
+    parser = argparse.ArgumentParser(description="APIサーバーのスループットとレイテンシを計測します")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="サーバーのURL（--fakeでは無視）")
+    parser.add_argument("--pattern", default="direct_query", choices=list(SERVER_PATTERNS))
+    parser.add_argument("--requests", type=int, default=100, help="送るリクエストの総数")
+    parser.add_argument("--concurrency", type=int, default=16, help="同時接続数")
+    parser.add_argument("--clients", type=int, default=0, help="X-Client-IDの種類（0なら接続ごとに別）")
+    parser.add_argument("--stream", action="store_true", help="SSEで受け取る")
+    parser.add_argument("--fake", action="store_true", help="フェイクのLLMで動くサーバーを同じプロセス内に立てる")
+    parser.add_argument("--ttft", type=float, default=0.05, help="--fakeの最初のトークンまでの平均秒数")
+    parser.add_argument("--tokens-per-second", type=float, default=200.0, help="--fakeの生成速度")
+    parser.add_argument("--max-concurrency", type=int, default=16, help="--fakeのサーバーの同時実行数")
+    parser.add_argument("--queue-size", type=int, default=64, help="--fakeのサーバーの待ち行列の長さ")
+    parser.add_argument("--timeout", type=float, default=30.0, help="--fakeのサーバーのリクエストの期限（秒）")
+    parser.add_argument("--json", dest="json_path", help="結果をJSONで書き出すファイル")
+    args = parser.parse_args(argv)
+
+    url = args.url
+    if args.fake:
+        llm = FakeChatModel(ttft=args.ttft, latency_distribution="lognormal", tokens_per_second=args.tokens_per_second)
+        get_registry().set_llm_factory(lambda config: llm)
+        url = serve_in_background(ServerConfig(
+            max_concurrency=args.max_concurrency,
+            queue_size=args.queue_size,
+            client_concurrency=args.concurrency,
+            timeout=args.timeout,
+        ))
+
+    result = asyncio.run(run_load_test(url, args.pattern, args.requests, args.concurrency, args.stream, args.clients))
+    print(format_result(result))
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(asdict(result), f, ensure_ascii=False, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
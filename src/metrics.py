@@ -0,0 +1,295 @@
+"""パターンの各ステップの計測値（レイテンシ・トークン数・再試行・キャッシュヒット）
+
+計測値はプロセス共有のMetricsRegistryにpattern・stepのラベル付きで集計し、
+Prometheusのテキスト形式で出力できる（HTTPエンドポイントまたはファイル）。
+1回の実行分の記録はRunTraceをon_stepに渡すとJSONで取り出せる。
+"""
+from dataclasses import dataclass, asdict, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import bisect
+import json
+import os
+import threading
+import time
+
+# 秒単位のヒストグラムの既定の区切り（LLMの応答時間向け）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in pairs) + "}"
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+class Counter:
+    """ラベル付きの単調増加カウンタ"""
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(tuple(str(labels[name]) for name in self.labels), 0.0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in items]
+
+class Histogram:
+    """ラベル付きのヒストグラム（累積バケット・合計・件数）"""
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        # ラベル → (各バケットの件数, 合計, 件数)
+        self._values: Dict[Tuple[str, ...], List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, **labels: str) -> int:
+        entry = self._values.get(tuple(str(labels[name]) for name in self.labels))
+        return entry[2] if entry else 0
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted((key, ([*counts], total, n)) for key, (counts, total, n) in self._values.items())
+        lines = []
+        for key, (counts, total, n) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, ('le', _format_value(bound)))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, ('le', '+Inf'))} {n}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {n}")
+        return lines
+
+class MetricsRegistry:
+    """メトリクスをまとめてPrometheusのテキスト形式で出力する"""
+    def __init__(self):
+        self._metrics: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        """Prometheusのテキスト形式（text/plain; version=0.0.4）"""
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        """ファイルに書き出す（node_exporterのtextfileコレクタ向けに置き換えで書く）"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    def serve(self, port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+        """/metricsでPrometheusのテキスト形式を返すHTTPサーバーをバックグラウンドで起動"""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+METRICS = MetricsRegistry()
+
+STEP_LABELS = ("pattern", "step")
+STEP_CALLS = METRICS.counter("ai_pattern_step_calls_total", "ステップの実行回数", STEP_LABELS + ("status",))
+STEP_DURATION = METRICS.histogram("ai_pattern_step_duration_seconds", "ステップの実行時間（秒）", STEP_LABELS)
+STEP_TTFT = METRICS.histogram("ai_pattern_step_ttft_seconds", "ストリーミングで最初のトークンが届くまでの時間（秒）", STEP_LABELS)
+STEP_TOKENS = METRICS.counter("ai_pattern_step_tokens_total", "ステップで消費したトークン数", STEP_LABELS + ("kind",))
+STEP_RETRIES = METRICS.counter("ai_pattern_step_retries_total", "ステップの呼び出しの再試行回数", STEP_LABELS)
+STEP_CACHE_HITS = METRICS.counter("ai_pattern_step_cache_hits_total", "LLMを呼ばずに済んだステップ数", STEP_LABELS + ("cache",))
+STEP_COMPACTIONS = METRICS.counter("ai_pattern_step_compactions_total", "受け渡しを予算内に圧縮したステップ数", STEP_LABELS + ("strategy",))
+STEP_COMPACTED_TOKENS = METRICS.counter("ai_pattern_step_compacted_tokens_total", "受け渡しの圧縮で削ったトークン数", STEP_LABELS)
+
+@dataclass
+class StepMetrics:
+    """1ステップ分の計測値"""
+    pattern: str
+    step: str
+    started_at: float = field(default_factory=time.time)
+    duration: float = 0.0
+    # ストリーミング時のみ（最初のトークンまでの秒数）
+    ttft: Optional[float] = None
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    retries: int = 0
+    # LLMを呼ばずに済んだ場合の理由（response: 応答キャッシュ、semantic: 意味的キャッシュ、shared: 同時実行の共有）
+    cache: Optional[str] = None
+    error: Optional[str] = None
+    # プロンプトに埋め込んだ前段の出力のトークン数（圧縮前・圧縮後）と圧縮方法（予算なしならNone）
+    context_tokens: Optional[int] = None
+    compacted_tokens: Optional[int] = None
+    compaction: Optional[str] = None
+    _start: float = field(default_factory=time.perf_counter, repr=False)
+
+    @property
+    def name(self) -> str:
+        """pattern/step形式の名前（例: chained_reasoning/assumptions）"""
+        return f"{self.pattern}/{self.step}"
+
+    def first_token(self) -> None:
+        """最初のトークンが届いた時刻を記録"""
+        if self.ttft is None:
+            self.ttft = time.perf_counter() - self._start
+
+    def add_usage(self, response: Any) -> None:
+        """応答（またはチャンク）のusage_metadataからトークン数を加算"""
+        usage = getattr(response, "usage_metadata", None)
+        if usage:
+            self.prompt_tokens += usage.get("input_tokens", 0)
+            self.completion_tokens += usage.get("output_tokens", 0)
+
+    def count_retry(self, attempt: int = 0, error: Optional[BaseException] = None) -> None:
+        """RetryPolicyのon_retryとして渡す"""
+        self.retries += 1
+
+    def record_compaction(self, compaction: Any) -> None:
+        """ContextBudgetの圧縮結果（context_budget.Compaction）を記録"""
+        self.context_tokens = compaction.tokens_before
+        self.compacted_tokens = compaction.tokens_after
+        self.compaction = compaction.strategy
+
+    def add_metrics(self, other: "StepMetrics") -> None:
+        """このステップのために行った別の呼び出し（要約など）のトークン数と再試行を加算"""
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.retries += other.retries
+
+    def finish(self, error: Optional[BaseException] = None) -> "StepMetrics":
+        """計測を終えてプロセス共有のメトリクスに反映"""
+        self.duration = time.perf_counter() - self._start
+        if error is not None:
+            self.error = f"{type(error).__name__}: {error}"
+        observe_step(self)
+        return self
+
+    def to_dict(self) -> Dict[str, Any]:
+        data = asdict(self)
+        data.pop("_start")
+        data["name"] = self.name
+        return data
+
+def observe_step(metrics: StepMetrics) -> None:
+    """ステップの計測値をPrometheusのメトリクスに反映"""
+    labels = {"pattern": metrics.pattern, "step": metrics.step}
+    STEP_CALLS.inc(status="error" if metrics.error else "ok", **labels)
+    STEP_DURATION.observe(metrics.duration, **labels)
+    if metrics.ttft is not None:
+        STEP_TTFT.observe(metrics.ttft, **labels)
+    if metrics.prompt_tokens:
+        STEP_TOKENS.inc(metrics.prompt_tokens, kind="prompt", **labels)
+    if metrics.completion_tokens:
+        STEP_TOKENS.inc(metrics.completion_tokens, kind="completion", **labels)
+    if metrics.retries:
+        STEP_RETRIES.inc(metrics.retries, **labels)
+    if metrics.cache:
+        STEP_CACHE_HITS.inc(cache=metrics.cache, **labels)
+    if metrics.compaction:
+        STEP_COMPACTIONS.inc(strategy=metrics.compaction, **labels)
+        STEP_COMPACTED_TOKENS.inc(metrics.context_tokens - metrics.compacted_tokens, **labels)
+
+class RunTrace:
+    """1回の実行のステップごとの計測値を集める（on_stepに渡す）"""
+    def __init__(self, question: str = ""):
+        self.question = question
+        self.started_at = time.time()
+        self.steps: List[StepMetrics] = []
+        # 最初のステップの開始と最後のステップの終了（perf_counter）
+        self._first: Optional[float] = None
+        self._last: Optional[float] = None
+
+    def on_step(self, event) -> None:
+        now = time.perf_counter()
+        metrics = getattr(event, "metrics", None)
+        start = now - metrics.duration if metrics is not None else now
+        self._first = start if self._first is None else min(self._first, start)
+        self._last = now if self._last is None else max(self._last, now)
+        if metrics is not None:
+            self.steps.append(metrics)
+
+    @property
+    def elapsed(self) -> float:
+        """最初のステップの開始から最後のステップの終了までの実時間（同時に実行したステップを重ねて数えない）"""
+        return self._last - self._first if self._first is not None else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "question": self.question,
+            "started_at": self.started_at,
+            "duration": self.elapsed,
+            "prompt_tokens": sum(step.prompt_tokens for step in self.steps),
+            "completion_tokens": sum(step.completion_tokens for step in self.steps),
+            "llm_calls": sum(1 for step in self.steps if step.cache is None),
+            "steps": [step.to_dict() for step in self.steps],
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), ensure_ascii=False, indent=2)
+
+    def save(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.to_json())
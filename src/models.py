@@ -1,21 +1,85 @@
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain.prompts import PromptTemplate
-from langchain.chains import LLMChain
-from typing import Dict, Any, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from typing import TYPE_CHECKING, Dict, Any, List, Optional, Callable, Iterable, Iterator, Generator, AsyncIterator, Awaitable, Union, Tuple
 from enum import Enum
-import streamlit as st
-from dotenv import load_dotenv
-import os
+from functools import lru_cache
+import asyncio
+import contextvars
+import hashlib
+import json
+import queue
+import re
+import string
+import threading
+import time
+import unicodedata
+from .cache import ResponseCache, response_cache_key
+from .singleflight import SingleFlight
+from .context_budget import SUMMARY_TEMPLATE, estimate_tokens
+from .config import ConsistencyConfig, DebateConfig, EvaluatorConfig, GeminiConfig, PromptConfig
+from .metrics import StepMetrics
+from .pipeline import PatternStep, Pipeline, StepCancelled, arun_graph, dependencies, run_graph, topological_order
+from .registry import config_key, get_registry
+from .run_budget import (
+    SKIPPED_OUTPUT,
+    BudgetExceeded,
+    acall_with_deadline,
+    aiterate_with_deadline,
+    call_with_deadline,
+    current_budget,
+    iterate_with_deadline
+)
 
-# .envファイルから環境変数を読み込む
-load_dotenv()
+# レート制限（LangChain）と意味的キャッシュ（numpy）は読み込みに時間がかかるため、使うときに読み込む
+if TYPE_CHECKING:
+    from .rate_limit import RetryPolicy
+    from .semantic_cache import HashingVectorizer, SemanticCache
 
-# APIキーを取得
-GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
+class StepEventType(Enum):
+    STARTED = "started"
+    FINISHED = "finished"
+    FAILED = "failed"
+
+@dataclass
+class StepEvent:
+    """ステップの開始・終了を通知するイベント"""
+    pattern: str
+    step: str
+    type: StepEventType
+    output: Optional[str] = None
+    error: Optional[BaseException] = None
+    # 意味的キャッシュから再生した出力ならTrue
+    cached: bool = False
+    # 終了・失敗時のステップの計測値（レイテンシ・トークン数・再試行・キャッシュヒット）
+    metrics: Optional[StepMetrics] = None
+
+StepCallback = Callable[[StepEvent], None]
+
+# バッチ実行の1件分の結果（失敗した質問は例外がそのまま入る）
+BatchOutput = Union[Dict[str, Any], Exception]
+
+@dataclass
+class StepChunk:
+    """ストリーミング中にステップから届いたトークン"""
+    step: str
+    text: str
 
 class BaseModel:
     """モデルの基底クラス"""
-    def __init__(self):
+    # チェーンのプロンプトテンプレート（各ステップのプロンプトが{question}に入る）
+    template = "{question}"
+    # 依存関係のないステップを同時に実行する上限
+    max_step_concurrency = 4
+
+    def __init__(
+        self,
+        gemini_config: Optional[GeminiConfig] = None,
+        prompt_config: Optional[PromptConfig] = None
+    ):
+        self.gemini_config = gemini_config or GeminiConfig()
+        self.prompt_config = prompt_config or PromptConfig(template=self.template)
+        # 自己整合性（候補の答えの多数決）の設定
+        self.consistency_config = ConsistencyConfig()
         # 立場の定義（必要に応じて変更可能）
         self.position_a = {
             "name": "革新的な思考",
@@ -31,43 +95,1328 @@ class BaseModel:
         }
         self.llm = self._initialize_llm()
         self.chain = self._create_chain()
-    
-    def _initialize_llm(self) -> ChatGoogleGenerativeAI:
-        """LLMを初期化"""
-        return ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash-lite",
-            google_api_key=GOOGLE_API_KEY,  # APIキーを指定
-            temperature=0.7,
-            convert_system_message_to_human=True
-        )
-    
-    def _create_chain(self) -> LLMChain:
-        """チェーンを作成"""
-        raise NotImplementedError
-    
-    def _get_llm_response(self, prompt: str) -> str:
-        """LLMの応答を取得"""
-        response = self.llm.invoke(prompt)
-        return response.content if hasattr(response, 'content') else str(response)
 
-class GeminiChainOfThought:
-    def __init__(self):
-        self.llm = self._initialize_llm()
-        self.chain = self._initialize_chain()
-    
     def _initialize_llm(self):
-        return ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash-lite",
-            temperature=0.7,
-            convert_system_message_to_human=True
+        """LLMを初期化（同じ設定のクライアントはプロセス内で共有）"""
+        return get_registry().get_llm(self.gemini_config)
+
+    def _create_chain(self):
+        """チェーンを作成（同じ設定・テンプレートのチェーンはプロセス内で共有）"""
+        return get_registry().get_chain(self.gemini_config, self.prompt_config.template)
+
+    def _get_llm_response(self, prompt: str) -> str:
+        """LLMの応答を取得（同じプロンプトの同時呼び出しは1回にまとめる）"""
+        key = response_cache_key(self.gemini_config, prompt)
+        return self._singleflight().do(key, lambda: _content(self.llm.invoke(prompt)))
+
+    def _singleflight(self) -> SingleFlight:
+        """同じ呼び出しの同時実行をまとめる共有テーブル"""
+        return get_registry().singleflight
+
+    def _step_config(self, step: PatternStep) -> GeminiConfig:
+        """ステップを呼び出すモデルの設定"""
+        return step.config or self.gemini_config
+
+    def _step_chain(self, step: PatternStep):
+        """ステップを呼び出すチェーン（ステップ独自の設定があればその共有チェーン）"""
+        if step.config is None:
+            return self.chain
+        return get_registry().get_chain(step.config, self.prompt_config.template)
+
+    def _call_config(self, step: PatternStep, prompt: str) -> Tuple[GeminiConfig, Any]:
+        """プロンプトを渡す(設定, チェーン)（実行の予算があれば残りに合わせてmax_output_tokensを縮める）"""
+        config, chain = self._step_config(step), self._step_chain(step)
+        budget = current_budget()
+        if budget is None:
+            return config, chain
+        limited = budget.limit(config, prompt)
+        if limited is not config:
+            chain = get_registry().get_chain(limited, self.prompt_config.template)
+        return limited, chain
+
+    def _prepare_call(self, step: PatternStep, prompt: str) -> Tuple[GeminiConfig, Any, str, Optional[str]]:
+        """応答キャッシュを引いてから呼び出しを準備し、(設定, チェーン, 呼び出しのキー, キャッシュ済みの応答)を返す
+
+        キャッシュにある応答は費用がかからないため、実行の予算を使い切っていても返す。
+        予算でmax_output_tokensを縮めた場合は、縮めた設定のキーでも引き直す。
+        """
+        config = self._step_config(step)
+        key, cached = self._cached_response(prompt, config)
+        if cached is not None:
+            return config, None, key, cached
+        limited, chain = self._call_config(step, prompt)
+        if limited is not config:
+            key, cached = self._cached_response(prompt, limited)
+        return limited, chain, key, cached
+
+    def _charge(self, metrics: StepMetrics, usage: Tuple[int, int], prompt: str, text: str) -> None:
+        """LLMを呼び出した分のトークン数を実行の予算に加算（usageは呼び出し前のmetricsのトークン数）"""
+        budget = current_budget()
+        if budget is None:
+            return
+        prompt_tokens = metrics.prompt_tokens - usage[0]
+        completion_tokens = metrics.completion_tokens - usage[1]
+        if not prompt_tokens and not completion_tokens:
+            # usage_metadataのないモデルは文字数から見積もる
+            prompt_tokens, completion_tokens = estimate_tokens(prompt), estimate_tokens(text)
+        budget.charge(prompt_tokens, completion_tokens)
+
+    def _response_cache(self, config: Optional[GeminiConfig] = None) -> Optional[ResponseCache]:
+        """この設定で使う応答キャッシュ（無効ならNone）"""
+        cache = get_registry().response_cache
+        if cache is None or not cache.accepts(config or self.gemini_config):
+            return None
+        return cache
+
+    def _cached_response(self, prompt: str, config: Optional[GeminiConfig] = None) -> Tuple[str, Optional[str]]:
+        """キャッシュを引き、(呼び出しのキー, キャッシュ済みの応答)を返す
+
+        キーは設定と展開済みプロンプトから作り、同時呼び出しの共有にも使う。
+        """
+        config = config or self.gemini_config
+        key = response_cache_key(config, self.prompt_config.template.format(question=prompt))
+        cache = self._response_cache(config)
+        return key, cache.lookup(key) if cache is not None else None
+
+    def _store_response(self, key: str, text: str, config: Optional[GeminiConfig] = None) -> None:
+        """応答をキャッシュに保存"""
+        config = config or self.gemini_config
+        cache = self._response_cache(config)
+        if cache is not None:
+            cache.update(key, text, config.model_name)
+
+    def _semantic_namespace(self, pattern: str, context: Dict[str, str]) -> str:
+        """パターン・設定・質問以外の入力（立場など）が同じものだけを比較対象にする"""
+        extra = {name: value for name, value in context.items() if name != "question"}
+        key = json.dumps(
+            [pattern, config_key(self.gemini_config), self.prompt_config.template, extra],
+            sort_keys=True,
+            ensure_ascii=False
+        )
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _semantic_lookup(self, pattern: str, context: Dict[str, str]) -> Optional[Dict[str, str]]:
+        """言い換え程度に近い質問の保存済みステップ出力を取得（なければNone）"""
+        cache: Optional["SemanticCache"] = get_registry().semantic_cache
+        if cache is None:
+            return None
+        hit = cache.lookup(self._semantic_namespace(pattern, context), context["question"])
+        return hit.result if hit is not None else None
+
+    def _semantic_store(
+        self,
+        pattern: str,
+        context: Dict[str, str],
+        steps: List[PatternStep],
+        outputs: Dict[str, str]
+    ) -> None:
+        """パターン全体のステップ出力を意味的キャッシュに登録
+
+        実行の予算でmax_output_tokensを縮めた呼び出しがあれば、途中で切れた出力かもしれないため保存しない。
+        """
+        cache: Optional["SemanticCache"] = get_registry().semantic_cache
+        budget = current_budget()
+        if cache is not None and (budget is None or not budget.limited):
+            cache.add(
+                self._semantic_namespace(pattern, context),
+                context["question"],
+                {step.name: outputs[step.name] for step in steps}
+            )
+
+    def _replay_steps(
+        self,
+        pattern: str,
+        steps: List[PatternStep],
+        stored: Dict[str, str],
+        on_step: Optional[StepCallback]
+    ) -> None:
+        """保存済みの出力でステップの開始・終了を通知（LLMは呼ばない）"""
+        for step in steps:
+            metrics = StepMetrics(pattern, step.name, cache="semantic")
+            _notify(on_step, StepEvent(pattern, step.name, StepEventType.STARTED, cached=True))
+            _notify(on_step, StepEvent(
+                pattern, step.name, StepEventType.FINISHED, output=stored[step.name], cached=True, metrics=metrics.finish()
+            ))
+
+    def _retry_policy(self) -> "RetryPolicy":
+        """ステップの呼び出しに適用する再試行の方針"""
+        return get_registry().retry_policy
+
+    def _batch_invoke(
+        self,
+        inputs: List[Dict[str, str]],
+        max_concurrency: Optional[int],
+        on_retry: Optional[Callable[[int], None]] = None,
+        chain: Any = None
+    ) -> List[Any]:
+        """chain.batchで一括実行し、再試行できる失敗だけをまとめて再実行
+
+        on_retryには再試行する入力の位置が渡される。chainを省略するとパターンのチェーンを使う。
+        """
+        chain = chain or self.chain
+        policy = self._retry_policy()
+        responses: List[Any] = [None] * len(inputs)
+        pending = list(range(len(inputs)))
+        attempt = 0
+        while pending:
+            attempt += 1
+            batch = chain.batch(
+                [inputs[i] for i in pending],
+                config={"max_concurrency": max_concurrency},
+                return_exceptions=True
+            )
+            retry = []
+            for i, response in zip(pending, batch):
+                responses[i] = response
+                if isinstance(response, Exception) and policy.should_retry(attempt, response):
+                    retry.append(i)
+            if retry:
+                policy.count_retries(len(retry))
+                if on_retry is not None:
+                    for i in retry:
+                        on_retry(i)
+                # 最も長いretry-afterに合わせて、失敗した分をまとめて待ってから再実行
+                time.sleep(max(policy.backoff(attempt, responses[i]) for i in retry))
+            pending = retry
+        return responses
+
+    async def _abatch_invoke(
+        self,
+        inputs: List[Dict[str, str]],
+        max_concurrency: Optional[int],
+        on_retry: Optional[Callable[[int], None]] = None,
+        chain: Any = None
+    ) -> List[Any]:
+        """_batch_invokeの非同期版（chain.abatchを使用）"""
+        chain = chain or self.chain
+        policy = self._retry_policy()
+        responses: List[Any] = [None] * len(inputs)
+        pending = list(range(len(inputs)))
+        attempt = 0
+        while pending:
+            attempt += 1
+            batch = await chain.abatch(
+                [inputs[i] for i in pending],
+                config={"max_concurrency": max_concurrency},
+                return_exceptions=True
+            )
+            retry = []
+            for i, response in zip(pending, batch):
+                responses[i] = response
+                if isinstance(response, Exception) and policy.should_retry(attempt, response):
+                    retry.append(i)
+            if retry:
+                policy.count_retries(len(retry))
+                if on_retry is not None:
+                    for i in retry:
+                        on_retry(i)
+                await asyncio.sleep(max(policy.backoff(attempt, responses[i]) for i in retry))
+            pending = retry
+        return responses
+
+    def _join_misses(self, misses: List[int], keys: Dict[int, str]) -> Tuple[Dict[int, Any], Dict[int, Any]]:
+        """各質問の呼び出しを共有テーブルに登録し、(代表して実行する分, 他の実行を待つ分)に分ける"""
+        flight = self._singleflight()
+        leaders, followers = {}, {}
+        for i in misses:
+            call, leader = flight.join(keys[i])
+            (leaders if leader else followers)[i] = call
+        return leaders, followers
+
+    def _finish_leaders(
+        self,
+        step: PatternStep,
+        results: List[Union[Dict[str, str], Exception]],
+        leaders: Dict[int, Any],
+        keys: Dict[int, str],
+        responses: List[Any],
+        metrics: Dict[int, StepMetrics],
+        prompts: Dict[int, str],
+        config: GeminiConfig
+    ) -> None:
+        """代表して実行した応答を結果に書き込み、待っている呼び出しに共有する（使ったトークン数は実行の予算に加算）"""
+        flight = self._singleflight()
+        for (i, call), response in zip(leaders.items(), responses):
+            if isinstance(response, Exception):
+                results[i] = response
+                _finish_failed(flight, keys[i], call, response)
+            else:
+                usage = (metrics[i].prompt_tokens, metrics[i].completion_tokens)
+                metrics[i].add_usage(response)
+                results[i][step.name] = _content(response)
+                self._store_response(keys[i], results[i][step.name], config)
+                flight.finish(keys[i], call, results[i][step.name])
+                self._charge(metrics[i], usage, prompts[i], results[i][step.name])
+
+    def _batch_chain(self, step: PatternStep, config: GeminiConfig):
+        """バッチで呼び出すチェーン（予算でmax_output_tokensを縮めた設定ならその共有チェーン）"""
+        if config is self._step_config(step):
+            return self._step_chain(step)
+        return get_registry().get_chain(config, self.prompt_config.template)
+
+    def _batch_limit(
+        self,
+        step: PatternStep,
+        results: List[Union[Dict[str, str], Exception]],
+        misses: List[int],
+        keys: Dict[int, str],
+        prompts: Dict[int, str],
+        metrics: Dict[int, StepMetrics],
+        stopped: set
+    ) -> Tuple[List[int], GeminiConfig]:
+        """実行の予算を質問ごとに確認し、(呼び出す質問, 呼び出す設定)を返す
+
+        予算を使い切った質問はstoppedに加えて呼び出しから外す。バッチは1つの設定で呼び出すため、
+        max_output_tokensは最も縮めた値に揃え、縮めた設定のキーで応答キャッシュを引き直す。
+        """
+        config = self._step_config(step)
+        budget = current_budget()
+        if budget is None:
+            return misses, config
+        allowed, limited = [], config
+        for i in misses:
+            try:
+                candidate = budget.limit(config, prompts[i])
+            except BudgetExceeded:
+                stopped.add(i)
+                continue
+            allowed.append(i)
+            if candidate.max_output_tokens < limited.max_output_tokens:
+                limited = candidate
+        if limited is config:
+            return allowed, config
+        calls = []
+        for i in allowed:
+            keys[i], cached = self._cached_response(prompts[i], limited)
+            if cached is not None:
+                results[i][step.name] = cached
+                metrics[i].cache = "response"
+            else:
+                calls.append(i)
+        return calls, limited
+
+    def _batch_misses(
+        self,
+        step: PatternStep,
+        results: List[Union[Dict[str, str], Exception]],
+        misses: List[int],
+        keys: Dict[int, str],
+        prompts: Dict[int, str],
+        max_concurrency: Optional[int],
+        metrics: Dict[int, StepMetrics],
+        config: GeminiConfig
+    ) -> None:
+        """キャッシュにない質問をconfigでまとめて実行し、resultsに書き込む
+
+        同じプロンプトはバッチ内の重複も、他で実行中のものも1回の呼び出しにまとめる。
+        """
+        flight = self._singleflight()
+        leaders, followers = self._join_misses(misses, keys)
+        order = list(leaders)
+        try:
+            responses = self._batch_invoke(
+                [{"question": prompts[i]} for i in order],
+                max_concurrency,
+                lambda position: metrics[order[position]].count_retry(),
+                self._batch_chain(step, config)
+            )
+        except BaseException as e:
+            for i, call in leaders.items():
+                _finish_failed(flight, keys[i], call, e)
+            raise
+        self._finish_leaders(step, results, leaders, keys, responses, metrics, prompts, config)
+        # 自分の代表分を確定させてから待つ（待つ相手が自分の代表分でも止まらない）
+        for i, call in followers.items():
+            try:
+                text = flight.wait(call)
+                if call.abandoned:
+                    text = self._run_step(step, results[i], metrics[i])
+                else:
+                    metrics[i].cache = "shared"
+                results[i][step.name] = text
+            except Exception as e:
+                results[i] = e
+
+    async def _abatch_misses(
+        self,
+        step: PatternStep,
+        results: List[Union[Dict[str, str], Exception]],
+        misses: List[int],
+        keys: Dict[int, str],
+        prompts: Dict[int, str],
+        max_concurrency: Optional[int],
+        metrics: Dict[int, StepMetrics],
+        config: GeminiConfig
+    ) -> None:
+        """_batch_missesの非同期版"""
+        flight = self._singleflight()
+        leaders, followers = self._join_misses(misses, keys)
+        for call in leaders.values():
+            flight.bind(call)
+        order = list(leaders)
+        try:
+            responses = await self._abatch_invoke(
+                [{"question": prompts[i]} for i in order],
+                max_concurrency,
+                lambda position: metrics[order[position]].count_retry(),
+                self._batch_chain(step, config)
+            )
+        except BaseException as e:
+            for i, call in leaders.items():
+                _finish_failed(flight, keys[i], call, e)
+            raise
+        self._finish_leaders(step, results, leaders, keys, responses, metrics, prompts, config)
+        for i, call in followers.items():
+            try:
+                text = await flight.await_call(call)
+                if call.abandoned:
+                    text = await self._arun_step(step, results[i], metrics[i])
+                else:
+                    metrics[i].cache = "shared"
+                results[i][step.name] = text
+            except Exception as e:
+                results[i] = e
+
+    def _step_prompt(self, step: PatternStep, outputs: Dict[str, str], metrics: StepMetrics) -> str:
+        """ステップのプロンプトを組み立てる（受け渡しが予算を超えていれば圧縮し、前後のトークン数をmetricsに記録）"""
+        budget = get_registry().context_budget
+        if budget is None:
+            return step.template.format(**outputs)
+        values = {name: outputs[name] for name in step.variables if name in outputs}
+        compaction = budget.compact(values, lambda text, tokens: self._summarize(step, text, tokens, metrics))
+        metrics.record_compaction(compaction)
+        return step.template.format(**{**outputs, **compaction.values})
+
+    async def _astep_prompt(self, step: PatternStep, outputs: Dict[str, str], metrics: StepMetrics) -> str:
+        """_step_promptの非同期版"""
+        budget = get_registry().context_budget
+        if budget is None:
+            return step.template.format(**outputs)
+        values = {name: outputs[name] for name in step.variables if name in outputs}
+        compaction = await budget.acompact(values, lambda text, tokens: self._asummarize(step, text, tokens, metrics))
+        metrics.record_compaction(compaction)
+        return step.template.format(**{**outputs, **compaction.values})
+
+    def _summarize(self, step: PatternStep, text: str, tokens: int, metrics: StepMetrics) -> str:
+        """受け渡しをLLMで要約する（要約の呼び出しは{ステップ名}_summaryとして計測し、トークン数はmetricsにも加算）"""
+        summary_metrics = StepMetrics(metrics.pattern, f"{step.name}_summary")
+        try:
+            summary = self._invoke_prompt(step, SUMMARY_TEMPLATE.format(tokens=tokens, text=text), summary_metrics)
+        except Exception as e:
+            summary_metrics.finish(e)
+            raise
+        metrics.add_metrics(summary_metrics.finish())
+        return summary
+
+    async def _asummarize(self, step: PatternStep, text: str, tokens: int, metrics: StepMetrics) -> str:
+        """_summarizeの非同期版"""
+        summary_metrics = StepMetrics(metrics.pattern, f"{step.name}_summary")
+        try:
+            summary = await self._ainvoke_prompt(step, SUMMARY_TEMPLATE.format(tokens=tokens, text=text), summary_metrics)
+        except Exception as e:
+            summary_metrics.finish(e)
+            raise
+        metrics.add_metrics(summary_metrics.finish())
+        return summary
+
+    def _run_step(self, step: PatternStep, outputs: Dict[str, str], metrics: Optional[StepMetrics] = None) -> str:
+        """1ステップ分のプロンプトを組み立ててLLMを呼び出す
+
+        キャッシュヒット・再試行・トークン数・受け渡しの圧縮はmetricsに記録する。
+        """
+        metrics = metrics if metrics is not None else StepMetrics("", step.name)
+        return self._invoke_prompt(step, self._step_prompt(step, outputs, metrics), metrics)
+
+    def _invoke_prompt(self, step: PatternStep, prompt: str, metrics: StepMetrics) -> str:
+        """組み立て済みのプロンプトをステップの設定でLLMに渡す（キャッシュ・同時実行の共有・再試行付き）"""
+        config, chain, key, cached = self._prepare_call(step, prompt)
+        if cached is not None:
+            metrics.cache = "response"
+            return cached
+        # 同じプロンプトを実行中の呼び出しがあれば、その結果を共有する
+        flight = self._singleflight()
+        call, shared = flight.lead(key)
+        if call is None:
+            metrics.cache = "shared"
+            return shared
+        try:
+            response = call_with_deadline(
+                lambda: self._retry_policy().call(lambda: chain.invoke({"question": prompt}), metrics.count_retry),
+                lambda response: _usage_tokens([response])
+            )
+            text = _content(response)
+            self._store_response(key, text, config)
+        except BaseException as e:
+            _finish_failed(flight, key, call, e)
+            raise
+        flight.finish(key, call, text)
+        usage = (metrics.prompt_tokens, metrics.completion_tokens)
+        metrics.add_usage(response)
+        self._charge(metrics, usage, prompt, text)
+        return text
+
+    def _stream_step(self, step: PatternStep, outputs: Dict[str, str], metrics: Optional[StepMetrics] = None) -> Iterator[str]:
+        """1ステップ分のプロンプトを組み立て、LLMの応答をトークンごとに返す"""
+        metrics = metrics if metrics is not None else StepMetrics("", step.name)
+        prompt = self._step_prompt(step, outputs, metrics)
+        config, chain, key, cached = self._prepare_call(step, prompt)
+        if cached is not None:
+            metrics.cache = "response"
+            yield cached
+            return
+        # 同じプロンプトを実行中の呼び出しがあれば、その完了を待って全文を1度に返す
+        flight = self._singleflight()
+        call, shared = flight.lead(key)
+        if call is None:
+            metrics.cache = "shared"
+            yield shared
+            return
+        parts = []
+        usage = (metrics.prompt_tokens, metrics.completion_tokens)
+        try:
+            for chunk in iterate_with_deadline(
+                self._retry_policy().stream(lambda: chain.stream({"question": prompt}), metrics.count_retry),
+                lambda chunk: _usage_tokens([chunk])
+            ):
+                metrics.add_usage(chunk)
+                text = _content(chunk)
+                if text:
+                    metrics.first_token()
+                    parts.append(text)
+                    yield text
+            text = "".join(parts)
+            self._store_response(key, text, config)
+        except BaseException as e:
+            _finish_failed(flight, key, call, e)
+            if isinstance(e, BudgetExceeded):
+                # 打ち切るまでに受け取った分も予算に加算する
+                self._charge(metrics, usage, prompt, "".join(parts))
+            raise
+        flight.finish(key, call, text)
+        self._charge(metrics, usage, prompt, text)
+
+    async def _arun_step(self, step: PatternStep, outputs: Dict[str, str], metrics: Optional[StepMetrics] = None) -> str:
+        """_run_stepの非同期版"""
+        metrics = metrics if metrics is not None else StepMetrics("", step.name)
+        return await self._ainvoke_prompt(step, await self._astep_prompt(step, outputs, metrics), metrics)
+
+    async def _ainvoke_prompt(self, step: PatternStep, prompt: str, metrics: StepMetrics) -> str:
+        """_invoke_promptの非同期版"""
+        config, chain, key, cached = self._prepare_call(step, prompt)
+        if cached is not None:
+            metrics.cache = "response"
+            return cached
+        flight = self._singleflight()
+        call, shared = await flight.alead(key)
+        if call is None:
+            metrics.cache = "shared"
+            return shared
+        usage = (metrics.prompt_tokens, metrics.completion_tokens)
+        try:
+            response = await acall_with_deadline(
+                self._retry_policy().acall(lambda: chain.ainvoke({"question": prompt}), metrics.count_retry)
+            )
+            text = _content(response)
+            self._store_response(key, text, config)
+        except BaseException as e:
+            _finish_failed(flight, key, call, e)
+            if isinstance(e, BudgetExceeded):
+                # 取り消した呼び出しも入力は送っているため、入力分を予算に加算する
+                self._charge(metrics, usage, prompt, "")
+            raise
+        flight.finish(key, call, text)
+        metrics.add_usage(response)
+        self._charge(metrics, usage, prompt, text)
+        return text
+
+    async def _astream_step(
+        self,
+        step: PatternStep,
+        outputs: Dict[str, str],
+        metrics: Optional[StepMetrics] = None
+    ) -> AsyncIterator[str]:
+        """_stream_stepの非同期版"""
+        metrics = metrics if metrics is not None else StepMetrics("", step.name)
+        prompt = await self._astep_prompt(step, outputs, metrics)
+        config, chain, key, cached = self._prepare_call(step, prompt)
+        if cached is not None:
+            metrics.cache = "response"
+            yield cached
+            return
+        flight = self._singleflight()
+        call, shared = await flight.alead(key)
+        if call is None:
+            metrics.cache = "shared"
+            yield shared
+            return
+        parts = []
+        usage = (metrics.prompt_tokens, metrics.completion_tokens)
+        try:
+            async for chunk in aiterate_with_deadline(
+                self._retry_policy().astream(lambda: chain.astream({"question": prompt}), metrics.count_retry)
+            ):
+                metrics.add_usage(chunk)
+                text = _content(chunk)
+                if text:
+                    metrics.first_token()
+                    parts.append(text)
+                    yield text
+            text = "".join(parts)
+            self._store_response(key, text, config)
+        except BaseException as e:
+            _finish_failed(flight, key, call, e)
+            if isinstance(e, BudgetExceeded):
+                # 打ち切るまでに受け取った分も予算に加算する
+                self._charge(metrics, usage, prompt, "".join(parts))
+            raise
+        flight.finish(key, call, text)
+        self._charge(metrics, usage, prompt, text)
+
+    def _run_steps(
+        self,
+        pattern: str,
+        steps: List[PatternStep],
+        context: Dict[str, str],
+        on_step: Optional[StepCallback] = None
+    ) -> Dict[str, str]:
+        """各ステップを1回ずつ実行し、開始・終了をon_stepへ通知
+
+        依存関係のないステップはスレッドで同時に実行する（通知は呼び出し元のスレッドから行う）。
+        """
+        stored = self._semantic_lookup(pattern, context)
+        if stored is not None:
+            self._replay_steps(pattern, steps, stored, on_step)
+            return {**context, **stored}
+        outputs = dict(context)
+        metrics: Dict[str, StepMetrics] = {}
+
+        def start(step: PatternStep) -> Callable[[], str]:
+            metrics[step.name] = StepMetrics(pattern, step.name)
+            _notify(on_step, StepEvent(pattern, step.name, StepEventType.STARTED))
+            # 実行中に他のステップの出力が書き込まれても影響しないよう、入力を写しておく
+            inputs = dict(outputs)
+            return lambda: self._run_step(step, inputs, metrics[step.name])
+
+        try:
+            run_graph(steps, start, self._step_finisher(pattern, outputs, metrics, on_step),
+                      self._step_failer(pattern, metrics, on_step), self.max_step_concurrency)
+        except BudgetExceeded:
+            # 予算を使い切ったら残りのステップは実行せず、そこまでの出力を返す（キャッシュには保存しない）
+            self._skip_steps(steps, outputs)
+            return outputs
+        self._semantic_store(pattern, context, steps, outputs)
+        return outputs
+
+    def _skip_steps(self, steps: List[PatternStep], outputs: Dict[str, str]) -> List[PatternStep]:
+        """予算を使い切って実行しなかったステップの出力をSKIPPED_OUTPUTにして返す"""
+        skipped = [step for step in topological_order(steps) if step.name not in outputs]
+        budget = current_budget()
+        for step in skipped:
+            outputs[step.name] = SKIPPED_OUTPUT
+            if budget is not None:
+                budget.skip(step.name)
+        return skipped
+
+    def _step_finisher(
+        self,
+        pattern: str,
+        outputs: Dict[str, str],
+        metrics: Dict[str, StepMetrics],
+        on_step: Optional[StepCallback]
+    ) -> Callable[[PatternStep, str], None]:
+        """終わったステップの出力を記録して通知する関数"""
+        def finish(step: PatternStep, text: str) -> None:
+            outputs[step.name] = text
+            _notify(on_step, StepEvent(
+                pattern, step.name, StepEventType.FINISHED, output=text, metrics=metrics[step.name].finish()
+            ))
+        return finish
+
+    def _step_failer(
+        self,
+        pattern: str,
+        metrics: Dict[str, StepMetrics],
+        on_step: Optional[StepCallback]
+    ) -> Callable[[PatternStep, Exception], None]:
+        """失敗したステップを通知する関数"""
+        def fail(step: PatternStep, error: Exception) -> None:
+            _notify(on_step, StepEvent(
+                pattern, step.name, StepEventType.FAILED, error=error, metrics=metrics[step.name].finish(error)
+            ))
+        return fail
+
+    def _stream_one(
+        self,
+        pattern: str,
+        step: PatternStep,
+        outputs: Dict[str, str],
+        on_step: Optional[StepCallback]
+    ) -> Iterator[StepChunk]:
+        """1ステップをその場でストリーミングし、出力をoutputsに書き込む"""
+        metrics = StepMetrics(pattern, step.name)
+        _notify(on_step, StepEvent(pattern, step.name, StepEventType.STARTED))
+        parts = []
+        try:
+            for text in self._stream_step(step, outputs, metrics):
+                parts.append(text)
+                yield StepChunk(step.name, text)
+        except Exception as e:
+            _notify(on_step, StepEvent(pattern, step.name, StepEventType.FAILED, error=e, metrics=metrics.finish(e)))
+            raise
+        outputs[step.name] = "".join(parts)
+        _notify(on_step, StepEvent(
+            pattern, step.name, StepEventType.FINISHED, output=outputs[step.name], metrics=metrics.finish()
+        ))
+
+    def _stream_event(
+        self,
+        pattern: str,
+        event: Tuple[str, str, Any],
+        outputs: Dict[str, str],
+        parts: Dict[str, List[str]],
+        running: Dict[str, Tuple[PatternStep, StepMetrics]],
+        steps: List[PatternStep],
+        on_step: Optional[StepCallback]
+    ) -> Optional[StepChunk]:
+        """同時にストリーミングしているステップから届いた(種類, ステップ名, 値)を処理し、返すチャンクがあれば返す
+
+        終わったステップの出力はoutputsに書き込む。失敗したステップがあれば、実行中の他のステップにも
+        StepCancelledで失敗を通知してから例外を送出する。
+        """
+        kind, name, value = event
+        if kind == "chunk":
+            parts.setdefault(name, []).append(value)
+            return StepChunk(name, value)
+        step, metrics = running.pop(name)
+        if kind == "failed":
+            _notify(on_step, StepEvent(pattern, name, StepEventType.FAILED, error=value, metrics=metrics.finish(value)))
+            for other, other_metrics in sorted(running.values(), key=lambda item: steps.index(item[0])):
+                error = StepCancelled(name)
+                _notify(on_step, StepEvent(
+                    pattern, other.name, StepEventType.FAILED, error=error, metrics=other_metrics.finish(error)
+                ))
+            running.clear()
+            raise value
+        outputs[name] = "".join(parts.pop(name, []))
+        _notify(on_step, StepEvent(pattern, name, StepEventType.FINISHED, output=outputs[name], metrics=metrics.finish()))
+        return None
+
+    def _stream_graph(
+        self,
+        pattern: str,
+        steps: List[PatternStep],
+        outputs: Dict[str, str],
+        on_step: Optional[StepCallback]
+    ) -> Iterator[StepChunk]:
+        """依存先が終わったステップから最大max_step_concurrency個ずつ同時にストリーミングし、届いた順にチャンクを返す
+
+        ステップの出力はoutputsに書き込む。通知とチャンクは呼び出し元のスレッドから返す（Streamlitの描画をしてよい）。
+        実行可能なステップが1つだけのときはスレッドを使わずにその場で実行する。
+        """
+        graph = dependencies(steps)
+        pending = topological_order(steps)
+        running: Dict[str, Tuple[PatternStep, StepMetrics]] = {}
+        parts: Dict[str, List[str]] = {}
+        events: "queue.Queue[Tuple[str, str, Any]]" = queue.Queue()
+        stopped = threading.Event()
+        pool: Optional[ThreadPoolExecutor] = None
+
+        def pump(step: PatternStep, inputs: Dict[str, str], metrics: StepMetrics) -> None:
+            stream = self._stream_step(step, inputs, metrics)
+            try:
+                for text in stream:
+                    if stopped.is_set():
+                        return
+                    events.put(("chunk", step.name, text))
+            except Exception as e:
+                events.put(("failed", step.name, e))
+                return
+            finally:
+                stream.close()
+            events.put(("finished", step.name, None))
+
+        try:
+            while pending or running:
+                done = {step.name for step in steps if step not in pending and step.name not in running}
+                ready = [step for step in pending if graph[step.name] <= done]
+                if len(ready) == 1 and not running:
+                    pending.remove(ready[0])
+                    yield from self._stream_one(pattern, ready[0], outputs, on_step)
+                    continue
+                for step in ready[:max(self.max_step_concurrency - len(running), 0)]:
+                    pending.remove(step)
+                    metrics = StepMetrics(pattern, step.name)
+                    running[step.name] = (step, metrics)
+                    _notify(on_step, StepEvent(pattern, step.name, StepEventType.STARTED))
+                    pool = pool or ThreadPoolExecutor(max_workers=self.max_step_concurrency)
+                    # 実行中の予算（run_budget）などのコンテキスト変数をスレッドに引き継ぐ
+                    pool.submit(contextvars.copy_context().run, pump, step, dict(outputs), metrics)
+                chunk = self._stream_event(pattern, events.get(), outputs, parts, running, steps, on_step)
+                if chunk is not None:
+                    yield chunk
+        finally:
+            # 失敗・途中で閉じられた場合は、実行中のステップを次のチャンクで打ち切る
+            stopped.set()
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+
+    async def _astream_one(
+        self,
+        pattern: str,
+        step: PatternStep,
+        outputs: Dict[str, str],
+        on_step: Optional[StepCallback]
+    ) -> AsyncIterator[StepChunk]:
+        """_stream_oneの非同期版"""
+        metrics = StepMetrics(pattern, step.name)
+        _notify(on_step, StepEvent(pattern, step.name, StepEventType.STARTED))
+        parts = []
+        try:
+            async for text in self._astream_step(step, outputs, metrics):
+                parts.append(text)
+                yield StepChunk(step.name, text)
+        except Exception as e:
+            _notify(on_step, StepEvent(pattern, step.name, StepEventType.FAILED, error=e, metrics=metrics.finish(e)))
+            raise
+        outputs[step.name] = "".join(parts)
+        _notify(on_step, StepEvent(
+            pattern, step.name, StepEventType.FINISHED, output=outputs[step.name], metrics=metrics.finish()
+        ))
+
+    async def _astream_graph(
+        self,
+        pattern: str,
+        steps: List[PatternStep],
+        outputs: Dict[str, str],
+        on_step: Optional[StepCallback]
+    ) -> AsyncIterator[StepChunk]:
+        """_stream_graphの非同期版（失敗・途中で閉じられた場合は実行中のステップをキャンセルする）"""
+        graph = dependencies(steps)
+        pending = topological_order(steps)
+        running: Dict[str, Tuple[PatternStep, StepMetrics]] = {}
+        parts: Dict[str, List[str]] = {}
+        events: "asyncio.Queue[Tuple[str, str, Any]]" = asyncio.Queue()
+        tasks: List[asyncio.Task] = []
+
+        async def pump(step: PatternStep, inputs: Dict[str, str], metrics: StepMetrics) -> None:
+            try:
+                async for text in self._astream_step(step, inputs, metrics):
+                    events.put_nowait(("chunk", step.name, text))
+            except Exception as e:
+                events.put_nowait(("failed", step.name, e))
+                return
+            events.put_nowait(("finished", step.name, None))
+
+        try:
+            while pending or running:
+                done = {step.name for step in steps if step not in pending and step.name not in running}
+                ready = [step for step in pending if graph[step.name] <= done]
+                if len(ready) == 1 and not running:
+                    pending.remove(ready[0])
+                    async for chunk in self._astream_one(pattern, ready[0], outputs, on_step):
+                        yield chunk
+                    continue
+                for step in ready[:max(self.max_step_concurrency - len(running), 0)]:
+                    pending.remove(step)
+                    metrics = StepMetrics(pattern, step.name)
+                    running[step.name] = (step, metrics)
+                    _notify(on_step, StepEvent(pattern, step.name, StepEventType.STARTED))
+                    tasks.append(asyncio.ensure_future(pump(step, dict(outputs), metrics)))
+                chunk = self._stream_event(pattern, await events.get(), outputs, parts, running, steps, on_step)
+                if chunk is not None:
+                    yield chunk
+        finally:
+            for task in tasks:
+                task.cancel()
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    def _stream_steps(
+        self,
+        pattern: str,
+        steps: List[PatternStep],
+        context: Dict[str, str],
+        on_step: Optional[StepCallback] = None
+    ) -> Generator[StepChunk, None, Dict[str, str]]:
+        """ステップを依存関係の順に実行し、届いたトークンをStepChunkとして逐次返す
+
+        依存関係のないステップは同時に実行し、各ステップのチャンクを届いた順に混ぜて返す。
+        ジェネレータの戻り値は全ステップの出力。
+        """
+        stored = self._semantic_lookup(pattern, context)
+        if stored is not None:
+            for step in steps:
+                metrics = StepMetrics(pattern, step.name, cache="semantic")
+                _notify(on_step, StepEvent(pattern, step.name, StepEventType.STARTED, cached=True))
+                yield StepChunk(step.name, stored[step.name])
+                _notify(on_step, StepEvent(
+                    pattern, step.name, StepEventType.FINISHED, output=stored[step.name], cached=True, metrics=metrics.finish()
+                ))
+            return {**context, **stored}
+        outputs = dict(context)
+        try:
+            yield from self._stream_graph(pattern, steps, outputs, on_step)
+        except BudgetExceeded:
+            # 実行しなかったステップは印だけを返す
+            for step in self._skip_steps(steps, outputs):
+                yield StepChunk(step.name, SKIPPED_OUTPUT)
+            return outputs
+        self._semantic_store(pattern, context, steps, outputs)
+        return outputs
+
+    async def _arun_steps(
+        self,
+        pattern: str,
+        steps: List[PatternStep],
+        context: Dict[str, str],
+        on_step: Optional[StepCallback] = None
+    ) -> Dict[str, str]:
+        """_run_stepsの非同期版（待機中はイベントループを他の質問に譲る）"""
+        stored = self._semantic_lookup(pattern, context)
+        if stored is not None:
+            self._replay_steps(pattern, steps, stored, on_step)
+            return {**context, **stored}
+        outputs = dict(context)
+        metrics: Dict[str, StepMetrics] = {}
+
+        def start(step: PatternStep) -> Callable[[], Awaitable[str]]:
+            metrics[step.name] = StepMetrics(pattern, step.name)
+            _notify(on_step, StepEvent(pattern, step.name, StepEventType.STARTED))
+            inputs = dict(outputs)
+            return lambda: self._arun_step(step, inputs, metrics[step.name])
+
+        try:
+            await arun_graph(steps, start, self._step_finisher(pattern, outputs, metrics, on_step),
+                             self._step_failer(pattern, metrics, on_step), self.max_step_concurrency)
+        except BudgetExceeded:
+            self._skip_steps(steps, outputs)
+            return outputs
+        self._semantic_store(pattern, context, steps, outputs)
+        return outputs
+
+    async def _astream_steps(
+        self,
+        pattern: str,
+        steps: List[PatternStep],
+        context: Dict[str, str],
+        on_step: Optional[StepCallback] = None
+    ) -> AsyncIterator[StepChunk]:
+        """_stream_stepsの非同期版"""
+        stored = self._semantic_lookup(pattern, context)
+        if stored is not None:
+            for step in steps:
+                metrics = StepMetrics(pattern, step.name, cache="semantic")
+                _notify(on_step, StepEvent(pattern, step.name, StepEventType.STARTED, cached=True))
+                yield StepChunk(step.name, stored[step.name])
+                _notify(on_step, StepEvent(
+                    pattern, step.name, StepEventType.FINISHED, output=stored[step.name], cached=True, metrics=metrics.finish()
+                ))
+            return
+        outputs = dict(context)
+        try:
+            async for chunk in self._astream_graph(pattern, steps, outputs, on_step):
+                yield chunk
+        except BudgetExceeded:
+            # 実行しなかったステップは印だけを返す
+            for step in self._skip_steps(steps, outputs):
+                yield StepChunk(step.name, SKIPPED_OUTPUT)
+            return
+        self._semantic_store(pattern, context, steps, outputs)
+
+    def _batch_lookup(
+        self,
+        pattern: str,
+        steps: List[PatternStep],
+        contexts: List[Dict[str, str]]
+    ) -> Tuple[List[Union[Dict[str, str], Exception]], set]:
+        """意味的キャッシュで答えられる質問を埋め、(結果の初期値, 再生した質問の位置)を返す"""
+        results: List[Union[Dict[str, str], Exception]] = [dict(context) for context in contexts]
+        replayed = set()
+        for i, context in enumerate(contexts):
+            stored = self._semantic_lookup(pattern, context)
+            if stored is not None:
+                self._replay_steps(pattern, steps, stored, None)
+                results[i].update(stored)
+                replayed.add(i)
+        return results, replayed
+
+    def _batch_step_misses(
+        self,
+        step: PatternStep,
+        results: List[Union[Dict[str, str], Exception]],
+        prompts: Dict[int, Union[str, Exception]],
+        metrics: Dict[int, StepMetrics]
+    ) -> Tuple[List[int], Dict[int, str]]:
+        """応答キャッシュで答えられる分を埋め、(呼び出しが必要な質問, キー)を返す
+
+        プロンプトの組み立て（受け渡しの要約）に失敗した質問は例外を結果に残す。
+        """
+        misses = []
+        keys = {}
+        for i, prompt in prompts.items():
+            if isinstance(prompt, Exception):
+                results[i] = prompt
+                continue
+            keys[i], cached = self._cached_response(prompt, self._step_config(step))
+            if cached is not None:
+                results[i][step.name] = cached
+                metrics[i].cache = "response"
+            else:
+                misses.append(i)
+        return misses, keys
+
+    def _batch_steps(
+        self,
+        pattern: str,
+        steps: List[PatternStep],
+        contexts: List[Dict[str, str]],
+        max_concurrency: Optional[int] = None
+    ) -> List[Union[Dict[str, str], Exception]]:
+        """同じステップを全質問まとめてchain.batchで実行（ステップは依存関係の順）
+
+        失敗した質問はその時点で例外を結果に残し、以降のステップから外す。
+        """
+        results, replayed = self._batch_lookup(pattern, steps, contexts)
+        # 実行の予算を使い切った質問（以降のステップは実行しない）
+        stopped: set = set()
+        for step in topological_order(steps):
+            live = [
+                i for i, result in enumerate(results)
+                if not isinstance(result, Exception) and i not in replayed and i not in stopped
+            ]
+            if not live:
+                break
+            metrics = {i: StepMetrics(pattern, step.name) for i in live}
+            prompts: Dict[int, Union[str, Exception]] = {}
+            for i in live:
+                try:
+                    prompts[i] = self._step_prompt(step, results[i], metrics[i])
+                except Exception as e:
+                    prompts[i] = e
+            misses, keys = self._batch_step_misses(step, results, prompts, metrics)
+            misses, config = self._batch_limit(step, results, misses, keys, prompts, metrics, stopped)
+            if misses:
+                self._batch_misses(step, results, misses, keys, prompts, max_concurrency, metrics, config)
+            for i in live:
+                metrics[i].finish(results[i] if isinstance(results[i], Exception) else None)
+        for i in stopped:
+            # 予算を使い切った質問はそこまでの出力を返す（キャッシュには保存しない）
+            self._skip_steps(steps, results[i])
+        for i, result in enumerate(results):
+            if not isinstance(result, Exception) and i not in replayed and i not in stopped:
+                self._semantic_store(pattern, contexts[i], steps, result)
+        return results
+
+    async def _abatch_steps(
+        self,
+        pattern: str,
+        steps: List[PatternStep],
+        contexts: List[Dict[str, str]],
+        max_concurrency: Optional[int] = None
+    ) -> List[Union[Dict[str, str], Exception]]:
+        """_batch_stepsの非同期版"""
+        results, replayed = self._batch_lookup(pattern, steps, contexts)
+        # 実行の予算を使い切った質問（以降のステップは実行しない）
+        stopped: set = set()
+        for step in topological_order(steps):
+            live = [
+                i for i, result in enumerate(results)
+                if not isinstance(result, Exception) and i not in replayed and i not in stopped
+            ]
+            if not live:
+                break
+            metrics = {i: StepMetrics(pattern, step.name) for i in live}
+            built = await asyncio.gather(
+                *(self._astep_prompt(step, results[i], metrics[i]) for i in live), return_exceptions=True
+            )
+            prompts = dict(zip(live, built))
+            misses, keys = self._batch_step_misses(step, results, prompts, metrics)
+            misses, config = self._batch_limit(step, results, misses, keys, prompts, metrics, stopped)
+            if misses:
+                await self._abatch_misses(step, results, misses, keys, prompts, max_concurrency, metrics, config)
+            for i in live:
+                metrics[i].finish(results[i] if isinstance(results[i], Exception) else None)
+        for i in stopped:
+            # 予算を使い切った質問はそこまでの出力を返す（キャッシュには保存しない）
+            self._skip_steps(steps, results[i])
+        for i, result in enumerate(results):
+            if not isinstance(result, Exception) and i not in replayed and i not in stopped:
+                self._semantic_store(pattern, contexts[i], steps, result)
+        return results
+
+    def _consistency_config(self, step: PatternStep, prompt: str, n: int) -> GeminiConfig:
+        """候補をn個生成する設定（実行の予算があれば残りに合わせてmax_output_tokensを縮める）"""
+        config = replace(
+            self._step_config(step), candidate_count=n, temperature=self.consistency_config.temperature
         )
-    
-    def _initialize_chain(self):
-        return LLMChain(
-            llm=self.llm,
-            prompt=PromptTemplate(
-                input_variables=["question"],
-                template="""
+        budget = current_budget()
+        return budget.limit(config, prompt) if budget is not None else config
+
+    def _sample_candidates(self, step: PatternStep, prompt: str, n: int, metrics: StepMetrics) -> Tuple[List[str], str]:
+        """1回の呼び出しでn個の候補を生成し、(候補, 生成方法)を返す
+
+        返った候補が足りなければ（候補数の指定に対応しないモデル・API）、残りを1候補ずつ同時に呼び出して補う。
+        生成方法はcandidates（1回の呼び出し）またはparallel（同時の呼び出しで補った）。
+        同じプロンプトから異なる候補が欲しいため、応答キャッシュと同時実行の共有は使わない。
+        """
+        config = self._consistency_config(step, prompt, n)
+        chain = get_registry().get_chain(config, self.prompt_config.template)
+        usage = (metrics.prompt_tokens, metrics.completion_tokens)
+        messages = []
+        try:
+            prompt_value = chain.first.invoke({"question": prompt})
+            result = call_with_deadline(
+                lambda: self._retry_policy().call(lambda: chain.last.generate_prompt([prompt_value]), metrics.count_retry),
+                lambda result: _usage_tokens(generation.message for generation in result.generations[0])
+            )
+            messages = [generation.message for generation in result.generations[0]][:n]
+        except Exception as e:
+            if not _candidates_unsupported(e):
+                raise
+        method = "candidates"
+        if len(messages) < n:
+            method = "parallel"
+            single = get_registry().get_chain(replace(config, candidate_count=1), self.prompt_config.template)
+            with ThreadPoolExecutor(max_workers=n - len(messages)) as pool:
+                messages += call_with_deadline(lambda: list(pool.map(
+                    lambda _: self._retry_policy().call(lambda: single.invoke({"question": prompt}), metrics.count_retry),
+                    range(n - len(messages))
+                )), _usage_tokens)
+        for message in messages:
+            metrics.add_usage(message)
+        texts = [_content(message) for message in messages]
+        self._charge(metrics, usage, prompt, "".join(texts))
+        return texts, method
+
+    async def _asample_candidates(self, step: PatternStep, prompt: str, n: int, metrics: StepMetrics) -> Tuple[List[str], str]:
+        """_sample_candidatesの非同期版"""
+        config = self._consistency_config(step, prompt, n)
+        chain = get_registry().get_chain(config, self.prompt_config.template)
+        usage = (metrics.prompt_tokens, metrics.completion_tokens)
+        messages = []
+        try:
+            prompt_value = chain.first.invoke({"question": prompt})
+            result = await acall_with_deadline(self._retry_policy().acall(
+                lambda: chain.last.agenerate_prompt([prompt_value]), metrics.count_retry
+            ))
+            messages = [generation.message for generation in result.generations[0]][:n]
+        except Exception as e:
+            if not _candidates_unsupported(e):
+                raise
+        method = "candidates"
+        if len(messages) < n:
+            method = "parallel"
+            single = get_registry().get_chain(replace(config, candidate_count=1), self.prompt_config.template)
+            messages += await acall_with_deadline(asyncio.gather(*(
+                self._retry_policy().acall(lambda: single.ainvoke({"question": prompt}), metrics.count_retry)
+                for _ in range(n - len(messages))
+            )))
+        for message in messages:
+            metrics.add_usage(message)
+        texts = [_content(message) for message in messages]
+        self._charge(metrics, usage, prompt, "".join(texts))
+        return texts, method
+
+    def _consistency_result(self, texts: List[str], method: str) -> Dict[str, Any]:
+        """候補の答えを多数決し、最も票の多い答えと一致率（agreement）を返す"""
+        answers = [extract_answer(text) for text in texts]
+        votes = vote_answers(answers, self.consistency_config.similarity)
+        if not votes:
+            # 候補がない（予算を使い切った）・どの候補からも答えを取り出せなかった
+            return {
+                "samples": texts, "answers": answers, "votes": [], "reasoning": SKIPPED_OUTPUT if not texts else texts[0],
+                "final_response": SKIPPED_OUTPUT if not texts else "", "agreement": 0.0, "method": method
+            }
+        winner = votes[0]
+        return {
+            "samples": texts,
+            "answers": answers,
+            # 同じ答えのまとまりごとの{answer, count, samples（候補の位置）}（票の多い順）
+            "votes": votes,
+            # 最も票の多い答えを出した最初の候補の推論
+            "reasoning": texts[winner["samples"][0]],
+            "final_response": winner["answer"],
+            "agreement": winner["count"] / len(texts),
+            # candidates（1回の呼び出し）・parallel（同時の呼び出しで補った）・budget（予算を使い切った）
+            "method": method
+        }
+
+    def _self_consistency(
+        self,
+        pattern: str,
+        step: PatternStep,
+        question: str,
+        samples: Optional[int],
+        on_step: Optional[StepCallback]
+    ) -> Dict[str, Any]:
+        """stepの候補を1回の呼び出しで複数生成し、答えを多数決する（ステップの開始・終了をon_stepへ通知）"""
+        metrics = StepMetrics(pattern, step.name)
+        _notify(on_step, StepEvent(pattern, step.name, StepEventType.STARTED))
+        try:
+            prompt = self._step_prompt(step, {"question": question}, metrics)
+            texts, method = self._sample_candidates(step, prompt, samples or self.consistency_config.samples, metrics)
+        except BudgetExceeded as e:
+            _notify(on_step, StepEvent(pattern, step.name, StepEventType.FAILED, error=e, metrics=metrics.finish(e)))
+            self._skip_steps([step], {})
+            return self._consistency_result([], "budget")
+        except Exception as e:
+            _notify(on_step, StepEvent(pattern, step.name, StepEventType.FAILED, error=e, metrics=metrics.finish(e)))
+            raise
+        result = self._consistency_result(texts, method)
+        _notify(on_step, StepEvent(
+            pattern, step.name, StepEventType.FINISHED, output=result["reasoning"], metrics=metrics.finish()
+        ))
+        return result
+
+    async def _aself_consistency(
+        self,
+        pattern: str,
+        step: PatternStep,
+        question: str,
+        samples: Optional[int],
+        on_step: Optional[StepCallback]
+    ) -> Dict[str, Any]:
+        """_self_consistencyの非同期版"""
+        metrics = StepMetrics(pattern, step.name)
+        _notify(on_step, StepEvent(pattern, step.name, StepEventType.STARTED))
+        try:
+            prompt = await self._astep_prompt(step, {"question": question}, metrics)
+            texts, method = await self._asample_candidates(step, prompt, samples or self.consistency_config.samples, metrics)
+        except BudgetExceeded as e:
+            _notify(on_step, StepEvent(pattern, step.name, StepEventType.FAILED, error=e, metrics=metrics.finish(e)))
+            self._skip_steps([step], {})
+            return self._consistency_result([], "budget")
+        except Exception as e:
+            _notify(on_step, StepEvent(pattern, step.name, StepEventType.FAILED, error=e, metrics=metrics.finish(e)))
+            raise
+        result = self._consistency_result(texts, method)
+        _notify(on_step, StepEvent(
+            pattern, step.name, StepEventType.FINISHED, output=result["reasoning"], metrics=metrics.finish()
+        ))
+        return result
+
+def _build_results(outputs: List[Union[Dict[str, str], Exception]], build: Callable) -> List[BatchOutput]:
+    """バッチの各出力から結果を組み立てる（失敗した質問は例外のまま残す）"""
+    return [output if isinstance(output, Exception) else build(output) for output in outputs]
+
+def _content(response: Any) -> str:
+    """LLMの応答（メッセージまたはチャンク）からテキストを取り出す"""
+    return response.content if hasattr(response, 'content') else str(response)
+
+def _finish_failed(flight: SingleFlight, key: str, call: Any, error: BaseException) -> None:
+    """代表者の失敗を待っている呼び出しに伝える
+
+    予算切れは代表者の実行の予算によるため共有せず、待っていた呼び出しに自分の予算でやり直させる。
+    """
+    flight.finish(key, call, error=error, abandon=isinstance(error, BudgetExceeded))
+
+def _usage_tokens(responses: Iterable[Any]) -> Tuple[int, int]:
+    """応答（メッセージまたはチャンク）のusage_metadataの(入力, 出力)トークン数の合計"""
+    prompt_tokens = completion_tokens = 0
+    for response in responses:
+        usage = getattr(response, "usage_metadata", None) or {}
+        prompt_tokens += usage.get("input_tokens", 0)
+        completion_tokens += usage.get("output_tokens", 0)
+    return prompt_tokens, completion_tokens
+
+def _candidates_unsupported(error: Exception) -> bool:
+    """候補数（candidate_count）の指定をAPIが不正な引数として拒んだか
+
+    他の原因の400でも1候補ずつの呼び出しで同じエラーになるため、取り違えても結果は変わらない。
+    """
+    from .rate_limit import is_invalid_argument
+    return is_invalid_argument(error)
+
+# 自己整合性の候補に答えの行を書かせる指示（extract_answerで取り出す）
+ANSWER_INSTRUCTION = "\n\n最後の行には「答え: 」に続けて最終的な答えだけを書いてください。"
+
+# 候補の最後に書かせる答えの行（「答え: 4」）
+_ANSWER_LINE = re.compile(r"(?:最終的な)?(?:答え|回答|結論|answer)\s*[:：]\s*(.+)", re.IGNORECASE)
+_NUMBER = re.compile(r"-?\d+(?:\.\d+)?")
+
+def extract_answer(text: str) -> str:
+    """候補の出力から最終的な答えを取り出す（「答え: 」の行がなければ最後の行）"""
+    found = _ANSWER_LINE.findall(text)
+    if found:
+        return found[-1].strip().strip("*").strip()
+    lines = [line.strip() for line in text.strip().splitlines() if line.strip()]
+    return lines[-1] if lines else ""
+
+def _normalize_answer(answer: str) -> str:
+    """全角・大文字小文字・空白・末尾の句点・数字の桁区切りの違いをならす"""
+    text = unicodedata.normalize("NFKC", answer).lower()
+    text = re.sub(r"(?<=\d),(?=\d{3})", "", text)
+    return re.sub(r"\s+", "", text).rstrip("。.．!！")
+
+def _same_answer(a: str, b: str, similarity: float) -> bool:
+    """正規化した2つの答えが同じか（数値を含む答えは数値が一致すれば同じ、それ以外は文字n-gramの類似度で判定）"""
+    if a == b:
+        return True
+    numbers_a, numbers_b = _NUMBER.findall(a), _NUMBER.findall(b)
+    if numbers_a or numbers_b:
+        return numbers_a == numbers_b
+    return _similarity(a, b) >= similarity
+
+def vote_answers(answers: List[str], similarity: float = 0.8) -> List[Dict[str, Any]]:
+    """答えを同じ答えごとにまとめ、票の多い順（同数なら先に出た順）に{answer, count, samples}を返す
+
+    空の答えは数えない。answerはまとまりの最初の答え、samplesは答えの位置。
+    """
+    clusters: List[Dict[str, Any]] = []
+    for i, answer in enumerate(answers):
+        key = _normalize_answer(answer)
+        if not key:
+            continue
+        for cluster in clusters:
+            if _same_answer(cluster["key"], key, similarity):
+                cluster["samples"].append(i)
+                break
+        else:
+            clusters.append({"answer": answer, "key": key, "samples": [i]})
+    clusters.sort(key=lambda cluster: -len(cluster["samples"]))
+    return [{"answer": c["answer"], "count": len(c["samples"]), "samples": c["samples"]} for c in clusters]
+
+def _notify(on_step: Optional[StepCallback], event: StepEvent) -> None:
+    """コールバックが指定されていればイベントを通知"""
+    if on_step is not None:
+        on_step(event)
+
+class DirectQuery(BaseModel):
+    """シンプルな質問応答パターン"""
+    steps = [
+        PatternStep("final_response", "{question}"),
+    ]
+
+    def answer(self, question: str, on_step: Optional[StepCallback] = None) -> Dict[str, str]:
+        """質問をそのままLLMに投げて回答を得る"""
+        outputs = self._run_steps("direct_query", self.steps, {"question": question}, on_step)
+        return {"final_response": outputs["final_response"]}
+
+    def stream_answer(self, question: str, on_step: Optional[StepCallback] = None) -> Iterator[StepChunk]:
+        """回答をトークンごとに返す"""
+        return self._stream_steps("direct_query", self.steps, {"question": question}, on_step)
+
+    async def aanswer(self, question: str, on_step: Optional[StepCallback] = None) -> Dict[str, str]:
+        """answerの非同期版"""
+        outputs = await self._arun_steps("direct_query", self.steps, {"question": question}, on_step)
+        return {"final_response": outputs["final_response"]}
+
+    def astream_answer(self, question: str, on_step: Optional[StepCallback] = None) -> AsyncIterator[StepChunk]:
+        """stream_answerの非同期版"""
+        return self._astream_steps("direct_query", self.steps, {"question": question}, on_step)
+
+    def batch_answer(self, questions: List[str], max_concurrency: Optional[int] = None) -> List[BatchOutput]:
+        """answerを複数の質問に対してまとめて実行"""
+        outputs = self._batch_steps("direct_query", self.steps, [{"question": q} for q in questions], max_concurrency)
+        return _build_results(outputs, lambda o: {"final_response": o["final_response"]})
+
+    async def abatch_answer(self, questions: List[str], max_concurrency: Optional[int] = None) -> List[BatchOutput]:
+        """batch_answerの非同期版"""
+        outputs = await self._abatch_steps("direct_query", self.steps, [{"question": q} for q in questions], max_concurrency)
+        return _build_results(outputs, lambda o: {"final_response": o["final_response"]})
+
+class GeminiChainOfThought(BaseModel):
+    template = """
                 以下の質問について、段階的に考えて回答してください。
 
                 質問: {question}
@@ -78,54 +1427,71 @@ class GeminiChainOfThought:
 
                 各ステップの思考プロセスを明確に示してください。
                 """
-            )
-        )
-    
-    def solve_problem(self, question: str) -> Dict[str, str]:
-        """Chain of Thoughtパターンで問題を解決"""
+    steps = [
         # 問題分析
-        analysis_result = self.chain.invoke({"question": question})
-        
+        PatternStep("analysis", "{question}"),
         # 思考プロセス構築
-        thought_process = self.chain.invoke({
-            "question": f"以下の問題分析に基づいて、思考プロセスを構築してください。\n\n{analysis_result['text']}"
-        })
-        
+        PatternStep("thought_process", "以下の問題分析に基づいて、思考プロセスを構築してください。\n\n{analysis}"),
         # 段階的推論
-        reasoning_result = self.chain.invoke({
-            "question": f"以下の思考プロセスに基づいて、段階的に推論してください。\n\n{thought_process['text']}"
-        })
-        
+        PatternStep("reasoning", "以下の思考プロセスに基づいて、段階的に推論してください。\n\n{thought_process}"),
         # 最終回答生成
-        final_answer = self.chain.invoke({
-            "question": f"以下の推論結果に基づいて、最終的な回答を生成してください。\n\n{reasoning_result['text']}"
-        })
-        
+        PatternStep("final_answer", "以下の推論結果に基づいて、最終的な回答を生成してください。\n\n{reasoning}"),
+    ]
+
+    def solve_problem(self, question: str, on_step: Optional[StepCallback] = None) -> Dict[str, str]:
+        """Chain of Thoughtパターンで問題を解決"""
+        outputs = self._run_steps("chain_of_thought", self.steps, {"question": question}, on_step)
+        return self._result(outputs)
+
+    async def asolve_problem(self, question: str, on_step: Optional[StepCallback] = None) -> Dict[str, str]:
+        """solve_problemの非同期版"""
+        outputs = await self._arun_steps("chain_of_thought", self.steps, {"question": question}, on_step)
+        return self._result(outputs)
+
+    def _result(self, outputs: Dict[str, str]) -> Dict[str, str]:
+        """ステップの出力から結果を組み立てる"""
         return {
-            "analysis": analysis_result['text'],
-            "thought_process": thought_process['text'],
-            "reasoning": reasoning_result['text'],
-            "final_answer": final_answer['text']
+            "analysis": outputs["analysis"],
+            "thought_process": outputs["thought_process"],
+            "reasoning": outputs["reasoning"],
+            "final_answer": outputs["final_answer"]
         }
 
-class GeminiReasoning:
-    def __init__(self):
-        self.llm = self._initialize_llm()
-        self.chain = self._initialize_chain()
-    
-    def _initialize_llm(self):
-        return ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash-lite",
-            temperature=0.7,
-            convert_system_message_to_human=True
-        )
-    
-    def _initialize_chain(self):
-        return LLMChain(
-            llm=self.llm,
-            prompt=PromptTemplate(
-                input_variables=["question"],
-                template="""
+    # 自己整合性：1つの推論の全体（最後に答えの行）を候補として複数生成する
+    consistency_step = PatternStep("samples", "{question}" + ANSWER_INSTRUCTION)
+
+    def solve_with_consistency(
+        self, question: str, on_step: Optional[StepCallback] = None, samples: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """自己整合性パターン（推論の候補を複数生成し、答えを多数決する）"""
+        return self._self_consistency("chain_of_thought_consistency", self.consistency_step, question, samples, on_step)
+
+    async def asolve_with_consistency(
+        self, question: str, on_step: Optional[StepCallback] = None, samples: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """solve_with_consistencyの非同期版"""
+        return await self._aself_consistency("chain_of_thought_consistency", self.consistency_step, question, samples, on_step)
+
+    def stream_solve_problem(self, question: str, on_step: Optional[StepCallback] = None) -> Iterator[StepChunk]:
+        """Chain of Thoughtパターン（ステップごとにトークンを逐次返す）"""
+        return self._stream_steps("chain_of_thought", self.steps, {"question": question}, on_step)
+
+    def astream_solve_problem(self, question: str, on_step: Optional[StepCallback] = None) -> AsyncIterator[StepChunk]:
+        """stream_solve_problemの非同期版"""
+        return self._astream_steps("chain_of_thought", self.steps, {"question": question}, on_step)
+
+    def batch_solve_problem(self, questions: List[str], max_concurrency: Optional[int] = None) -> List[BatchOutput]:
+        """solve_problemを複数の質問に対してまとめて実行"""
+        outputs = self._batch_steps("chain_of_thought", self.steps, [{"question": q} for q in questions], max_concurrency)
+        return _build_results(outputs, self._result)
+
+    async def abatch_solve_problem(self, questions: List[str], max_concurrency: Optional[int] = None) -> List[BatchOutput]:
+        """batch_solve_problemの非同期版"""
+        outputs = await self._abatch_steps("chain_of_thought", self.steps, [{"question": q} for q in questions], max_concurrency)
+        return _build_results(outputs, self._result)
+
+class GeminiReasoning(BaseModel):
+    template = """
                 以下の質問について、構造化された推論を行ってください。
 
                 質問: {question}
@@ -137,158 +1503,772 @@ class GeminiReasoning:
 
                 各ステップの結果を明確に示してください。
                 """
-            )
-        )
-    
-    def direct_reasoning(self, question: str) -> Dict[str, str]:
-        """直接推論パターン"""
+    direct_steps = [
         # 前提条件分析
-        assumptions = self.chain.invoke({
-            "question": f"以下の質問について、前提条件を分析してください。\n\n{question}"
-        })
-        
+        PatternStep("assumptions", "以下の質問について、前提条件を分析してください。\n\n{question}"),
         # データ処理
-        data_processing = self.chain.invoke({
-            "question": f"以下の前提条件に基づいて、データを処理してください。\n\n{assumptions['text']}"
-        })
-        
+        PatternStep("data_processing", "以下の前提条件に基づいて、データを処理してください。\n\n{assumptions}"),
         # 推論実行
-        reasoning = self.chain.invoke({
-            "question": f"以下のデータに基づいて、推論を実行してください。\n\n{data_processing['text']}"
-        })
-        
-        return {
-            "assumptions": assumptions['text'],
-            "data_processing": data_processing['text'],
-            "reasoning": reasoning['text']
-        }
-    
-    def chained_reasoning(self, question: str) -> Dict[str, str]:
-        """チェーン推論パターン"""
+        PatternStep("reasoning", "以下のデータに基づいて、推論を実行してください。\n\n{data_processing}"),
+    ]
+    chained_steps = [
         # 問題分解
-        decomposition = self.chain.invoke({
-            "question": f"以下の問題を分解してください。\n\n{question}"
-        })
-        
+        PatternStep("decomposition", "以下の問題を分解してください。\n\n{question}"),
         # データ分析
-        data_analysis = self.chain.invoke({
-            "question": f"以下の問題分解に基づいて、データを分析してください。\n\n{decomposition['text']}"
-        })
-        
+        PatternStep("data_analysis", "以下の問題分解に基づいて、データを分析してください。\n\n{decomposition}"),
         # 仮定設定
-        assumptions = self.chain.invoke({
-            "question": f"以下のデータ分析に基づいて、仮定を設定してください。\n\n{data_analysis['text']}"
-        })
-        
+        PatternStep("assumptions", "以下のデータ分析に基づいて、仮定を設定してください。\n\n{data_analysis}"),
         # 推論実行
-        final_result = self.chain.invoke({
-            "question": f"以下の仮定に基づいて、最終的な結論を導き出してください。\n\n{assumptions['text']}"
-        })
-        
+        PatternStep("final_result", "以下の仮定に基づいて、最終的な結論を導き出してください。\n\n{assumptions}"),
+    ]
+
+    def direct_reasoning(self, question: str, on_step: Optional[StepCallback] = None) -> Dict[str, str]:
+        """直接推論パターン"""
+        outputs = self._run_steps("direct_reasoning", self.direct_steps, {"question": question}, on_step)
+        return self._direct_result(outputs)
+
+    def stream_direct_reasoning(self, question: str, on_step: Optional[StepCallback] = None) -> Iterator[StepChunk]:
+        """直接推論パターン（ステップごとにトークンを逐次返す）"""
+        return self._stream_steps("direct_reasoning", self.direct_steps, {"question": question}, on_step)
+
+    def chained_reasoning(self, question: str, on_step: Optional[StepCallback] = None) -> Dict[str, str]:
+        """チェーン推論パターン"""
+        outputs = self._run_steps("chained_reasoning", self.chained_steps, {"question": question}, on_step)
+        return self._chained_result(outputs)
+
+    def stream_chained_reasoning(self, question: str, on_step: Optional[StepCallback] = None) -> Iterator[StepChunk]:
+        """チェーン推論パターン（ステップごとにトークンを逐次返す）"""
+        return self._stream_steps("chained_reasoning", self.chained_steps, {"question": question}, on_step)
+
+    async def adirect_reasoning(self, question: str, on_step: Optional[StepCallback] = None) -> Dict[str, str]:
+        """direct_reasoningの非同期版"""
+        outputs = await self._arun_steps("direct_reasoning", self.direct_steps, {"question": question}, on_step)
+        return self._direct_result(outputs)
+
+    async def achained_reasoning(self, question: str, on_step: Optional[StepCallback] = None) -> Dict[str, str]:
+        """chained_reasoningの非同期版"""
+        outputs = await self._arun_steps("chained_reasoning", self.chained_steps, {"question": question}, on_step)
+        return self._chained_result(outputs)
+
+    def astream_direct_reasoning(self, question: str, on_step: Optional[StepCallback] = None) -> AsyncIterator[StepChunk]:
+        """stream_direct_reasoningの非同期版"""
+        return self._astream_steps("direct_reasoning", self.direct_steps, {"question": question}, on_step)
+
+    def astream_chained_reasoning(self, question: str, on_step: Optional[StepCallback] = None) -> AsyncIterator[StepChunk]:
+        """stream_chained_reasoningの非同期版"""
+        return self._astream_steps("chained_reasoning", self.chained_steps, {"question": question}, on_step)
+
+    # 自己整合性：構造化された推論の全体（最後に答えの行）を候補として複数生成する
+    consistency_step = PatternStep("samples", "{question}" + ANSWER_INSTRUCTION)
+
+    def consistent_reasoning(
+        self, question: str, on_step: Optional[StepCallback] = None, samples: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """自己整合性パターン（推論の候補を複数生成し、答えを多数決する）"""
+        return self._self_consistency("reasoning_consistency", self.consistency_step, question, samples, on_step)
+
+    async def aconsistent_reasoning(
+        self, question: str, on_step: Optional[StepCallback] = None, samples: Optional[int] = None
+    ) -> Dict[str, Any]:
+        """consistent_reasoningの非同期版"""
+        return await self._aself_consistency("reasoning_consistency", self.consistency_step, question, samples, on_step)
+
+    def batch_direct_reasoning(self, questions: List[str], max_concurrency: Optional[int] = None) -> List[BatchOutput]:
+        """direct_reasoningを複数の質問に対してまとめて実行"""
+        outputs = self._batch_steps("direct_reasoning", self.direct_steps, [{"question": q} for q in questions], max_concurrency)
+        return _build_results(outputs, self._direct_result)
+
+    def batch_chained_reasoning(self, questions: List[str], max_concurrency: Optional[int] = None) -> List[BatchOutput]:
+        """chained_reasoningを複数の質問に対してまとめて実行"""
+        outputs = self._batch_steps("chained_reasoning", self.chained_steps, [{"question": q} for q in questions], max_concurrency)
+        return _build_results(outputs, self._chained_result)
+
+    async def abatch_direct_reasoning(self, questions: List[str], max_concurrency: Optional[int] = None) -> List[BatchOutput]:
+        """batch_direct_reasoningの非同期版"""
+        outputs = await self._abatch_steps("direct_reasoning", self.direct_steps, [{"question": q} for q in questions], max_concurrency)
+        return _build_results(outputs, self._direct_result)
+
+    async def abatch_chained_reasoning(self, questions: List[str], max_concurrency: Optional[int] = None) -> List[BatchOutput]:
+        """batch_chained_reasoningの非同期版"""
+        outputs = await self._abatch_steps("chained_reasoning", self.chained_steps, [{"question": q} for q in questions], max_concurrency)
+        return _build_results(outputs, self._chained_result)
+
+    def _direct_result(self, outputs: Dict[str, str]) -> Dict[str, str]:
+        """直接推論の結果を組み立てる"""
         return {
-            "decomposition": decomposition['text'],
-            "data_analysis": data_analysis['text'],
-            "assumptions": assumptions['text'],
-            "final_result": final_result['text']
+            "assumptions": outputs["assumptions"],
+            "data_processing": outputs["data_processing"],
+            "reasoning": outputs["reasoning"]
         }
 
-class EvaluatorOptimizer:
-    def __init__(self):
-        self.generator = self._initialize_llm("generator")
-        self.evaluator = self._initialize_llm("evaluator")
-        self.optimizer = self._initialize_llm("optimizer")
-    
-    def _initialize_llm(self, role: str):
-        return ChatGoogleGenerativeAI(
-            model="gemini-2.0-flash-lite",
-            temperature=0.7,
-            convert_system_message_to_human=True
-        )
-    
-    def generate_optimized_response(self, question: str) -> Dict[str, Any]:
-        """Evaluator-Optimizerワークフロー"""
-        iterations = []
-        
-        # 初期回答生成
-        initial_response = self.generator.invoke({
-            "question": question
-        })
+    def _chained_result(self, outputs: Dict[str, str]) -> Dict[str, str]:
+        """チェーン推論の結果を組み立てる"""
+        return {
+            "decomposition": outputs["decomposition"],
+            "data_analysis": outputs["data_analysis"],
+            "assumptions": outputs["assumptions"],
+            "final_result": outputs["final_result"]
+        }
+
+class EvaluatorOptimizer(BaseModel):
+    """生成した回答を評価（点数と改善点）し、目標の点数に届くか改善が頭打ちになるまで最適化を繰り返す"""
+    generate_step = PatternStep("response", "{question}")
+    evaluation_template = (
+        "以下の質問に対する回答を評価してください。\n\n質問: {question}\n\n回答:\n{response}\n\n"
+        "0〜10の点数と改善点を、次のJSON形式だけで答えてください。\n"
+        '{{"score": 点数, "critique": "改善点"}}'
+    )
+    optimization_template = (
+        "以下の評価に基づいて、質問への回答を改善してください。\n\n質問: {question}\n\n"
+        "現在の回答:\n{response}\n\n評価（{score}点）:\n{critique}\n\n改善した回答だけを出力してください。"
+    )
+    pattern = "evaluator_optimizer"
+
+    def __init__(
+        self,
+        gemini_config: Optional[GeminiConfig] = None,
+        prompt_config: Optional[PromptConfig] = None,
+        evaluator_config: Optional[EvaluatorConfig] = None
+    ):
+        super().__init__(gemini_config, prompt_config)
+        self.evaluator_config = evaluator_config or EvaluatorConfig()
+        # 生成・評価・最適化の各ロールは同じ設定の共有クライアントを使う
+        self.generator = self.llm
+        self.evaluator = self.llm
+        self.optimizer = self.llm
+
+    def evaluation_step(self, iteration: int) -> PatternStep:
+        """iteration回目の評価ステップ"""
+        return PatternStep(f"evaluation{iteration}", self.evaluation_template)
+
+    def optimization_step(self, iteration: int) -> PatternStep:
+        """iteration回目の評価に基づく最適化ステップ"""
+        return PatternStep(f"optimized_response{iteration}", self.optimization_template)
+
+    def step_labels(self) -> Dict[str, str]:
+        """ステップ名 → 表示名（最大回数まで繰り返した場合のすべてのステップ）"""
+        labels = {self.generate_step.name: "初期回答生成"}
+        for i in range(1, self.evaluator_config.max_iterations + 1):
+            labels[self.evaluation_step(i).name] = f"評価（{i}回目）"
+            if i < self.evaluator_config.max_iterations:
+                labels[self.optimization_step(i).name] = f"最適化（{i}回目）"
+        return labels
+
+    def _evaluate(self, iterations: List[Dict[str, Any]], response: str, evaluation: str, started: float) -> Optional[str]:
+        """評価をiterationsに記録し、終える理由（続ける場合はNone）を返す"""
+        if evaluation == SKIPPED_OUTPUT and iterations:
+            # 予算を使い切って評価できなかった回答は記録せず、それまでの最良の回答で終える
+            return "budget"
+        score, critique = parse_evaluation(evaluation)
+        previous = iterations[-1]["score"] if iterations else None
         iterations.append({
-            "iteration": 1,
-            "response": initial_response['text']
-        })
-        
-        # 評価
-        evaluation = self.evaluator.invoke({
-            "question": f"以下の回答を評価し、改善点を指摘してください。\n\n{initial_response['text']}"
-        })
-        iterations[0]["evaluation"] = evaluation['text']
-        
-        # 最適化
-        optimized_response = self.optimizer.invoke({
-            "question": f"以下の評価に基づいて、回答を最適化してください。\n\n{evaluation['text']}"
+            "iteration": len(iterations) + 1,
+            "response": response,
+            "score": score,
+            "critique": critique,
+            "evaluation": evaluation,
+            "optimized_response": None,
+            "elapsed": time.perf_counter() - started
         })
-        iterations[0]["optimized_response"] = optimized_response['text']
-        
+        config = self.evaluator_config
+        budget = current_budget()
+        if budget is not None and budget.exhausted is not None:
+            return "budget"
+        if score >= config.target_score:
+            return "target_score"
+        if previous is not None and score - previous < config.min_improvement:
+            return "plateau"
+        if len(iterations) >= config.max_iterations:
+            return "max_iterations"
+        return None
+
+    def _optimization_context(self, question: str, iteration: Dict[str, Any]) -> Dict[str, str]:
+        """最適化ステップの入力"""
+        return {
+            "question": question,
+            "response": iteration["response"],
+            "score": _format_score(iteration["score"]),
+            "critique": iteration["critique"]
+        }
+
+    def _optimized(self, iteration: Dict[str, Any], response: str, started: float) -> None:
+        """最適化の結果と、評価から最適化までの所要時間を記録"""
+        iteration["optimized_response"] = response
+        iteration["elapsed"] = time.perf_counter() - started
+
+    def _result(self, iterations: List[Dict[str, Any]], stop_reason: str) -> Dict[str, Any]:
+        """最も点数の高い回答（同点なら後のもの）を最終回答にする"""
+        best = max(iterations, key=lambda it: (it["score"], it["iteration"]))
         return {
             "iterations": iterations,
-            "final_response": optimized_response['text']
+            "final_response": best["response"],
+            "final_score": best["score"],
+            # target_score（目標に到達）・plateau（改善が頭打ち）・max_iterations（最大回数）・budget（実行の予算を使い切った）
+            "stop_reason": stop_reason
         }
 
-class DebateBasedCooperation(BaseModel):
-    def _create_chain(self) -> LLMChain:
-        """ディベートのプロンプトチェーンを作成"""
-        return LLMChain(
-            llm=self.llm,
-            prompt=PromptTemplate(
-                input_variables=["question", "position_a_name", "position_b_name"],
-                template="""
-                以下の質問について、{position_a_name}と{position_b_name}の両方の視点から議論を行い、最適な回答を導き出してください。
-                質問: {question}
-                """
+    def generate_optimized_response(self, question: str, on_step: Optional[StepCallback] = None) -> Dict[str, Any]:
+        """Evaluator-Optimizerワークフロー"""
+        context = {"question": question}
+        response = self._run_steps(self.pattern, [self.generate_step], context, on_step)["response"]
+        iterations: List[Dict[str, Any]] = []
+        while True:
+            started = time.perf_counter()
+            step = self.evaluation_step(len(iterations) + 1)
+            evaluation = self._run_steps(self.pattern, [step], {**context, "response": response}, on_step)[step.name]
+            stop_reason = self._evaluate(iterations, response, evaluation, started)
+            if stop_reason is not None:
+                return self._result(iterations, stop_reason)
+            step = self.optimization_step(len(iterations))
+            response = self._run_steps(
+                self.pattern, [step], self._optimization_context(question, iterations[-1]), on_step
+            )[step.name]
+            self._optimized(iterations[-1], response, started)
+
+    async def agenerate_optimized_response(self, question: str, on_step: Optional[StepCallback] = None) -> Dict[str, Any]:
+        """generate_optimized_responseの非同期版"""
+        context = {"question": question}
+        response = (await self._arun_steps(self.pattern, [self.generate_step], context, on_step))["response"]
+        iterations: List[Dict[str, Any]] = []
+        while True:
+            started = time.perf_counter()
+            step = self.evaluation_step(len(iterations) + 1)
+            evaluation = (await self._arun_steps(self.pattern, [step], {**context, "response": response}, on_step))[step.name]
+            stop_reason = self._evaluate(iterations, response, evaluation, started)
+            if stop_reason is not None:
+                return self._result(iterations, stop_reason)
+            step = self.optimization_step(len(iterations))
+            response = (await self._arun_steps(
+                self.pattern, [step], self._optimization_context(question, iterations[-1]), on_step
+            ))[step.name]
+            self._optimized(iterations[-1], response, started)
+
+    def stream_optimized_response(self, question: str, on_step: Optional[StepCallback] = None) -> Iterator[StepChunk]:
+        """Evaluator-Optimizerワークフロー（ステップごとにトークンを逐次返す）
+
+        ジェネレータの戻り値はgenerate_optimized_responseと同じ結果。
+        """
+        context = {"question": question}
+        outputs = yield from self._stream_steps(self.pattern, [self.generate_step], context, on_step)
+        response = outputs["response"]
+        iterations: List[Dict[str, Any]] = []
+        while True:
+            started = time.perf_counter()
+            step = self.evaluation_step(len(iterations) + 1)
+            outputs = yield from self._stream_steps(self.pattern, [step], {**context, "response": response}, on_step)
+            stop_reason = self._evaluate(iterations, response, outputs[step.name], started)
+            if stop_reason is not None:
+                return self._result(iterations, stop_reason)
+            step = self.optimization_step(len(iterations))
+            outputs = yield from self._stream_steps(
+                self.pattern, [step], self._optimization_context(question, iterations[-1]), on_step
             )
-        )
+            response = outputs[step.name]
+            self._optimized(iterations[-1], response, started)
 
-    def generate_debate_response(self, question: str) -> Dict[str, Any]:
-        """ディベートベースの協調パターン"""
+    async def astream_optimized_response(self, question: str, on_step: Optional[StepCallback] = None) -> AsyncIterator[StepChunk]:
+        """stream_optimized_responseの非同期版"""
+        context = {"question": question}
+
+        async def stream(step: PatternStep, inputs: Dict[str, str], texts: List[str]) -> AsyncIterator[StepChunk]:
+            async for chunk in self._astream_steps(self.pattern, [step], inputs, on_step):
+                texts.append(chunk.text)
+                yield chunk
+
+        texts: List[str] = []
+        async for chunk in stream(self.generate_step, context, texts):
+            yield chunk
+        response = "".join(texts)
+        iterations: List[Dict[str, Any]] = []
+        while True:
+            started = time.perf_counter()
+            texts = []
+            async for chunk in stream(self.evaluation_step(len(iterations) + 1), {**context, "response": response}, texts):
+                yield chunk
+            if self._evaluate(iterations, response, "".join(texts), started) is not None:
+                return
+            texts = []
+            async for chunk in stream(
+                self.optimization_step(len(iterations)), self._optimization_context(question, iterations[-1]), texts
+            ):
+                yield chunk
+            response = "".join(texts)
+            self._optimized(iterations[-1], response, started)
+
+    def _batch_evaluated(
+        self,
+        live: List[int],
+        outputs: List[Union[Dict[str, str], Exception]],
+        responses: List[Any],
+        iterations: List[List[Dict[str, Any]]],
+        stop_reasons: Dict[int, str],
+        started: float
+    ) -> List[int]:
+        """バッチの評価結果を記録し、最適化を続ける質問を返す（失敗した質問は例外を残す）"""
+        continuing = []
+        for i, output in zip(live, outputs):
+            if isinstance(output, Exception):
+                responses[i] = output
+                continue
+            reason = self._evaluate(iterations[i], responses[i], output[f"evaluation{len(iterations[i]) + 1}"], started)
+            if reason is None:
+                continuing.append(i)
+            else:
+                stop_reasons[i] = reason
+        return continuing
+
+    def _batch_optimized(
+        self,
+        live: List[int],
+        outputs: List[Union[Dict[str, str], Exception]],
+        responses: List[Any],
+        iterations: List[List[Dict[str, Any]]],
+        started: float
+    ) -> None:
+        """バッチの最適化結果を記録"""
+        for i, output in zip(live, outputs):
+            if isinstance(output, Exception):
+                responses[i] = output
+            else:
+                responses[i] = output[f"optimized_response{len(iterations[i])}"]
+                self._optimized(iterations[i][-1], responses[i], started)
+
+    def _batch_results(
+        self,
+        responses: List[Any],
+        iterations: List[List[Dict[str, Any]]],
+        stop_reasons: Dict[int, str]
+    ) -> List[BatchOutput]:
+        """各質問の結果を組み立てる（失敗した質問は例外のまま残す）"""
+        return [
+            response if isinstance(response, Exception) else self._result(iterations[i], stop_reasons[i])
+            for i, response in enumerate(responses)
+        ]
+
+    def batch_optimized_response(self, questions: List[str], max_concurrency: Optional[int] = None) -> List[BatchOutput]:
+        """generate_optimized_responseを複数の質問に対してまとめて実行（終えた質問は以降の評価から外す）"""
+        outputs = self._batch_steps(self.pattern, [self.generate_step], [{"question": q} for q in questions], max_concurrency)
+        responses: List[Any] = [o if isinstance(o, Exception) else o["response"] for o in outputs]
+        iterations: List[List[Dict[str, Any]]] = [[] for _ in questions]
+        stop_reasons: Dict[int, str] = {}
+        live = [i for i, response in enumerate(responses) if not isinstance(response, Exception)]
+        for iteration in range(1, self.evaluator_config.max_iterations + 1):
+            started = time.perf_counter()
+            outputs = self._batch_steps(
+                self.pattern, [self.evaluation_step(iteration)],
+                [{"question": questions[i], "response": responses[i]} for i in live], max_concurrency
+            )
+            live = self._batch_evaluated(live, outputs, responses, iterations, stop_reasons, started)
+            if not live:
+                break
+            outputs = self._batch_steps(
+                self.pattern, [self.optimization_step(iteration)],
+                [self._optimization_context(questions[i], iterations[i][-1]) for i in live], max_concurrency
+            )
+            self._batch_optimized(live, outputs, responses, iterations, started)
+            live = [i for i in live if not isinstance(responses[i], Exception)]
+        return self._batch_results(responses, iterations, stop_reasons)
+
+    async def abatch_optimized_response(self, questions: List[str], max_concurrency: Optional[int] = None) -> List[BatchOutput]:
+        """batch_optimized_responseの非同期版"""
+        outputs = await self._abatch_steps(self.pattern, [self.generate_step], [{"question": q} for q in questions], max_concurrency)
+        responses: List[Any] = [o if isinstance(o, Exception) else o["response"] for o in outputs]
+        iterations: List[List[Dict[str, Any]]] = [[] for _ in questions]
+        stop_reasons: Dict[int, str] = {}
+        live = [i for i, response in enumerate(responses) if not isinstance(response, Exception)]
+        for iteration in range(1, self.evaluator_config.max_iterations + 1):
+            started = time.perf_counter()
+            outputs = await self._abatch_steps(
+                self.pattern, [self.evaluation_step(iteration)],
+                [{"question": questions[i], "response": responses[i]} for i in live], max_concurrency
+            )
+            live = self._batch_evaluated(live, outputs, responses, iterations, stop_reasons, started)
+            if not live:
+                break
+            outputs = await self._abatch_steps(
+                self.pattern, [self.optimization_step(iteration)],
+                [self._optimization_context(questions[i], iterations[i][-1]) for i in live], max_concurrency
+            )
+            self._batch_optimized(live, outputs, responses, iterations, started)
+            live = [i for i in live if not isinstance(responses[i], Exception)]
+        return self._batch_results(responses, iterations, stop_reasons)
+
+# JSONになりきらなかった「"score": 7」
+_SCORE_KEY = re.compile(r'"?score"?\s*[:：]\s*"?([0-9]+(?:\.[0-9]+)?)', re.IGNORECASE)
+_SCORE_PATTERNS = [
+    re.compile(r"(?:点数|スコア|評価)\s*[:：は]?\s*([0-9]+(?:\.[0-9]+)?)"),
+    re.compile(r"([0-9]+(?:\.[0-9]+)?)\s*点"),
+]
+# 満点と一緒に書いた点数（「10点満点中7点」「7点（10点満点）」「7/10」）。満点の数字を点数と取り違えないよう先に探す
+_NUMBER_PART = r"[0-9]+(?:\.[0-9]+)?"
+_SCORE_OUT_OF_PATTERNS = [
+    re.compile(rf"(?P<max>{_NUMBER_PART})\s*点満点中\s*(?P<score>{_NUMBER_PART})"),
+    re.compile(rf"(?P<score>{_NUMBER_PART})\s*(?:点\s*[（(]?|[（(])\s*(?P<max>{_NUMBER_PART})\s*点満点"),
+    re.compile(rf"(?P<score>{_NUMBER_PART})\s*/\s*(?P<max>{_NUMBER_PART})"),
+]
+
+def parse_evaluation(text: str) -> Tuple[float, str]:
+    """評価の出力から(0〜10の点数, 改善点)を取り出す
+
+    JSONで返らなかった場合も「点数: 7」「7/10」「10点満点中7点」などの書き方から点数を拾う
+    （10点満点以外は10点満点に換算する）。点数が読み取れなければ0点とし、出力全体を改善点として扱う。
+    """
+    critique = text.strip()
+    match = re.search(r"\{.*\}", text, re.DOTALL)
+    if match:
         try:
-            # 立場Aからの意見
-            position_a_opinion = str(self._get_llm_response(
-                f"{self.position_a['name']}の視点から以下の質問について意見を述べてください。{self.position_a['focus']}してください。\n質問: {question}"
-            ))
-            
-            # 立場Bからの反論
-            position_b_rebuttal = str(self._get_llm_response(
-                f"{self.position_b['name']}の視点から以下の意見に対して反論してください。{self.position_b['focus']}してください。\n意見: {position_a_opinion}"
-            ))
-            
-            # 立場Aからの再反論
-            position_a_rebuttal = str(self._get_llm_response(
-                f"{self.position_a['name']}の視点から以下の反論に対して再反論してください。{self.position_a['focus']}してください。\n反論: {position_b_rebuttal}"
-            ))
-            
-            # 立場Bからの再反論
-            position_b_final_rebuttal = str(self._get_llm_response(
-                f"{self.position_b['name']}の視点から以下の再反論に対して最終的な反論をしてください。{self.position_b['focus']}してください。\n再反論: {position_a_rebuttal}"
-            ))
-            
-            # 合意形成
-            consensus = str(self._get_llm_response(
-                f"以下の議論を踏まえて、{self.position_a['name']}と{self.position_b['name']}の両方を考慮した合意形成を行ってください。\n\n{self.position_a['name']}の意見: {position_a_opinion}\n{self.position_b['name']}の反論: {position_b_rebuttal}\n{self.position_a['name']}の再反論: {position_a_rebuttal}\n{self.position_b['name']}の最終反論: {position_b_final_rebuttal}"
-            ))
-            
-            return {
-                "iterations": [{
-                    "iteration": 1,
-                    "position_a_opinion": position_a_opinion,
-                    "position_b_rebuttal": position_b_rebuttal,
-                    "position_a_rebuttal": position_a_rebuttal,
-                    "position_b_final_rebuttal": position_b_final_rebuttal,
-                    "position_a": self.position_a,
-                    "position_b": self.position_b
-                }],
-                "final_response": consensus
+            data = json.loads(match.group(0))
+            if isinstance(data, dict) and "score" in data:
+                critique = str(data.get("critique", critique))
+                return min(max(float(data["score"]), 0.0), 10.0), critique
+        except (ValueError, TypeError):
+            pass
+    found = _SCORE_KEY.search(text)
+    if found:
+        return min(max(float(found.group(1)), 0.0), 10.0), critique
+    for pattern in _SCORE_OUT_OF_PATTERNS:
+        for found in pattern.finditer(text):
+            score, maximum = float(found.group("score")), float(found.group("max"))
+            # 日付（2024/10）など満点を超える組み合わせは点数として扱わない
+            if 0 < maximum and score <= maximum:
+                return score * 10 / maximum, critique
+    for pattern in _SCORE_PATTERNS:
+        found = pattern.search(text)
+        if found:
+            return min(max(float(found.group(1)), 0.0), 10.0), critique
+    return 0.0, critique
+
+def _format_score(score: float) -> str:
+    return str(int(score)) if float(score).is_integer() else f"{score:.1f}"
+
+class DebateBasedCooperation(BaseModel):
+    """N個の立場がRラウンド議論して合意を形成するパターン
+
+    各ラウンドでは全立場の発言を前のラウンドの議論に対して同時に生成するため、
+    所要時間は立場の数ではなくラウンド数に比例する。全立場の発言が前のラウンドから
+    ほとんど変わらなくなったら（収束したら）残りのラウンドを省いて合意形成に進む。
+    """
+    # {name}・{focus}は立場ごとに埋め込み、{{question}}などは実行時に埋め込む
+    opening_template = "{name}の視点から以下の質問について意見を述べてください。{focus}してください。\n質問: {{question}}"
+    rebuttal_template = (
+        "{name}の視点から、前のラウンドの議論を踏まえて意見を述べてください。"
+        "他の立場の主張に反論し、{focus}してください。\n質問: {{question}}\n\n前のラウンドの議論:\n{{transcript}}"
+    )
+    consensus_step = PatternStep(
+        "consensus",
+        "以下の議論を踏まえて、{positions}のすべての立場を考慮した合意形成を行ってください。\n\n{transcript}"
+    )
+    pattern = "debate_based_cooperation"
+
+    def __init__(
+        self,
+        gemini_config: Optional[GeminiConfig] = None,
+        prompt_config: Optional[PromptConfig] = None,
+        positions: Optional[List[Dict[str, str]]] = None,
+        debate_config: Optional[DebateConfig] = None
+    ):
+        super().__init__(gemini_config, prompt_config)
+        # 立場の定義（name・emoji・focus・style）。指定しなければ革新的・保守的の2つ
+        self.positions = positions or [self.position_a, self.position_b]
+        self.debate_config = debate_config or DebateConfig()
+        # 1ラウンドの全立場の発言を同時に生成する
+        self.max_step_concurrency = max(self.max_step_concurrency, len(self.positions))
+
+    def position_key(self, index: int) -> str:
+        """立場のキー（position_a, position_b, ...）"""
+        return f"position_{string.ascii_lowercase[index]}" if index < 26 else f"position_{index + 1}"
+
+    def round_steps(self, round_number: int) -> List[PatternStep]:
+        """1ラウンド分の各立場の発言ステップ"""
+        template = self.opening_template if round_number == 1 else self.rebuttal_template
+        return [
+            PatternStep(
+                f"round{round_number}_{self.position_key(i)}",
+                template.format(name=_escape_braces(position["name"]), focus=_escape_braces(position["focus"]))
+            )
+            for i, position in enumerate(self.positions)
+        ]
+
+    def step_labels(self) -> Dict[str, str]:
+        """ステップ名 → 表示名（全ラウンドと合意形成）"""
+        labels = {
+            step.name: f"{position['name']}（ラウンド{round_number}）"
+            for round_number in range(1, self.debate_config.rounds + 1)
+            for step, position in zip(self.round_steps(round_number), self.positions)
+        }
+        labels[self.consensus_step.name] = "合意形成"
+        return labels
+
+    def _debate_context(self, question: str) -> Dict[str, str]:
+        """プロンプトに埋め込む質問と立場の一覧"""
+        return {"question": question, "positions": "、".join(p["name"] for p in self.positions)}
+
+    def _round_context(self, context: Dict[str, str], rounds: List[Dict[str, Any]]) -> Dict[str, str]:
+        """次のラウンドの入力（直前のラウンドの議論）"""
+        return {**context, "transcript": self._transcript(rounds[-1:])}
+
+    def _transcript(self, rounds: List[Dict[str, Any]]) -> str:
+        """ラウンドの発言を立場名付きの文章にする"""
+        blocks = []
+        for debate_round in rounds:
+            lines = [f"【ラウンド{debate_round['round']}】"] if len(rounds) > 1 else []
+            for i, position in enumerate(self.positions):
+                lines.append(f"{position['name']}: {debate_round['statements'][self.position_key(i)]}")
+            blocks.append("\n".join(lines))
+        return "\n\n".join(blocks)
+
+    def _round(self, round_number: int, outputs: Dict[str, str]) -> Dict[str, Any]:
+        """ステップの出力から1ラウンド分の記録を作る"""
+        return {
+            "round": round_number,
+            "statements": {
+                self.position_key(i): outputs[f"round{round_number}_{self.position_key(i)}"]
+                for i in range(len(self.positions))
             }
-        except Exception as e:
-            st.error(f"Error in Debate-based Cooperation: {str(e)}")
-            return {"final_response": "処理中にエラーが発生しました。"} 
\ No newline at end of file
+        }
+
+    def _converged(self, rounds: List[Dict[str, Any]]) -> bool:
+        """最後のラウンドで全立場の発言が前のラウンドからほとんど変わっていなければTrue"""
+        if len(rounds) < 2:
+            return False
+        previous, latest = rounds[-2]["statements"], rounds[-1]["statements"]
+        threshold = self.debate_config.convergence_threshold
+        return all(_similarity(previous[key], latest[key]) >= threshold for key in latest)
+
+    def _should_stop(self, rounds: List[Dict[str, Any]]) -> bool:
+        """残りのラウンドを省くか（最終ラウンドの後は省くものがない。実行の予算を使い切っていれば省く）"""
+        if len(rounds) >= self.debate_config.rounds:
+            return False
+        budget = current_budget()
+        return (budget is not None and budget.exhausted is not None) or self._converged(rounds)
+
+    def generate_debate_response(self, question: str, on_step: Optional[StepCallback] = None) -> Dict[str, Any]:
+        """ディベートベースの協調パターン"""
+        context = self._debate_context(question)
+        rounds: List[Dict[str, Any]] = []
+        for round_number in range(1, self.debate_config.rounds + 1):
+            outputs = self._run_steps(
+                self.pattern, self.round_steps(round_number), self._round_context(context, rounds), on_step
+            )
+            rounds.append(self._round(round_number, outputs))
+            if self._should_stop(rounds):
+                break
+        outputs = self._run_steps(
+            self.pattern, [self.consensus_step], {**context, "transcript": self._transcript(rounds)}, on_step
+        )
+        return self._result(rounds, outputs["consensus"])
+
+    async def agenerate_debate_response(self, question: str, on_step: Optional[StepCallback] = None) -> Dict[str, Any]:
+        """generate_debate_responseの非同期版"""
+        context = self._debate_context(question)
+        rounds: List[Dict[str, Any]] = []
+        for round_number in range(1, self.debate_config.rounds + 1):
+            outputs = await self._arun_steps(
+                self.pattern, self.round_steps(round_number), self._round_context(context, rounds), on_step
+            )
+            rounds.append(self._round(round_number, outputs))
+            if self._should_stop(rounds):
+                break
+        outputs = await self._arun_steps(
+            self.pattern, [self.consensus_step], {**context, "transcript": self._transcript(rounds)}, on_step
+        )
+        return self._result(rounds, outputs["consensus"])
+
+    def _result(self, rounds: List[Dict[str, Any]], consensus: str) -> Dict[str, Any]:
+        """ラウンドの記録と合意形成から結果を組み立てる"""
+        if consensus == SKIPPED_OUTPUT:
+            # 予算を使い切って合意形成できなかった場合は、最後のラウンドの議論を最終回答の代わりにする
+            consensus = f"{SKIPPED_OUTPUT}\n\n{self._transcript(rounds[-1:])}"
+        return {
+            "positions": [{**position, "key": self.position_key(i)} for i, position in enumerate(self.positions)],
+            "rounds": rounds,
+            # 収束したため予定より少ないラウンドで終えた場合はTrue
+            "converged": len(rounds) < self.debate_config.rounds and self._converged(rounds),
+            "final_response": consensus
+        }
+
+    def stream_debate_response(self, question: str, on_step: Optional[StepCallback] = None) -> Iterator[StepChunk]:
+        """ディベートベースの協調パターン（ステップごとにトークンを逐次返す）
+
+        各ラウンドの全立場の発言は同時に生成し、チャンクを届いた順に返す。
+        ジェネレータの戻り値はgenerate_debate_responseと同じ結果。
+        """
+        context = self._debate_context(question)
+        rounds: List[Dict[str, Any]] = []
+        for round_number in range(1, self.debate_config.rounds + 1):
+            outputs = yield from self._stream_steps(
+                self.pattern, self.round_steps(round_number), self._round_context(context, rounds), on_step
+            )
+            rounds.append(self._round(round_number, outputs))
+            if self._should_stop(rounds):
+                break
+        outputs = yield from self._stream_steps(
+            self.pattern, [self.consensus_step], {**context, "transcript": self._transcript(rounds)}, on_step
+        )
+        return self._result(rounds, outputs["consensus"])
+
+    async def astream_debate_response(self, question: str, on_step: Optional[StepCallback] = None) -> AsyncIterator[StepChunk]:
+        """stream_debate_responseの非同期版"""
+        context = self._debate_context(question)
+        rounds: List[Dict[str, Any]] = []
+        for round_number in range(1, self.debate_config.rounds + 1):
+            outputs: Dict[str, str] = {}
+            async for chunk in self._astream_steps(
+                self.pattern, self.round_steps(round_number), self._round_context(context, rounds), on_step
+            ):
+                outputs[chunk.step] = outputs.get(chunk.step, "") + chunk.text
+                yield chunk
+            rounds.append(self._round(round_number, outputs))
+            if self._should_stop(rounds):
+                break
+        async for chunk in self._astream_steps(
+            self.pattern, [self.consensus_step], {**context, "transcript": self._transcript(rounds)}, on_step
+        ):
+            yield chunk
+
+    def _record_rounds(
+        self,
+        round_number: int,
+        live: List[int],
+        outputs: List[Union[Dict[str, str], Exception]],
+        rounds: List[List[Dict[str, Any]]],
+        failed: Dict[int, Exception]
+    ) -> None:
+        """バッチの1ラウンド分の出力を各質問の記録に加える（失敗した質問は以降から外す）"""
+        for i, output in zip(live, outputs):
+            if isinstance(output, Exception):
+                failed[i] = output
+            else:
+                rounds[i].append(self._round(round_number, output))
+
+    def _batch_live(self, rounds: List[List[Dict[str, Any]]], failed: Dict[int, Exception], round_number: int) -> List[int]:
+        """次のラウンドを実行する質問（失敗・収束した質問を除く）"""
+        return [
+            i for i, question_rounds in enumerate(rounds)
+            if i not in failed and len(question_rounds) == round_number - 1
+            and not (question_rounds and self._converged(question_rounds))
+        ]
+
+    def _batch_results(
+        self,
+        rounds: List[List[Dict[str, Any]]],
+        failed: Dict[int, Exception],
+        live: List[int],
+        outputs: List[Union[Dict[str, str], Exception]]
+    ) -> List[BatchOutput]:
+        """合意形成の出力と各質問のラウンドから結果を組み立てる"""
+        results: List[BatchOutput] = [failed.get(i) for i in range(len(rounds))]
+        for i, output in zip(live, outputs):
+            results[i] = output if isinstance(output, Exception) else self._result(rounds[i], output["consensus"])
+        return results
+
+    def batch_debate_response(self, questions: List[str], max_concurrency: Optional[int] = None) -> List[BatchOutput]:
+        """generate_debate_responseを複数の質問に対してまとめて実行（収束した質問は以降のラウンドから外す）"""
+        contexts = [self._debate_context(q) for q in questions]
+        rounds: List[List[Dict[str, Any]]] = [[] for _ in questions]
+        failed: Dict[int, Exception] = {}
+        for round_number in range(1, self.debate_config.rounds + 1):
+            live = self._batch_live(rounds, failed, round_number)
+            if not live:
+                break
+            outputs = self._batch_steps(
+                self.pattern, self.round_steps(round_number),
+                [self._round_context(contexts[i], rounds[i]) for i in live], max_concurrency
+            )
+            self._record_rounds(round_number, live, outputs, rounds, failed)
+        live = [i for i in range(len(questions)) if i not in failed]
+        outputs = self._batch_steps(
+            self.pattern, [self.consensus_step],
+            [{**contexts[i], "transcript": self._transcript(rounds[i])} for i in live], max_concurrency
+        )
+        return self._batch_results(rounds, failed, live, outputs)
+
+    async def abatch_debate_response(self, questions: List[str], max_concurrency: Optional[int] = None) -> List[BatchOutput]:
+        """batch_debate_responseの非同期版"""
+        contexts = [self._debate_context(q) for q in questions]
+        rounds: List[List[Dict[str, Any]]] = [[] for _ in questions]
+        failed: Dict[int, Exception] = {}
+        for round_number in range(1, self.debate_config.rounds + 1):
+            live = self._batch_live(rounds, failed, round_number)
+            if not live:
+                break
+            outputs = await self._abatch_steps(
+                self.pattern, self.round_steps(round_number),
+                [self._round_context(contexts[i], rounds[i]) for i in live], max_concurrency
+            )
+            self._record_rounds(round_number, live, outputs, rounds, failed)
+        live = [i for i in range(len(questions)) if i not in failed]
+        outputs = await self._abatch_steps(
+            self.pattern, [self.consensus_step],
+            [{**contexts[i], "transcript": self._transcript(rounds[i])} for i in live], max_concurrency
+        )
+        return self._batch_results(rounds, failed, live, outputs)
+
+def _escape_braces(text: str) -> str:
+    """テンプレートに埋め込む固定の文字列の波括弧をエスケープ"""
+    return text.replace("{", "{{").replace("}", "}}")
+
+@lru_cache(maxsize=None)
+def _vectorizer() -> "HashingVectorizer":
+    """発言の比較に使うベクトル化（numpyは最初に比較するときに読み込む）"""
+    from .semantic_cache import HashingVectorizer
+    return HashingVectorizer()
+
+def _similarity(a: str, b: str) -> float:
+    """2つの発言の文字n-gramのコサイン類似度"""
+    vectorizer = _vectorizer()
+    return float(vectorizer.transform(a) @ vectorizer.transform(b))
+
+class PipelinePattern(BaseModel):
+    """データで定義したパイプライン（src/pipeline.Pipeline）を実行するパターン
+
+    新しいパターンはクラスを書かずに、ステップのテンプレートと依存関係だけで追加できる:
+
+        PipelinePattern(Pipeline.from_json("pros_cons.json")).run("質問")
+    """
+    def __init__(
+        self,
+        pipeline: Pipeline,
+        gemini_config: Optional[GeminiConfig] = None,
+        prompt_config: Optional[PromptConfig] = None
+    ):
+        self.pipeline = pipeline
+        super().__init__(gemini_config, prompt_config)
+
+    def _context(self, question: str) -> Dict[str, str]:
+        """プロンプトに埋め込む質問と固定値"""
+        return {**self.pipeline.variables, "question": question}
+
+    def _result(self, outputs: Dict[str, str]) -> Dict[str, str]:
+        """各ステップの出力と最終回答"""
+        result = {step.name: outputs[step.name] for step in self.pipeline.steps}
+        result["final_response"] = outputs[self.pipeline.output]
+        return result
+
+    def run(self, question: str, on_step: Optional[StepCallback] = None) -> Dict[str, str]:
+        """パイプラインを実行（依存関係のないステップは同時に実行）"""
+        outputs = self._run_steps(self.pipeline.name, self.pipeline.steps, self._context(question), on_step)
+        return self._result(outputs)
+
+    async def arun(self, question: str, on_step: Optional[StepCallback] = None) -> Dict[str, str]:
+        """runの非同期版"""
+        outputs = await self._arun_steps(self.pipeline.name, self.pipeline.steps, self._context(question), on_step)
+        return self._result(outputs)
+
+    def stream_run(self, question: str, on_step: Optional[StepCallback] = None) -> Iterator[StepChunk]:
+        """パイプラインを実行（ステップごとにトークンを逐次返す）"""
+        return self._stream_steps(self.pipeline.name, self.pipeline.steps, self._context(question), on_step)
+
+    def astream_run(self, question: str, on_step: Optional[StepCallback] = None) -> AsyncIterator[StepChunk]:
+        """stream_runの非同期版"""
+        return self._astream_steps(self.pipeline.name, self.pipeline.steps, self._context(question), on_step)
+
+    def batch_run(self, questions: List[str], max_concurrency: Optional[int] = None) -> List[BatchOutput]:
+        """runを複数の質問に対してまとめて実行"""
+        outputs = self._batch_steps(self.pipeline.name, self.pipeline.steps, [self._context(q) for q in questions], max_concurrency)
+        return _build_results(outputs, self._result)
+
+    async def abatch_run(self, questions: List[str], max_concurrency: Optional[int] = None) -> List[BatchOutput]:
+        """batch_runの非同期版"""
+        outputs = await self._abatch_steps(self.pipeline.name, self.pipeline.steps, [self._context(q) for q in questions], max_concurrency)
+        return _build_results(outputs, self._result)
@@ -0,0 +1,225 @@
+"""パターンのステップを依存関係のグラフ（DAG）として定義・実行する
+
+ステップのテンプレートに埋め込んだ名前（例: "{analysis}"）のうち、他のステップの名前が依存先になる。
+依存先がすべて終わったステップから、上限の数まで同時に実行する。
+新しいパターンはPipelineとしてデータ（dictやJSON）で定義でき、models.PipelinePatternで実行できる。
+"""
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple, TypeVar
+import asyncio
+import contextvars
+import json
+import string
+from .config import GeminiConfig
+
+T = TypeVar("T")
+
+@dataclass
+class PatternStep:
+    """パターンを構成する1ステップ
+
+    templateには質問や前段ステップの出力を名前で埋め込む（例: "{analysis}"）。
+    埋め込んだステップが終わってから実行され、依存関係のないステップとは同時に実行できる。
+    """
+    name: str
+    template: str
+    # テンプレートには埋め込まないが、先に終わっている必要があるステップ
+    inputs: Tuple[str, ...] = ()
+    # このステップだけ別のモデル設定で呼び出す場合に指定（Noneならパターンの設定）
+    config: Optional[GeminiConfig] = None
+
+    @property
+    def variables(self) -> Set[str]:
+        """テンプレートに埋め込んだ名前"""
+        return {name for _, name, _, _ in string.Formatter().parse(self.template) if name}
+
+def dependencies(steps: List[PatternStep]) -> Dict[str, Set[str]]:
+    """ステップ名 → 先に終わっている必要があるステップ名"""
+    names = [step.name for step in steps]
+    duplicated = {name for name in names if names.count(name) > 1}
+    if duplicated:
+        raise ValueError(f"ステップ名が重複しています: {', '.join(sorted(duplicated))}")
+    graph = {}
+    for step in steps:
+        unknown = set(step.inputs) - set(names)
+        if unknown:
+            raise ValueError(f"ステップ{step.name}のinputsに存在しないステップがあります: {', '.join(sorted(unknown))}")
+        graph[step.name] = (step.variables | set(step.inputs)) & set(names)
+    return graph
+
+def topological_order(steps: List[PatternStep]) -> List[PatternStep]:
+    """依存先が先に来る順に並べる（順序に制約がなければ定義順のまま）"""
+    graph = dependencies(steps)
+    done: Set[str] = set()
+    ordered = []
+    pending = list(steps)
+    while pending:
+        ready = next((step for step in pending if graph[step.name] <= done), None)
+        if ready is None:
+            raise ValueError(f"ステップの依存関係が循環しています: {', '.join(step.name for step in pending)}")
+        pending.remove(ready)
+        done.add(ready.name)
+        ordered.append(ready)
+    return ordered
+
+class StepCancelled(Exception):
+    """同じグラフの他のステップが失敗したため、結果を使わずに打ち切ったステップ"""
+    def __init__(self, failed: str):
+        super().__init__(f"ステップ{failed}が失敗したため中断しました")
+        self.failed = failed
+
+def _cancel_running(
+    running: List[PatternStep],
+    steps: List[PatternStep],
+    failed: PatternStep,
+    fail: Callable[[PatternStep, Exception], None]
+) -> None:
+    """失敗したステップと同時に実行中だったステップにも終了（StepCancelled）を通知する"""
+    for step in sorted(running, key=steps.index):
+        fail(step, StepCancelled(failed.name))
+
+def run_graph(
+    steps: List[PatternStep],
+    start: Callable[[PatternStep], Callable[[], T]],
+    finish: Callable[[PatternStep, T], None],
+    fail: Callable[[PatternStep, Exception], None],
+    max_concurrency: int = 4
+) -> None:
+    """依存先が終わったステップから最大max_concurrency個ずつ同時に実行する
+
+    start（実行する関数を返す）・finish・failは呼び出し元のスレッドで呼ぶため、
+    Streamlitの描画などスレッドに縛られた通知をしてよい。実行可能なステップが1つだけのときは
+    スレッドを使わずにその場で実行する。失敗したステップがあれば、実行中の分にはStepCancelledで失敗を通知し、
+    完了を待って例外を送出する（開始したステップには必ず終了か失敗を通知する）。
+    """
+    graph = dependencies(steps)
+    topological_order(steps)
+    done: Set[str] = set()
+    pending = list(steps)
+    running: Dict[Future, PatternStep] = {}
+    pool: Optional[ThreadPoolExecutor] = None
+    try:
+        while pending or running:
+            ready = [step for step in pending if graph[step.name] <= done]
+            if len(ready) == 1 and not running:
+                step = ready[0]
+                pending.remove(step)
+                task = start(step)
+                try:
+                    result = task()
+                except Exception as e:
+                    fail(step, e)
+                    raise
+                done.add(step.name)
+                finish(step, result)
+                continue
+            for step in ready[:max(max_concurrency - len(running), 0)]:
+                pending.remove(step)
+                task = start(step)
+                pool = pool or ThreadPoolExecutor(max_workers=max_concurrency)
+                # 実行中の予算（run_budget）などのコンテキスト変数をスレッドに引き継ぐ
+                running[pool.submit(contextvars.copy_context().run, task)] = step
+            completed, _ = wait(running, return_when=FIRST_COMPLETED)
+            # 定義順に通知する（同時に終わったステップの順序を決定的にするため）
+            for future in sorted(completed, key=lambda f: steps.index(running[f])):
+                step = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    fail(step, e)
+                    _cancel_running(list(running.values()), steps, step, fail)
+                    raise
+                done.add(step.name)
+                finish(step, result)
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+async def arun_graph(
+    steps: List[PatternStep],
+    start: Callable[[PatternStep], Callable[[], Awaitable[T]]],
+    finish: Callable[[PatternStep, T], None],
+    fail: Callable[[PatternStep, Exception], None],
+    max_concurrency: int = 4
+) -> None:
+    """run_graphの非同期版（失敗したステップがあれば実行中の分はキャンセルし、StepCancelledで失敗を通知する）"""
+    graph = dependencies(steps)
+    topological_order(steps)
+    done: Set[str] = set()
+    pending = list(steps)
+    running: Dict[asyncio.Task, PatternStep] = {}
+    try:
+        while pending or running:
+            ready = [step for step in pending if graph[step.name] <= done]
+            for step in ready[:max(max_concurrency - len(running), 0)]:
+                pending.remove(step)
+                running[asyncio.ensure_future(start(step)())] = step
+            completed, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(completed, key=lambda t: steps.index(running[t])):
+                step = running.pop(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    fail(step, e)
+                    _cancel_running(list(running.values()), steps, step, fail)
+                    raise
+                done.add(step.name)
+                finish(step, result)
+    finally:
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+
+@dataclass
+class Pipeline:
+    """データで定義するパターン（ステップのDAGと、最終回答にするステップ）"""
+    name: str
+    steps: List[PatternStep]
+    # final_responseにするステップ（省略時は最後に定義したステップ）
+    output: Optional[str] = None
+    # プロンプトに埋め込む質問以外の固定値
+    variables: Dict[str, str] = field(default_factory=dict)
+
+    def __post_init__(self):
+        topological_order(self.steps)
+        names = {step.name for step in self.steps}
+        if not self.steps:
+            raise ValueError(f"パイプライン{self.name}にステップがありません")
+        self.output = self.output or self.steps[-1].name
+        if self.output not in names:
+            raise ValueError(f"パイプライン{self.name}に出力のステップ{self.output}がありません")
+        for step in self.steps:
+            unknown = step.variables - names - set(self.variables) - {"question"}
+            if unknown:
+                raise ValueError(f"ステップ{step.name}のテンプレートに未定義の名前があります: {', '.join(sorted(unknown))}")
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Pipeline":
+        """dictから作成する
+
+        例: {"name": "pros_cons", "steps": [{"name": "pros", "template": "{question}の利点"}, ...], "output": "summary"}
+        ステップのconfigにはGeminiConfigのフィールドを指定できる。
+        """
+        steps = [
+            PatternStep(
+                name=step["name"],
+                template=step["template"],
+                inputs=tuple(step.get("inputs", ())),
+                config=GeminiConfig(**step["config"]) if step.get("config") else None
+            )
+            for step in data["steps"]
+        ]
+        return cls(
+            name=data["name"],
+            steps=steps,
+            output=data.get("output"),
+            variables=dict(data.get("variables", {}))
+        )
+
+    @classmethod
+    def from_json(cls, path: str) -> "Pipeline":
+        """JSONファイルから作成する"""
+        with open(path, encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
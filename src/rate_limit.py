@@ -0,0 +1,334 @@
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, Optional, TypeVar
+import asyncio
+import random
+import re
+import threading
+import time
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from langchain_core.rate_limiters import BaseRateLimiter
+from .config import RateLimitConfig
+
+T = TypeVar("T")
+# 再試行のたびに(失敗した試行の回数, 例外)で呼ばれるコールバック
+RetryCallback = Callable[[int, BaseException], None]
+
+class TokenBucket:
+    """1分あたりの上限で補充されるトークンバケット（スレッドセーフ）
+
+    reserveは残量が足りなくても先に差し引き（前借り）、前借りが返済されるまでの
+    待ち時間を返す。同時に待つ呼び出しは予約した順に少しずつずれて解放されるため、
+    一斉に再試行して上限を超えることがない。
+    """
+    def __init__(
+        self,
+        rate_per_minute: float,
+        capacity: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.rate = rate_per_minute / 60.0
+        # 既定では10秒分までのバーストを許す
+        self.capacity = capacity if capacity is not None else max(rate_per_minute / 6.0, 1.0)
+        self.clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float = 1.0) -> float:
+        """amount分を差し引き、使ってよくなるまでの待ち秒数を返す（0なら即時）"""
+        with self._lock:
+            self._refill(self.clock())
+            self._tokens -= amount
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def debit(self, amount: float) -> None:
+        """実際の使用量との差分を後から反映する（負なら返却）"""
+        with self._lock:
+            self._refill(self.clock())
+            self._tokens = min(self.capacity, self._tokens - amount)
+
+    @property
+    def available(self) -> float:
+        """現在の残量（前借り中なら負）"""
+        with self._lock:
+            self._refill(self.clock())
+            return self._tokens
+
+class RateLimiter(BaseRateLimiter):
+    """リクエスト数/分とトークン数/分の両方を守るプロセス共有のレート制限
+
+    チャットモデルのrate_limiterとして設定すると、invoke・stream・batch・asyncの
+    すべての呼び出しが実行前にacquireを通る。トークン数は応答後にしか分からないため、
+    estimated_tokensを先に予約し、UsageCallbackHandlerが実際の使用量で差分を精算する。
+    """
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        estimated_tokens: int = 0,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        self.requests = TokenBucket(requests_per_minute, clock=clock) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute, clock=clock) if tokens_per_minute else None
+        self.estimated_tokens = estimated_tokens
+        self.acquired = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+        self.tokens_used = 0
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """1リクエスト分を予約し、待つべき秒数を返す"""
+        wait = self.requests.reserve(1) if self.requests else 0.0
+        if self.tokens:
+            wait = max(wait, self.tokens.reserve(self.estimated_tokens))
+        with self._lock:
+            self.acquired += 1
+            if wait > 0:
+                self.throttled += 1
+                self.wait_seconds += wait
+        return wait
+
+    def _cancel(self) -> None:
+        """待たずに諦めた予約を返却"""
+        if self.requests:
+            self.requests.debit(-1)
+        if self.tokens:
+            self.tokens.debit(-self.estimated_tokens)
+
+    def acquire(self, *, blocking: bool = True) -> bool:
+        wait = self._reserve()
+        if wait > 0:
+            if not blocking:
+                self._cancel()
+                return False
+            time.sleep(wait)
+        return True
+
+    async def aacquire(self, *, blocking: bool = True) -> bool:
+        wait = self._reserve()
+        if wait > 0:
+            if not blocking:
+                self._cancel()
+                return False
+            await asyncio.sleep(wait)
+        return True
+
+    def record_usage(self, total_tokens: int) -> None:
+        """応答の実際のトークン数で予約分を精算"""
+        with self._lock:
+            self.tokens_used += total_tokens
+        if self.tokens:
+            self.tokens.debit(total_tokens - self.estimated_tokens)
+
+    def stats(self) -> Dict[str, float]:
+        """待機の統計"""
+        return {
+            "requests": self.acquired,
+            "throttled": self.throttled,
+            "wait_seconds": self.wait_seconds,
+            "tokens": self.tokens_used,
+        }
+
+class UsageCallbackHandler(BaseCallbackHandler):
+    """応答のusage_metadataからトークン数をRateLimiterへ反映するコールバック"""
+    def __init__(self, limiter: RateLimiter):
+        self.limiter = limiter
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
+        total = 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    total += usage.get("total_tokens", 0)
+        if total:
+            self.limiter.record_usage(total)
+
+# 再試行する例外のクラス名（google.api_core・HTTPクライアント由来）
+_RETRYABLE_NAMES = {
+    "ResourceExhausted", "TooManyRequests", "ServiceUnavailable", "DeadlineExceeded",
+    "InternalServerError", "BadGateway", "GatewayTimeout",
+}
+_RETRYABLE_CODES = {429, 500, 502, 503, 504}
+_RETRY_IN = re.compile(r"retry in ([0-9.]+)\s*s", re.IGNORECASE)
+_STATUS_429 = re.compile(r"\b429\b|RESOURCE_EXHAUSTED")
+
+def _causes(error: BaseException) -> Iterator[BaseException]:
+    """例外とその原因をたどる（ラップされたAPIエラーも判定するため）"""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        yield error
+        error = error.__cause__ or error.__context__
+
+def is_retryable(error: BaseException) -> bool:
+    """レート制限や一時的なサーバーエラーならTrue"""
+    for e in _causes(error):
+        if type(e).__name__ in _RETRYABLE_NAMES or isinstance(e, (TimeoutError, ConnectionError)):
+            return True
+        code = getattr(e, "code", None) or getattr(e, "status_code", None)
+        if isinstance(code, int) and code in _RETRYABLE_CODES:
+            return True
+        if _STATUS_429.search(str(e)):
+            return True
+    return False
+
+def is_invalid_argument(error: BaseException) -> bool:
+    """リクエストの引数が不正（HTTP 400・google.api_coreのInvalidArgument）ならTrue"""
+    for e in _causes(error):
+        if type(e).__name__ == "InvalidArgument":
+            return True
+        code = getattr(e, "code", None) or getattr(e, "status_code", None)
+        if isinstance(code, int) and code == 400:
+            return True
+    return False
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """サーバーが指定した再試行までの秒数（指定がなければNone）"""
+    for e in _causes(error):
+        value = getattr(e, "retry_after", None)
+        if value is not None:
+            return float(value)
+        headers = getattr(getattr(e, "response", None), "headers", None) or {}
+        if headers.get("retry-after"):
+            try:
+                return float(headers["retry-after"])
+            except ValueError:
+                pass
+        # google.rpc.RetryInfo
+        details = getattr(e, "details", None)
+        for detail in details if isinstance(details, (list, tuple)) else []:
+            delay = getattr(detail, "retry_delay", None)
+            if delay is not None:
+                return delay.seconds + delay.nanos / 1e9
+        match = _RETRY_IN.search(str(e))
+        if match:
+            return float(match.group(1))
+    return None
+
+@dataclass
+class RetryPolicy:
+    """ジッター付き指数バックオフで再試行する方針
+
+    サーバーがretry-afterを返した場合はその秒数を下回らないように待つ。
+    """
+    max_attempts: int = 5
+    base_delay: float = 1.0
+    max_delay: float = 60.0
+    retries: int = field(default=0, init=False)
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
+
+    def backoff(self, attempt: int, error: Optional[BaseException] = None) -> float:
+        """attempt回目（1始まり）の失敗後に待つ秒数"""
+        # フルジッター: 0〜上限の一様乱数で、同時に失敗した呼び出しの再試行を分散させる
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+        hint = retry_after(error) if error is not None else None
+        if hint is not None:
+            delay = max(delay, min(hint, self.max_delay))
+        return delay
+
+    def should_retry(self, attempt: int, error: BaseException) -> bool:
+        """attempt回目の失敗を再試行するか"""
+        return attempt < self.max_attempts and is_retryable(error)
+
+    def count_retries(self, n: int = 1) -> None:
+        """再試行の回数を記録"""
+        with self._lock:
+            self.retries += n
+
+    def call(self, fn: Callable[[], T], on_retry: Optional[RetryCallback] = None) -> T:
+        """fnを再試行付きで呼び出す"""
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return fn()
+            except Exception as e:
+                if not self.should_retry(attempt, e):
+                    raise
+                self.count_retries()
+                if on_retry is not None:
+                    on_retry(attempt, e)
+                time.sleep(self.backoff(attempt, e))
+
+    async def acall(self, fn: Callable[[], Awaitable[T]], on_retry: Optional[RetryCallback] = None) -> T:
+        """callの非同期版"""
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await fn()
+            except Exception as e:
+                if not self.should_retry(attempt, e):
+                    raise
+                self.count_retries()
+                if on_retry is not None:
+                    on_retry(attempt, e)
+                await asyncio.sleep(self.backoff(attempt, e))
+
+    def stream(self, fn: Callable[[], Iterator[T]], on_retry: Optional[RetryCallback] = None) -> Iterator[T]:
+        """ストリームを再試行付きで開始する
+
+        最初のチャンクが届く前の失敗だけを再試行する（途中まで返した出力は取り消せないため）。
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            started = False
+            try:
+                for item in fn():
+                    started = True
+                    yield item
+                return
+            except Exception as e:
+                if started or not self.should_retry(attempt, e):
+                    raise
+                self.count_retries()
+                if on_retry is not None:
+                    on_retry(attempt, e)
+                time.sleep(self.backoff(attempt, e))
+
+    async def astream(self, fn: Callable[[], AsyncIterator[T]], on_retry: Optional[RetryCallback] = None) -> AsyncIterator[T]:
+        """streamの非同期版"""
+        attempt = 0
+        while True:
+            attempt += 1
+            started = False
+            try:
+                async for item in fn():
+                    started = True
+                    yield item
+                return
+            except Exception as e:
+                if started or not self.should_retry(attempt, e):
+                    raise
+                self.count_retries()
+                if on_retry is not None:
+                    on_retry(attempt, e)
+                await asyncio.sleep(self.backoff(attempt, e))
+
+def create_rate_limiter(config: Optional[RateLimitConfig] = None) -> Optional[RateLimiter]:
+    """設定からレート制限を作成（上限が指定されていなければNone）"""
+    config = config or RateLimitConfig()
+    if not config.requests_per_minute and not config.tokens_per_minute:
+        return None
+    return RateLimiter(
+        requests_per_minute=config.requests_per_minute,
+        tokens_per_minute=config.tokens_per_minute,
+        estimated_tokens=config.estimated_tokens
+    )
+
+def create_retry_policy(config: Optional[RateLimitConfig] = None) -> RetryPolicy:
+    """設定から再試行の方針を作成"""
+    config = config or RateLimitConfig()
+    return RetryPolicy(
+        max_attempts=config.max_attempts,
+        base_delay=config.base_delay,
+        max_delay=config.max_delay
+    )
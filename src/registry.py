@@ -0,0 +1,203 @@
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional, Tuple, Union
+import importlib
+import threading
+import os
+from .cache import ResponseCache
+from .config import GeminiConfig, load_env
+from .context_budget import ContextBudget
+from .singleflight import SingleFlight
+
+# LangChain（レート制限を含む）・GeminiのSDK・numpyは読み込みに時間がかかるため、import時には読み込まず使うときに読み込む
+if TYPE_CHECKING:
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    from .rate_limit import RateLimiter, RetryPolicy
+    from .semantic_cache import SemanticCache
+
+LLMFactory = Callable[[GeminiConfig], Any]
+
+# パターンのクラス名 → 定義しているモジュール（get_patternで最初に使うときに読み込む）
+PATTERN_MODULES: Dict[str, str] = {
+    "DirectQuery": ".models",
+    "GeminiChainOfThought": ".models",
+    "GeminiReasoning": ".models",
+    "EvaluatorOptimizer": ".models",
+    "DebateBasedCooperation": ".models",
+    "PatternRouter": ".router",
+}
+
+def load_pattern_class(name: str) -> type:
+    """クラス名からパターンのクラスを読み込む"""
+    if name not in PATTERN_MODULES:
+        raise ValueError(f"未対応のパターンです: {name}（{', '.join(PATTERN_MODULES)}）")
+    module = importlib.import_module(PATTERN_MODULES[name], __package__)
+    return getattr(module, name)
+
+def config_key(config: GeminiConfig) -> Tuple:
+    """実際に効く設定値からクライアントのキーを作成"""
+    return (
+        config.model_name,
+        config.temperature,
+        config.top_p,
+        config.top_k,
+        config.max_output_tokens,
+        config.candidate_count,
+        tuple(config.stop_sequences or ()),
+    )
+
+def create_gemini_llm(config: GeminiConfig) -> "ChatGoogleGenerativeAI":
+    """設定からGeminiクライアントを生成（SDKの読み込みに時間がかかるため、最初の生成時に読み込む）"""
+    from langchain_google_genai import ChatGoogleGenerativeAI
+    load_env()
+    return ChatGoogleGenerativeAI(
+        model=config.model_name,
+        google_api_key=os.getenv("GOOGLE_API_KEY"),
+        temperature=config.temperature,
+        top_p=config.top_p,
+        top_k=config.top_k,
+        max_output_tokens=config.max_output_tokens,
+        n=config.candidate_count,
+        stop=config.stop_sequences,
+        convert_system_message_to_human=True,
+        # 再試行はRetryPolicyに一本化する（クライアント内でも再試行すると待ち時間が掛け算になる）
+        max_retries=1
+    )
+
+class ClientRegistry:
+    """LLMクライアント・チェーン・パターンをプロセス内で共有するレジストリ
+
+    同じ設定に対しては常に同じインスタンスを返す。
+    生成はロックで保護しているため、複数スレッド・複数セッションから呼び出してよい。
+    """
+    def __init__(self, llm_factory: Optional[LLMFactory] = None):
+        self._lock = threading.RLock()
+        self._llm_factory = llm_factory or create_gemini_llm
+        self._llms: Dict[Tuple, Any] = {}
+        self._chains: Dict[Tuple, Any] = {}
+        self._patterns: Dict[Tuple, Any] = {}
+        # パターンの各ステップが参照する応答キャッシュ（Noneで無効）
+        self.response_cache: Optional[ResponseCache] = None
+        # パターン単位で言い換えを吸収する意味的キャッシュ（Noneで無効）
+        self.semantic_cache: Optional["SemanticCache"] = None
+        # すべてのクライアントで共有するレート制限（Noneで無効）
+        self.rate_limiter: Optional["RateLimiter"] = None
+        # パターンの各ステップの呼び出しに適用する再試行の方針（最初に参照したときに既定の方針を作る）
+        self._retry_policy: Optional["RetryPolicy"] = None
+        # 同じプロンプトの同時呼び出しを1回の上流呼び出しにまとめる共有テーブル
+        self.singleflight = SingleFlight()
+        # ステップ間の受け渡しのトークン数の予算（Noneで制限しない）
+        self.context_budget: Optional[ContextBudget] = None
+
+    @property
+    def retry_policy(self) -> "RetryPolicy":
+        """パターンの各ステップの呼び出しに適用する再試行の方針"""
+        if self._retry_policy is None:
+            with self._lock:
+                if self._retry_policy is None:
+                    from .rate_limit import RetryPolicy
+                    self._retry_policy = RetryPolicy()
+        return self._retry_policy
+
+    @property
+    def llm_factory(self) -> LLMFactory:
+        """クライアントの生成方法"""
+        return self._llm_factory
+
+    def get_llm(self, config: GeminiConfig):
+        """設定に対応する共有クライアントを取得"""
+        key = config_key(config)
+        llm = self._llms.get(key)
+        if llm is None:
+            with self._lock:
+                llm = self._llms.get(key)
+                if llm is None:
+                    llm = self._with_rate_limiter(self._llm_factory(config))
+                    self._llms[key] = llm
+        return llm
+
+    def _with_rate_limiter(self, llm):
+        """共有のレート制限とトークン使用量の精算をクライアントに設定"""
+        from langchain_core.language_models import BaseChatModel
+        from .rate_limit import UsageCallbackHandler
+        if self.rate_limiter is None or not isinstance(llm, BaseChatModel):
+            return llm
+        callbacks = llm.callbacks.handlers if hasattr(llm.callbacks, "handlers") else list(llm.callbacks or [])
+        return llm.model_copy(update={
+            "rate_limiter": self.rate_limiter,
+            "callbacks": [*callbacks, UsageCallbackHandler(self.rate_limiter)],
+        })
+
+    def get_chain(self, config: GeminiConfig, template: str):
+        """設定とテンプレートに対応する組み立て済みチェーンを取得"""
+        key = (config_key(config), template)
+        chain = self._chains.get(key)
+        if chain is None:
+            with self._lock:
+                chain = self._chains.get(key)
+                if chain is None:
+                    from langchain_core.prompts import PromptTemplate
+                    prompt = PromptTemplate(input_variables=["question"], template=template)
+                    chain = prompt | self.get_llm(config)
+                    self._chains[key] = chain
+        return chain
+
+    def get_pattern(self, pattern_class: Union[type, str], config: Optional[GeminiConfig] = None):
+        """パターンのインスタンスをプロセス内で1度だけ生成して共有
+
+        pattern_classにはクラス名（例: "GeminiReasoning"）も指定でき、その場合はモジュールを最初に使うときに読み込む。
+        """
+        if isinstance(pattern_class, str):
+            pattern_class = load_pattern_class(pattern_class)
+        config = config or GeminiConfig()
+        key = (pattern_class, config_key(config))
+        pattern = self._patterns.get(key)
+        if pattern is None:
+            with self._lock:
+                pattern = self._patterns.get(key)
+                if pattern is None:
+                    pattern = pattern_class(gemini_config=config)
+                    self._patterns[key] = pattern
+        return pattern
+
+    def set_llm_factory(self, llm_factory: Optional[LLMFactory]) -> None:
+        """クライアントの生成方法を差し替える（Noneで既定のGeminiに戻す）"""
+        with self._lock:
+            self._llm_factory = llm_factory or create_gemini_llm
+            self.clear()
+
+    def set_response_cache(self, cache: Optional[ResponseCache]) -> None:
+        """応答キャッシュを設定する（Noneで無効化）"""
+        self.response_cache = cache
+
+    def set_semantic_cache(self, cache: Optional["SemanticCache"]) -> None:
+        """意味的キャッシュを設定する（Noneで無効化）"""
+        self.semantic_cache = cache
+
+    def set_rate_limiter(self, limiter: Optional["RateLimiter"]) -> None:
+        """全クライアント共有のレート制限を設定する（Noneで無効化）
+
+        既存のクライアントは破棄し、次回の取得時に新しい設定で作り直す。
+        """
+        with self._lock:
+            self.rate_limiter = limiter
+            self.clear()
+
+    def set_context_budget(self, budget: Optional[ContextBudget]) -> None:
+        """ステップ間の受け渡しの予算を設定する（Noneで無効化）"""
+        self.context_budget = budget
+
+    def set_retry_policy(self, policy: "RetryPolicy") -> None:
+        """再試行の方針を設定する"""
+        self._retry_policy = policy
+
+    def clear(self) -> None:
+        """共有しているインスタンスをすべて破棄"""
+        with self._lock:
+            self._llms.clear()
+            self._chains.clear()
+            self._patterns.clear()
+
+_registry = ClientRegistry()
+
+def get_registry() -> ClientRegistry:
+    """プロセス共有のレジストリを取得"""
+    return _registry
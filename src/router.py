@@ -0,0 +1,300 @@
+"""質問に合わせて、十分に答えられる最も安いパターンを選んで実行する（自動選択）
+
+質問の文面（計算式・「とは」・「なぜ」・「べきか」・長さなど）から種類を分類し、種類ごとに呼び出しの
+少ない順に並べたパターンの最初のものを実行する。回答が空・曖昧・短すぎる場合は次の重いパターンで答え直す。
+classifier=llmでは、文面だけで確信が持てない質問を短い呼び出し1回で分類する。
+
+選択の記録（分類・確信度・試したパターン・呼び出し回数・比較対象より省いた回数）はJSONLに追記し、
+しきい値の調整に使える。
+
+使い方:
+    python -m src.router "2+2は？" "在宅勤務を導入すべきか"   # 分類だけを表示
+    python -m src.router --stats                              # 記録の集計を表示
+"""
+from dataclasses import asdict, dataclass, field, replace
+from typing import Any, Dict, List, Optional, Tuple
+import argparse
+import json
+import os
+import re
+import sys
+import threading
+import time
+from .config import GeminiConfig, RouterConfig
+from .jobs import JobRunner, run_pattern
+from .metrics import METRICS
+from .models import StepCallback, StepEvent, StepEventType
+from .registry import get_registry
+from .run_budget import SKIPPED_OUTPUT, current_budget
+
+# 質問の種類 → 試す順（呼び出しの少ない順）のパターン
+ESCALATION: Dict[str, List[str]] = {
+    "simple": ["direct_query", "direct_reasoning", "chain_of_thought"],
+    "reasoning": ["direct_reasoning", "chain_of_thought", "evaluator_optimizer"],
+    "complex": ["chained_reasoning", "evaluator_optimizer"],
+    "opinion": ["debate_based_cooperation"],
+}
+
+# パターン → 既定の設定での呼び出し回数（比較対象の回数の見積もりに使う）
+PATTERN_CALLS: Dict[str, int] = {
+    "direct_query": 1,
+    "direct_reasoning": 3,
+    "chain_of_thought": 4,
+    "chained_reasoning": 4,
+    "evaluator_optimizer": 4,
+    "debate_based_cooperation": 5,
+}
+
+# パターン → 結果のうち最終回答のキー
+FINAL_KEYS: Dict[str, str] = {
+    "direct_query": "final_response",
+    "direct_reasoning": "reasoning",
+    "chain_of_thought": "final_answer",
+    "chained_reasoning": "final_result",
+    "evaluator_optimizer": "final_response",
+    "debate_based_cooperation": "final_response",
+}
+
+CLASSIFY_TEMPLATE = (
+    "次の質問に答えるのに必要な考え方を、simple（事実・定義・簡単な計算）・reasoning（理由や方法の説明）・"
+    "complex（複数の段階の分析や計画）・opinion（賛否や立場の比較）のいずれか1語だけで答えてください。\n\n質問: {question}"
+)
+
+_ARITHMETIC = re.compile(r"[0-9０-９]+\s*[+\-*/×÷＋－＊／]\s*[0-9０-９]+")
+_FACT = re.compile(r"とは(何|なに)?|何ですか|なんですか|いくつ|何時|何人|何年|どこ|誰|意味は|定義")
+_REASONING = re.compile(r"なぜ|どうして|理由|どうすれば|どのように|どうやって|説明|証明|原因|仕組み|違い|方法|改善|もし")
+_COMPLEX = re.compile(r"計画|戦略|設計|最適|比較|それぞれ|複数|手順|段階|影響|見積|シナリオ|課題")
+_OPINION = re.compile(r"べきか|べきでしょうか|是非|賛成|反対|賛否|メリット.*デメリット|長所.*短所|どちらが(良|よ)い|どう思")
+# 答えを避けた・確信のない回答
+_HEDGE = re.compile(r"わかりません|分かりません|判断できません|お答えできません|情報が(不足|足りません)|不明です|I don't know|cannot determine", re.I)
+
+ROUTER_DECISIONS = METRICS.counter("ai_pattern_router_decisions_total", "自動選択で最終的に使ったパターン", ("kind", "pattern"))
+ROUTER_ESCALATIONS = METRICS.counter("ai_pattern_router_escalations_total", "回答の確認に通らず重いパターンへ切り替えた回数", ("pattern", "reason"))
+ROUTER_CALLS = METRICS.counter("ai_pattern_router_llm_calls_total", "自動選択での呼び出し回数（分類を含む）", ("kind",))
+ROUTER_BASELINE_CALLS = METRICS.counter("ai_pattern_router_baseline_calls_total", "比較対象のパターンで答えた場合の呼び出し回数", ("kind",))
+
+@dataclass
+class Classification:
+    """質問の種類の分類"""
+    kind: str
+    # 0〜1（文面の手がかりが1つの種類に偏っているほど高い）
+    confidence: float
+    # 分類の手がかり（例: arithmetic・opinion:べきか）
+    signals: List[str] = field(default_factory=list)
+    # heuristic（文面から）・llm（LLMの呼び出しで）
+    classifier: str = "heuristic"
+
+def classify_question(question: str) -> Classification:
+    """質問の文面から種類を分類する（LLMは呼ばない）"""
+    text = question.strip()
+    scores = {kind: 0 for kind in ESCALATION}
+    signals: List[str] = []
+
+    def add(kind: str, score: int, signal: str) -> None:
+        scores[kind] += score
+        signals.append(signal)
+
+    # キーワードは長さより強い手がかりとして重みを付ける
+    if _ARITHMETIC.search(text):
+        add("simple", 3, "arithmetic")
+    for kind, pattern in (("simple", _FACT), ("reasoning", _REASONING), ("complex", _COMPLEX)):
+        for keyword in sorted(set(match.group(0) for match in pattern.finditer(text))):
+            add(kind, 2, f"{kind}:{keyword}")
+    for match in _OPINION.finditer(text):
+        add("opinion", 3, f"opinion:{match.group(0)}")
+    if len(text) <= 25:
+        add("simple", 1, "short")
+    # 文の数と長さは多段の分析が要る質問の手がかりにする
+    if len(text) > 120 or len(re.findall(r"[。？?！!]", text)) >= 3:
+        add("complex", 1, "long")
+    total = sum(scores.values())
+    if total == 0:
+        return Classification("reasoning", 0.0, signals)
+    kind = max(scores, key=lambda k: (scores[k], -list(ESCALATION).index(k)))
+    return Classification(kind, scores[kind] / total, signals)
+
+def check_answer(kind: str, answer: str, min_chars: int) -> Optional[str]:
+    """回答が十分か確かめ、不十分なら理由（empty・hedge・short）を返す"""
+    text = answer.strip()
+    if not text:
+        return "empty"
+    if _HEDGE.search(text):
+        return "hedge"
+    if kind != "simple" and len(text) < min_chars:
+        return "short"
+    return None
+
+@dataclass
+class RouteDecision:
+    """自動選択の記録"""
+    question: str
+    classification: Classification
+    # 試したパターンごとの{pattern, llm_calls, passed, reason}
+    attempts: List[Dict[str, Any]] = field(default_factory=list)
+    # 最終回答を出したパターン
+    pattern: Optional[str] = None
+    # 分類とすべての試行の呼び出し回数
+    llm_calls: int = 0
+    baseline: str = "chain_of_thought"
+    baseline_calls: int = 0
+    elapsed: float = 0.0
+    created_at: float = field(default_factory=time.time)
+
+    @property
+    def calls_saved(self) -> int:
+        """比較対象のパターンで答えた場合より少なく済んだ呼び出し回数（多くかかったら0）"""
+        return max(self.baseline_calls - self.llm_calls, 0)
+
+    @property
+    def extra_calls(self) -> int:
+        """比較対象のパターンで答えた場合より多くかかった呼び出し回数（少なく済んだら0）"""
+        return max(self.llm_calls - self.baseline_calls, 0)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {**asdict(self), "calls_saved": self.calls_saved, "extra_calls": self.extra_calls}
+
+class PatternRouter:
+    """質問を分類し、十分に答えられる最も安いパターンで実行する
+
+    runnerは(パターン名, 質問, モデル設定, ステップの通知先)を受け取る（既定はjobs.run_pattern）。
+    """
+    pattern = "auto"
+
+    def __init__(
+        self,
+        gemini_config: Optional[GeminiConfig] = None,
+        router_config: Optional[RouterConfig] = None,
+        runner: Optional[JobRunner] = None
+    ):
+        self.gemini_config = gemini_config or GeminiConfig()
+        self.router_config = router_config or RouterConfig()
+        self.runner = runner or run_pattern
+        self._log_lock = threading.Lock()
+
+    def classify(self, question: str) -> Tuple[Classification, int]:
+        """質問を分類し、(分類, 分類に使った呼び出し回数)を返す"""
+        classification = classify_question(question)
+        config = self.router_config
+        if config.classifier != "llm" or classification.confidence >= config.min_confidence:
+            return classification, 0
+        # 1語だけ答えればよいため、温度を下げて出力を短く抑える
+        llm_config = replace(self.gemini_config, temperature=0.0, max_output_tokens=16)
+        calls = [0]
+        text = get_registry().get_pattern("DirectQuery", llm_config).answer(
+            CLASSIFY_TEMPLATE.format(question=question), self._call_counter(calls, None)
+        )["final_response"].lower()
+        found = [kind for kind in ESCALATION if kind in text]
+        if found:
+            classification = Classification(found[0], 1.0, classification.signals, "llm")
+        return classification, calls[0]
+
+    @staticmethod
+    def _call_counter(calls: List[int], on_step: Optional[StepCallback]) -> StepCallback:
+        """LLMを実際に呼んだステップを数えてon_stepへ渡す通知先"""
+        def count(event: StepEvent) -> None:
+            if event.type == StepEventType.FINISHED and event.metrics is not None and event.metrics.cache is None:
+                calls[0] += 1
+            if on_step is not None:
+                on_step(event)
+        return count
+
+    def _notify(self, on_step: Optional[StepCallback], step: str, event_type: StepEventType, output: Optional[str] = None) -> None:
+        """選択（route）と最終回答（answer）の進捗を通知（実行したパターンのステップはそのまま届く）"""
+        if on_step is not None:
+            on_step(StepEvent(self.pattern, step, event_type, output=output))
+
+    def answer(self, question: str, on_step: Optional[StepCallback] = None) -> Dict[str, Any]:
+        """質問に合ったパターンで答え、結果に最終回答（final_response）と選択の記録（route）を加える"""
+        started = time.perf_counter()
+        config = self.router_config
+        self._notify(on_step, "route", StepEventType.STARTED)
+        classification, calls = self.classify(question)
+        decision = RouteDecision(
+            question, classification, llm_calls=calls,
+            baseline=config.baseline, baseline_calls=PATTERN_CALLS.get(config.baseline, 0)
+        )
+        ladder = ESCALATION[classification.kind][:config.max_escalations + 1]
+        self._notify(on_step, "route", StepEventType.FINISHED, f"{classification.kind} → {ladder[0]}")
+        self._notify(on_step, "answer", StepEventType.STARTED)
+        for pattern in ladder:
+            attempt_calls = [0]
+            result = self.runner(pattern, question, self.gemini_config, self._call_counter(attempt_calls, on_step))
+            final = result[FINAL_KEYS[pattern]]
+            decision.llm_calls += attempt_calls[0]
+            decision.pattern = pattern
+            budget = current_budget()
+            if SKIPPED_OUTPUT in final or (budget is not None and budget.exhausted is not None):
+                # 予算を使い切ったら重いパターンには切り替えない
+                reason = "budget"
+            else:
+                reason = check_answer(classification.kind, final, config.min_answer_chars)
+            decision.attempts.append({"pattern": pattern, "llm_calls": attempt_calls[0], "passed": reason is None, "reason": reason})
+            if reason is None or reason == "budget" or pattern == ladder[-1]:
+                break
+            ROUTER_ESCALATIONS.inc(pattern=pattern, reason=reason)
+        decision.elapsed = time.perf_counter() - started
+        self._record(decision)
+        self._notify(on_step, "answer", StepEventType.FINISHED, final)
+        return {**result, "final_response": final, "route": decision.to_dict()}
+
+    def _record(self, decision: RouteDecision) -> None:
+        """選択をメトリクスとJSONLの記録に残す"""
+        kind = decision.classification.kind
+        ROUTER_DECISIONS.inc(kind=kind, pattern=decision.pattern)
+        ROUTER_CALLS.inc(decision.llm_calls, kind=kind)
+        ROUTER_BASELINE_CALLS.inc(decision.baseline_calls, kind=kind)
+        path = self.router_config.log_path
+        if not path:
+            return
+        with self._log_lock:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(decision.to_dict(), ensure_ascii=False) + "\n")
+
+def summarize_log(path: str, min_confidence: float = 0.6) -> Dict[str, Any]:
+    """選択の記録を種類ごとに集計（件数・使ったパターン・切り替えた件数・省いた／余分にかかった呼び出し回数・確信度の低い件数）"""
+    kinds: Dict[str, Dict[str, Any]] = {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            summary = kinds.setdefault(record["classification"]["kind"], {
+                "runs": 0, "patterns": {}, "escalated": 0, "llm_calls": 0, "calls_saved": 0, "extra_calls": 0,
+                "low_confidence": 0
+            })
+            summary["runs"] += 1
+            summary["patterns"][record["pattern"]] = summary["patterns"].get(record["pattern"], 0) + 1
+            summary["escalated"] += len(record["attempts"]) > 1
+            summary["llm_calls"] += record["llm_calls"]
+            # 以前の記録は比較対象より多くかかった回数を負のcalls_savedで残している
+            summary["calls_saved"] += max(record["calls_saved"], 0)
+            summary["extra_calls"] += record.get("extra_calls", max(-record["calls_saved"], 0))
+            summary["low_confidence"] += record["classification"]["confidence"] < min_confidence
+    return kinds
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """自動選択のCLIエントリーポイント（分類の確認と記録の集計）"""
+    config = RouterConfig()
+    parser = argparse.ArgumentParser(description="質問の分類と自動選択の記録を確認します")
+    parser.add_argument("questions", nargs="*", help="分類する質問")
+    parser.add_argument("--stats", action="store_true", help="記録を種類ごとに集計して表示する")
+    parser.add_argument("--log", default=config.log_path, help="選択の記録（JSONL）")
+    args = parser.parse_args(argv)
+
+    for question in args.questions:
+        classification = classify_question(question)
+        print(
+            f"{classification.kind}（確信度 {classification.confidence:.2f}）→ {ESCALATION[classification.kind][0]}"
+            f"  {', '.join(classification.signals)}  {question}"
+        )
+    if args.stats:
+        if not os.path.exists(args.log):
+            print(f"記録がありません: {args.log}", file=sys.stderr)
+            return 1
+        print(json.dumps(summarize_log(args.log, config.min_confidence), ensure_ascii=False, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,322 @@
+"""パターン1回の実行全体のトークン数・費用・時間の予算
+
+max_output_tokensは1回の呼び出しの上限でしかないため、ラウンドや反復を重ねるパターンでは
+実行全体の消費が膨らむ。RunBudgetは実行中の呼び出しの入力・出力トークン数と推定費用を積算し、
+残りのステップのmax_output_tokensを残りの予算に合わせて縮め、使い切ったら以降のステップを実行しない
+（パターンはそこまでの出力とSKIPPED_OUTPUTの印を付けた部分的な結果を返す）。
+
+時間の上限は呼び出しの開始時だけでなく、実行中の呼び出しも残り時間で打ち切る（call_with_deadlineなど）。
+同期の呼び出しは打ち切っても止められないため、後から届いた応答の使用量も予算に加算する（超過分はsummaryに表れる）。
+非同期の呼び出しは取り消すため、取り消した後の使用量は加算しない。
+予算はcontextvarsで実行に結び付けるため、パターンのメソッドの引数を変えずに使える。
+
+    with use_budget(RunBudget(max_tokens=20000, max_seconds=30)) as budget:
+        result = EvaluatorOptimizer().generate_optimized_response("質問")
+    budget.summary()
+"""
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from dataclasses import replace
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple, TypeVar
+import asyncio
+import queue
+import threading
+import time
+from .config import GeminiConfig, RunBudgetConfig
+from .context_budget import estimate_tokens
+
+T = TypeVar("T")
+# 応答（またはチャンク）から(入力, 出力)トークン数を取り出す関数
+UsageReader = Callable[[Any], Tuple[int, int]]
+
+# 予算を使い切って実行しなかったステップの出力
+SKIPPED_OUTPUT = "（実行の予算の上限に達したため、このステップは実行していません）"
+
+class BudgetExceeded(Exception):
+    """実行の予算を使い切った（reasonはtokens・cost・timeのいずれか）"""
+    def __init__(self, reason: str):
+        super().__init__(f"実行の予算（{reason}）の上限に達しました")
+        self.reason = reason
+
+class RunBudget:
+    """1回の実行のトークン数・推定費用・時間の予算（スレッドセーフ）
+
+    上限はいずれもNone（または0）で制限しない。単価は100万トークンあたりのUSD。
+    """
+    def __init__(
+        self,
+        max_tokens: Optional[int] = None,
+        max_cost: Optional[float] = None,
+        max_seconds: Optional[float] = None,
+        input_price: float = 0.075,
+        output_price: float = 0.30,
+        min_output_tokens: int = 64
+    ):
+        self.max_tokens = max_tokens or None
+        self.max_cost = max_cost or None
+        self.max_seconds = max_seconds or None
+        self.input_price = input_price
+        self.output_price = output_price
+        self.min_output_tokens = min_output_tokens
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.calls = 0
+        # max_output_tokensを縮めて呼び出した回数（縮めた出力は完全な結果として意味的キャッシュに保存しない）
+        self.limited = 0
+        # 使い切った予算（tokens・cost・time。使い切っていなければNone）
+        self.exhausted: Optional[str] = None
+        # 予算を使い切って実行しなかったステップ
+        self.skipped: List[str] = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @property
+    def cost(self) -> float:
+        """これまでの推定費用（USD）"""
+        return (self.prompt_tokens * self.input_price + self.completion_tokens * self.output_price) / 1_000_000
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._start
+
+    def remaining_seconds(self) -> Optional[float]:
+        """残りの秒数（時間の上限がなければNone）"""
+        if self.max_seconds is None:
+            return None
+        return max(self.max_seconds - self.elapsed, 0.0)
+
+    def _allowances(self, prompt_tokens: int) -> Dict[str, int]:
+        """予算の種類 → このプロンプトの後に残る出力トークン数"""
+        allowances = {}
+        if self.max_tokens is not None:
+            allowances["tokens"] = self.max_tokens - self.prompt_tokens - self.completion_tokens - prompt_tokens
+        if self.max_cost is not None and self.output_price > 0:
+            remaining = self.max_cost - self.cost - prompt_tokens * self.input_price / 1_000_000
+            allowances["cost"] = int(remaining * 1_000_000 / self.output_price)
+        return allowances
+
+    def limit(self, config: GeminiConfig, prompt: str) -> GeminiConfig:
+        """残りの予算に合わせてmax_output_tokensを縮めた設定を返す（使い切っていればBudgetExceeded）
+
+        縮めた値は2のべき乗に切り下げ、作成するクライアントの種類が増えすぎないようにする。
+        """
+        allowances: Dict[str, int] = {}
+        with self._lock:
+            if self.exhausted is None and self.max_seconds is not None and self.elapsed >= self.max_seconds:
+                self.exhausted = "time"
+            if self.exhausted is None:
+                allowances = self._allowances(estimate_tokens(prompt))
+                if allowances:
+                    reason = min(allowances, key=allowances.get)
+                    allowance = allowances[reason]
+                    if allowance < self.min_output_tokens:
+                        self.exhausted = reason
+            if self.exhausted is not None:
+                raise BudgetExceeded(self.exhausted)
+        if not allowances or allowance >= config.max_output_tokens:
+            return config
+        with self._lock:
+            self.limited += 1
+        return replace(config, max_output_tokens=1 << (allowance.bit_length() - 1))
+
+    def charge(self, prompt_tokens: int, completion_tokens: int, calls: int = 1) -> None:
+        """1回の呼び出しで使ったトークン数を加算（同じ呼び出しの追加分はcalls=0）"""
+        with self._lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.calls += calls
+
+    def expire(self) -> BudgetExceeded:
+        """実行中の呼び出しが時間の上限に達した（使い切ったことを記録し、送出する例外を返す）"""
+        with self._lock:
+            if self.exhausted is None:
+                self.exhausted = "time"
+            return BudgetExceeded(self.exhausted)
+
+    def skip(self, step: str) -> None:
+        """予算を使い切って実行しなかったステップを記録"""
+        with self._lock:
+            self.skipped.append(step)
+
+    def summary(self) -> Dict[str, Any]:
+        """上限と消費量（JSONにできる形）"""
+        return {
+            "max_tokens": self.max_tokens,
+            "max_cost": self.max_cost,
+            "max_seconds": self.max_seconds,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cost": round(self.cost, 6),
+            "elapsed": round(self.elapsed, 3),
+            "calls": self.calls,
+            "limited": self.limited,
+            "exhausted": self.exhausted,
+            "skipped": list(self.skipped)
+        }
+
+_current: ContextVar[Optional[RunBudget]] = ContextVar("run_budget", default=None)
+
+def current_budget() -> Optional[RunBudget]:
+    """実行中の予算（なければNone）"""
+    return _current.get()
+
+@contextmanager
+def use_budget(budget: Optional[RunBudget]) -> Iterator[Optional[RunBudget]]:
+    """ブロック内で実行するパターンにbudgetを適用する（Noneなら予算なし）"""
+    token = _current.set(budget)
+    try:
+        yield budget
+    finally:
+        _current.reset(token)
+
+def _deadline() -> Optional[RunBudget]:
+    """時間の上限がある実行中の予算（なければNone）"""
+    budget = current_budget()
+    return budget if budget is not None and budget.max_seconds is not None else None
+
+# 期限付きの同期呼び出しを実行するスレッドの上限（打ち切った呼び出しも応答が届くまで1つ使う）
+DEADLINE_WORKERS = 64
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+def _deadline_executor() -> ThreadPoolExecutor:
+    """期限付きの同期呼び出しを実行するプロセス共有のスレッドプール"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=DEADLINE_WORKERS, thread_name_prefix="run-budget")
+        return _executor
+
+def _charge_late(budget: RunBudget, usage: Optional[UsageReader], responses: List[Any], calls: int) -> None:
+    """打ち切った後に届いた応答の使用量を予算に加算"""
+    if usage is None or not responses:
+        return
+    tokens = [usage(response) for response in responses]
+    budget.charge(sum(t[0] for t in tokens), sum(t[1] for t in tokens), calls)
+
+def call_with_deadline(fn: Callable[[], T], usage: Optional[UsageReader] = None) -> T:
+    """fnを呼び出し、予算の残り時間を過ぎたらBudgetExceededで打ち切る
+
+    同期の呼び出しは中断できないため共有のスレッドプールで実行し、期限を過ぎたら結果を待たずに戻る。
+    usageを渡すと、打ち切った呼び出しの応答が後から届いたときにその使用量を予算に加算する。
+    """
+    budget = _deadline()
+    if budget is None:
+        return fn()
+    future = _deadline_executor().submit(copy_context().run, fn)
+    try:
+        return future.result(timeout=budget.remaining_seconds())
+    except FutureTimeout:
+        def charge(done: Future) -> None:
+            if not done.cancelled() and done.exception() is None:
+                _charge_late(budget, usage, [done.result()], 1)
+
+        future.add_done_callback(charge)
+        raise budget.expire() from None
+
+async def acall_with_deadline(awaitable: Awaitable[T]) -> T:
+    """call_with_deadlineの非同期版（期限を過ぎたら取り消す）"""
+    budget = _deadline()
+    if budget is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, budget.remaining_seconds())
+    except asyncio.TimeoutError:
+        raise budget.expire() from None
+
+_DONE = object()
+
+def iterate_with_deadline(iterator: Iterator[T], usage: Optional[UsageReader] = None) -> Iterator[T]:
+    """iteratorの要素を返し、予算の残り時間を過ぎても次の要素が届かなければBudgetExceededで打ち切る
+
+    iteratorは共有のスレッドプールの1つのスレッドだけで読み進める。打ち切った後は次の要素が届いた時点で
+    iteratorを閉じ、受け取らなかった要素の使用量をusageで予算に加算する（呼び出し自体は呼び出し側が数える）。
+    """
+    budget = _deadline()
+    if budget is None:
+        yield from iterator
+        return
+    items: "queue.Queue[Tuple[Any, Optional[BaseException]]]" = queue.Queue()
+    lock = threading.Lock()
+    abandoned = threading.Event()
+
+    def produce() -> None:
+        try:
+            for item in iterator:
+                with lock:
+                    if not abandoned.is_set():
+                        items.put((item, None))
+                        continue
+                _charge_late(budget, usage, [item], 0)
+                break
+            items.put((_DONE, None))
+        except BaseException as e:
+            items.put((_DONE, e))
+        finally:
+            close = getattr(iterator, "close", None)
+            if close is not None:
+                close()
+
+    _deadline_executor().submit(copy_context().run, produce)
+    try:
+        while True:
+            try:
+                item, error = items.get(timeout=budget.remaining_seconds())
+            except queue.Empty:
+                raise budget.expire() from None
+            if error is not None:
+                raise error
+            if item is _DONE:
+                return
+            yield item
+    finally:
+        with lock:
+            abandoned.set()
+            unread = []
+            while not items.empty():
+                item, _ = items.get_nowait()
+                if item is not _DONE:
+                    unread.append(item)
+        _charge_late(budget, usage, unread, 0)
+
+async def aiterate_with_deadline(iterator: AsyncIterator[T]) -> AsyncIterator[T]:
+    """iterate_with_deadlineの非同期版"""
+    budget = _deadline()
+    if budget is None:
+        async for item in iterator:
+            yield item
+        return
+    while True:
+        try:
+            item = await asyncio.wait_for(iterator.__anext__(), budget.remaining_seconds())
+        except StopAsyncIteration:
+            return
+        except asyncio.TimeoutError:
+            raise budget.expire() from None
+        yield item
+
+def create_run_budget(
+    config: Optional[RunBudgetConfig] = None,
+    max_tokens: Optional[int] = None,
+    max_cost: Optional[float] = None,
+    max_seconds: Optional[float] = None
+) -> Optional[RunBudget]:
+    """設定から予算を作成（引数の上限は設定の上限より緩められない。上限がひとつもなければNone）"""
+    config = config or RunBudgetConfig()
+
+    def tighter(ceiling, requested):
+        values = [value for value in (ceiling, requested) if value]
+        return min(values) if values else None
+
+    budget = RunBudget(
+        tighter(config.max_tokens, max_tokens),
+        tighter(config.max_cost, max_cost),
+        tighter(config.max_seconds, max_seconds),
+        config.input_price,
+        config.output_price,
+        config.min_output_tokens
+    )
+    if budget.max_tokens is None and budget.max_cost is None and budget.max_seconds is None:
+        return None
+    return budget
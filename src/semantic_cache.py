@@ -0,0 +1,258 @@
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+import atexit
+import json
+import os
+import re
+import threading
+import unicodedata
+import zlib
+import numpy as np
+from .config import SemanticCacheConfig
+
+class HashingVectorizer:
+    """文字n-gramをハッシュして固定次元のベクトルに変換（学習不要・ローカルで完結）"""
+    def __init__(self, dim: int = 256, ngram_sizes: tuple = (1, 2)):
+        self.dim = dim
+        self.ngram_sizes = ngram_sizes
+
+    def _normalize(self, text: str) -> str:
+        """全角・半角や大文字・小文字、空白の違いを吸収"""
+        text = unicodedata.normalize("NFKC", text).lower()
+        return "".join(text.split())
+
+    def transform(self, text: str) -> np.ndarray:
+        """テキストをL2正規化済みのベクトルに変換"""
+        text = self._normalize(text)
+        grams = [
+            text[i:i + n]
+            for n in self.ngram_sizes
+            for i in range(max(len(text) - n + 1, 0))
+        ] or [text]
+        hashes = np.array([zlib.crc32(gram.encode("utf-8")) for gram in grams], dtype=np.uint32)
+        # 下位ビットで次元、最上位ビットで符号を決めて衝突の偏りを打ち消す
+        signs = np.where(hashes >> 31, -1.0, 1.0)
+        vector = np.bincount(hashes % self.dim, weights=signs, minlength=self.dim).astype(np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+def numbers(text: str) -> List[str]:
+    """質問に含まれる数値（全角・桁区切りの違いはならす）"""
+    text = unicodedata.normalize("NFKC", text)
+    return _NUMBER.findall(re.sub(r"(?<=\d),(?=\d{3})", "", text))
+
+def _popcount(values: np.ndarray) -> np.ndarray:
+    """uint64配列の各要素の立っているビット数"""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(values)
+    return _POPCOUNT_TABLE[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+class SimHasher:
+    """ランダム超平面による64ビットの署名（角度が近いベクトルほどハミング距離が小さい）"""
+    def __init__(self, dim: int, seed: int = 0):
+        self.planes = np.random.default_rng(seed).standard_normal((dim, 64)).astype(np.float32)
+        self.weights = (np.uint64(1) << np.arange(64, dtype=np.uint64))
+
+    def signatures(self, vectors: np.ndarray) -> np.ndarray:
+        """ベクトル（1件または行列）を64ビット署名に変換"""
+        bits = (np.atleast_2d(vectors) @ self.planes) > 0
+        return (bits * self.weights).sum(axis=1, dtype=np.uint64)
+
+@dataclass
+class SemanticHit:
+    """類似質問の検索結果"""
+    question: str
+    result: Any
+    similarity: float
+
+class _Index:
+    """1つの名前空間（パターン）の行列インデックス
+
+    max_entriesに達したら最も古いエントリから上書きする。
+    """
+    def __init__(self, dim: int, max_entries: int, capacity: int = 1024):
+        self.max_entries = max_entries
+        self.vectors = np.zeros((min(capacity, max_entries), dim), dtype=np.float32)
+        self.signatures = np.zeros(len(self.vectors), dtype=np.uint64)
+        self.size = 0
+        self.questions: List[str] = []
+        self.results: List[Any] = []
+        # 満杯時に次に上書きする位置
+        self._cursor = 0
+
+    def add(self, vector: np.ndarray, signature: np.uint64, question: str, result: Any) -> None:
+        if self.size == self.max_entries:
+            slot = self._cursor
+            self._cursor = (self._cursor + 1) % self.max_entries
+            self.vectors[slot] = vector
+            self.signatures[slot] = signature
+            self.questions[slot] = question
+            self.results[slot] = result
+            return
+        if self.size == len(self.vectors):
+            # 容量を倍にして償却O(1)で追加
+            capacity = min(len(self.vectors) * 2, self.max_entries)
+            grown = np.zeros((capacity, self.vectors.shape[1]), dtype=np.float32)
+            grown[:self.size] = self.vectors[:self.size]
+            self.vectors = grown
+            signatures = np.zeros(capacity, dtype=np.uint64)
+            signatures[:self.size] = self.signatures[:self.size]
+            self.signatures = signatures
+        self.vectors[self.size] = vector
+        self.signatures[self.size] = signature
+        self.questions.append(question)
+        self.results.append(result)
+        self.size += 1
+
+class SemanticCache:
+    """言い換え程度に近い質問に対して保存済みのパターン結果を返すキャッシュ
+
+    質問をHashingVectorizerでベクトル化して名前空間ごとの行列に保持する。
+    検索はまず64ビットSimHashのハミング距離で候補を絞り込み（10万件でも配列1本の
+    popcountで済む）、候補だけを正確なコサイン類似度で並べ替える。
+    max_hamming=64にすると絞り込みを行わず全件を比較する。
+    """
+    def __init__(
+        self,
+        threshold: float = 0.9,
+        dim: int = 256,
+        max_hamming: int = 20,
+        snapshot_path: Optional[str] = None,
+        max_entries: int = 100_000,
+        autosave_every: int = 100
+    ):
+        self.threshold = threshold
+        self.vectorizer = HashingVectorizer(dim)
+        self.hasher = SimHasher(dim)
+        self.max_hamming = max_hamming
+        self.snapshot_path = snapshot_path
+        self.max_entries = max_entries
+        self.autosave_every = autosave_every
+        self.hits = 0
+        self.misses = 0
+        self._indexes: Dict[str, _Index] = {}
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        if snapshot_path and os.path.exists(snapshot_path + ".npz"):
+            self.load()
+
+    def search(self, namespace: str, question: str, k: int = 5) -> List[SemanticHit]:
+        """近傍候補の中から類似度の高い順に上位k件を返す"""
+        index = self._indexes.get(namespace)
+        if index is None or index.size == 0:
+            return []
+        # 追加と競合しないよう、参照する行数を先に確定させる
+        size = index.size
+        vector = self.vectorizer.transform(question)
+        if self.max_hamming >= 64:
+            candidates = np.arange(size)
+        else:
+            distances = _popcount(index.signatures[:size] ^ self.hasher.signatures(vector)[0])
+            candidates = np.flatnonzero(distances <= self.max_hamming)
+        if len(candidates) == 0:
+            return []
+        scores = index.vectors[candidates] @ vector
+        k = min(k, len(candidates))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            SemanticHit(index.questions[candidates[i]], index.results[candidates[i]], float(scores[i]))
+            for i in top
+        ]
+
+    def lookup(self, namespace: str, question: str) -> Optional[SemanticHit]:
+        """しきい値以上に似た質問があればその結果を返す
+
+        数値はn-gramのベクトルをほとんど動かさないため（「2024年」と「2025年」が0.9を超える）、
+        含まれる数値が完全に一致する質問だけをヒットとする。
+        """
+        expected = numbers(question)
+        for hit in self.search(namespace, question):
+            if hit.similarity < self.threshold:
+                break
+            if numbers(hit.question) == expected:
+                self.hits += 1
+                return hit
+        self.misses += 1
+        return None
+
+    def add(self, namespace: str, question: str, result: Any) -> None:
+        """質問と結果を登録"""
+        vector = self.vectorizer.transform(question)
+        signature = self.hasher.signatures(vector)[0]
+        with self._lock:
+            index = self._indexes.setdefault(namespace, _Index(self.vectorizer.dim, self.max_entries))
+            index.add(vector, signature, question, result)
+            self._unsaved += 1
+            should_save = self.snapshot_path and self._unsaved >= self.autosave_every
+        if should_save:
+            self.save()
+
+    def save(self) -> None:
+        """ベクトル行列と結果をスナップショットとして保存"""
+        if not self.snapshot_path:
+            return
+        with self._lock:
+            namespaces = list(self._indexes)
+            arrays = {f"ns{i}": self._indexes[ns].vectors[:self._indexes[ns].size] for i, ns in enumerate(namespaces)}
+            entries = {
+                ns: {"questions": self._indexes[ns].questions, "results": self._indexes[ns].results}
+                for ns in namespaces
+            }
+            self._unsaved = 0
+        directory = os.path.dirname(self.snapshot_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        np.savez(self.snapshot_path + ".npz", **arrays)
+        with open(self.snapshot_path + ".json", "w", encoding="utf-8") as f:
+            json.dump({"dim": self.vectorizer.dim, "namespaces": namespaces, "entries": entries}, f, ensure_ascii=False)
+
+    def load(self) -> None:
+        """スナップショットから復元"""
+        with open(self.snapshot_path + ".json", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["dim"] != self.vectorizer.dim:
+            return
+        arrays = np.load(self.snapshot_path + ".npz")
+        with self._lock:
+            self._indexes.clear()
+            for i, ns in enumerate(meta["namespaces"]):
+                vectors = arrays[f"ns{i}"][-self.max_entries:]
+                index = _Index(self.vectorizer.dim, self.max_entries, capacity=max(len(vectors), 1024))
+                index.vectors[:len(vectors)] = vectors
+                index.signatures[:len(vectors)] = self.hasher.signatures(vectors) if len(vectors) else []
+                index.size = len(vectors)
+                index.questions = meta["entries"][ns]["questions"][-self.max_entries:]
+                index.results = meta["entries"][ns]["results"][-self.max_entries:]
+                self._indexes[ns] = index
+
+    def __len__(self) -> int:
+        return sum(index.size for index in self._indexes.values())
+
+    def stats(self) -> Dict[str, float]:
+        """ヒット・ミスの統計"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self),
+        }
+
+def create_semantic_cache(config: Optional[SemanticCacheConfig] = None) -> Optional[SemanticCache]:
+    """設定から意味的キャッシュを作成（無効ならNone）"""
+    config = config or SemanticCacheConfig()
+    if not config.enabled:
+        return None
+    cache = SemanticCache(
+        threshold=config.threshold,
+        snapshot_path=config.snapshot_path,
+        max_entries=config.max_entries
+    )
+    # 自動保存の間隔に満たない追加分も終了時に保存する
+    atexit.register(cache.save)
+    return cache
@@ -0,0 +1,407 @@
+"""パターンをHTTPで公開する非同期APIサーバー（Streamlitなしで使うため）
+
+    POST /patterns/{name}  {"question": "...", "stream": false, "timeout": 30, "budget": {"max_tokens": 20000}}
+    GET  /patterns         実行できるパターンの一覧
+    GET  /runs             実行履歴の一覧・検索（?q=&pattern=&limit=&before=）
+    GET  /runs/{id}        保存した実行の全体（LLMは呼ばない）
+    GET  /health           実行中・待機中のリクエスト数
+    GET  /metrics          Prometheusのテキスト形式の計測値
+
+"stream": true（またはAccept: text/event-stream）ではServer-Sent Eventsでトークンを逐次返す。
+同時に実行するリクエスト数・待ち行列の長さ・クライアントごとの同時リクエスト数に上限を設け、
+待ち行列が埋まったら503、クライアントの上限を超えたら429で即座に断る（過負荷で全員の応答が遅れないようにする）。
+待ち行列での待ち時間を含めて期限を過ぎたリクエストは504で打ち切る。
+リクエストごとに実行の予算（トークン数・推定費用・時間。RUN_MAX_*が上限）を適用し、
+使い切ったら残りのステップを省いた途中までの結果と予算の消費量（"budget"）を返す。
+
+使い方:
+    python -m src.server --port 8000
+"""
+from dataclasses import asdict
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+import argparse
+import asyncio
+import json
+import sys
+import time
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+from .cache import create_response_cache
+from .config import CassetteConfig, RunBudgetConfig, ServerConfig
+from .context_budget import create_context_budget
+from .history import RunStore, create_run_store
+from .metrics import METRICS
+from .rate_limit import create_rate_limiter, create_retry_policy
+from .registry import get_registry
+from .run_budget import SKIPPED_OUTPUT, RunBudget, create_run_budget, use_budget
+
+# パターン名 → (パターンのクラス名, 非同期の実行メソッド名, 非同期のストリーミングメソッド名)
+SERVER_PATTERNS: Dict[str, Tuple[str, str, str]] = {
+    "direct_query": ("DirectQuery", "aanswer", "astream_answer"),
+    "chain_of_thought": ("GeminiChainOfThought", "asolve_problem", "astream_solve_problem"),
+    "direct_reasoning": ("GeminiReasoning", "adirect_reasoning", "astream_direct_reasoning"),
+    "chained_reasoning": ("GeminiReasoning", "achained_reasoning", "astream_chained_reasoning"),
+    "evaluator_optimizer": ("EvaluatorOptimizer", "agenerate_optimized_response", "astream_optimized_response"),
+    "debate_based_cooperation": ("DebateBasedCooperation", "agenerate_debate_response", "astream_debate_response"),
+}
+
+SERVER_REQUESTS = METRICS.counter("ai_pattern_server_requests_total", "APIサーバーのリクエスト数", ("pattern", "status"))
+SERVER_DURATION = METRICS.histogram("ai_pattern_server_request_seconds", "APIサーバーの応答時間（待ち行列を含む秒）", ("pattern",))
+SERVER_QUEUE_WAIT = METRICS.histogram("ai_pattern_server_queue_wait_seconds", "APIサーバーの待ち行列での待ち時間（秒）", ("pattern",))
+
+class Overloaded(Exception):
+    """受け付けられないリクエスト（statusは503か429）"""
+    def __init__(self, message: str, status: int = 503, retry_after: int = 1):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class AdmissionControl:
+    """同時実行数・待ち行列・クライアントごとの同時リクエスト数を制御する
+
+    受け付けたリクエスト（実行中＋待機中）がmax_concurrency + queue_sizeに達したら新しいリクエストを断る。
+    イベントループ上でだけ使うためロックは持たない。
+    """
+    def __init__(self, max_concurrency: int = 16, queue_size: int = 64, client_concurrency: int = 4):
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size
+        self.client_concurrency = client_concurrency
+        self.admitted = 0
+        self.running = 0
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._clients: Dict[str, int] = {}
+
+    def admit(self, client: str) -> None:
+        """リクエストを受け付ける（上限に達していればOverloaded）"""
+        if self.admitted >= self.max_concurrency + self.queue_size:
+            raise Overloaded("サーバーが混雑しています。しばらくしてから再試行してください")
+        if self._clients.get(client, 0) >= self.client_concurrency:
+            raise Overloaded(f"同時に送れるリクエストは{self.client_concurrency}件までです", status=429)
+        self.admitted += 1
+        self._clients[client] = self._clients.get(client, 0) + 1
+
+    def leave(self, client: str) -> None:
+        """受け付けたリクエストが終わった（成功・失敗・期限切れのいずれも）"""
+        self.admitted -= 1
+        self._clients[client] -= 1
+        if not self._clients[client]:
+            del self._clients[client]
+
+    async def __aenter__(self) -> "AdmissionControl":
+        """実行枠が空くまで待つ"""
+        # セマフォは作成したイベントループでしか使えないため、ループごとに作る（テストではリクエストごとにループが変わる）
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop, self._slots = loop, asyncio.Semaphore(self.max_concurrency)
+        await self._slots.acquire()
+        self.running += 1
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.running -= 1
+        self._slots.release()
+
+    def stats(self) -> Dict[str, int]:
+        """実行中・待機中のリクエスト数と上限"""
+        return {
+            "running": self.running,
+            "queued": self.admitted - self.running,
+            "max_concurrency": self.max_concurrency,
+            "queue_size": self.queue_size,
+            "clients": len(self._clients),
+        }
+
+class AdmittedStream(StreamingResponse):
+    """受け付けの枠を応答の終了時に返すストリーミング応答
+
+    クライアントが本文を読み始める前に切断すると本文のジェネレーターは始まらず、その中のfinallyも実行されない。
+    そのため枠は応答そのもの（切断を含む）の終了時に返す。
+    """
+    def __init__(self, content: AsyncIterator[str], release: Callable[[], None], **kwargs: Any):
+        super().__init__(content, **kwargs)
+        self.release = release
+
+    async def __call__(self, scope, receive, send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # 途中で切断された本文を閉じて実行枠を返してから、受け付けの枠を返す
+            await self.body_iterator.aclose()
+            self.release()
+
+def _client_id(request: Request) -> str:
+    """クライアントの識別子（X-Client-IDがなければ接続元のアドレス）"""
+    return request.headers.get("x-client-id") or (request.client.host if request.client else "unknown")
+
+def _error(message: str, status: int, headers: Optional[Dict[str, str]] = None) -> JSONResponse:
+    return JSONResponse({"error": message}, status_code=status, headers=headers)
+
+def _sse(event: str, data: Any) -> str:
+    """Server-Sent Eventsの1イベント"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+def _step_event(event) -> Dict[str, Any]:
+    """StepEventをSSEで送る辞書にする（出力はchunkで送っているため含めない）"""
+    return {
+        "step": event.step,
+        "type": event.type.value,
+        "cached": event.cached,
+        "error": f"{type(event.error).__name__}: {event.error}" if event.error is not None else None,
+        "metrics": event.metrics.to_dict() if event.metrics is not None else None,
+    }
+
+def _request_budget(limits: Any, config: RunBudgetConfig) -> Optional[RunBudget]:
+    """本文のbudgetからリクエストの予算を作成（サーバーの上限より緩くはできない。不正な指定はValueError）"""
+    if limits is None:
+        limits = {}
+    if not isinstance(limits, dict) or set(limits) - {"max_tokens", "max_cost", "max_seconds"}:
+        raise ValueError("budgetはmax_tokens・max_cost・max_secondsのオブジェクトで指定してください")
+    return create_run_budget(
+        config,
+        int(limits["max_tokens"]) if limits.get("max_tokens") else None,
+        float(limits["max_cost"]) if limits.get("max_cost") else None,
+        float(limits["max_seconds"]) if limits.get("max_seconds") else None
+    )
+
+def _request_timeout(value: Any, config: ServerConfig) -> float:
+    """本文のtimeoutから期限の秒数を求める（サーバーの上限までに抑える。正の数でなければValueError）"""
+    if value is None:
+        return config.timeout
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not value > 0:
+        raise ValueError("timeoutは正の秒数で指定してください")
+    return min(float(value), config.timeout)
+
+def _runs_query(params: Any) -> Dict[str, Any]:
+    """実行履歴の一覧のクエリ文字列を検索の引数にする（不正な指定はValueError）"""
+    try:
+        limit = int(params.get("limit", 20))
+        before = float(params["before"]) if params.get("before") else None
+    except ValueError:
+        raise ValueError("limitは整数、beforeはUNIX時刻で指定してください") from None
+    if not 1 <= limit <= 200:
+        raise ValueError("limitは1〜200で指定してください")
+    return {"text": params.get("q", ""), "pattern": params.get("pattern") or None, "limit": limit, "before": before}
+
+def _budget_summary(budget: Optional[RunBudget]) -> Optional[Dict[str, Any]]:
+    return budget.summary() if budget is not None else None
+
+def create_app(
+    config: Optional[ServerConfig] = None,
+    budget_config: Optional[RunBudgetConfig] = None,
+    run_store: Optional[RunStore] = None
+) -> Starlette:
+    """APIサーバーのアプリケーションを作成（レジストリの設定はそのまま使う。run_storeがなければ/runsは404）"""
+    config = config or ServerConfig()
+    budget_config = budget_config or RunBudgetConfig()
+    admission = AdmissionControl(config.max_concurrency, config.queue_size, config.client_concurrency)
+
+    def runner(name: str, stream: bool) -> Callable:
+        pattern_class, method, stream_method = SERVER_PATTERNS[name]
+        return getattr(get_registry().get_pattern(pattern_class), stream_method if stream else method)
+
+    async def run_json(name: str, question: str, client: str, timeout: float, budget: Optional[RunBudget]) -> Response:
+        started = time.perf_counter()
+
+        async def run() -> Dict[str, Any]:
+            async with admission:
+                SERVER_QUEUE_WAIT.observe(time.perf_counter() - started, pattern=name)
+                with use_budget(budget):
+                    return await runner(name, stream=False)(question)
+
+        try:
+            result = await asyncio.wait_for(run(), timeout)
+        except asyncio.TimeoutError:
+            return _error(f"{timeout:g}秒の期限内に終わりませんでした", 504)
+        except Exception as e:
+            return _error(f"{type(e).__name__}: {e}", 500)
+        finally:
+            admission.leave(client)
+            SERVER_DURATION.observe(time.perf_counter() - started, pattern=name)
+        return JSONResponse({
+            "pattern": name,
+            "question": question,
+            "result": result,
+            "budget": _budget_summary(budget),
+            "duration": time.perf_counter() - started
+        })
+
+    async def run_stream(
+        name: str, question: str, client: str, timeout: float, budget: Optional[RunBudget]
+    ) -> AsyncIterator[str]:
+        started = time.perf_counter()
+        events: List[Dict[str, Any]] = []
+        outputs: Dict[str, str] = {}
+
+        def on_step(event) -> None:
+            events.append(_step_event(event))
+            if event.output is not None:
+                outputs[event.step] = event.output
+
+        def flush() -> List[str]:
+            sent = [_sse("step", event) for event in events]
+            events.clear()
+            return sent
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        def remaining() -> float:
+            return max(deadline - loop.time(), 0.0)
+
+        try:
+            # 期限は実行枠の待ちと各チャンクの待ちに残り時間として割り当てる（チャンクを送っている間も期限に数える）
+            await asyncio.wait_for(admission.__aenter__(), remaining())
+            try:
+                SERVER_QUEUE_WAIT.observe(time.perf_counter() - started, pattern=name)
+                with use_budget(budget):
+                    chunks = runner(name, stream=True)(question, on_step).__aiter__()
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(chunks.__anext__(), remaining())
+                        except StopAsyncIteration:
+                            break
+                        for event in flush():
+                            yield event
+                        yield _sse("chunk", {"step": chunk.step, "text": chunk.text})
+            finally:
+                await admission.__aexit__(None, None, None)
+            for event in flush():
+                yield event
+            if budget is not None:
+                # 予算を使い切って省いたステップは終了の通知がないため、印を出力にする
+                outputs.update((step, SKIPPED_OUTPUT) for step in budget.skipped)
+            yield _sse("done", {
+                "outputs": outputs, "budget": _budget_summary(budget), "duration": time.perf_counter() - started
+            })
+            SERVER_REQUESTS.inc(pattern=name, status="200")
+        except asyncio.TimeoutError:
+            SERVER_REQUESTS.inc(pattern=name, status="504")
+            yield _sse("error", {"error": f"{timeout:g}秒の期限内に終わりませんでした", "status": 504})
+        except Exception as e:
+            SERVER_REQUESTS.inc(pattern=name, status="500")
+            for event in flush():
+                yield event
+            yield _sse("error", {"error": f"{type(e).__name__}: {e}", "status": 500})
+        finally:
+            SERVER_DURATION.observe(time.perf_counter() - started, pattern=name)
+
+    async def run_pattern(request: Request) -> Response:
+        name = request.path_params["name"]
+        if name not in SERVER_PATTERNS:
+            return _error(f"未対応のパターンです: {name}（{', '.join(SERVER_PATTERNS)}）", 404)
+        try:
+            body = await request.json()
+        except ValueError:
+            return _error("本文はJSONで送ってください", 400)
+        question = body.get("question") if isinstance(body, dict) else None
+        if not isinstance(question, str) or not question.strip():
+            return _error("questionを指定してください", 400)
+        stream = bool(body.get("stream")) or "text/event-stream" in request.headers.get("accept", "")
+        try:
+            timeout = _request_timeout(body.get("timeout"), config)
+            budget = _request_budget(body.get("budget"), budget_config)
+        except (TypeError, ValueError) as e:
+            return _error(str(e), 400)
+        client = _client_id(request)
+        try:
+            admission.admit(client)
+        except Overloaded as e:
+            SERVER_REQUESTS.inc(pattern=name, status=str(e.status))
+            return _error(str(e), e.status, {"Retry-After": str(e.retry_after)})
+        if stream:
+            return AdmittedStream(
+                run_stream(name, question, client, timeout, budget),
+                lambda: admission.leave(client),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+        response = await run_json(name, question, client, timeout, budget)
+        SERVER_REQUESTS.inc(pattern=name, status=str(response.status_code))
+        return response
+
+    async def list_patterns(request: Request) -> Response:
+        return JSONResponse({"patterns": list(SERVER_PATTERNS)})
+
+    async def list_runs(request: Request) -> Response:
+        if run_store is None:
+            return _error("実行履歴は無効です（HISTORY_ENABLED）", 404)
+        try:
+            query = _runs_query(request.query_params)
+        except ValueError as e:
+            return _error(str(e), 400)
+        if query["text"].strip():
+            runs = run_store.search(query["text"], query["pattern"], query["limit"])
+        else:
+            runs = run_store.recent(query["pattern"], query["limit"], query["before"])
+        return JSONResponse({"runs": [asdict(run) for run in runs]})
+
+    async def get_run(request: Request) -> Response:
+        if run_store is None:
+            return _error("実行履歴は無効です（HISTORY_ENABLED）", 404)
+        record = run_store.get(request.path_params["run_id"])
+        if record is None:
+            return _error(f"実行が見つかりません: {request.path_params['run_id']}", 404)
+        return JSONResponse(asdict(record))
+
+    async def health(request: Request) -> Response:
+        return JSONResponse({"status": "ok", **admission.stats()})
+
+    async def metrics(request: Request) -> Response:
+        return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
+
+    app = Starlette(routes=[
+        Route("/patterns", list_patterns, methods=["GET"]),
+        Route("/patterns/{name}", run_pattern, methods=["POST"]),
+        Route("/runs", list_runs, methods=["GET"]),
+        Route("/runs/{run_id:int}", get_run, methods=["GET"]),
+        Route("/health", health, methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
+    ])
+    app.state.admission = admission
+    return app
+
+def configure_registry() -> None:
+    """環境変数の設定からレジストリの共有オブジェクト（キャッシュ・レート制限など）を作成"""
+    registry = get_registry()
+    cassette = None
+    if CassetteConfig().mode != "off":
+        from .cassette import create_cassette
+        cassette = create_cassette()
+        registry.set_llm_factory(cassette.llm_factory())
+    # 再生はネットワークを使わないため、レート制限を掛けない
+    replaying = cassette is not None and cassette.mode == "replay"
+    registry.set_rate_limiter(None if replaying else create_rate_limiter())
+    registry.set_retry_policy(create_retry_policy())
+    registry.set_context_budget(create_context_budget())
+    registry.set_response_cache(create_response_cache())
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """APIサーバーのCLIエントリーポイント"""
+    config = ServerConfig()
+    parser = argparse.ArgumentParser(description="パターンをHTTP APIとして公開します")
+    parser.add_argument("--host", default=config.host)
+    parser.add_argument("--port", type=int, default=config.port)
+    parser.add_argument("--max-concurrency", type=int, default=config.max_concurrency, help="同時に実行するリクエスト数")
+    parser.add_argument("--queue-size", type=int, default=config.queue_size, help="実行待ちにできるリクエスト数")
+    parser.add_argument("--client-concurrency", type=int, default=config.client_concurrency, help="1クライアントの同時リクエスト数")
+    parser.add_argument("--timeout", type=float, default=config.timeout, help="リクエストの期限（秒）")
+    args = parser.parse_args(argv)
+
+    import uvicorn
+    configure_registry()
+    app = create_app(ServerConfig(
+        host=args.host,
+        port=args.port,
+        max_concurrency=args.max_concurrency,
+        queue_size=args.queue_size,
+        client_concurrency=args.client_concurrency,
+        timeout=args.timeout,
+    ), run_store=create_run_store())
+    uvicorn.run(app, host=args.host, port=args.port)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,167 @@
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple, TypeVar
+import asyncio
+import threading
+
+T = TypeVar("T")
+
+class _Call:
+    """実行中の1回分の呼び出し"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[Exception] = None
+        # 代表者がキャンセル等で結果を残さずに抜けた場合はTrue（待っていた側がやり直す）
+        self.abandoned = False
+        self.waiters = 0
+        # 代表者がasyncioで実行している場合の完了通知
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.future: Optional[asyncio.Future] = None
+
+    def outcome(self) -> Any:
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class SingleFlight:
+    """同じキーの同時実行を1回の上流呼び出しにまとめる
+
+    最初に来た呼び出し（代表者）だけが実行し、実行中に同じキーで来た呼び出しは
+    完了を待って同じ結果（または例外）を受け取る。スレッドとasyncioのどちらから
+    呼び出してもよく、両者が混在しても同じ呼び出しを共有する。
+    完了した結果は保持しない（保持はResponseCacheの役割）。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self.executed = 0
+        self.shared = 0
+        self.max_waiters = 0
+
+    def join(self, key: Hashable) -> Tuple[_Call, bool]:
+        """キーの呼び出しに参加し、(呼び出し, 自分が代表者か)を返す"""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+                return call, True
+            call.waiters += 1
+            self.max_waiters = max(self.max_waiters, call.waiters)
+            return call, False
+
+    def finish(
+        self,
+        key: Hashable,
+        call: _Call,
+        result: Any = None,
+        error: Optional[BaseException] = None,
+        abandon: bool = False
+    ) -> None:
+        """代表者が結果を登録し、待っている呼び出しを起こす
+
+        errorがExceptionでない（キャンセル・ジェネレータの破棄など）場合やabandonがTrue
+        （代表者だけの事情で失敗した）場合は結果を共有せず、待っていた呼び出しにやり直させる。
+        """
+        if error is None:
+            call.result = result
+        elif isinstance(error, Exception) and not abandon:
+            call.error = error
+        else:
+            call.abandoned = True
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+            self.executed += 1
+            if not call.abandoned:
+                self.shared += call.waiters
+        call.done.set()
+        if call.future is not None and not call.loop.is_closed():
+            call.loop.call_soon_threadsafe(_resolve, call.future)
+
+    def wait(self, call: _Call) -> Any:
+        """代表者の完了を待って結果を返す（代表者が中断した場合は_Call.abandoned）"""
+        call.done.wait()
+        return call.outcome()
+
+    async def await_call(self, call: _Call) -> Any:
+        """waitの非同期版"""
+        if not call.done.is_set():
+            if call.future is not None and call.loop is asyncio.get_running_loop():
+                await asyncio.shield(call.future)
+            else:
+                # 代表者が別スレッド・別ループの場合はスレッドで待つ
+                await asyncio.to_thread(call.done.wait)
+        return call.outcome()
+
+    def lead(self, key: Hashable) -> Tuple[Optional[_Call], Any]:
+        """代表者になれれば(呼び出し, None)、なれなければ共有した結果を(None, 結果)で返す
+
+        代表者になった場合は、実行後に必ずfinishを呼ぶこと。
+        """
+        while True:
+            call, leader = self.join(key)
+            if leader:
+                return call, None
+            result = self.wait(call)
+            if not call.abandoned:
+                return None, result
+
+    async def alead(self, key: Hashable) -> Tuple[Optional[_Call], Any]:
+        """leadの非同期版"""
+        while True:
+            call, leader = self.join(key)
+            if leader:
+                self.bind(call)
+                return call, None
+            result = await self.await_call(call)
+            if not call.abandoned:
+                return None, result
+
+    def do(self, key: Hashable, fn: Callable[[], T]) -> T:
+        """fnを同じキーの同時呼び出しと共有して実行"""
+        call, result = self.lead(key)
+        if call is None:
+            return result
+        try:
+            result = fn()
+        except BaseException as e:
+            self.finish(key, call, error=e)
+            raise
+        self.finish(key, call, result)
+        return result
+
+    async def ado(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """doの非同期版"""
+        call, result = await self.alead(key)
+        if call is None:
+            return result
+        try:
+            result = await fn()
+        except BaseException as e:
+            self.finish(key, call, error=e)
+            raise
+        self.finish(key, call, result)
+        return result
+
+    def bind(self, call: _Call) -> None:
+        """代表者が実行中のイベントループに完了通知を結び付ける"""
+        call.loop = asyncio.get_running_loop()
+        call.future = call.loop.create_future()
+
+    @property
+    def in_flight(self) -> int:
+        """実行中の呼び出し数"""
+        return len(self._calls)
+
+    def stats(self) -> Dict[str, int]:
+        """上流の呼び出し数と、まとめたことで省けた呼び出し数"""
+        return {
+            "executed": self.executed,
+            "shared": self.shared,
+            "in_flight": self.in_flight,
+            "max_waiters": self.max_waiters,
+        }
+
+def _resolve(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
@@ -0,0 +1,4 @@
+import os
+
+# APIキー未設定の環境でもクライアントを生成できるようにダミーのキーを設定
+os.environ.setdefault("GOOGLE_API_KEY", "test-api-key")
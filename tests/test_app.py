@@ -0,0 +1,114 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from src.app import AIPatternDemo, StepProgress, StepStatus, display_progress, run_comparison
+from src.fake_llm import FakeChatModel
+from src.history import RunStore
+from src.registry import get_registry
+from src.run_budget import current_budget
+
+RUNNERS = {
+    "シンプルな質問応答": "direct_query",
+    "段階的思考（Chain of Thought）": "chain_of_thought",
+    "構造化推論": "direct_reasoning",
+    "連鎖推論": "chained_reasoning",
+    "生成と評価の繰り返し": "evaluator_optimizer_workflow",
+    "ディベートベースの協調": "debate_based_cooperation",
+}
+
+@pytest.fixture
+def fake():
+    llm = FakeChatModel(ttft=0.05)
+    get_registry().set_llm_factory(lambda config: llm)
+    yield llm
+    get_registry().set_llm_factory(None)
+
+def test_comparison_runs_patterns_concurrently(fake):
+    """全パターンの比較は最も遅いパターン程度の時間で終わり、終わった順に結果を返す"""
+    start = time.perf_counter()
+    results = list(run_comparison(AIPatternDemo(), RUNNERS, "質問", max_workers=6))
+    elapsed = time.perf_counter() - start
+
+    assert {r.pattern for r in results} == set(RUNNERS)
+    assert all(r.error is None and r.result["final_response"] for r in results)
+    # 4段のパターンが最後に終わる（ディベートは各ラウンドを同時に生成するため3段分）
+    assert results[0].pattern == "シンプルな質問応答"
+    assert results[-1].pattern in {"段階的思考（Chain of Thought）", "連鎖推論", "生成と評価の繰り返し"}
+    assert elapsed < 0.6 * sum(r.elapsed for r in results)
+    # 同じプロンプトになる単純な質問応答と生成と評価の初回生成は1回の呼び出しを共有する
+    assert fake.calls == sum(r.trace.to_dict()["llm_calls"] for r in results) == 1 + 4 + 3 + 4 + 4 + 5 - 1
+
+def test_comparison_reports_calls_tokens_and_step_outputs(fake):
+    """パターンごとの呼び出し回数・トークン数・途中のステップ出力を返す"""
+    results = {r.pattern: r for r in run_comparison(AIPatternDemo(), RUNNERS, "別の質問", max_workers=2)}
+
+    chained = results["連鎖推論"]
+    assert chained.trace.to_dict()["llm_calls"] == 4
+    assert chained.trace.to_dict()["completion_tokens"] == 4 * fake.output_tokens
+    assert set(chained.outputs) == {"decomposition", "data_analysis", "assumptions", "final_result"}
+
+class CountingDemo:
+    """同時に実行中のパターン数と、各実行に適用された予算を記録するAIPatternDemoの代わり"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+        self.budgets = []
+
+    def __getattr__(self, runner):
+        def run(question, on_step):
+            with self.lock:
+                self.running += 1
+                self.peak = max(self.peak, self.running)
+                self.budgets.append(current_budget())
+            time.sleep(0.05)
+            with self.lock:
+                self.running -= 1
+            return {"final_response": runner}
+        return run
+
+def test_comparisons_share_pool_budget_and_history(tmp_path, monkeypatch):
+    """同時の比較はプロセス共有のプールの上限を守り、パターンごとに予算を適用して実行履歴に保存する"""
+    monkeypatch.setenv("RUN_MAX_TOKENS", "100000")
+    demo, pool, store = CountingDemo(), ThreadPoolExecutor(max_workers=2), RunStore(str(tmp_path / "runs.sqlite3"))
+    runners = dict(list(RUNNERS.items())[:3])
+
+    def session():
+        list(run_comparison(demo, runners, "質問", max_workers=3, pool=pool, run_store=store))
+
+    sessions = [threading.Thread(target=session) for _ in range(2)]
+    for thread in sessions:
+        thread.start()
+    for thread in sessions:
+        thread.join()
+    pool.shutdown()
+
+    assert demo.peak == 2
+    assert len(demo.budgets) == 6 and None not in demo.budgets
+    assert len({id(budget) for budget in demo.budgets}) == 6
+    assert len(store.recent(limit=10)) == 6
+
+class RecordingSlot:
+    """描画した内容を記録するプレースホルダーの代わり"""
+    def __init__(self):
+        self.rendered = []
+
+    def markdown(self, body, unsafe_allow_html=False):
+        self.rendered.append(body)
+
+def test_progress_redraws_only_changed_steps():
+    """進捗表示は状態が変わったステップだけを描き直し、スタイルは毎回送らない"""
+    step_progress = StepProgress(["分析", "推論", "回答"])
+    container = object()
+    step_progress.container = container
+    step_progress.slots = {step: RecordingSlot() for step in step_progress.steps}
+
+    display_progress(step_progress, container)
+    step_progress.update_status("分析", StepStatus.PROCESSING)
+    display_progress(step_progress, container)
+    display_progress(step_progress, container)
+
+    assert [len(slot.rendered) for slot in step_progress.slots.values()] == [2, 1, 1]
+    assert "processing" in step_progress.slots["分析"].rendered[-1]
+    assert not any("<style>" in body for slot in step_progress.slots.values() for body in slot.rendered)
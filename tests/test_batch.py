@@ -0,0 +1,57 @@
+import asyncio
+import json
+import pytest
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+from src.batch import run_batch, arun_batch, load_questions, main
+from src.registry import get_registry
+
+def _echo(prompt_value):
+    """プロンプトの末尾行を返すフェイクLLM（「失敗」を含む場合はエラー）"""
+    text = prompt_value.to_string()
+    if "失敗" in text:
+        raise RuntimeError("upstream error")
+    return AIMessage(content=text.strip().splitlines()[-1])
+
+@pytest.fixture(autouse=True)
+def echo_llm():
+    get_registry().set_llm_factory(lambda config: RunnableLambda(_echo))
+    yield
+    get_registry().set_llm_factory(None)
+    # CLIが設定したレート制限と受け渡しの予算を他のテストに持ち越さない
+    get_registry().set_rate_limiter(None)
+    get_registry().set_context_budget(None)
+
+def test_results_keep_input_order_with_per_item_errors():
+    """結果は入力順で、失敗した質問だけがエラーになる"""
+    questions = ["質問A", "失敗する質問", "質問C"]
+    results = run_batch("direct_query", questions, max_concurrency=2)
+
+    assert [r.question for r in results] == questions
+    assert results[0].result == {"final_response": "質問A"}
+    assert results[1].result is None and "upstream error" in results[1].error
+    assert results[2].result == {"final_response": "質問C"}
+
+def test_async_batch_runs_all_steps():
+    """非同期バッチでも全ステップを実行する"""
+    results = asyncio.run(arun_batch("chained_reasoning", ["質問1", "質問2"], max_concurrency=4))
+
+    assert all(r.error is None for r in results)
+    assert set(results[1].result) == {"decomposition", "data_analysis", "assumptions", "final_result"}
+
+def test_unknown_pattern_is_rejected():
+    """未対応のパターン名はエラーになる"""
+    with pytest.raises(ValueError):
+        run_batch("unknown", ["質問"])
+
+def test_cli_writes_jsonl(tmp_path):
+    """CLIはJSONLを読み込み、結果をJSONLで書き出す"""
+    source = tmp_path / "questions.jsonl"
+    source.write_text('{"question": "質問1"}\n"質問2"\n', encoding="utf-8")
+    output = tmp_path / "results.jsonl"
+
+    assert load_questions(str(source)) == ["質問1", "質問2"]
+    assert main(["direct_query", str(source), "--output", str(output)]) == 0
+    records = [json.loads(line) for line in output.read_text(encoding="utf-8").splitlines()]
+    assert [r["index"] for r in records] == [0, 1]
+    assert records[1]["result"]["final_response"] == "質問2"
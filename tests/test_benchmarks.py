@@ -0,0 +1,137 @@
+import asyncio
+import pytest
+from langchain_core.messages import HumanMessage
+from src.app import AIPatternDemo
+from src.benchmark import BENCHMARK_PATTERNS, IMPORT_TARGETS, import_problems, measure_import_time, percentile, run_benchmark
+from src.fake_llm import FakeChatModel, FakeLLMError, FakeRateLimitError
+from src.models import DirectQuery
+from src.rate_limit import RetryPolicy
+from src.registry import get_registry
+
+# パターンごとの1問あたりのLLM呼び出し回数（増えたら回帰）
+EXPECTED_CALLS = {
+    "direct_query": 1,
+    "chain_of_thought": 4,
+    "direct_reasoning": 3,
+    "chained_reasoning": 4,
+    # フェイクの評価は点数が読み取れず0点のため、2回目の評価で頭打ちとして終える
+    "evaluator_optimizer": 4,
+    "debate_based_cooperation": 5,
+}
+
+# アプリのランナー名 → パターン名
+APP_RUNNERS = {
+    "direct_query": "direct_query",
+    "chain_of_thought": "chain_of_thought",
+    "direct_reasoning": "direct_reasoning",
+    "chained_reasoning": "chained_reasoning",
+    "evaluator_optimizer_workflow": "evaluator_optimizer",
+    "debate_based_cooperation": "debate_based_cooperation",
+}
+
+@pytest.fixture
+def fake():
+    llm = FakeChatModel()
+    get_registry().set_llm_factory(lambda config: llm)
+    yield llm
+    get_registry().set_llm_factory(None)
+    get_registry().set_retry_policy(RetryPolicy())
+
+@pytest.mark.parametrize("pattern", list(BENCHMARK_PATTERNS))
+def test_benchmark_reports_calls_and_latency(pattern):
+    """ベンチマークはパターンごとの呼び出し回数とレイテンシを報告する"""
+    questions = [f"質問{i}" for i in range(4)]
+    result = run_benchmark(pattern, questions, concurrency=2, llm_factory=lambda: FakeChatModel(ttft=0.001))
+
+    assert result.errors == 0
+    assert result.calls_per_question == EXPECTED_CALLS[pattern]
+    assert 0 < result.p50_ms <= result.p90_ms <= result.p99_ms
+    assert result.qps > 0
+
+def test_benchmark_restores_callers_llm_factory(fake):
+    """ベンチマークの終了後は呼び出し元が設定したLLMファクトリに戻る"""
+    factory = get_registry().llm_factory
+    run_benchmark("direct_query", ["質問"], llm_factory=lambda: FakeChatModel(ttft=0.001))
+
+    assert get_registry().llm_factory is factory
+    AIPatternDemo().direct_query("質問")
+    assert fake.calls == 1
+
+@pytest.mark.parametrize("runner", list(APP_RUNNERS))
+def test_app_runs_each_pattern_once(fake, runner):
+    """アプリは通常実行・ストリーミングともパターンを1回だけ実行する"""
+    demo = AIPatternDemo()
+    result = getattr(demo, runner)("質問")
+    assert fake.calls == EXPECTED_CALLS[APP_RUNNERS[runner]]
+    assert result["final_response"]
+
+    list(demo.stream(runner, "別の質問"))
+    assert fake.calls == 2 * EXPECTED_CALLS[APP_RUNNERS[runner]]
+
+def test_framework_overhead_per_call_is_small():
+    """フェイクの待ち時間を除いた1呼び出しあたりのオーバーヘッドが小さい"""
+    questions = [f"質問{i}" for i in range(20)]
+    result = run_benchmark("chained_reasoning", questions, llm_factory=lambda: FakeChatModel(ttft=0.002))
+
+    assert result.overhead_per_call_ms < 25
+
+def test_throughput_scales_with_concurrency():
+    """待ち時間が支配的な場合、並列度を上げるとスループットが上がる"""
+    questions = [f"質問{i}" for i in range(8)]
+
+    def factory():
+        return FakeChatModel(ttft=0.05)
+
+    serial = run_benchmark("direct_query", questions, concurrency=1, llm_factory=factory)
+    parallel = run_benchmark("direct_query", questions, concurrency=8, llm_factory=factory)
+
+    assert parallel.qps > 3 * serial.qps
+
+def test_fake_model_is_deterministic_and_reports_usage(fake):
+    """フェイクの応答はプロンプトごとに決まり、使用量と複数候補を返す"""
+    fake.n = 3
+    first = fake.invoke("質問")
+    again = fake.invoke("質問")
+    result = fake.generate([[HumanMessage(content="質問")]])
+
+    assert first.content == again.content and first.content.startswith("[")
+    assert first.usage_metadata["output_tokens"] == 3 * fake.output_tokens
+    assert len({g.text for g in result.generations[0]}) == 3
+
+def test_fake_model_streams_tokens_at_configured_rate():
+    """ストリーミングはoutput_tokens個のチャンクを設定した速度で返す"""
+    llm = FakeChatModel(output_tokens=10, tokens_per_second=1000)
+    chunks = list(llm.stream("質問"))
+
+    assert len(chunks) == 10
+    assert chunks[-1].usage_metadata["output_tokens"] == 10
+    assert llm.simulated_seconds == pytest.approx(0.009)
+
+def test_injected_rate_limits_are_retried(fake):
+    """注入した429は再試行で回復し、一般的なエラーはそのまま失敗する"""
+    get_registry().set_retry_policy(RetryPolicy(base_delay=0.0))
+    fake.failure_rate = 0.2
+    outputs = DirectQuery().batch_answer([f"質問{i}" for i in range(20)])
+
+    assert all(not isinstance(o, Exception) for o in outputs)
+    assert fake.calls > 20
+
+    fake.rate_limit_ratio = 0.0
+    fake.failure_rate = 1.0
+    with pytest.raises(FakeLLMError) as error:
+        asyncio.run(DirectQuery().aanswer("別の質問"))
+    assert not isinstance(error.value, FakeRateLimitError)
+
+@pytest.mark.parametrize("module", list(IMPORT_TARGETS))
+def test_cold_import_stays_lazy(module):
+    """バッチやライブラリとしてのimportはStreamlitやGeminiのSDKを読み込まず、上限時間内に終わる"""
+    budget_ms, forbidden = IMPORT_TARGETS[module]
+    profile = measure_import_time(module, forbidden)
+
+    assert profile.total_ms > 0
+    assert import_problems(profile, budget_ms) == []
+
+def test_percentile_interpolates():
+    """パーセンタイルは線形補間で計算する"""
+    assert percentile([1, 2, 3, 4], 50) == 2.5
+    assert percentile([5], 99) == 5
@@ -0,0 +1,191 @@
+import asyncio
+import threading
+import time
+import pytest
+from starlette.testclient import TestClient
+from src.cache import SQLiteResponseCache
+from src.config import RunBudgetConfig, ServerConfig
+from src.fake_llm import FakeChatModel
+from src.models import DebateBasedCooperation, EvaluatorOptimizer, GeminiReasoning
+from src.registry import get_registry
+from src.run_budget import SKIPPED_OUTPUT, RunBudget, iterate_with_deadline, use_budget
+from src.semantic_cache import SemanticCache
+from src.server import create_app
+
+@pytest.fixture
+def fake():
+    llm, limits = FakeChatModel(), []
+
+    def factory(config):
+        # クライアントを作成した設定のmax_output_tokensを記録する
+        limits.append(config.max_output_tokens)
+        return llm
+
+    get_registry().set_llm_factory(factory)
+    yield llm, limits
+    get_registry().set_llm_factory(None)
+
+def test_budget_shrinks_output_and_skips_remaining_steps(fake):
+    """残りの予算に合わせて出力の上限を縮め、使い切ったら残りのステップに印を付けて途中までの結果を返す"""
+    with use_budget(RunBudget(max_tokens=400)) as budget:
+        result = GeminiReasoning().chained_reasoning("在宅勤務を導入すべきか")
+    llm, limits = fake
+
+    assert result["decomposition"] != SKIPPED_OUTPUT
+    assert result["final_result"] == SKIPPED_OUTPUT
+    assert budget.exhausted == "tokens"
+    assert budget.skipped == ["assumptions", "final_result"]
+    assert budget.calls == llm.calls == 2
+    # 2のべき乗に切り下げた上限のクライアントを作る
+    assert min(limits) < max(limits)
+    assert all(limit & (limit - 1) == 0 for limit in limits)
+
+    # 予算がなければ同じ質問でも最後まで実行する
+    assert GeminiReasoning().chained_reasoning("在宅勤務を導入すべきか")["final_result"] != SKIPPED_OUTPUT
+
+def test_cached_steps_run_without_budget(fake, tmp_path):
+    """応答キャッシュにあるステップは費用がかからないため、予算を使い切っていても実行する"""
+    get_registry().set_response_cache(SQLiteResponseCache(str(tmp_path / "responses.sqlite3"), cache_sampled=True))
+    try:
+        expected = GeminiReasoning().chained_reasoning("在宅勤務を導入すべきか")
+        with use_budget(RunBudget(max_tokens=1)) as budget:
+            result = GeminiReasoning().chained_reasoning("在宅勤務を導入すべきか")
+    finally:
+        get_registry().set_response_cache(None)
+
+    assert result == expected
+    assert budget.calls == 0 and budget.exhausted is None and budget.skipped == []
+
+def test_batch_is_charged_and_stops_questions(fake):
+    """バッチ実行も予算を確認して使ったトークン数を加算し、使い切ったら以降のステップを省く"""
+    questions = ["質問1", "質問2", "質問3"]
+    with use_budget(RunBudget(max_tokens=1000)) as budget:
+        results = GeminiReasoning().batch_chained_reasoning(questions)
+    llm, _ = fake
+
+    assert budget.calls == llm.calls and budget.exhausted == "tokens"
+    assert all(result["decomposition"] != SKIPPED_OUTPUT for result in results)
+    assert all(result["final_result"] == SKIPPED_OUTPUT for result in results)
+
+    calls = llm.calls
+    with use_budget(RunBudget(max_tokens=1000)) as budget:
+        results = asyncio.run(GeminiReasoning().abatch_chained_reasoning(["質問4", "質問5", "質問6"]))
+    assert budget.calls == llm.calls - calls and budget.exhausted == "tokens"
+    assert all(result["final_result"] == SKIPPED_OUTPUT for result in results)
+
+def test_iterative_patterns_stop_early(fake):
+    """評価の繰り返しは予算で打ち切った理由を返し、ディベートは合意形成の代わりに最後の議論を返す"""
+    with use_budget(RunBudget(max_tokens=500)):
+        result = EvaluatorOptimizer().generate_optimized_response("在宅勤務を導入すべきか")
+    assert result["stop_reason"] == "budget"
+    assert result["final_response"] != SKIPPED_OUTPUT
+
+    with use_budget(RunBudget(max_tokens=600)) as budget:
+        result = DebateBasedCooperation().generate_debate_response("在宅勤務を導入すべきか")
+    llm, _ = fake
+    # 立場の発言はスレッドで同時に実行しても同じ予算に計上される（同時に確認した発言は両方とも実行されうる）
+    assert budget.calls == llm.calls - 3 and budget.skipped[-1] == "consensus"
+    assert not result["converged"]
+    assert result["final_response"].startswith(SKIPPED_OUTPUT)
+    assert "保守的な思考" in result["final_response"]
+
+def test_server_applies_request_budget(fake):
+    """リクエストの予算はサーバーの上限より緩くできず、消費量を応答に含める"""
+    client = TestClient(create_app(ServerConfig(), RunBudgetConfig(max_tokens=400)))
+
+    response = client.post("/patterns/chained_reasoning", json={"question": "質問", "budget": {"max_tokens": 100000}})
+    assert response.status_code == 200
+    assert response.json()["budget"]["max_tokens"] == 400
+    assert response.json()["result"]["final_result"] == SKIPPED_OUTPUT
+
+    response = client.post("/patterns/direct_query", json={"question": "質問", "budget": {"max_tokens": 10}})
+    assert response.json()["budget"]["exhausted"] == "tokens"
+    assert client.post("/patterns/direct_query", json={"question": "質問", "budget": {"tokens": 1}}).status_code == 400
+
+def test_time_limit_interrupts_running_call(fake):
+    """時間の上限は実行中の呼び出しも打ち切り、同期・非同期・ストリーミングのいずれも期限の近くで戻る"""
+    get_registry().set_llm_factory(lambda config: FakeChatModel(ttft=1.0))
+
+    def timed(run):
+        start = time.perf_counter()
+        with use_budget(RunBudget(max_seconds=0.2)) as budget:
+            result = run()
+        return result, budget, time.perf_counter() - start
+
+    result, budget, elapsed = timed(lambda: GeminiReasoning().chained_reasoning("質問"))
+    assert elapsed < 0.6 and budget.exhausted == "time"
+    assert result["decomposition"] == SKIPPED_OUTPUT
+
+    result, budget, elapsed = timed(lambda: asyncio.run(GeminiReasoning().achained_reasoning("質問")))
+    assert elapsed < 0.6 and budget.exhausted == "time"
+
+    chunks, budget, elapsed = timed(lambda: list(GeminiReasoning().stream_chained_reasoning("質問")))
+    assert elapsed < 0.6 and budget.exhausted == "time"
+    assert chunks[0].text == SKIPPED_OUTPUT
+
+def test_budget_timeout_is_not_shared_with_waiting_runs():
+    """代表者の予算切れは同じプロンプトを待っていた実行に共有せず、待っていた側は自分の予算でやり直す"""
+    llm = FakeChatModel(ttft=0.5)
+    get_registry().set_llm_factory(lambda config: llm)
+    results = {}
+
+    def run(name, budget):
+        with use_budget(budget):
+            results[name] = GeminiReasoning().direct_reasoning("質問")
+
+    try:
+        leader = threading.Thread(target=run, args=("budgeted", RunBudget(max_seconds=0.1)))
+        leader.start()
+        time.sleep(0.05)
+        follower = threading.Thread(target=run, args=("unbudgeted", None))
+        follower.start()
+        leader.join()
+        follower.join()
+    finally:
+        get_registry().set_llm_factory(None)
+
+    assert all(output == SKIPPED_OUTPUT for output in results["budgeted"].values())
+    assert all(output != SKIPPED_OUTPUT for output in results["unbudgeted"].values())
+    # 打ち切った最初のステップの呼び出し＋待っていた側が自分で実行した3ステップ
+    assert llm.calls == 4
+
+def test_abandoned_call_is_charged_when_it_returns():
+    """時間の上限で打ち切った同期の呼び出しも、後から届いた応答の使用量を予算に加算する"""
+    get_registry().set_llm_factory(lambda config: FakeChatModel(ttft=0.3))
+    try:
+        with use_budget(RunBudget(max_seconds=0.1)) as budget:
+            GeminiReasoning().direct_reasoning("質問")
+        assert budget.calls == 0
+        time.sleep(0.5)
+    finally:
+        get_registry().set_llm_factory(None)
+
+    assert budget.calls == 1 and budget.completion_tokens > 0
+
+def test_stream_is_read_from_one_thread():
+    """期限付きのストリームは1つのスレッドだけで読み進める"""
+    threads = set()
+
+    def chunks():
+        for i in range(5):
+            threads.add(threading.get_ident())
+            yield i
+
+    with use_budget(RunBudget(max_seconds=5)):
+        assert list(iterate_with_deadline(chunks())) == list(range(5))
+    assert len(threads) == 1 and threading.get_ident() not in threads
+
+def test_limited_outputs_are_not_stored_semantically(fake):
+    """予算で出力の上限を縮めた実行の結果は意味的キャッシュに保存せず、予算のない言い換えには使わない"""
+    llm, limits = fake
+    get_registry().set_semantic_cache(SemanticCache())
+    try:
+        with use_budget(RunBudget(max_tokens=1500)) as budget:
+            GeminiReasoning().direct_reasoning("日本の少子高齢化の影響を分析してください")
+        calls = llm.calls
+        GeminiReasoning().direct_reasoning("日本の少子高齢化の影響を分析して下さい")
+    finally:
+        get_registry().set_semantic_cache(None)
+
+    assert budget.limited > 0 and budget.exhausted is None
+    assert llm.calls == calls + 3
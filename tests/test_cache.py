@@ -0,0 +1,102 @@
+import pytest
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from src.cache import SQLiteResponseCache, response_cache_key
+from src.config import GeminiConfig
+from src.models import GeminiReasoning
+from src.registry import get_registry
+
+@pytest.fixture
+def cache(tmp_path):
+    return SQLiteResponseCache(str(tmp_path / "responses.sqlite3"), max_entries=2)
+
+def test_lookup_counts_hits_and_misses(cache):
+    """ヒット・ミスを数える"""
+    assert cache.lookup("k") is None
+    cache.update("k", "応答")
+    assert cache.lookup("k") == "応答"
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+def test_least_recently_used_entry_is_evicted(cache, monkeypatch):
+    """上限を超えると最終アクセスが最も古いエントリを削除する"""
+    clock = iter(range(100))
+    monkeypatch.setattr("src.cache.time.time", lambda: next(clock))
+    cache.update("a", "A")
+    cache.update("b", "B")
+    cache.lookup("a")
+    cache.update("c", "C")
+
+    assert len(cache) == 2
+    assert cache.lookup("b") is None
+    assert cache.lookup("a") == "A"
+    assert cache.stats()["evictions"] == 1
+
+def test_hits_batch_access_time_writes(tmp_path, monkeypatch):
+    """ヒットのたびには書き込まず、溜めた最終アクセスをまとめて書き込む"""
+    now = [1000.0]
+    monkeypatch.setattr("src.cache.time.time", lambda: now[0])
+    cache = SQLiteResponseCache(str(tmp_path / "touch.sqlite3"), touch_batch=3, touch_interval=60)
+    for key in ("a", "b", "c"):
+        cache.update(key, key.upper())
+    written = cache._conn.total_changes
+
+    now[0] += 1
+    cache.lookup("a")
+    cache.lookup("b")
+    assert cache._conn.total_changes == written
+
+    cache.lookup("c")
+    assert cache._conn.total_changes == written + 3
+    assert {row[0] for row in cache._conn.execute("SELECT accessed_at FROM responses")} == {1001.0}
+
+def test_eviction_counts_entries_from_other_processes(tmp_path):
+    """同じファイルに別のキャッシュが書き込んだ分も数えて上限を守る"""
+    path = str(tmp_path / "shared.sqlite3")
+    first = SQLiteResponseCache(path, max_entries=2)
+    second = SQLiteResponseCache(path, max_entries=2)
+    first.update("a", "A")
+    first.update("b", "B")
+    second.update("c", "C")
+
+    assert len(second) == 2
+    assert second._count() == 2
+    assert second.lookup("c") == "C"
+
+def test_expired_entry_is_a_miss(tmp_path, monkeypatch):
+    """TTLを過ぎたエントリはミスになる"""
+    now = [1000.0]
+    monkeypatch.setattr("src.cache.time.time", lambda: now[0])
+    cache = SQLiteResponseCache(str(tmp_path / "ttl.sqlite3"), ttl=60)
+    cache.update("k", "応答")
+    now[0] += 61
+
+    assert cache.lookup("k") is None
+    assert cache.stats()["expirations"] == 1
+
+def test_key_depends_on_sampling_parameters():
+    """サンプリング設定が違えば別のキーになる"""
+    assert response_cache_key(GeminiConfig(temperature=0), "p") != response_cache_key(GeminiConfig(temperature=0.5), "p")
+
+def test_sampled_calls_can_opt_out(tmp_path):
+    """cache_sampled=Falseならtemperature>0の呼び出しはキャッシュしない"""
+    cache = SQLiteResponseCache(str(tmp_path / "c.sqlite3"), cache_sampled=False)
+    assert not cache.accepts(GeminiConfig(temperature=0.7))
+    assert cache.accepts(GeminiConfig(temperature=0))
+
+def test_repeated_pattern_run_is_served_from_cache(cache):
+    """同じ質問の再実行はLLMを呼び出さない"""
+    llm = FakeListChatModel(responses=[f"応答{i}" for i in range(10)])
+    registry = get_registry()
+    registry.set_llm_factory(lambda config: llm)
+    registry.set_response_cache(SQLiteResponseCache(cache.path, max_entries=100))
+    try:
+        first = GeminiReasoning().direct_reasoning("質問")
+        second = GeminiReasoning().direct_reasoning("質問")
+        streamed = "".join(c.text for c in GeminiReasoning().stream_direct_reasoning("質問") if c.step == "reasoning")
+    finally:
+        registry.set_response_cache(None)
+        registry.set_llm_factory(None)
+
+    assert llm.i == 3
+    assert first == second
+    assert streamed == first["reasoning"]
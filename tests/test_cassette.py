@@ -0,0 +1,83 @@
+import asyncio
+import json
+import time
+import pytest
+from src.batch import main
+from src.cassette import Cassette, CassetteMissError
+from src.config import GeminiConfig
+from src.fake_llm import FakeChatModel
+from src.models import GeminiReasoning
+from src.registry import get_registry
+
+@pytest.fixture
+def use_cassette():
+    def use(cassette, inner=None):
+        get_registry().set_llm_factory(cassette.llm_factory(inner))
+        return cassette
+    yield use
+    get_registry().set_llm_factory(None)
+    # バッチのCLIが設定したレート制限と受け渡しの予算を他のテストに持ち越さない
+    get_registry().set_rate_limiter(None)
+    get_registry().set_context_budget(None)
+
+def test_replay_matches_recording_without_upstream_calls(use_cassette, tmp_path):
+    """記録した呼び出しは通常実行・ストリーミング・非同期のどれでも同じ応答で再生される"""
+    path = str(tmp_path / "cassette.jsonl")
+    fake = FakeChatModel()
+    recorder = use_cassette(Cassette(path, mode="record"), lambda config: fake)
+    recorded = GeminiReasoning().chained_reasoning("在宅勤務を導入すべきか")
+    recorder.close()
+    calls = fake.calls
+
+    player = use_cassette(Cassette(path))
+    pattern = GeminiReasoning()
+    assert pattern.chained_reasoning("在宅勤務を導入すべきか") == recorded
+    assert "".join(c.text for c in pattern.stream_chained_reasoning("在宅勤務を導入すべきか")
+                   if c.step == "final_result") == recorded["final_result"]
+    assert asyncio.run(pattern.achained_reasoning("在宅勤務を導入すべきか")) == recorded
+    assert fake.calls == calls
+    assert player.stats()["hits"] == 12 and len(player) == 4
+
+def test_replay_latency_is_optional(use_cassette, tmp_path):
+    """既定では待ち時間なしで再生し、replay_latencyでは記録時のチャンクの間隔を再現する"""
+    path = str(tmp_path / "cassette.jsonl")
+    fake = FakeChatModel(ttft=0.1, tokens_per_second=100, output_tokens=10)
+    recorder = use_cassette(Cassette(path, mode="record"), lambda config: fake)
+    chunks = [chunk.content for chunk in get_registry().get_llm(GeminiConfig()).stream("質問")]
+    recorder.close()
+
+    for replay_latency, bounds in ((False, (0, 0.05)), (True, (0.17, 0.5))):
+        use_cassette(Cassette(path, replay_latency=replay_latency))
+        start = time.perf_counter()
+        replayed = [chunk.content for chunk in get_registry().get_llm(GeminiConfig()).stream("質問")]
+        elapsed = time.perf_counter() - start
+        assert replayed == chunks
+        assert bounds[0] <= elapsed < bounds[1]
+
+def test_repeated_prompts_replay_in_recorded_order(use_cassette, tmp_path):
+    """同じプロンプトの記録は記録した順に返し、記録のない呼び出しはエラーになる"""
+    path = str(tmp_path / "cassette.jsonl")
+    recorder = use_cassette(Cassette(path, mode="record"), lambda config: FakeChatModel(responses=["1回目", "2回目"]))
+    llm = get_registry().get_llm(GeminiConfig())
+    assert [llm.invoke("同じ質問").content for _ in range(2)] == ["1回目", "2回目"]
+    recorder.close()
+
+    use_cassette(Cassette(path))
+    llm = get_registry().get_llm(GeminiConfig())
+    assert [llm.invoke("同じ質問").content for _ in range(3)] == ["1回目", "2回目", "1回目"]
+    with pytest.raises(CassetteMissError):
+        llm.invoke("記録していない質問")
+
+def test_batch_cli_replays_cassette(use_cassette, tmp_path):
+    """バッチ実行のCLIはカセットから再生できる"""
+    cassette_path = str(tmp_path / "cassette.jsonl")
+    recorder = use_cassette(Cassette(cassette_path, mode="record"), lambda config: FakeChatModel())
+    expected = GeminiReasoning().direct_reasoning("質問1")
+    recorder.close()
+    source = tmp_path / "questions.txt"
+    source.write_text("質問1\n", encoding="utf-8")
+    output = tmp_path / "results.jsonl"
+
+    assert main(["direct_reasoning", str(source), "--output", str(output), "--cassette", cassette_path]) == 0
+    record = json.loads(output.read_text(encoding="utf-8"))
+    assert record["result"]["reasoning"] == expected["reasoning"]
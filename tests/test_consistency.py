@@ -0,0 +1,95 @@
+import pytest
+from src.fake_llm import FakeChatModel
+from src.models import GeminiChainOfThought, GeminiReasoning, extract_answer, vote_answers
+from src.registry import get_registry
+from src.run_budget import SKIPPED_OUTPUT, RunBudget, use_budget
+
+@pytest.fixture
+def factory():
+    created = []
+
+    def set_factory(create):
+        def factory(config):
+            created.append(config)
+            return create(config)
+        get_registry().set_llm_factory(factory)
+        return created
+
+    yield set_factory
+    get_registry().set_llm_factory(None)
+
+def test_vote_answers_groups_equivalent_answers():
+    """全角・単位・書き方の違う同じ答えをまとめ、票の多い答えを先頭にする"""
+    texts = ["計算すると\n答え: 4", "答え: ４", "答え: 5", "途中の推論\n最終的な答え：4個", "推論だけ"]
+    answers = [extract_answer(text) for text in texts]
+
+    assert answers == ["4", "４", "5", "4個", "推論だけ"]
+    votes = vote_answers(answers)
+    assert [(vote["answer"], vote["count"]) for vote in votes] == [("4", 3), ("5", 1), ("推論だけ", 1)]
+    assert votes[0]["samples"] == [0, 1, 3]
+
+def test_samples_come_from_one_call(factory):
+    """候補数を指定した1回の呼び出しで候補を生成し、答えを多数決する"""
+    llms = []
+    created = factory(lambda config: llms.append(FakeChatModel(n=config.candidate_count)) or llms[-1])
+
+    result = GeminiChainOfThought().solve_with_consistency("2+2は？", samples=5)
+
+    assert sum(llm.calls for llm in llms) == 1
+    assert created[-1].candidate_count == 5
+    assert len(result["samples"]) == 5 and len(set(result["samples"])) == 5
+    assert result["method"] == "candidates"
+    assert sum(vote["count"] for vote in result["votes"]) == 5
+    assert result["agreement"] == result["votes"][0]["count"] / 5
+
+def test_falls_back_to_parallel_calls(factory):
+    """候補を1つしか返さないモデルでは、足りない候補を同時の呼び出しで補う"""
+    llm = FakeChatModel(responses=["推論\n答え: 4"])
+    factory(lambda config: llm)
+
+    result = GeminiReasoning().consistent_reasoning("2+2は？", samples=5)
+
+    assert llm.calls == 5
+    assert result["method"] == "parallel"
+    assert result["final_response"] == "4" and result["agreement"] == 1.0
+
+class InvalidArgument(Exception):
+    """google.api_core.exceptions.InvalidArgumentの代わり（HTTP 400）"""
+    code = 400
+
+class RejectingChatModel(FakeChatModel):
+    """候補数を指定した呼び出しを指定の例外で拒むフェイクモデル"""
+    error: Exception
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        raise self.error
+
+@pytest.mark.parametrize("error, fallback", [
+    (InvalidArgument("candidateCount must be 1"), True),
+    (RuntimeError("Invalid argument: candidate_count"), False),
+    (ValueError("connection reset"), False),
+])
+def test_falls_back_only_when_candidates_are_rejected(factory, error, fallback):
+    """候補数の指定が不正な引数（400）として拒まれたときだけ1候補ずつ呼び出し、他のエラーはそのまま返す"""
+    single = FakeChatModel(responses=["推論\n答え: 4"])
+    factory(lambda config: RejectingChatModel(error=error) if config.candidate_count > 1 else single)
+
+    if fallback:
+        result = GeminiReasoning().consistent_reasoning("2+2は？", samples=3)
+        assert single.calls == 3 and result["method"] == "parallel"
+    else:
+        with pytest.raises(type(error)):
+            GeminiReasoning().consistent_reasoning("2+2は？", samples=3)
+        assert single.calls == 0
+
+def test_budget_skips_sampling(factory):
+    """予算を使い切っていれば候補を生成せず、実行しなかった印を返す"""
+    llm = FakeChatModel()
+    factory(lambda config: llm)
+
+    with use_budget(RunBudget(max_tokens=10)) as budget:
+        result = GeminiReasoning().consistent_reasoning("2+2は？")
+
+    assert llm.calls == 0
+    assert result["final_response"] == SKIPPED_OUTPUT and result["method"] == "budget"
+    assert budget.skipped == ["samples"]
@@ -0,0 +1,72 @@
+import pytest
+from src.context_budget import ContextBudget, allocate, estimate_tokens, extract_key_sentences, truncate
+from src.fake_llm import FakeChatModel
+from src.metrics import RunTrace
+from src.models import GeminiReasoning
+from src.registry import get_registry
+
+ANALYSIS = (
+    "結論として、在宅勤務は生産性を高める。"
+    "通勤時間がなくなり、在宅勤務では集中できる時間が増える。"
+    "ただし天気の話題は関係がない。"
+    "在宅勤務の生産性は、コミュニケーションの工夫でさらに高められる。"
+)
+
+@pytest.fixture
+def use_budget():
+    def use(budget, llm):
+        get_registry().set_context_budget(budget)
+        get_registry().set_llm_factory(lambda config: llm)
+        return llm
+    yield use
+    get_registry().set_context_budget(None)
+    get_registry().set_llm_factory(None)
+
+def test_truncate_and_extract_fit_the_budget():
+    """切り詰めも重要文の抽出も予算内に収まり、抽出は元の順序を保つ"""
+    assert truncate("短い文章", 100) == "短い文章"
+    assert estimate_tokens(truncate("あ" * 100, 20)) <= 20
+
+    extracted = extract_key_sentences(ANALYSIS, 60)
+
+    assert estimate_tokens(extracted) <= 60
+    assert extracted.startswith("結論として")
+    assert "天気" not in extracted
+    sentences = extracted.splitlines()
+    assert sentences == sorted(sentences, key=ANALYSIS.index)
+
+def test_allocate_keeps_short_handoffs_whole():
+    """短い受け渡しはそのまま残し、残りの予算を長いものに均等に割り当てる"""
+    assert allocate({"short": 10, "long1": 500, "long2": 300}, 210) == {"short": 10, "long1": 100, "long2": 100}
+
+def test_pattern_records_compaction_per_step(use_budget):
+    """予算を超える受け渡しは圧縮され、圧縮前後のトークン数がステップの計測値に残る"""
+    fake = use_budget(ContextBudget(step_tokens=40), FakeChatModel(responses=[ANALYSIS * 3]))
+    trace = RunTrace()
+
+    GeminiReasoning().chained_reasoning("在宅勤務について", on_step=trace.on_step)
+
+    compacted = [step for step in trace.steps if step.compaction]
+    assert compacted and all(step.compaction == "extractive" for step in compacted)
+    assert all(step.compacted_tokens <= 40 < step.context_tokens for step in compacted)
+    # 質問は圧縮せず、前段の出力は全文を埋め込まない
+    assert "在宅勤務について" in fake.prompts[0]
+    assert all(ANALYSIS * 3 not in prompt for prompt in fake.prompts[1:])
+    assert trace.steps[0].context_tokens == 0
+
+def test_summarize_strategy_calls_llm(use_budget):
+    """summarizeでは予算を超えた受け渡しをLLMで要約し、そのトークン数もステップに加算する"""
+    fake = use_budget(ContextBudget(step_tokens=40, strategy="summarize"), FakeChatModel(responses=[ANALYSIS * 3]))
+    trace = RunTrace()
+
+    GeminiReasoning().chained_reasoning("在宅勤務について", on_step=trace.on_step)
+
+    summaries = [prompt for prompt in fake.prompts if "トークン程度に要約" in prompt]
+    assert summaries
+    assert fake.calls == 4 + len(summaries)
+    assert {step.compaction for step in trace.steps if step.compaction} == {"summarize"}
+
+def test_unknown_strategy_is_rejected():
+    """未対応の圧縮方法はエラーになる"""
+    with pytest.raises(ValueError):
+        ContextBudget(strategy="unknown")
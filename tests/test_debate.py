@@ -0,0 +1,100 @@
+import asyncio
+import time
+import pytest
+from src.config import DebateConfig
+from src.fake_llm import FakeChatModel
+from src.models import DebateBasedCooperation
+from src.registry import get_registry
+
+POSITIONS = [
+    {"name": "技術者", "emoji": "🔧", "focus": "実装の容易さを重視", "style": "info"},
+    {"name": "経営者", "emoji": "💼", "focus": "費用対効果を重視", "style": "warning"},
+    {"name": "利用者", "emoji": "🙋", "focus": "使いやすさを重視", "style": "success"},
+]
+
+@pytest.fixture
+def use_llm():
+    def use(llm):
+        get_registry().set_llm_factory(lambda config: llm)
+        return llm
+    yield use
+    get_registry().set_llm_factory(None)
+
+def test_rounds_generate_positions_concurrently(use_llm):
+    """各ラウンドの全立場の発言は同時に生成され、所要時間はラウンド数に比例する"""
+    fake = use_llm(FakeChatModel(ttft=0.1))
+    debate = DebateBasedCooperation(
+        positions=POSITIONS, debate_config=DebateConfig(rounds=3, convergence_threshold=1.1)
+    )
+
+    start = time.perf_counter()
+    result = debate.generate_debate_response("新しいシステムを導入すべきか")
+    elapsed = time.perf_counter() - start
+
+    # 3立場×3ラウンド＋合意形成で10回の呼び出し、4段分の時間
+    assert fake.calls == 10
+    assert elapsed < 0.7
+    assert [len(r["statements"]) for r in result["rounds"]] == [3, 3, 3]
+    # 2ラウンド目以降は前のラウンドの全立場の発言を読む
+    round2 = [p for p in fake.prompts if "前のラウンドの議論" in p]
+    assert len(round2) == 6
+    assert all(all(f"{p['name']}: " in prompt for p in POSITIONS) for prompt in round2)
+    assert "技術者、経営者、利用者" in fake.prompts[-1]
+
+def test_converged_debate_skips_remaining_rounds(use_llm):
+    """全立場の発言が前のラウンドと変わらなくなったら残りのラウンドを省く"""
+    fake = use_llm(FakeChatModel(responses=["導入すべきだが段階的に進めるべきだ"]))
+    debate = DebateBasedCooperation(positions=POSITIONS, debate_config=DebateConfig(rounds=4))
+
+    result = debate.generate_debate_response("質問")
+
+    assert result["converged"]
+    assert len(result["rounds"]) == 2
+    assert fake.calls == 3 * 2 + 1
+    assert list(debate.step_labels())[-1] == "consensus"
+
+def test_batch_debate_drops_converged_questions(use_llm):
+    """バッチ実行でも収束した質問は以降のラウンドから外れる"""
+    use_llm(FakeChatModel(responses=["同じ主張を繰り返す"]))
+    debate = DebateBasedCooperation(debate_config=DebateConfig(rounds=3))
+
+    results = debate.batch_debate_response(["質問1", "質問2"])
+
+    assert all(r["converged"] and len(r["rounds"]) == 2 for r in results)
+    assert all(r["final_response"] == "同じ主張を繰り返す" for r in results)
+
+def _drain(stream):
+    """ジェネレータのチャンクと戻り値を返す"""
+    chunks = []
+    while True:
+        try:
+            chunks.append(next(stream))
+        except StopIteration as stop:
+            return chunks, stop.value
+
+def test_streaming_generates_positions_concurrently(use_llm):
+    """ストリーミングでも各ラウンドの全立場の発言を同時に生成し、最後に通常実行と同じ形の結果を返す"""
+    use_llm(FakeChatModel(ttft=0.1))
+    debate = DebateBasedCooperation(
+        positions=POSITIONS, debate_config=DebateConfig(rounds=3, convergence_threshold=1.1)
+    )
+
+    start = time.perf_counter()
+    chunks, result = _drain(debate.stream_debate_response("新しいシステムを導入すべきか"))
+    elapsed = time.perf_counter() - start
+
+    assert elapsed < 0.7
+    assert not result["converged"] and len(result["rounds"]) == 3
+    for debate_round in result["rounds"]:
+        for key, statement in debate_round["statements"].items():
+            step = f"round{debate_round['round']}_{key}"
+            assert "".join(chunk.text for chunk in chunks if chunk.step == step) == statement
+    assert "".join(chunk.text for chunk in chunks if chunk.step == "consensus") == result["final_response"]
+
+    async def collect():
+        return [chunk async for chunk in debate.astream_debate_response("別の質問")]
+
+    start = time.perf_counter()
+    chunks = asyncio.run(collect())
+    assert time.perf_counter() - start < 0.7
+    assert {chunk.step for chunk in chunks} == set(debate.step_labels())
@@ -0,0 +1,93 @@
+import asyncio
+import pytest
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from src.config import EvaluatorConfig
+from src.models import EvaluatorOptimizer, parse_evaluation
+from src.registry import get_registry
+
+def _evaluation(score):
+    return f'{{"score": {score}, "critique": "{score}点の理由"}}'
+
+@pytest.fixture
+def responses():
+    """生成・評価・最適化の応答を順に返すフェイクを設定する"""
+    def use(items):
+        # 最後の応答の後にiが0へ戻らないよう、使われない応答を足しておく
+        llm = FakeListChatModel(responses=[*items, "未使用"])
+        get_registry().set_llm_factory(lambda config: llm)
+        return llm
+    yield use
+    get_registry().set_llm_factory(None)
+
+def test_parse_evaluation_reads_json_and_loose_formats():
+    """JSONでも「点数: 7」「6/10」形式でも点数を読み取り、読めなければ0点"""
+    assert parse_evaluation('評価です {"score": 7.5, "critique": "具体例が足りない"}') == (7.5, "具体例が足りない")
+    assert parse_evaluation("点数: 7\n根拠が弱い")[0] == 7.0
+    assert parse_evaluation("総合 6/10")[0] == 6.0
+    assert parse_evaluation('{"score": 12}')[0] == 10.0
+    assert parse_evaluation("よくできています") == (0.0, "よくできています")
+
+@pytest.mark.parametrize("text, score", [
+    ("10点満点中7点です", 7.0),
+    ("評価: 10点満点中7点", 7.0),
+    ("7点（10点満点）", 7.0),
+    ("スコア 7/10", 7.0),
+    ("20点満点中15点", 7.5),
+    ("総合 3/5", 6.0),
+    ("2024/10の資料では8点", 8.0),
+])
+def test_parse_evaluation_reads_score_out_of_maximum(text, score):
+    """満点と一緒に書いた点数は満点の数字と取り違えず、10点満点に換算する"""
+    assert parse_evaluation(text)[0] == score
+
+def test_loop_stops_at_target_score(responses):
+    """目標の点数に届いたら最大回数を待たずに終える"""
+    llm = responses(["初稿", _evaluation(5), "改稿1", _evaluation(6.5), "改稿2", _evaluation(9)])
+    optimizer = EvaluatorOptimizer(evaluator_config=EvaluatorConfig(max_iterations=5, target_score=8))
+
+    result = optimizer.generate_optimized_response("質問")
+
+    assert llm.i == 6
+    assert result["stop_reason"] == "target_score"
+    assert result["final_response"] == "改稿2" and result["final_score"] == 9
+    assert [it["response"] for it in result["iterations"]] == ["初稿", "改稿1", "改稿2"]
+    assert result["iterations"][0]["critique"] == "5点の理由"
+    assert all(it["elapsed"] >= 0 for it in result["iterations"])
+
+def test_plateau_keeps_best_response(responses):
+    """点数が下がったら終え、最も点数の高い回答を残す"""
+    responses(["初稿", _evaluation(6), "改稿1", _evaluation(5)])
+    result = EvaluatorOptimizer().generate_optimized_response("質問")
+
+    assert result["stop_reason"] == "plateau"
+    assert result["final_response"] == "初稿"
+
+def test_max_iterations_bounds_calls(responses):
+    """改善が続いても評価は最大回数まで（最後の評価の後は最適化しない）"""
+    llm = responses(["初稿", _evaluation(1), "改稿1", _evaluation(3), "改稿2", _evaluation(5)])
+    result = EvaluatorOptimizer(evaluator_config=EvaluatorConfig(max_iterations=3)).generate_optimized_response("質問")
+
+    assert llm.i == 6
+    assert result["stop_reason"] == "max_iterations"
+    assert result["iterations"][-1]["optimized_response"] is None
+
+def test_stream_and_async_follow_same_loop(responses):
+    """ストリーミング・非同期版も同じ回数で終える"""
+    llm = responses(["初稿", _evaluation(9)] * 2)
+    optimizer = EvaluatorOptimizer()
+
+    chunks = list(optimizer.stream_optimized_response("質問1"))
+    result = asyncio.run(optimizer.agenerate_optimized_response("質問2"))
+
+    assert [c.step for c in chunks][-1] == "evaluation1"
+    assert result["stop_reason"] == "target_score"
+    assert llm.i == 4
+
+def test_batch_drops_finished_questions(responses):
+    """バッチ実行では目標に届いた質問を以降の評価から外す"""
+    llm = responses(["初稿A", "初稿B", _evaluation(9), _evaluation(4), "改稿B", _evaluation(8)])
+    results = EvaluatorOptimizer().batch_optimized_response(["質問A", "質問B"], max_concurrency=1)
+
+    assert llm.i == 6
+    assert [len(r["iterations"]) for r in results] == [1, 2]
+    assert [r["final_response"] for r in results] == ["初稿A", "改稿B"]
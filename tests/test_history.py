@@ -0,0 +1,82 @@
+import json
+import pytest
+from src.fake_llm import FakeChatModel
+from src.history import RunStore
+from src.metrics import RunTrace
+from src.models import DebateBasedCooperation, GeminiReasoning, StepEventType
+from src.registry import get_registry
+
+@pytest.fixture
+def fake():
+    llm = FakeChatModel()
+    get_registry().set_llm_factory(lambda config: llm)
+    yield llm
+    get_registry().set_llm_factory(None)
+
+def _run(question):
+    """連鎖推論を実行し、(結果, トレース, ステップの出力)を返す"""
+    trace = RunTrace(question)
+    outputs = {}
+
+    def on_step(event):
+        trace.on_step(event)
+        if event.type == StepEventType.FINISHED:
+            outputs[event.step] = event.output
+
+    result = GeminiReasoning().chained_reasoning(question, on_step)
+    return result, trace, outputs
+
+def test_recorded_run_replays_without_llm_calls(fake, tmp_path):
+    """保存した実行は結果・各ステップの出力と計測値ごと、LLMを呼ばずに取り出せる"""
+    store = RunStore(str(tmp_path / "runs.sqlite3"))
+    result, trace, outputs = _run("在宅勤務を導入すべきか")
+    run_id = store.record("chained_reasoning", "在宅勤務を導入すべきか", result, trace, outputs)
+    calls = fake.calls
+
+    record = RunStore(str(tmp_path / "runs.sqlite3")).get(run_id)
+
+    assert fake.calls == calls
+    assert record.result == result
+    assert [step["step"] for step in record.steps] == ["decomposition", "data_analysis", "assumptions", "final_result"]
+    assert all(step["output"] == outputs[step["step"]] for step in record.steps)
+    assert record.duration == pytest.approx(trace.elapsed)
+    assert record.config["model_name"]
+
+def test_duration_is_wall_time_of_parallel_steps(tmp_path):
+    """同時に実行したステップの時間は重ねて数えず、実行全体の実時間を保存する"""
+    get_registry().set_llm_factory(lambda config: FakeChatModel(ttft=0.1))
+    trace = RunTrace("在宅勤務を導入すべきか")
+    try:
+        result = DebateBasedCooperation().generate_debate_response(trace.question, trace.on_step)
+    finally:
+        get_registry().set_llm_factory(None)
+    store = RunStore(str(tmp_path / "runs.sqlite3"))
+
+    record = store.get(store.record("debate_based_cooperation", trace.question, result, trace))
+
+    assert record.duration == pytest.approx(trace.elapsed)
+    assert record.duration < 0.8 * sum(step.duration for step in trace.steps)
+
+def test_search_by_output_pattern_and_question(fake):
+    """質問・ステップの出力の全文検索、パターンでの絞り込み、同じ質問の最新の実行を引ける"""
+    store = RunStore(":memory:")
+    first = store.record("direct_query", "在宅勤務の利点", {"final_response": "通勤時間がなくなる"})
+    second = store.record("chained_reasoning", "在宅勤務の利点", {"final_response": "集中できる時間が増える"})
+    store.record("direct_query", "東京の人口は？", {"final_response": "約1400万人"})
+
+    assert [run.id for run in store.search("通勤時間")] == [first]
+    assert [run.id for run in store.search("在宅勤務")] == [second, first]
+    assert [run.id for run in store.search("在宅勤務", pattern="direct_query")] == [first]
+    # 3文字未満は質問の部分一致で探す
+    assert [run.question for run in store.search("東京")] == ["東京の人口は？"]
+    assert store.latest(" 在宅勤務の利点 ").id == second
+    assert len(store.recent(limit=2)) == 2 and len(store) == 3
+
+def test_step_payloads_are_compressed():
+    """ステップの出力は圧縮して保存する"""
+    store = RunStore(":memory:")
+    outputs = {f"step{i}": "在宅勤務の利点と欠点を比較します。" * 50 for i in range(4)}
+    store.record("chained_reasoning", "質問", {"final_response": outputs["step3"], **outputs}, outputs=outputs)
+
+    raw = len(json.dumps(outputs, ensure_ascii=False).encode("utf-8"))
+    assert store.stats()["payload_bytes"] < raw / 10
@@ -0,0 +1,79 @@
+import time
+import pytest
+from src.config import GeminiConfig
+from src.fake_llm import FakeChatModel
+from src.jobs import JobQueue, JobStatus
+from src.models import GeminiReasoning, StepEventType
+from src.registry import get_registry
+
+@pytest.fixture
+def fake():
+    llm = FakeChatModel(ttft=0.05)
+    get_registry().set_llm_factory(lambda config: llm)
+    yield llm
+    get_registry().set_llm_factory(None)
+
+def test_job_runs_in_background_and_streams_progress(fake):
+    """投入はすぐに戻り、ステップの進捗がイベントとして順に届き、結果は直接実行と同じになる"""
+    queue = JobQueue(workers=2)
+    start = time.perf_counter()
+    job_id = queue.submit("chained_reasoning", "在宅勤務を導入すべきか")
+    assert time.perf_counter() - start < 0.05
+
+    events, since, done = [], 0, False
+    while not done:
+        received, done = queue.wait(job_id, since, timeout=1.0)
+        since += len(received)
+        events += received
+
+    job = queue.get(job_id)
+    assert job.status == JobStatus.SUCCEEDED
+    assert job.result == GeminiReasoning().chained_reasoning("在宅勤務を導入すべきか")
+    assert [(event.step, event.type) for event in events][:2] == [
+        ("decomposition", StepEventType.STARTED), ("decomposition", StepEventType.FINISHED)
+    ]
+    assert len(events) == 8 and len(job.trace.steps) == 4 and set(job.outputs) == set(job.result) - {"question"}
+    queue.shutdown()
+
+def test_duplicate_submissions_share_one_job(fake):
+    """同じ内容の投入は実行中・成功済みのジョブにまとめ、設定が違えば別のジョブ、失敗したジョブは再実行する"""
+    queue = JobQueue(workers=4)
+    first = queue.submit("direct_query", "東京の人口は？")
+    assert queue.submit("direct_query", " 東京の人口は？ ") == first
+    queue.result(first, timeout=5)
+    assert queue.submit("direct_query", "東京の人口は？") == first
+    assert fake.calls == 1
+    assert queue.submit("direct_query", "東京の人口は？", GeminiConfig(temperature=0.1)) != first
+
+    failing = JobQueue(runner=lambda *args: 1 / 0)
+    failed = failing.submit("direct_query", "質問")
+    assert failing.result(failed, timeout=5).status == JobStatus.FAILED
+    assert failing.submit("direct_query", "質問") != failed
+    assert queue.stats()["deduplicated"] == 2
+    queue.shutdown()
+    failing.shutdown()
+
+def test_finished_jobs_are_evicted(fake):
+    """完了したジョブは件数の上限を超えると古いものから捨て、捨てたジョブは再投入で実行し直す"""
+    queue = JobQueue(workers=1, max_finished=2)
+    job_ids = [queue.submit("direct_query", f"質問{i}") for i in range(3)]
+    # ワーカーが1つなので最後のジョブが終われば全部終わっている
+    queue.result(job_ids[-1], timeout=5)
+
+    assert queue.get(job_ids[0]) is None
+    assert all(queue.get(job_id) is not None for job_id in job_ids[1:])
+    assert queue.submit("direct_query", "質問0") != job_ids[0]
+    assert queue.stats()["evicted"] == 1
+    queue.shutdown()
+
+def test_on_finish_failure_is_logged(fake, caplog):
+    """完了時の処理（履歴の保存など）の失敗はワーカーで握りつぶさずログに残す"""
+    def record(job):
+        raise OSError("disk full")
+
+    queue = JobQueue(workers=1, on_finish=record)
+    job_id = queue.submit("direct_query", "質問")
+    queue.shutdown()
+
+    assert queue.get(job_id).status == JobStatus.SUCCEEDED
+    assert any(job_id in r.getMessage() and r.exc_info[0] is OSError for r in caplog.records)
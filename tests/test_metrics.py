@@ -0,0 +1,116 @@
+import json
+import urllib.request
+import pytest
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+from src.cache import SQLiteResponseCache
+from src.fake_llm import FakeChatModel
+from src.metrics import (
+    METRICS, STEP_CACHE_HITS, STEP_CALLS, STEP_DURATION, STEP_RETRIES, STEP_TOKENS, MetricsRegistry, RunTrace
+)
+from src.models import DirectQuery, GeminiReasoning, StepEventType
+from src.rate_limit import RetryPolicy
+from src.registry import get_registry
+
+@pytest.fixture
+def fake():
+    llm = FakeChatModel(output_tokens=5)
+    get_registry().set_llm_factory(lambda config: llm)
+    yield llm
+    get_registry().set_llm_factory(None)
+    get_registry().set_response_cache(None)
+    get_registry().set_retry_policy(RetryPolicy())
+
+def test_trace_records_each_step(fake):
+    """各ステップの計測値が終了イベントに付き、RunTraceでJSONにできる"""
+    trace = RunTrace("質問")
+    GeminiReasoning().chained_reasoning("質問", trace.on_step)
+
+    assert [s.name for s in trace.steps] == [
+        "chained_reasoning/decomposition",
+        "chained_reasoning/data_analysis",
+        "chained_reasoning/assumptions",
+        "chained_reasoning/final_result",
+    ]
+    assert all(s.completion_tokens == 5 and s.prompt_tokens > 0 and s.duration > 0 for s in trace.steps)
+    data = json.loads(trace.to_json())
+    assert data["llm_calls"] == 4
+    assert data["completion_tokens"] == 20
+
+def test_streaming_records_time_to_first_token(fake):
+    """ストリーミングでは最初のトークンまでの時間とトークン数を記録する"""
+    events = []
+    list(DirectQuery().stream_answer("ストリーミングの質問", events.append))
+
+    finished = [e for e in events if e.type == StepEventType.FINISHED][0]
+    assert finished.metrics.ttft is not None
+    assert finished.metrics.ttft <= finished.metrics.duration
+    assert finished.metrics.completion_tokens == 5
+
+def test_cache_hits_and_retries_are_counted(fake):
+    """応答キャッシュのヒットと再試行がpattern・stepのラベル付きで集計される"""
+    labels = {"pattern": "direct_query", "step": "final_response"}
+    hits = STEP_CACHE_HITS.value(cache="response", **labels)
+    retries = STEP_RETRIES.value(**labels)
+    get_registry().set_response_cache(SQLiteResponseCache(":memory:"))
+    DirectQuery().answer("キャッシュされる質問")
+    DirectQuery().answer("キャッシュされる質問")
+    assert STEP_CACHE_HITS.value(cache="response", **labels) == hits + 1
+
+    failures = []
+
+    def flaky(prompt_value):
+        failures.append(1)
+        if len(failures) == 1:
+            raise RuntimeError("429 Too Many Requests")
+        return AIMessage(content="応答")
+
+    get_registry().set_response_cache(None)
+    get_registry().set_retry_policy(RetryPolicy(base_delay=0.0))
+    get_registry().set_llm_factory(lambda config: RunnableLambda(flaky))
+    DirectQuery().answer("再試行される質問")
+    assert STEP_RETRIES.value(**labels) == retries + 1
+
+def test_batch_records_every_item(fake):
+    """バッチでも質問ごとにステップの計測値を記録する"""
+    labels = {"pattern": "direct_reasoning", "step": "reasoning"}
+    before = STEP_CALLS.value(status="ok", **labels)
+    tokens = STEP_TOKENS.value(kind="completion", **labels)
+
+    GeminiReasoning().batch_direct_reasoning(["質問1", "質問2", "質問3"])
+
+    assert STEP_CALLS.value(status="ok", **labels) == before + 3
+    assert STEP_TOKENS.value(kind="completion", **labels) == tokens + 15
+    assert STEP_DURATION.count(**labels) >= 3
+
+def test_prometheus_text_exposition(tmp_path):
+    """ヒストグラムとカウンタをPrometheusのテキスト形式で出力する"""
+    registry = MetricsRegistry()
+    histogram = registry.histogram("latency_seconds", "レイテンシ", ("step",), buckets=(0.1, 1.0))
+    counter = registry.counter("calls_total", "呼び出し", ("step",))
+    histogram.observe(0.05, step="a")
+    histogram.observe(0.5, step="a")
+    counter.inc(step='say "hi"')
+
+    text = registry.render()
+    assert '# TYPE latency_seconds histogram' in text
+    assert 'latency_seconds_bucket{step="a",le="0.1"} 1' in text
+    assert 'latency_seconds_bucket{step="a",le="1"} 2' in text
+    assert 'latency_seconds_bucket{step="a",le="+Inf"} 2' in text
+    assert 'latency_seconds_count{step="a"} 2' in text
+    assert 'calls_total{step="say \\"hi\\""} 1' in text
+
+    path = tmp_path / "metrics.prom"
+    registry.write(str(path))
+    assert path.read_text(encoding="utf-8") == text
+
+def test_metrics_endpoint(fake):
+    """/metricsでプロセス共有のメトリクスを返す"""
+    DirectQuery().answer("エンドポイントの質問")
+    server = METRICS.serve(0, host="127.0.0.1")
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        body = urllib.request.urlopen(url, timeout=5).read().decode("utf-8")
+    finally:
+        server.shutdown()
+    assert 'ai_pattern_step_duration_seconds_count{pattern="direct_query",step="final_response"}' in body
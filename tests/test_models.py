@@ -0,0 +1,107 @@
+import asyncio
+import pytest
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from src.registry import get_registry
+from src.models import (
+    GeminiChainOfThought, GeminiReasoning, EvaluatorOptimizer,
+    DebateBasedCooperation, StepEventType
+)
+
+@pytest.fixture
+def fake_llm():
+    """LLMを呼び出し回数を数えられるフェイクに差し替える"""
+    llm = FakeListChatModel(responses=[f"応答{i}" for i in range(20)])
+    get_registry().set_llm_factory(lambda config: llm)
+    yield llm
+    get_registry().set_llm_factory(None)
+
+def test_chained_reasoning_runs_each_step_once(fake_llm):
+    """連鎖推論は4ステップをそれぞれ1回だけ実行する"""
+    events = []
+    result = GeminiReasoning().chained_reasoning("質問", events.append)
+
+    assert fake_llm.i == 4
+    assert [(e.step, e.type) for e in events] == [
+        ("decomposition", StepEventType.STARTED),
+        ("decomposition", StepEventType.FINISHED),
+        ("data_analysis", StepEventType.STARTED),
+        ("data_analysis", StepEventType.FINISHED),
+        ("assumptions", StepEventType.STARTED),
+        ("assumptions", StepEventType.FINISHED),
+        ("final_result", StepEventType.STARTED),
+        ("final_result", StepEventType.FINISHED),
+    ]
+    assert result["final_result"] == "応答3"
+    assert events[1].output == result["decomposition"]
+
+def test_evaluator_optimizer_stops_when_score_plateaus(fake_llm):
+    """点数が上がらなければ2回目の評価で終え、最初の回答を最終回答にする"""
+    result = EvaluatorOptimizer().generate_optimized_response("質問")
+
+    assert fake_llm.i == 4
+    assert result["stop_reason"] == "plateau"
+    assert [it["score"] for it in result["iterations"]] == [0.0, 0.0]
+    assert result["iterations"][0]["optimized_response"] == result["iterations"][1]["response"] == "応答2"
+    assert result["final_response"] == "応答2"
+
+def test_step_failure_is_notified(monkeypatch, fake_llm):
+    """失敗したステップはFAILEDとして通知される"""
+    def fail(self, step, outputs, metrics=None):
+        raise RuntimeError("boom")
+    monkeypatch.setattr(GeminiChainOfThought, "_run_step", fail)
+    events = []
+
+    with pytest.raises(RuntimeError):
+        GeminiChainOfThought().solve_problem("質問", events.append)
+    assert [e.type for e in events] == [StepEventType.STARTED, StepEventType.FAILED]
+
+def test_debate_prompts_include_positions(fake_llm):
+    """既定のディベートは2立場×2ラウンドと合意形成の5回の呼び出しで立場名を埋め込んだプロンプトを使う"""
+    debate = DebateBasedCooperation()
+    result = debate.generate_debate_response("質問")
+
+    assert fake_llm.i == 5
+    assert result["positions"][0]["name"] == "革新的な思考"
+    assert [r["round"] for r in result["rounds"]] == [1, 2]
+    assert set(result["rounds"][1]["statements"]) == {"position_a", "position_b"}
+    assert not result["converged"]
+
+def test_stream_chained_reasoning_yields_tokens_per_step(fake_llm):
+    """ストリーミングはステップごとにトークンを返し、ステップ完了も通知する"""
+    events = []
+    chunks = list(GeminiReasoning().stream_chained_reasoning("質問", events.append))
+
+    steps = [chunk.step for chunk in chunks]
+    assert steps[0] == "decomposition"
+    assert steps[-1] == "final_result"
+    assert "".join(c.text for c in chunks if c.step == "decomposition") == "応答0"
+    assert fake_llm.i == 4
+    finished = [e for e in events if e.type == StepEventType.FINISHED]
+    assert [e.output for e in finished] == ["応答0", "応答1", "応答2", "応答3"]
+
+def test_async_patterns_share_one_event_loop(fake_llm):
+    """非同期版は1つのイベントループで複数の質問を並行して処理できる"""
+    async def run():
+        reasoner = GeminiReasoning()
+        return await asyncio.gather(
+            reasoner.achained_reasoning("質問1"),
+            reasoner.adirect_reasoning("質問2"),
+            DebateBasedCooperation().agenerate_debate_response("質問3")
+        )
+
+    chained, direct, debate = asyncio.run(run())
+
+    assert fake_llm.i == 4 + 3 + 5
+    assert set(chained) == {"decomposition", "data_analysis", "assumptions", "final_result"}
+    assert set(direct) == {"assumptions", "data_processing", "reasoning"}
+    assert len(debate["rounds"]) == 2
+
+def test_astream_solve_problem_yields_tokens(fake_llm):
+    """非同期ストリーミングもステップごとにトークンを返す"""
+    async def collect():
+        return [chunk async for chunk in GeminiChainOfThought().astream_solve_problem("質問")]
+
+    chunks = asyncio.run(collect())
+
+    assert [c.step for c in chunks][-1] == "final_answer"
+    assert fake_llm.i == 4
@@ -0,0 +1,123 @@
+import asyncio
+import time
+import pytest
+from src.config import GeminiConfig
+from src.fake_llm import FakeChatModel
+from src.models import PipelinePattern, StepEventType
+from src.pipeline import Pipeline, PatternStep, StepCancelled, arun_graph, dependencies, run_graph, topological_order
+from src.registry import get_registry
+
+PROS_CONS = {
+    "name": "pros_cons",
+    "steps": [
+        {"name": "pros", "template": "{question}の利点を挙げてください"},
+        {"name": "cons", "template": "{question}の欠点を挙げてください"},
+        {"name": "risks", "template": "{question}のリスクを{tone}に挙げてください"},
+        {"name": "summary", "template": "利点: {pros}\n欠点: {cons}\nリスク: {risks}\nをまとめてください"},
+    ],
+    "variables": {"tone": "具体的"},
+}
+
+@pytest.fixture
+def fake():
+    """1回の呼び出しに0.1秒かかるフェイク"""
+    llm = FakeChatModel(ttft=0.1)
+    get_registry().set_llm_factory(lambda config: llm)
+    yield llm
+    get_registry().set_llm_factory(None)
+
+def test_dependencies_come_from_template_and_inputs():
+    """テンプレートに埋め込んだステップとinputsが依存先になる"""
+    steps = [
+        PatternStep("a", "{question}"),
+        PatternStep("b", "{a}と{question}"),
+        PatternStep("c", "{question}", inputs=("b",)),
+    ]
+
+    assert dependencies(steps) == {"a": set(), "b": {"a"}, "c": {"b"}}
+    assert [s.name for s in topological_order(list(reversed(steps)))] == ["a", "b", "c"]
+
+def test_invalid_pipelines_are_rejected():
+    """循環・未定義の名前・存在しない出力は定義時にエラーになる"""
+    with pytest.raises(ValueError, match="循環"):
+        Pipeline("loop", [PatternStep("a", "{b}"), PatternStep("b", "{a}")])
+    with pytest.raises(ValueError, match="未定義"):
+        Pipeline("typo", [PatternStep("a", "{qestion}")])
+    with pytest.raises(ValueError, match="出力"):
+        Pipeline("output", [PatternStep("a", "{question}")], output="b")
+
+def test_independent_steps_run_concurrently(fake):
+    """依存関係のない3ステップは同時に実行され、まとめは最後に1回だけ実行される"""
+    events = []
+    start = time.perf_counter()
+    result = PipelinePattern(Pipeline.from_dict(PROS_CONS)).run("在宅勤務", events.append)
+    elapsed = time.perf_counter() - start
+
+    assert fake.calls == 4
+    assert elapsed < 0.35
+    assert any("リスクを具体的に" in prompt for prompt in fake.prompts)
+    assert result["final_response"] == result["summary"]
+    assert [e.step for e in events if e.type == StepEventType.STARTED][:3] == ["pros", "cons", "risks"]
+    finished = [e.step for e in events if e.type == StepEventType.FINISHED]
+    assert finished[-1] == "summary" and set(finished[:3]) == {"pros", "cons", "risks"}
+
+def test_async_run_matches_sync_run(fake):
+    """非同期版も同時に実行し、同期版と同じ出力になる"""
+    pattern = PipelinePattern(Pipeline.from_dict(PROS_CONS))
+    start = time.perf_counter()
+    result = asyncio.run(pattern.arun("在宅勤務"))
+    elapsed = time.perf_counter() - start
+
+    assert elapsed < 0.35
+    assert result == pattern.run("在宅勤務")
+
+def test_step_config_uses_its_own_client():
+    """configを指定したステップだけ別の設定のクライアントで呼び出す"""
+    created = []
+
+    def factory(config):
+        created.append(config.temperature)
+        return FakeChatModel(responses=[f"温度{config.temperature}"])
+
+    get_registry().set_llm_factory(factory)
+    try:
+        pipeline = Pipeline.from_dict({"name": "mixed", "steps": [
+            {"name": "draft", "template": "{question}"},
+            {"name": "check", "template": "{draft}を確認", "config": {"temperature": 0.0}},
+        ]})
+        result = PipelinePattern(pipeline, gemini_config=GeminiConfig(temperature=0.7)).run("質問")
+    finally:
+        get_registry().set_llm_factory(None)
+
+    assert result == {"draft": "温度0.7", "check": "温度0.0", "final_response": "温度0.0"}
+    assert sorted(created) == [0.0, 0.7]
+
+def test_failure_ends_every_started_step():
+    """1つのステップが失敗したら、同時に実行中だったステップにも中断の失敗を通知する"""
+    steps = [PatternStep("fast", "{question}"), PatternStep("slow", "{question}"), PatternStep("after", "{fast}{slow}")]
+    delays = {"fast": 0.01, "slow": 0.2}
+
+    def start(step):
+        def task():
+            time.sleep(delays[step.name])
+            if step.name == "fast":
+                raise ValueError("失敗")
+            return step.name
+        return task
+
+    async def astart(step):
+        await asyncio.sleep(delays[step.name])
+        if step.name == "fast":
+            raise ValueError("失敗")
+        return step.name
+
+    for run in (
+        lambda finish, fail: run_graph(steps, start, finish, fail),
+        lambda finish, fail: asyncio.run(arun_graph(steps, lambda step: lambda: astart(step), finish, fail)),
+    ):
+        ended = {}
+        with pytest.raises(ValueError):
+            run(lambda step, result: ended.setdefault(step.name, result), lambda step, e: ended.setdefault(step.name, e))
+        assert set(ended) == {"fast", "slow"}
+        assert isinstance(ended["fast"], ValueError)
+        assert isinstance(ended["slow"], StepCancelled) and ended["slow"].failed == "fast"
@@ -0,0 +1,109 @@
+import asyncio
+import pytest
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+from src.models import DirectQuery, GeminiReasoning
+from src.rate_limit import RateLimiter, RetryPolicy, TokenBucket, is_retryable, retry_after
+from src.registry import get_registry
+
+class ResourceExhausted(Exception):
+    """google.api_core.exceptions.ResourceExhausted相当のテスト用例外"""
+    code = 429
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def registry():
+    registry = get_registry()
+    registry.set_retry_policy(RetryPolicy(base_delay=0.0))
+    yield registry
+    registry.set_llm_factory(None)
+    registry.set_rate_limiter(None)
+    registry.set_retry_policy(RetryPolicy())
+
+def test_token_bucket_queues_reservations():
+    """残量を超えた予約は補充速度に応じて順番に待たされる"""
+    clock = FakeClock()
+    bucket = TokenBucket(60, capacity=2, clock=clock)
+
+    assert [bucket.reserve() for _ in range(4)] == [0.0, 0.0, 1.0, 2.0]
+    clock.now = 2.0
+    assert bucket.reserve() == pytest.approx(1.0)
+
+def test_rate_limiter_settles_actual_token_usage():
+    """応答後の実際のトークン数で予約分を精算し、超過分だけ次の呼び出しが待つ"""
+    clock = FakeClock()
+    limiter = RateLimiter(tokens_per_minute=600, estimated_tokens=10, clock=clock)
+
+    assert limiter._reserve() == 0.0
+    limiter.record_usage(110)
+    # 容量100に対して110使ったので、予約10と合わせて20トークン分（2秒）待つ
+    assert limiter._reserve() == pytest.approx(2.0)
+    assert limiter.stats()["throttled"] == 1
+
+def test_retryable_errors_and_retry_after():
+    """429や一時的なエラーだけを再試行し、サーバー指定の待ち時間を読み取る"""
+    error = ResourceExhausted("429 Quota exceeded. Please retry in 7.5s.")
+    wrapped = RuntimeError("generation failed")
+    wrapped.__cause__ = error
+
+    assert is_retryable(error) and is_retryable(wrapped)
+    assert not is_retryable(ValueError("invalid argument"))
+    assert retry_after(wrapped) == 7.5
+    assert RetryPolicy(base_delay=0.0).backoff(1, error) == 7.5
+    assert 0 <= RetryPolicy(base_delay=1.0).backoff(3) <= 4.0
+
+def test_step_is_retried_after_rate_limit(registry):
+    """429で失敗したステップは再試行され、パターンは最後まで完了する"""
+    calls = []
+
+    def flaky(prompt_value):
+        calls.append(prompt_value)
+        if len(calls) == 1:
+            raise ResourceExhausted("429 Resource has been exhausted")
+        return AIMessage(content=f"応答{len(calls)}")
+
+    registry.set_llm_factory(lambda config: RunnableLambda(flaky))
+    result = GeminiReasoning().direct_reasoning("質問")
+
+    assert len(calls) == 4
+    assert result["reasoning"] == "応答4"
+    assert registry.retry_policy.retries == 1
+
+def test_batch_retries_only_failed_items(registry):
+    """バッチでは再試行できる失敗だけをまとめて再実行する"""
+    failed = set()
+
+    def flaky(prompt_value):
+        text = prompt_value.to_string()
+        if text.startswith("B") and text not in failed:
+            failed.add(text)
+            raise ResourceExhausted("429")
+        if text.startswith("C"):
+            raise ValueError("bad request")
+        return AIMessage(content=text)
+
+    registry.set_llm_factory(lambda config: RunnableLambda(flaky))
+    outputs = DirectQuery().batch_answer(["A", "B", "C"])
+
+    assert outputs[0] == {"final_response": "A"}
+    assert outputs[1] == {"final_response": "B"}
+    assert isinstance(outputs[2], ValueError)
+    assert registry.retry_policy.retries == 1
+
+def test_shared_limiter_is_attached_to_every_client(registry):
+    """レート制限を設定すると、すべてのクライアントが同じリミッターを通る"""
+    limiter = RateLimiter(requests_per_minute=6000)
+    registry.set_llm_factory(lambda config: FakeListChatModel(responses=["応答"] * 10))
+    registry.set_rate_limiter(limiter)
+
+    asyncio.run(DirectQuery().aanswer("質問"))
+    GeminiReasoning().chained_reasoning("質問")
+
+    assert limiter.stats()["requests"] == 5
@@ -0,0 +1,37 @@
+import threading
+from src.config import GeminiConfig
+from src.registry import ClientRegistry
+from src.models import GeminiReasoning, EvaluatorOptimizer
+
+def test_same_config_shares_client():
+    """同じ設定では同じクライアントを共有する"""
+    created = []
+    registry = ClientRegistry(lambda config: created.append(config) or object())
+
+    llm_a = registry.get_llm(GeminiConfig(temperature=0.2))
+    llm_b = registry.get_llm(GeminiConfig(temperature=0.2))
+    llm_c = registry.get_llm(GeminiConfig(temperature=0.9))
+
+    assert llm_a is llm_b
+    assert llm_a is not llm_c
+    assert len(created) == 2
+
+def test_pattern_built_once_across_threads():
+    """複数スレッドから要求してもパターンは1度だけ生成される"""
+    registry = ClientRegistry()
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(registry.get_pattern(GeminiReasoning)))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len({id(pattern) for pattern in results}) == 1
+
+def test_evaluator_roles_share_client():
+    """Evaluator-Optimizerの各ロールは1つのクライアントを共有する"""
+    pattern = EvaluatorOptimizer()
+    assert pattern.generator is pattern.evaluator is pattern.optimizer
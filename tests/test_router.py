@@ -0,0 +1,70 @@
+import json
+import pytest
+from src.config import RouterConfig
+from src.fake_llm import FakeChatModel
+from src.registry import get_registry
+from src.router import PatternRouter, classify_question, summarize_log
+
+@pytest.fixture
+def fake():
+    llm = FakeChatModel()
+    get_registry().set_llm_factory(lambda config: llm)
+    yield llm
+    get_registry().set_llm_factory(None)
+
+@pytest.mark.parametrize("question, kind", [
+    ("2+2は？", "simple"),
+    ("Pythonとは何ですか？", "simple"),
+    ("なぜ空は青いのですか", "reasoning"),
+    ("新規事業の3年間の計画を立て、市場・競合・資金のそれぞれの観点から課題を整理してください", "complex"),
+    ("在宅勤務を導入すべきか", "opinion"),
+])
+def test_classify_question(question, kind):
+    """質問の文面から種類を判定する"""
+    assert classify_question(question).kind == kind
+
+def test_simple_question_uses_one_call(fake, tmp_path):
+    """単純な質問は1回の呼び出しで答え、比較対象より省いた回数を記録に残す"""
+    log = tmp_path / "router.jsonl"
+    router = PatternRouter(router_config=RouterConfig(log_path=str(log)))
+
+    result = router.answer("2+2は？")
+
+    assert fake.calls == 1
+    assert result["route"]["pattern"] == "direct_query"
+    assert result["route"]["calls_saved"] == 3 and result["route"]["extra_calls"] == 0
+    record = json.loads(log.read_text(encoding="utf-8"))
+    assert record["classification"]["kind"] == "simple" and record["attempts"][0]["passed"]
+    assert summarize_log(str(log))["simple"]["calls_saved"] == 3
+
+def test_opinion_question_records_extra_calls(fake, tmp_path):
+    """比較対象より呼び出しの多いパターン（討論）で答えたら、省いた回数は0にして多くかかった回数を別に記録する"""
+    log = tmp_path / "router.jsonl"
+    router = PatternRouter(router_config=RouterConfig(log_path=str(log)))
+
+    result = router.answer("在宅勤務を導入すべきか")
+
+    route = result["route"]
+    assert route["pattern"] == "debate_based_cooperation"
+    assert route["llm_calls"] == fake.calls > route["baseline_calls"]
+    assert route["calls_saved"] == 0
+    assert route["extra_calls"] == route["llm_calls"] - route["baseline_calls"]
+    summary = summarize_log(str(log))["opinion"]
+    assert summary["calls_saved"] == 0 and summary["extra_calls"] == route["extra_calls"]
+
+def test_escalates_when_answer_is_not_confident(tmp_path):
+    """曖昧な回答は次の重いパターンで答え直し、切り替えの理由を記録する"""
+    answers = {"direct_query": {"final_response": "わかりません"}, "direct_reasoning": {"reasoning": "4です"}}
+    ran = []
+
+    def runner(pattern, question, config, on_step):
+        ran.append(pattern)
+        return answers[pattern]
+
+    router = PatternRouter(router_config=RouterConfig(log_path=str(tmp_path / "router.jsonl")), runner=runner)
+    result = router.answer("2+2は？")
+
+    assert ran == ["direct_query", "direct_reasoning"]
+    assert result["final_response"] == "4です"
+    assert [attempt["reason"] for attempt in result["route"]["attempts"]] == ["hedge", None]
+    assert summarize_log(str(tmp_path / "router.jsonl"))["simple"]["escalated"] == 1
@@ -0,0 +1,74 @@
+from langchain_core.language_models.fake_chat_models import FakeListChatModel
+from src.models import GeminiReasoning, StepEventType
+from src.registry import get_registry
+from src.semantic_cache import SemanticCache
+
+def test_paraphrase_hits_and_unrelated_question_misses():
+    """1〜2文字違いの質問はヒットし、無関係な質問はミスになる"""
+    cache = SemanticCache(threshold=0.9)
+    cache.add("pattern", "新しいビジネスを始める際のリスク評価", {"answer": "A"})
+
+    hit = cache.lookup("pattern", "新しいビジネスを始める時のリスク評価")
+    assert hit is not None and hit.result == {"answer": "A"}
+    assert cache.lookup("pattern", "東京の人口は？") is None
+    assert cache.lookup("other", "新しいビジネスを始める際のリスク評価") is None
+
+def test_question_with_different_number_misses():
+    """数値だけが違う質問は類似度が高くてもミスになり、同じ数値の言い換えはヒットする"""
+    cache = SemanticCache(threshold=0.85)
+    cache.add("pattern", "2024年の日本のGDP成長率を教えてください", {"answer": "2024"})
+    cache.add("pattern", "1234+5678は？", {"answer": "6912"})
+
+    assert cache.lookup("pattern", "2025年の日本のGDP成長率を教えてください") is None
+    assert cache.lookup("pattern", "1234+5679は？") is None
+    hit = cache.lookup("pattern", "２０２４年の日本のGDP成長率を教えて下さい")
+    assert hit is not None and hit.result == {"answer": "2024"}
+
+def test_search_returns_top_k_in_order():
+    """searchは類似度の高い順に返す"""
+    cache = SemanticCache(max_hamming=64)
+    for question in ["日本の少子高齢化の影響を分析してください", "日本の少子化の影響", "Pythonとは何ですか？"]:
+        cache.add("p", question, question)
+
+    hits = cache.search("p", "日本の少子高齢化の影響を分析して", k=2)
+    assert [h.question for h in hits] == ["日本の少子高齢化の影響を分析してください", "日本の少子化の影響"]
+    assert hits[0].similarity >= hits[1].similarity
+
+def test_oldest_entry_is_overwritten_when_full():
+    """上限に達したら最も古いエントリから上書きする"""
+    cache = SemanticCache(max_entries=2)
+    for question in ["質問その一です", "質問その二です", "まったく別の三つ目"]:
+        cache.add("p", question, question)
+
+    assert len(cache) == 2
+    assert cache.lookup("p", "質問その一です") is None
+    assert cache.lookup("p", "まったく別の三つ目") is not None
+
+def test_snapshot_round_trip(tmp_path):
+    """スナップショットから復元できる"""
+    path = str(tmp_path / "semantic")
+    cache = SemanticCache(snapshot_path=path)
+    cache.add("p", "Pythonとは何ですか？", {"final_response": "言語"})
+    cache.save()
+
+    restored = SemanticCache(snapshot_path=path)
+    assert restored.lookup("p", "Pythonとは何ですか").result == {"final_response": "言語"}
+
+def test_paraphrased_question_skips_llm_calls():
+    """言い換えた質問ではLLMを呼ばずに保存済みの結果を再生する"""
+    llm = FakeListChatModel(responses=[f"応答{i}" for i in range(10)])
+    registry = get_registry()
+    registry.set_llm_factory(lambda config: llm)
+    registry.set_semantic_cache(SemanticCache())
+    events = []
+    try:
+        first = GeminiReasoning().direct_reasoning("日本の少子高齢化の影響を分析してください")
+        second = GeminiReasoning().direct_reasoning("日本の少子高齢化の影響を分析して下さい", events.append)
+    finally:
+        registry.set_semantic_cache(None)
+        registry.set_llm_factory(None)
+
+    assert llm.i == 3
+    assert first == second
+    assert all(e.cached for e in events)
+    assert [e.type for e in events].count(StepEventType.FINISHED) == 3
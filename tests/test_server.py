@@ -0,0 +1,137 @@
+import asyncio
+import json
+import httpx
+import pytest
+from starlette.testclient import TestClient
+from src.config import ServerConfig
+from src.fake_llm import FakeChatModel
+from src.history import RunStore
+from src.models import GeminiReasoning
+from src.registry import get_registry
+from src.server import create_app
+
+@pytest.fixture
+def use_fake():
+    def use(llm):
+        get_registry().set_llm_factory(lambda config: llm)
+        return llm
+    yield use
+    get_registry().set_llm_factory(None)
+
+def _events(body: str):
+    """SSEの本文を(イベント名, データ)の列にする"""
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+async def _post_all(app, bodies, client_ids):
+    """同時にリクエストを送り、ステータスコードを送った順に返す"""
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        responses = await asyncio.gather(*(
+            client.post("/patterns/direct_query", json=body, headers={"X-Client-ID": client_id})
+            for body, client_id in zip(bodies, client_ids)
+        ))
+    return [response.status_code for response in responses]
+
+def test_json_and_sse_match_direct_call(use_fake):
+    """JSONの応答はパターンを直接呼んだ結果と同じで、SSEではステップごとのトークンと最後に全出力が届く"""
+    use_fake(FakeChatModel())
+    expected = GeminiReasoning().chained_reasoning("在宅勤務を導入すべきか")
+    client = TestClient(create_app(ServerConfig()))
+
+    response = client.post("/patterns/chained_reasoning", json={"question": "在宅勤務を導入すべきか"})
+    assert response.status_code == 200
+    assert response.json()["result"] == expected
+
+    response = client.post("/patterns/chained_reasoning", json={"question": "在宅勤務を導入すべきか", "stream": True})
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = _events(response.text)
+    assert events[-1][0] == "done"
+    outputs = events[-1][1]["outputs"]
+    assert outputs["final_result"] == expected["final_result"]
+    for step, output in outputs.items():
+        assert "".join(data["text"] for event, data in events if event == "chunk" and data["step"] == step) == output
+    assert [data["type"] for event, data in events if event == "step"] == ["started", "finished"] * 4
+
+def test_invalid_requests(use_fake):
+    """未対応のパターンは404、質問のない本文や正の秒数でない期限は400になる"""
+    use_fake(FakeChatModel())
+    client = TestClient(create_app(ServerConfig()))
+
+    assert client.post("/patterns/unknown", json={"question": "質問"}).status_code == 404
+    assert client.post("/patterns/direct_query", json={}).status_code == 400
+    assert client.post("/patterns/direct_query", content=b"not json").status_code == 400
+    for timeout in ["abc", 0, -1, True]:
+        assert client.post("/patterns/direct_query", json={"question": "質問", "timeout": timeout}).status_code == 400
+    assert "direct_query" in client.get("/patterns").json()["patterns"]
+
+def test_saturated_server_sheds_load(use_fake):
+    """実行枠と待ち行列が埋まると503、クライアントごとの上限を超えると429で即座に断る"""
+    use_fake(FakeChatModel(ttft=0.2))
+    app = create_app(ServerConfig(max_concurrency=1, queue_size=1, client_concurrency=1))
+    bodies = [{"question": f"質問{i}"} for i in range(3)]
+
+    assert asyncio.run(_post_all(app, bodies, ["a", "b", "c"])) == [200, 200, 503]
+    assert asyncio.run(_post_all(app, bodies, ["a", "a", "b"])) == [200, 429, 200]
+    assert app.state.admission.stats()["queued"] == 0
+
+def test_deadline_includes_queue_wait(use_fake):
+    """待ち行列での待ち時間も含めて期限を過ぎたリクエストは504で打ち切る"""
+    use_fake(FakeChatModel(ttft=0.3))
+    app = create_app(ServerConfig(max_concurrency=1, queue_size=4, timeout=0.5))
+    bodies = [{"question": "質問1"}, {"question": "質問2"}, {"question": "質問3", "timeout": 0.05}]
+
+    statuses = asyncio.run(_post_all(app, bodies, ["a", "b", "c"]))
+
+    assert statuses == [200, 504, 504]
+    stats = app.state.admission.stats()
+    assert stats["running"] == stats["queued"] == stats["clients"] == 0
+
+async def _disconnect_before_body(app):
+    """SSEのリクエストを送り、応答の開始を受け取る前に切断する"""
+    body = json.dumps({"question": "質問", "stream": True}).encode()
+    scope = {
+        "type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"}, "http_version": "1.1",
+        "method": "POST", "scheme": "http", "path": "/patterns/direct_query", "raw_path": b"/patterns/direct_query",
+        "query_string": b"", "root_path": "", "headers": [(b"content-type", b"application/json")],
+        "client": ("10.0.0.1", 1234), "server": ("test", 80),
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        raise OSError("切断")
+
+    with pytest.raises(Exception):
+        await app(scope, receive, send)
+
+def test_disconnect_releases_admission(use_fake):
+    """本文を読む前に切断したクライアントの枠も返し、以降のリクエストを断らない"""
+    use_fake(FakeChatModel())
+    app = create_app(ServerConfig(max_concurrency=1, queue_size=0, client_concurrency=1))
+
+    for _ in range(3):
+        asyncio.run(_disconnect_before_body(app))
+
+    stats = app.state.admission.stats()
+    assert stats["running"] == stats["queued"] == stats["clients"] == 0
+    assert TestClient(app).post("/patterns/direct_query", json={"question": "質問"}).status_code == 200
+
+def test_runs_are_readable_over_http():
+    """保存した実行を一覧・検索し、IDで全体を読み出せる（履歴が無効なら404）"""
+    store = RunStore(":memory:")
+    first = store.record("direct_query", "在宅勤務の利点", {"final_response": "通勤時間がなくなる"})
+    store.record("chained_reasoning", "東京の人口は？", {"final_response": "約1400万人"})
+    client = TestClient(create_app(ServerConfig(), run_store=store))
+
+    assert [run["question"] for run in client.get("/runs").json()["runs"]] == ["東京の人口は？", "在宅勤務の利点"]
+    assert [run["id"] for run in client.get("/runs", params={"q": "通勤時間"}).json()["runs"]] == [first]
+    assert len(client.get("/runs", params={"pattern": "direct_query", "limit": 1}).json()["runs"]) == 1
+    assert client.get(f"/runs/{first}").json()["result"] == {"final_response": "通勤時間がなくなる"}
+    assert client.get("/runs/999").status_code == 404
+    assert client.get("/runs", params={"limit": "abc"}).status_code == 400
+    assert TestClient(create_app(ServerConfig())).get("/runs").status_code == 404
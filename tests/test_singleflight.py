@@ -0,0 +1,88 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+from src.models import DirectQuery
+from src.registry import get_registry
+from src.singleflight import SingleFlight
+
+@pytest.fixture
+def flight():
+    registry = get_registry()
+    registry.singleflight = SingleFlight()
+    yield registry.singleflight
+    registry.set_llm_factory(None)
+
+def _gated_llm(flight, waiters, calls):
+    """待ち合わせがwaiters件そろうまで応答を返さないフェイクLLM"""
+    def respond(prompt_value):
+        calls.append(prompt_value.to_string())
+        deadline = time.time() + 5
+        while flight.max_waiters < waiters and time.time() < deadline:
+            time.sleep(0.001)
+        return AIMessage(content=f"応答:{prompt_value.to_string()}")
+    return RunnableLambda(respond)
+
+def test_concurrent_threads_share_one_call(flight):
+    """同じ質問を複数スレッドから同時に実行しても上流の呼び出しは1回"""
+    calls = []
+    get_registry().set_llm_factory(lambda config: _gated_llm(flight, 7, calls))
+    pattern = DirectQuery()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda _: pattern.answer("質問"), range(8)))
+
+    assert len(calls) == 1
+    assert all(r == {"final_response": "応答:質問"} for r in results)
+    assert flight.stats() == {"executed": 1, "shared": 7, "in_flight": 0, "max_waiters": 7}
+
+def test_concurrent_tasks_and_streams_share_one_call(flight):
+    """asyncioのタスクとストリーミングも同じ呼び出しを共有する"""
+    calls = []
+    get_registry().set_llm_factory(lambda config: _gated_llm(flight, 3, calls))
+    pattern = DirectQuery()
+
+    async def stream():
+        return "".join([chunk.text async for chunk in pattern.astream_answer("質問")])
+
+    async def run():
+        return await asyncio.gather(pattern.aanswer("質問"), pattern.aanswer("質問"), stream(), stream())
+
+    results = asyncio.run(run())
+
+    assert len(calls) == 1
+    assert results[:2] == [{"final_response": "応答:質問"}] * 2
+    assert results[2:] == ["応答:質問"] * 2
+
+def test_batch_duplicates_are_called_once(flight):
+    """バッチ内の重複した質問は1回だけ呼び出す"""
+    calls = []
+    get_registry().set_llm_factory(
+        lambda config: RunnableLambda(lambda p: calls.append(p) or AIMessage(content=p.to_string()))
+    )
+
+    outputs = DirectQuery().batch_answer(["A", "B", "A", "A"])
+
+    assert len(calls) == 2
+    assert [o["final_response"] for o in outputs] == ["A", "B", "A", "A"]
+    assert flight.stats()["shared"] == 2
+
+def test_leader_error_is_shared_and_abandoned_call_is_retried():
+    """代表者の例外は待っていた側にも伝わり、中断された場合は待っていた側が実行し直す"""
+    flight = SingleFlight()
+    call, _ = flight.lead("key")
+    waiter = ThreadPoolExecutor(max_workers=1).submit(flight.do, "key", lambda: "再実行")
+    while flight.max_waiters < 1:
+        time.sleep(0.001)
+    flight.finish("key", call, error=GeneratorExit())
+    assert waiter.result(timeout=5) == "再実行"
+
+    call, _ = flight.lead("key")
+    waiter = ThreadPoolExecutor(max_workers=1).submit(flight.do, "key", lambda: "実行されない")
+    while flight.max_waiters < 1 or call.waiters < 1:
+        time.sleep(0.001)
+    flight.finish("key", call, error=RuntimeError("upstream error"))
+    with pytest.raises(RuntimeError):
+        waiter.result(timeout=5)